@@ -855,9 +855,8 @@ def completed_chart():
         type = request.vars.type
     else:
         return "Programming Error: Question Type missing"
-    getAnswers = response.s3.survey_getAllAnswersForQuestionInSeries
-    answers = getAnswers(qstnID, seriesID)
-    analysisTool = survey_analysis_type[type](qstnID, answers)
+    getAnalysis = response.s3.survey_getQuestionAnalysis
+    analysisTool = getAnalysis(qstnID, type, seriesID)
     qstnName = analysisTool.qstnWidget.question.name
     image = analysisTool.drawChart(output="png")
     return image
@@ -68,6 +68,14 @@ deployment_settings.base.migrate = True
 # To just create the .table files:
 #deployment_settings.base.fake_migrate = True
 
+# Compile all XSLT stylesheets at startup rather than at first use
+#deployment_settings.base.xslt_warmup = True
+
+# Import large CSV files uploaded for direct import (without review) in chunks
+# of this many rows (each chunk is committed separately, so memory use is
+# bounded by the chunk size)
+#deployment_settings.base.import_chunk_size = 5000
+
 # Enable/disable pre-population of the database.
 # Should be non-zero on 1st_run to pre-populate the database
 # - unless doing a manual DB migration
@@ -115,6 +123,13 @@ deployment_settings.mail.sender = "'Sahana' <sahana@your.org>"
 deployment_settings.mail.approver = "useradmin@your.org"
 # Daily Limit on Sending of emails
 #deployment_settings.mail.limit = 1000
+# Number of connections to the mail server kept open to send Email
+# (0 opens a new connection for each message)
+#deployment_settings.mail.pool_size = 2
+# Outbox: number of messages processed per batch, and the maximum number
+# of messages sent concurrently through the Email/SMS gateway
+#deployment_settings.msg.outbox_batch_size = 500
+#deployment_settings.msg.outbox_workers = 4
 
 # Frontpage settings
 # RSS feeds
@@ -194,6 +209,9 @@ deployment_settings.L10n.religions = {
 #deployment_settings.base.paper_size = T("Letter")
 # Location of Logo used in pdfs headers
 #deployment_settings.ui.pdf_logo = "static/img/mylogo.png"
+# Number of worker processes to OCR scanned forms (defaults to the number of
+# CPUs, 1 to process the pages in a single thread)
+#deployment_settings.pdf.ocr_processes = 4
 
 # GIS (Map) settings
 # Restrict the Location Selector to just certain countries
@@ -297,6 +315,13 @@ deployment_settings.gis.spatialdb = False
 deployment_settings.twitter.oauth_consumer_key = ""
 deployment_settings.twitter.oauth_consumer_secret = ""
 
+# Synchronization settings:
+# Maximum number of requests to peer repositories running at the same time
+#deployment_settings.sync.workers = 4
+# Number of records transferred per request (interrupted transfers resume
+# from the last complete chunk), 0 to transfer all records at once
+#deployment_settings.sync.chunk_size = 500
+
 # Use 'soft' deletes
 deployment_settings.security.archive_not_delete = True
 
@@ -342,6 +367,10 @@ deployment_settings.security.archive_not_delete = True
 # Should potentially large dropdowns be turned into autocompletes?
 # (unused currently)
 #deployment_settings.ui.autocomplete = True
+# Disable the text index for autocomplete searches (in-memory unless the
+# pg_trgm extension is installed in PostgreSQL and the trigram indexes have
+# been created at first run or by the s3_text_index task)
+#deployment_settings.ui.autocomplete_index = False
 #deployment_settings.ui.update_label = T("Edit")
 # Enable this for a UN-style deployment
 #deployment_settings.ui.cluster = True
@@ -152,6 +152,11 @@ current.gis = gis
 s3.crud = Storage()
 s3mgr = s3base.S3RequestManager()
 current.manager = s3mgr
+s3mgr.import_chunk_size = deployment_settings.get_base_import_chunk_size()
+
+# Precompile the XSLT stylesheets (once per process)
+if deployment_settings.get_base_xslt_warmup():
+    s3base.S3XSLTCache.warmup(os.path.join(request.folder, "static", "formats"))
 
 # MSG
 msg = s3base.S3Msg()
@@ -1012,6 +1012,21 @@ def gis_location_onaccept(form):
     """
     # Update the Path
     gis.update_location_tree(form.vars.id, form.vars.parent)
+    # Update the in-memory point index
+    gis.update_point_index(form.vars.id)
+    # Update the autocomplete search index
+    s3base.S3TextIndex.update_index("gis_location", form.vars.id)
+    return
+
+def gis_location_ondelete(row):
+    """
+        On Delete for GIS Locations (after DB I/O)
+    """
+    # Update the in-memory point index and location tree
+    gis.update_point_index(row.id, delete=True)
+    gis.update_location_hierarchy(row.id, delete=True)
+    # Update the autocomplete search index
+    s3base.S3TextIndex.update_index("gis_location", row.id, delete=True)
     return
 
 def gis_location_onvalidation(form):
@@ -1262,7 +1277,7 @@ def gis_location_duplicate(job):
         lat = "lat" in job.data and job.data.lat
         lon = "lon" in job.data and job.data.lon
 
-        query = (table.name.lower().like('%%%s%%' % name.lower()))
+        query = (table.name.lower() == name.lower())
         if parent:
             query = query & (table.parent == parent)
         if level:
@@ -1276,10 +1291,27 @@ def gis_location_duplicate(job):
             job.data.id = _duplicate.id
             job.method = job.METHOD.UPDATE
 
+def gis_location_duplicate_key(job):
+    """
+      The key under which gis_location_duplicate would find a duplicate of
+      the record being imported: records with different names can't be
+      duplicates of each other. Used by bulk imports to tell whether the
+      record could be a duplicate of a record pending for insert.
+
+      @param job: An S3ImportJob object which includes all the details
+                  of the record being imported
+    """
+    name = job.data.get("name", None)
+    if not name:
+        return None
+    return name.lower()
+
 s3mgr.configure("gis_location",
                 onvalidation=gis_location_onvalidation,
                 onaccept=gis_location_onaccept,
+                ondelete=gis_location_ondelete,
                 deduplicate=gis_location_duplicate,
+                deduplicate_key=gis_location_duplicate_key,
                 list_fields = ["id",
                                "name",
                                "level",
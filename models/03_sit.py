@@ -41,6 +41,14 @@ table = super_entity(tablename, "track_id", trackable_types,
                      Field("track_timestmp", "datetime",
                            readable=False,
                            writable=False),
+                     # Latest presence (index maintained by S3Tracker)
+                     Field("track_location_id", db.gis_location,
+                           ondelete="SET NULL",
+                           readable=False,
+                           writable=False),
+                     Field("track_interlock",
+                           readable=False,
+                           writable=False),
                      )
 
 s3mgr.configure(tablename,
@@ -230,6 +230,39 @@ def person_represent(id):
                      time_expire=10)
     return name
 
+def person_id_represent(id):
+    """ Representation of person_id fields """
+
+    return (id and [person_represent(id)] or [NONE])[0]
+
+def person_represent_bulk(ids):
+    """ Batch form of person_id_represent (see s3mgr.represent) """
+
+    table = db.pr_person
+    rows = db(table.id.belongs(ids)).select(table.id,
+                                            table.first_name,
+                                            table.middle_name,
+                                            table.last_name)
+    return dict([(row.id, s3_fullname(row)) for row in rows])
+
+person_id_represent.bulk = person_represent_bulk
+
+# -----------------------------------------------------------------------------
+def pr_person_onaccept(form):
+    """ Onaccept callback """
+
+    # Update the autocomplete search index
+    s3base.S3TextIndex.update_index("pr_person", form.vars.id)
+    return
+
+# -----------------------------------------------------------------------------
+def pr_person_ondelete(row):
+    """ Ondelete callback """
+
+    # Update the autocomplete search index
+    s3base.S3TextIndex.update_index("pr_person", row.id, delete=True)
+    return
+
 # -----------------------------------------------------------------------------
 def pr_person_onvalidation(form):
     """ Onvalidation callback """
@@ -338,6 +371,8 @@ s3mgr.configure(tablename,
                                "age_group"
                             ],
                 onvalidation=pr_person_onvalidation,
+                onaccept=pr_person_onaccept,
+                ondelete=pr_person_ondelete,
                 search_method=pr_person_search,
                 deduplicate=person_deduplicate,
                 main="first_name",
@@ -367,8 +402,7 @@ person_id = S3ReusableField("person_id", db.pr_person,
                                         orderby="pr_person.first_name",
                                         sort=True,
                                         error_message=T("Person must be specified!"))),
-                            represent = lambda id: (id and \
-                                        [person_represent(id)] or [NONE])[0],
+                            represent = person_id_represent,
                             label = T("Person"),
                             comment = pr_person_id_comment,
                             ondelete = "RESTRICT",
@@ -409,8 +443,26 @@ table.description.comment = DIV(DIV(_class="tooltip",
     _title="%s|%s" % (T("Group description"),
                       T("A brief description of the group (optional)"))))
 
+# -----------------------------------------------------------------------------
+def pr_group_onaccept(form):
+    """ Onaccept callback """
+
+    # Update the autocomplete search index
+    s3base.S3TextIndex.update_index("pr_group", form.vars.id)
+    return
+
+# -----------------------------------------------------------------------------
+def pr_group_ondelete(row):
+    """ Ondelete callback """
+
+    # Update the autocomplete search index
+    s3base.S3TextIndex.update_index("pr_group", row.id, delete=True)
+    return
+
 s3mgr.configure(tablename,
                 super_entity=db.pr_pentity,
+                onaccept=pr_group_onaccept,
+                ondelete=pr_group_ondelete,
                 main="name",
                 extra="description")
 
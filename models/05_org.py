@@ -291,8 +291,26 @@ s3.crud_strings[tablename] = Storage(
     msg_record_deleted = T("Organization deleted"),
     msg_list_empty = T("No Organizations currently registered"))
 
+# -----------------------------------------------------------------------------
+def org_organisation_onaccept(form):
+    """ Onaccept callback """
+
+    # Update the autocomplete search index
+    s3base.S3TextIndex.update_index("org_organisation", form.vars.id)
+    return
+
+# -----------------------------------------------------------------------------
+def org_organisation_ondelete(row):
+    """ Ondelete callback """
+
+    # Update the autocomplete search index
+    s3base.S3TextIndex.update_index("org_organisation", row.id, delete=True)
+    return
+
 s3mgr.configure(tablename,
                 super_entity = db.pr_pentity,
+                onaccept = org_organisation_onaccept,
+                ondelete = org_organisation_ondelete,
                 list_fields = ["id",
                                "name",
                                "acronym",
@@ -326,6 +344,17 @@ def organisation_represent(id, showlink=False, acronym=True):
 
     return represent
 
+def organisation_represent_bulk(ids):
+    """ Batch form of organisation_represent (see s3mgr.represent) """
+
+    table = db.org_organisation
+    rows = db(table.id.belongs(ids)).select(table.id,
+                                            table.name,
+                                            table.acronym)
+    return dict([(row.id, organisation_represent(row)) for row in rows])
+
+organisation_represent.bulk = organisation_represent_bulk
+
 organisation_popup_url = URL(c="org", f="organisation",
                              args="create",
                              vars=dict(format="popup"))
@@ -98,6 +98,12 @@ if session.s3.ocr_enabled:
                                                        "ocr_payload"),
                                       notnull=True),
                                 Field("page_number", "integer", notnull=True),
+                                # page has been processed by OCR
+                                Field("processed", "boolean", default=False),
+                                # error message if the OCR of the set failed
+                                Field("error", "text",
+                                      readable=False,
+                                      writable=False),
                                 *s3_meta_fields())
 
         #======================================================================
@@ -165,4 +171,31 @@ if session.s3.ocr_enabled:
                        "ocr_field_crops",
                        "ocr_data_xml")
 
+# =============================================================================
+# Tasks to be callable async
+# =============================================================================
+def ocr_parse(form_uuid, set_uuid, is_component=0, user_id=None):
+    """
+        OCR a set of uploaded pages and store the data for review
+            - will normally be done Asynchronously if there is a worker alive
+
+        @param form_uuid: UUID of the OCR form (ocr_meta)
+        @param set_uuid: UUID of the set of uploaded pages (ocr_payload)
+        @param is_component: 1 if the form is for a component, else 0
+        @param user_id: calling request's auth.user.id or None
+    """
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    # Run the Task
+    s3mgr.load("ocr_meta")
+    parser = s3base.S3OCRImageParser(None)
+    output = parser.process(form_uuid,
+                            set_uuid,
+                            is_component=bool(is_component))
+    db.commit()
+    return output is not None
+
+tasks["ocr_parse"] = ocr_parse
+
 # END =========================================================================
@@ -41,6 +41,10 @@ if deployment_settings.has_module(module):
 
         module = "survey"
 
+        # Question lookups used when importing answers, see getQuestionsByCode()
+        seriesTemplates = {}
+        templateQuestions = {}
+
         survey_template_status = {
             1: T("Pending"),
             2: T("Active"),
@@ -788,7 +792,9 @@ if deployment_settings.has_module(module):
                         if numericQuestion == "Count":
                             # get the count of replies for the label question
                             gqstn_type = gqstn["type"]
-                            analysisTool = survey_analysis_type[gqstn_type](gqstn_id, ganswers)
+                            analysisTool = getQuestionAnalysis(gqstn_id,
+                                                               gqstn_type,
+                                                               series_id)
                             map = analysisTool.uniqueCount()
                             debug += "Type: %s<br />Count: %s<br />" % (gqstn_type, map)
                             label = map.keys()
@@ -1162,19 +1168,17 @@ $("#chart_btn").click(function(){
                 return False
             series_id = form.vars.series_id
             answer_list = form.vars.answer_list
-            qstn_list = getAllQuestionsForSeries(series_id)
-            qstns = []
-            for qstn in qstn_list:
-                qstns.append(qstn["code"])
-            answerList = answer_list.splitlines(True)
-            for answer in answerList:
-                qstn_code = answer[1:answer.find('","')]
-                if qstn_code not in qstns:
-                    msg = "%s: %s" % (T("Unknown question code"), qstn_code)
-                    if answer_list not in form.errors:
-                        form.errors.answer_list = msg
-                    else:
-                        form.errors.answer_list += msg
+            questions = getQuestionsByCode(series_id)
+            errors = []
+            for (qstn_code, value) in parseAnswerList(answer_list):
+                if qstn_code not in questions:
+                    errors.append("%s: %s" % (T("Unknown question code"),
+                                              qstn_code))
+                elif not validateAnswer(questions[qstn_code], value):
+                    errors.append("%s: %s" % (T("Invalid answer"),
+                                              qstn_code))
+            if errors:
+                form.errors.answer_list = ", ".join(errors)
             return True
 
         def complete_onaccept(form):
@@ -1204,7 +1208,18 @@ $("#chart_btn").click(function(){
             # Save all the answers from answerList in the survey_answer table
             ##################################################################
             answerList = record.answer_list
-            importAnswers(complete_id, answerList)
+            oldAnswers = getAnswersForComplete(complete_id)
+            (newAnswers, errors) = importAnswers(complete_id,
+                                                 series_id,
+                                                 answerList,
+                                                 oldAnswers)
+            if errors:
+                response.warning = "%s: %s" % (T("Answers not saved"),
+                                               ", ".join(errors))
+            ##################################################################
+            # Apply the changed answers to the stored analysis of the series
+            ##################################################################
+            updateAnalysis(series_id, oldAnswers, newAnswers)
             ##################################################################
             # Extract the default template location question and save the
             # answer in the location field
@@ -1308,9 +1323,21 @@ $("#chart_btn").click(function(){
 
 
 
+        def complete_ondelete_cascade(row):
+            """
+                Remove the answers of the response from the stored analysis
+                of the series, whilst they are still linked to the response
+            """
+            record = db.survey_complete[row.id]
+            if record and record.series_id:
+                updateAnalysis(record.series_id,
+                               getAnswersForComplete(row.id),
+                               {})
+
         s3mgr.configure(tablename,
                         onvalidation = complete_onvalidate,
                         onaccept = complete_onaccept,
+                        ondelete_cascade = complete_ondelete_cascade,
                         )
 
         # ---------------------------------------------------------------------
@@ -1374,6 +1401,47 @@ $("#chart_btn").click(function(){
                         onaccept = answer_onaccept,
                         )
 
+        # ---------------------------------------------------------------------
+        # Analysis
+        # ---------------------------------------------------------------------
+        """
+            The survey_analysis table holds, for each question of a series,
+            the number of times each answer value has been given. It is
+            updated as each response is saved, so that the summary, chart
+            and map pages don't have to read every survey_answer record.
+
+            There is one record per value, and the replies are added to or
+            subtracted from it in the database (no read-modify-write), so
+            that concurrent responses don't overwrite each other's counts.
+            For free text questions only the number of replies is kept, as
+            a single record with a null value.
+        """
+        resourcename = "analysis"
+        tablename = "%s_%s" % (module, resourcename)
+        table = db.define_table(tablename,
+                                Field("series_id",
+                                       "reference survey_series",
+                                       readable=False,
+                                       writable=False
+                                       ),
+                                Field("question_id",
+                                       "reference survey_question",
+                                       readable=False,
+                                       writable=False
+                                       ),
+                                Field("value",
+                                       "text",
+                                       readable=False,
+                                       writable=False
+                                       ),
+                                Field("replies",
+                                       "integer",
+                                       default=0,
+                                       readable=False,
+                                       writable=False
+                                       ),
+                                *s3_meta_fields())
+
 
         # ---------------------------------------------------------------------
         # Translate
@@ -2117,20 +2185,21 @@ $("#chart_btn").click(function(){
             header = THEAD(hr)
 
             questions = getAllQuestionsForSeries(series_id)
+            analysis = getSeriesAnalysis(series_id)
             line = []
             body = TBODY()
             for question in questions:
                 question_id = question["qstn_id"]
-                widgetObj = getWidgetFromQuestion(question_id)
+                analysisTool = getQuestionAnalysis(question_id,
+                                                   question["type"],
+                                                   series_id,
+                                                   analysis.get(question_id, []))
+                widgetObj = analysisTool.qstnWidget
                 br = TR()
                 br.append(question["posn"])
                 br.append(question["name"])
                 br.append(question["code"])
                 type = widgetObj.type_represent()
-                answers = getAllAnswersForQuestionInSeries(question_id,
-                                                           series_id)
-                analysisTool = survey_analysis_type[question["type"]](question_id,
-                                                                      answers)
                 chart = analysisTool.chartButton(series_id)
                 cell = TD()
                 cell.append(type)
@@ -2200,18 +2269,231 @@ $("#chart_btn").click(function(){
                 answers.append(answer)
             return answers
 
+        def getAnswersForComplete(complete_id):
+            """
+                function to return the answers of a response as a dict
+                of {question_id: value}
+            """
+            atable = db.survey_answer
+            query = (atable.complete_id == complete_id) & \
+                    (atable.deleted != True)
+            rows = db(query).select(atable.question_id,
+                                    atable.value,
+                                   )
+            answers = {}
+            for row in rows:
+                answers[row.question_id] = row.value
+            return answers
+
+        def storeAnalysis(series_id, tally, new=False):
+            """
+                private function to add the value counts in tally to the
+                stored analysis of the series
+
+                @param series_id: the series
+                @param tally: dict of {question_id: {value: count}}, a
+                              negative count removes answers
+                @param new: the series has no stored analysis yet, so
+                            all counts can be inserted in one go
+            """
+            if not tally:
+                return
+            qtable = db.survey_question
+            antable = db.survey_analysis
+            question_ids = tally.keys()
+            rows = db(qtable.id.belongs(question_ids)).select(qtable.id,
+                                                              qtable.type)
+            freeText = [row.id for row in rows if row.type in ("String",
+                                                               "Text")]
+            # Combine the counts of all free text answers
+            values = {}
+            for (question_id, counts) in tally.items():
+                for (value, count) in counts.items():
+                    if question_id in freeText:
+                        value = None
+                    key = (question_id, value)
+                    values[key] = values.get(key, 0) + count
+            stored = {}
+            if not new:
+                query = (antable.series_id == series_id) & \
+                        (antable.question_id.belongs(question_ids)) & \
+                        (antable.deleted != True)
+                rows = db(query).select(antable.id,
+                                        antable.question_id,
+                                        antable.value,
+                                       )
+                for row in rows:
+                    stored[(row.question_id, row.value)] = row.id
+            records = []
+            for ((question_id, value), count) in values.items():
+                if not count:
+                    continue
+                key = (question_id, value)
+                if key in stored:
+                    db(antable.id == stored[key]).update(
+                                        replies = antable.replies + count)
+                else:
+                    records.append(dict(series_id = series_id,
+                                        question_id = question_id,
+                                        value = value,
+                                        replies = count))
+            if records:
+                antable.bulk_insert(records)
+
+        def buildAnalysis(series_id):
+            """
+                function to (re)build the stored analysis of a series from
+                all of its responses
+            """
+            ctable = db.survey_complete
+            atable = db.survey_answer
+            antable = db.survey_analysis
+            db(antable.series_id == series_id).delete()
+            query = (ctable.series_id == series_id) & \
+                    (ctable.deleted != True) & \
+                    (atable.complete_id == ctable.id) & \
+                    (atable.deleted != True)
+            rows = db(query).select(atable.question_id,
+                                    atable.value,
+                                   )
+            tally = {}
+            for row in rows:
+                counts = tally.setdefault(row.question_id, {})
+                counts[row.value] = counts.get(row.value, 0) + 1
+            storeAnalysis(series_id, tally, new=True)
+
+        def updateAnalysis(series_id, oldAnswers, newAnswers):
+            """
+                function to apply the change in the answers of a single
+                response to the stored analysis of the series. If the
+                series has no stored analysis yet then it is built from
+                all of its responses.
+
+                @param series_id: the series
+                @param oldAnswers: dict of {question_id: value} before
+                @param newAnswers: dict of {question_id: value} after
+            """
+            antable = db.survey_analysis
+            query = (antable.series_id == series_id) & \
+                    (antable.deleted != True)
+            if not db(query).select(antable.id, limitby=(0, 1)).first():
+                buildAnalysis(series_id)
+                return
+            tally = {}
+            for (question_id, value) in oldAnswers.items():
+                if question_id not in newAnswers or \
+                   newAnswers[question_id] != value:
+                    counts = tally.setdefault(question_id, {})
+                    counts[value] = counts.get(value, 0) - 1
+            for (question_id, value) in newAnswers.items():
+                if question_id not in oldAnswers or \
+                   oldAnswers[question_id] != value:
+                    counts = tally.setdefault(question_id, {})
+                    counts[value] = counts.get(value, 0) + 1
+            storeAnalysis(series_id, tally)
+
+        def getSeriesAnalysis(series_id, question_id=None):
+            """
+                function to return the stored analysis of a series as a
+                dict of {question_id: [(value, count), ...]}
+
+                If the series has responses but no stored analysis then
+                it is built first.
+            """
+            antable = db.survey_analysis
+            query = (antable.series_id == series_id) & \
+                    (antable.deleted != True)
+            if question_id != None:
+                query &= (antable.question_id == question_id)
+            # Concurrent first responses may have inserted the same value
+            # more than once, so add up the replies
+            replies = antable.replies.sum()
+            def select():
+                return db(query).select(antable.question_id,
+                                        antable.value,
+                                        replies,
+                                        groupby=antable.question_id | \
+                                                antable.value,
+                                       )
+            rows = select()
+            if not rows:
+                ctable = db.survey_complete
+                cquery = (ctable.series_id == series_id) & \
+                         (ctable.deleted != True)
+                squery = (antable.series_id == series_id) & \
+                         (antable.deleted != True)
+                if db(cquery).select(ctable.id, limitby=(0, 1)).first() and \
+                   not db(squery).select(antable.id, limitby=(0, 1)).first():
+                    buildAnalysis(series_id)
+                    rows = select()
+            analysis = {}
+            for row in rows:
+                count = row[replies]
+                if count > 0:
+                    question_id = row[antable.question_id]
+                    analysis.setdefault(question_id, []).append(
+                                            (row[antable.value], count))
+            return analysis
+
+        def getQuestionAnalysis(question_id, type, series_id, value_list=None):
+            """
+                function to return the analysis object for a question
+                in a series
+
+                The analysis is built from the stored value counts (one
+                answer with a count per value), so that it doesn't need to
+                read the survey_answer records. Link and GridChild questions
+                depend on the other answers of each response, so they are
+                still built from the individual answers.
+
+                @param value_list: the stored [(value, count)] pairs, if
+                                   already loaded with getSeriesAnalysis()
+            """
+            if type in ("Link", "GridChild"):
+                answers = getAllAnswersForQuestionInSeries(question_id,
+                                                           series_id)
+            else:
+                if value_list == None:
+                    analysis = getSeriesAnalysis(series_id, question_id)
+                    value_list = analysis.get(int(question_id), [])
+                answers = []
+                for (value, count) in value_list:
+                    answers.append({"answer_id": None,
+                                    "value": value,
+                                    "complete_id": None,
+                                    "count": count,
+                                   })
+            return survey_analysis_type[type](question_id, answers)
+
         def getLocationList(series_id):
             s3 = response.s3
-            response_locations = []
             question_id = getLocationQuestion(series_id)
             answers = s3.survey_getAllAnswersForQuestionInSeries(question_id,
                                                                  series_id)
-            analysisTool = survey_analysis_type["Location"](question_id,
-                                                            answers)
-            for (key, value) in analysisTool.known.items():
-                value.key = key
-                value.complete_id = analysisTool.complete_id[key]
-                response_locations.append(value)
+            # Look up each distinct location once, rather than once for
+            # every response
+            completed = {}
+            for answer in answers:
+                value = answer["value"]
+                if value in completed:
+                    completed[value].append(answer["complete_id"])
+                else:
+                    completed[value] = [answer["complete_id"]]
+            widgetObj = survey_question_type["Location"](question_id)
+            known = {}
+            for (value, complete_id_list) in completed.items():
+                record = widgetObj.getLocationRecord(None, value)
+                if record == None or len(record.result) != 1:
+                    continue
+                key = record.key
+                if key in known:
+                    known[key].complete_id.extend(complete_id_list)
+                else:
+                    location = record.result.first()
+                    location.key = key
+                    location.complete_id = complete_id_list
+                    known[key] = location
+            response_locations = known.values()
             return response_locations
 
 
@@ -2271,28 +2553,41 @@ $("#chart_btn").click(function(){
         def survey_build_completed_list(series_id, question_id_list):
             table = TABLE(_id="completed_list",
                           _class="dataTable display")
+            qtable = db.survey_question
+            ctable = db.survey_complete
+            atable = db.survey_answer
+            question_id_list = [int(question_id)
+                                for question_id in question_id_list]
+            rows = db(qtable.id.belongs(question_id_list)).select(qtable.id,
+                                                                 qtable.name,
+                                                                 qtable.type)
+            questions = dict([(row.id, row) for row in rows])
             hr = TR()
+            widgets = {}
             for question_id in question_id_list:
-                qtable = db.survey_question
-                query = (qtable.id == question_id)
-                question = db(query).select(qtable.name,
-                                            limitby=(0, 1)).first()
+                question = questions[question_id]
                 hr.append(TH(question.name))
+                widgets[question_id] = survey_question_type[question.type](question_id)
             header = THEAD(hr)
 
             body = TBODY()
             matrix = {}
-            for question_id in question_id_list:
-                answers = getAllAnswersForQuestionInSeries(question_id,
-                                                           series_id)
-                widgetObj = getWidgetFromQuestion(question_id)
-                for answer in answers:
-                    complete_id = answer["complete_id"]
-                    data = {question_id: widgetObj.repr(answer["value"])}
-                    if complete_id in matrix:
-                        matrix[complete_id].update(data)
-                    else:
-                        matrix.update({complete_id:data})
+            # Get the answers to all of the selected questions at once
+            query = (atable.question_id.belongs(question_id_list)) & \
+                    (atable.complete_id == ctable.id) & \
+                    (ctable.series_id == series_id)
+            rows = db(query).select(atable.question_id,
+                                    atable.value,
+                                    atable.complete_id,
+                                   )
+            for row in rows:
+                question_id = row.question_id
+                complete_id = row.complete_id
+                data = {question_id: widgets[question_id].repr(row.value)}
+                if complete_id in matrix:
+                    matrix[complete_id].update(data)
+                else:
+                    matrix.update({complete_id:data})
 
             for row in matrix.values():
                 br = TR()
@@ -2311,42 +2606,160 @@ $("#chart_btn").click(function(){
             response.s3.dataTableID = "completed_list"
             return table
 
-        def importAnswers(id, list):
+        def getQuestionsByCode(series_id):
             """
-                private function used to save the answer_list stored in
-                survey_complete into answer records held in survey_answer
+                function to return the questions of the template used by the
+                series, as a dict of {code: Storage(id, type, widget)}
+
+                The lookup is done once per template and cached for the rest
+                of the request, so that importing many responses doesn't
+                repeat it. The widget is created when it is first needed.
+            """
+            sertable = db.survey_series
+            q_ltable = db.survey_question_list
+            qsntable = db.survey_question
+            series_id = int(series_id)
+            if series_id not in seriesTemplates:
+                row = db(sertable.id == series_id).select(sertable.template_id,
+                                                          limitby=(0, 1)).first()
+                seriesTemplates[series_id] = row and row.template_id
+            template_id = seriesTemplates[series_id]
+            if template_id not in templateQuestions:
+                query = (q_ltable.template_id == template_id) & \
+                        (q_ltable.question_id == qsntable.id)
+                rows = db(query).select(qsntable.id,
+                                        qsntable.code,
+                                        qsntable.type)
+                questions = {}
+                for row in rows:
+                    questions[row.code] = Storage(id = row.id,
+                                                  type = row.type,
+                                                  widget = None)
+                templateQuestions[template_id] = questions
+            return templateQuestions[template_id]
+
+        def getQuestionWidget(question):
+            """
+                function to return the (cached) widget for a question
+                returned by getQuestionsByCode()
+            """
+            if question.widget == None:
+                question.widget = survey_question_type[question.type](question.id)
+            return question.widget
+
+        def validateAnswer(question, value):
+            """
+                function to validate an answer using the widget of
+                the question
+
+                @returns: False if the answer is invalid, else True
+            """
+            widgetObj = getQuestionWidget(question)
+            result = widgetObj.validate([value], question.id)
+            return result != widgetObj.ANSWER_INVALID
+
+        def parseAnswerList(answer_list):
+            """
+                private function to read the "code","answer" lines of an
+                answer_list
+
+                @returns: a list of (code, answer) tuples
             """
             import csv
             try:
                 from cStringIO import StringIO    # Faster, where available
             except:
                 from StringIO import StringIO
-            strio = StringIO()
-            strio.write(list)
-            strio.seek(0)
-            answer = []
-            reader = csv.reader(strio)
+            answers = []
+            if not answer_list:
+                return answers
+            reader = csv.reader(StringIO(answer_list))
             for row in reader:
-                if row != None:
-                    row.insert(0,id)
-                    answer.append(row)
-
-            from tempfile import TemporaryFile
-            csvfile = TemporaryFile()
-            writer = csv.writer(csvfile)
-            writer.writerow(["complete_id", "question_code", "value"])
-            for row in answer:
-                writer.writerow(row)
-            csvfile.seek(0)
-            xsl = os.path.join("applications",
-                               request.application,
-                               "static",
-                               "formats",
-                               "s3csv",
-                               "survey",
-                               "answer.xsl")
-            resource = s3mgr.define_resource("survey", "answer")
-            resource.import_xml(csvfile, stylesheet = xsl, format="csv",)
+                if row:
+                    if len(row) > 1:
+                        answers.append((row[0], row[1]))
+                    else:
+                        answers.append((row[0], ""))
+            return answers
+
+        def importAnswers(complete_id, series_id, answer_list, oldAnswers):
+            """
+                private function used to save the answer_list stored in
+                survey_complete into answer records held in survey_answer
+
+                The question codes are resolved once per template, each
+                answer is validated and formatted by its question widget
+                (as answer_onaccept would do) and all new answers are
+                written with a single bulk insert. The written answers
+                are audited like the ones saved through a form.
+
+                Imports reject responses with unknown question codes or
+                invalid answers in complete_onvalidate; answers saved
+                without that validation are skipped and returned as errors.
+
+                @param oldAnswers: the current answers of the response,
+                                   as returned by getAnswersForComplete()
+                @returns: tuple of (answers, errors), the answers of the
+                          response after the import as a dict of
+                          {question_id: value}, and a list of messages for
+                          the skipped answers
+            """
+            atable = db.survey_answer
+            questions = getQuestionsByCode(series_id)
+            answers = dict(oldAnswers)
+            errors = []
+            inserts = {}
+            updates = {}
+            for (code, value) in parseAnswerList(answer_list):
+                if code not in questions:
+                    errors.append("%s: %s" % (T("Unknown question code"),
+                                              code))
+                    continue
+                question = questions[code]
+                if not validateAnswer(question, value):
+                    errors.append("%s: %s" % (T("Invalid answer"), code))
+                    continue
+                value = getQuestionWidget(question).onaccept(value)
+                question_id = question.id
+                if question_id in oldAnswers:
+                    if oldAnswers[question_id] != value:
+                        updates[question_id] = value
+                else:
+                    inserts[question_id] = value
+                answers[question_id] = value
+            if updates:
+                query = (atable.complete_id == complete_id) & \
+                        (atable.question_id.belongs(updates.keys())) & \
+                        (atable.deleted != True)
+                rows = db(query).select(atable.id, atable.question_id)
+                for row in rows:
+                    value = updates[row.question_id]
+                    db(atable.id == row.id).update(value = value)
+                    auditAnswer("update", row.id, complete_id,
+                                row.question_id, value)
+            if inserts:
+                items = inserts.items()
+                ids = atable.bulk_insert([dict(complete_id = complete_id,
+                                               question_id = question_id,
+                                               value = value)
+                                          for (question_id, value) in items])
+                for (id, (question_id, value)) in zip(ids, items):
+                    auditAnswer("create", id, complete_id, question_id, value)
+            return (answers, errors)
+
+        def auditAnswer(method, id, complete_id, question_id, value):
+            """
+                private function to audit an answer written by
+                importAnswers()
+            """
+            form = Storage(vars = Storage(id = id,
+                                          complete_id = complete_id,
+                                          question_id = question_id,
+                                          value = value))
+            s3_audit(method, "survey", "answer",
+                     form=form,
+                     record=id,
+                     representation="xml")
 
         # ---------------------------------------------------------------------
         # Functions not currently used
@@ -2543,6 +2956,10 @@ $("#chart_btn").click(function(){
             survey_build_completed_list = survey_build_completed_list,
             survey_save_answers_for_complete = survey_save_answers_for_complete,
             survey_getAllAnswersForQuestionInSeries = getAllAnswersForQuestionInSeries,
+            survey_getSeriesAnalysis = getSeriesAnalysis,
+            survey_getQuestionAnalysis = getQuestionAnalysis,
+            survey_buildAnalysis = buildAnalysis,
+            survey_updateAnalysis = updateAnalysis,
             survey_getLocationList = getLocationList,
             survey_getPriorityQuestionForSeries = getPriorityQuestionForSeries,
             survey_get_series_questions = survey_get_series_questions,
@@ -2564,6 +2981,7 @@ $("#chart_btn").click(function(){
                  "survey_series",
                  "survey_complete",
                  "survey_answer",
+                 "survey_analysis",
                  "survey_translate",
                  )
 
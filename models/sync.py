@@ -53,6 +53,10 @@ def sync_tables():
     # -------------------------------------------------------------------------
     tablename = "sync_status"
     table = db.define_table(tablename,
+                            # Repository (None for the global status)
+                            Field("repository_id", "integer",
+                                  readable=False,
+                                  writable=False),
                             Field("running", "boolean",
                                   default=False,
                                   readable=False,
@@ -330,6 +334,14 @@ def sync_tables():
                                   label = T("Conflict Policy"),
                                   represent = sync_policy_represent),
 
+                            # Positions of interrupted chunked transfers
+                            Field("pull_checkpoint",
+                                  readable=False,
+                                  writable=False),
+                            Field("push_checkpoint",
+                                  readable=False,
+                                  writable=False),
+
                             *s3_meta_fields())
 
     table.resource_name.comment = DIV(_class="tooltip",
@@ -595,14 +607,14 @@ def sync_now(r, **attr):
                 elif task_id is None:
                     response.flash = T("Manual synchronization completed.")
                 else:
-                    sync.set_status(manual=True)
+                    sync.set_status(repository_id=repository.id, manual=True)
                     response.flash = T("Manual synchronization started in the background.")
         else:
             r.error(405, manager.ERROR.BAD_METHOD)
     else:
         r.error(501, manager.ERROR.BAD_FORMAT)
 
-    status = sync.get_status()
+    status = sync.get_status(repository_id=r.id)
     if status.running:
         output.update(form=T("Synchronization currently active - refresh page to update status."))
     elif not status.manual:
@@ -630,7 +642,7 @@ def sync_synchronize(repository_id, user_id=None, manual=False):
     repository = db(query).select(limitby=(0, 1)).first()
     if repository:
         sync = s3base.S3Sync()
-        status = sync.get_status()
+        status = sync.get_status(repository_id=repository.id)
         if status.running:
             message = "Synchronization already active - skipping run"
             sync.log.write(repository_id=repository.id,
@@ -643,14 +655,32 @@ def sync_synchronize(repository_id, user_id=None, manual=False):
                            message=message)
             db.commit()
             return sync.log.ERROR
-        sync.set_status(running=True, manual=manual)
-        try:
-            sync.synchronize(repository)
-        finally:
-            sync.set_status(running=False, manual=False)
+        sync.synchronize(repository, manual=manual)
     db.commit()
     return s3base.S3SyncLog.SUCCESS
 
 tasks["sync_synchronize"] = sync_synchronize
 
+# -----------------------------------------------------------------------------
+def sync_synchronize_all(user_id=None):
+    """
+        Run all tasks for all repositories in parallel, to be called
+        from scheduler
+    """
+
+    auth.s3_impersonate(user_id)
+
+    s3mgr.load("sync_repository")
+    rtable = db.sync_repository
+    query = (rtable.deleted != True) & \
+            (rtable.url != None)
+    repositories = db(query).select()
+    if repositories:
+        sync = s3base.S3Sync()
+        sync.synchronize_all(repositories)
+    db.commit()
+    return s3base.S3SyncLog.SUCCESS
+
+tasks["sync_synchronize_all"] = sync_synchronize_all
+
 # END =========================================================================
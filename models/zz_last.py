@@ -2,6 +2,21 @@
 
 # File needs to be last in order to be able to have all Tables defined
 
+# -----------------------------------------------------------------------------
+def s3_text_index(user_id=None):
+    """
+        Create the trigram indexes for the autocomplete searches, e.g.
+        after installing pg_trgm in PostgreSQL, to be called from scheduler
+    """
+
+    if user_id:
+        # Authenticate
+        auth.s3_impersonate(user_id)
+    s3base.S3TextIndex.create_indexes()
+    return True
+
+tasks["s3_text_index"] = s3_text_index
+
 # Instantiate Scheduler instance with the list of tasks
 response.s3.tasks = tasks
 s3task = s3base.S3Task()
@@ -1151,6 +1151,9 @@ if populate > 0:
     # Ensure DB population committed when running through shell
     db.commit()
 
+    # Trigram indexes for the autocomplete searches (PostgreSQL with pg_trgm)
+    s3base.S3TextIndex.create_indexes()
+
     # Prepopulate import (from CSV)
 
     # Override authorization
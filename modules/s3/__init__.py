@@ -62,12 +62,13 @@ from s3widgets import *
 # RESTful API
 from s3rest import *
 from s3method import *
+from s3xml import S3XSLTCache
 
 # Method Handlers
 from s3crud import *
 from s3search import *
 from s3cube import *
-from s3pdf import S3PDF
+from s3pdf import S3PDF, S3OCRImageParser
 from s3import import *
 
 # GIS Mapping
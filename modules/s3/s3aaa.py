@@ -1531,6 +1531,7 @@ class AuthS3(Auth):
         if role_id:
             for acl in acls:
                 self.s3_update_acl(role_id, **acl)
+            self.permission.clear_cache()
 
         return role_id
 
@@ -1564,6 +1565,7 @@ class AuthS3(Auth):
             ptable = self.permission.table
             pquery = (ptable.group_id == role.id)
             db(pquery).update(deleted=True)
+            self.permission.clear_cache()
             # Remove the role
             db(gquery).update(role=None, deleted=True)
 
@@ -1782,6 +1784,7 @@ class AuthS3(Auth):
                 success = record.update_record(**acl)
             else:
                 success = table.insert(**acl)
+            self.permission.clear_cache()
 
         return success
 
@@ -2361,6 +2364,9 @@ class S3Permission(object):
         update = UPDATE,
         delete = DELETE)
 
+    # Process-wide ACL cache (see load_acls)
+    acl_cache = None
+
     # Policy helpers
     most_permissive = lambda self, acl: \
                              reduce(lambda x, y: (x[0]|y[0], x[1]|y[1]),
@@ -2443,6 +2449,11 @@ class S3Permission(object):
         self.page_acls = Storage()
         self.table_acls = Storage()
 
+        # ACL index for the current user's roles
+        self.acls = None
+        self.acl_roles = None
+        self.acl_checked = False
+
         # Pages which never require permission:
         # Make sure that any data access via these pages uses
         # accessible_query explicitly!
@@ -2498,6 +2509,117 @@ class S3Permission(object):
                             *(s3_uid()+s3_timestamp()+s3_deletion_status()))
 
 
+    # -------------------------------------------------------------------------
+    def load_acls(self):
+        """
+            Load all ACLs into the process-wide ACL cache, if the cache
+            is empty or outdated
+
+            The cache is validated once per request against a version
+            stamp of the permissions table (latest modification and
+            number of records), so that changes made by other processes
+            take effect with the next request.
+
+            @returns: the ACL cache (Storage)
+        """
+
+        cache = S3Permission.acl_cache
+        if cache is not None and self.acl_checked:
+            return cache
+
+        db = current.db
+        table = self.table
+
+        latest = table.modified_on.max()
+        total = table.id.count()
+        row = db(table.id > 0).select(latest, total).first()
+        version = (row[latest], row[total])
+
+        if cache is None or cache.version != version:
+            query = (table.deleted != True)
+            rows = db(query).select(table.group_id,
+                                    table.controller,
+                                    table.function,
+                                    table.tablename,
+                                    table.oacl,
+                                    table.uacl,
+                                    table.all_organisations,
+                                    table.organisation,
+                                    table.all_facilities,
+                                    table.facility)
+            acls = [Storage(row) for row in rows]
+            # Tables with ACLs for any role
+            restricted = set([acl.tablename for acl in acls
+                              if acl.tablename and
+                                 acl.controller is None and
+                                 acl.function is None])
+            cache = Storage(version=version,
+                            acls=acls,
+                            restricted=restricted,
+                            indexes={})
+            S3Permission.acl_cache = cache
+
+        self.acl_checked = True
+        return cache
+
+    # -------------------------------------------------------------------------
+    def get_acls(self, roles):
+        """
+            Get the ACL index for a set of roles
+
+            @param roles: list of role IDs (empty list for anonymous)
+
+            @returns: Storage with:
+                        controllers - dict {controller: {function: [ACLs]}}
+                                      of all ACLs with a controller (with or
+                                      without tablename)
+                        tables - dict {tablename: {controller: [ACLs]}} of
+                                 all ACLs with a tablename (controller None
+                                 for ACLs without controller)
+        """
+
+        key = tuple(sorted(roles))
+        if self.acls is not None and self.acl_roles == key:
+            return self.acls
+
+        cache = self.load_acls()
+        index = cache.indexes.get(key, None)
+        if index is None:
+            if roles:
+                group_ids = set(roles)
+            else:
+                group_ids = set([None])
+            controllers = {}
+            tables = {}
+            for acl in cache.acls:
+                if acl.group_id not in group_ids:
+                    continue
+                if acl.controller:
+                    functions = controllers.setdefault(acl.controller, {})
+                    functions.setdefault(acl.function, []).append(acl)
+                if acl.tablename:
+                    buckets = tables.setdefault(acl.tablename, {})
+                    buckets.setdefault(acl.controller, []).append(acl)
+            index = Storage(controllers=controllers, tables=tables)
+            cache.indexes[key] = index
+
+        self.acls = index
+        self.acl_roles = key
+        return index
+
+    # -------------------------------------------------------------------------
+    def clear_cache(self):
+        """
+            Invalidate the ACL caches, to be called after writing
+            to the permissions table
+        """
+
+        S3Permission.acl_cache = None
+        self.acls = None
+        self.acl_roles = None
+        self.page_acls = Storage()
+        self.table_acls = Storage()
+
     # -------------------------------------------------------------------------
     def __call__(self,
                  c=None,
@@ -2648,23 +2770,21 @@ class S3Permission(object):
 
         if page_acl is None:
             page_acl = (self.NONE, self.NONE) # default
-            q = ((t.deleted != True) & \
-                 (t.controller == c) & \
-                 ((t.function == f) | (t.function == None)))
-            if roles:
-                query = (t.group_id.belongs(roles)) & q
-            else:
-                query = (t.group_id == None) & q
+            # All ACLs for this controller and function (or for the
+            # controller in general), with or without a table
+            functions = self.get_acls(roles).controllers.get(c, {})
+            rows = functions.get(None, [])
+            if f is not None:
+                rows = rows + functions.get(f, [])
             # Additional restrictions in OrgAuth
             if policy in (6, 7) and require_org:
-                field = t.organisation
-                query &= ((t.all_organisations == True) | \
-                          (field == require_org) | (field == None))
+                rows = [row for row in rows
+                        if row.all_organisations or
+                           row.organisation in (require_org, None)]
             if policy == 7 and require_fac:
-                field = t.facility
-                query &= ((t.all_facilities == True) | \
-                          (field == require_fac) | (field == None))
-            rows = current.db(query).select()
+                rows = [row for row in rows
+                        if row.all_facilities or
+                           row.facility in (require_fac, None)]
             if rows:
                 # ACLs found, check for function-specific
                 controller_acl = []
@@ -2728,23 +2848,21 @@ class S3Permission(object):
                                          require_fac), None)
 
         if table_acl is None:
-            q = ((t.deleted != True) & \
-                 (t.tablename == tablename) &
-                 ((t.controller == c) | (t.controller == None)))
-            if roles:
-                query = (t.group_id.belongs(roles)) & q
-            else:
-                query = (t.group_id == None) & q
+            # All ACLs for this table, in general or for this controller
+            # (with or without a function)
+            buckets = self.get_acls(roles).tables.get(tablename, {})
+            rows = buckets.get(None, [])
+            if c is not None:
+                rows = rows + buckets.get(c, [])
             # Additional restrictions in OrgAuth
             if policy in (6, 7) and require_org:
-                field = t.organisation
-                query &= ((t.all_organisations == True) | \
-                          (field == require_org) | (field == None))
+                rows = [row for row in rows
+                        if row.all_organisations or
+                           row.organisation in (require_org, None)]
             if policy == 7 and require_fac:
-                field = t.facility
-                query &= ((t.all_facilities == True) | \
-                          (field == require_fac) | (field == None))
-            rows = current.db(query).select()
+                rows = [row for row in rows
+                        if row.all_facilities or
+                           row.facility in (require_fac, None)]
             table_acl = [(r.oacl, r.uacl) for r in rows]
             if table_acl:
                 # ACL found, apply most permissive role
@@ -2916,20 +3034,16 @@ class S3Permission(object):
             if not roles:
                 hidden_modules = restricted_modules
             else:
-                t = self.table
-                query = (t.deleted != True) & \
-                        (t.controller.belongs(restricted_modules)) & \
-                        (t.tablename == None)
-                if roles:
-                    query = query & (t.group_id.belongs(roles))
-                else:
-                    query = query & (t.group_id == None)
-                rows = current.db(query).select()
                 acls = dict()
-                for acl in rows:
-                    if acl.controller not in acls:
-                        acls[acl.controller] = self.NONE
-                    acls[acl.controller] |= acl.oacl | acl.uacl
+                controllers = self.get_acls(roles).controllers
+                for c in restricted_modules:
+                    for rows in controllers.get(c, {}).values():
+                        for acl in rows:
+                            if acl.tablename is not None:
+                                continue
+                            if c not in acls:
+                                acls[c] = self.NONE
+                            acls[c] |= acl.oacl | acl.uacl
                 hidden_modules = [m for m in restricted_modules
                                     if m not in acls or not acls[m]]
         return hidden_modules
@@ -3018,15 +3132,16 @@ class S3Permission(object):
                       denied), or a list of ACLs to apply.
         """
 
-        db = current.db
-        table = self.table
-
         if not self.use_cacls:
             # We do not use ACLs at all
             return None
 
+        acls = self.get_acls(roles)
+
         c = c or self.controller
         f = f or self.function
+        if t is not None and hasattr(t, "_tablename"):
+            t = t._tablename
         if self.page_restricted(c=c, f=f):
             page_restricted = True
         else:
@@ -3035,22 +3150,18 @@ class S3Permission(object):
         # Get page ACLs
         page_acls = None
         if page_restricted:
-            # Base query
-            query = (table.deleted != True) & \
-                    (table.function == None)
+            functions = [None]
             if f and self.use_facls:
-                query = (query | (table.function == f))
-            query &= (table.controller == c)
+                functions.append(f)
+            page_acls = []
+            controller_acls = acls.controllers.get(c, {})
+            for function in functions:
+                page_acls.extend(controller_acls.get(function, []))
             # Do not use delegated ACLs except for policy 6 and 7
             if self.policy not in (6, 7):
-                query &= ((table.organisation == None) & \
-                          (table.facility == None))
-            # Restrict to available roles
-            if roles:
-                query &= (table.group_id.belongs(roles))
-            else:
-                query &= (table.group_id == None)
-            page_acls = db(query).select(table.ALL)
+                page_acls = [acl for acl in page_acls
+                             if acl.organisation is None and
+                                acl.facility is None]
             if page_acls:
                 if f and self.use_facls:
                     facl = [acl for acl in page_acls if acl.function != None]
@@ -3067,23 +3178,16 @@ class S3Permission(object):
         # Get table ACLs
         table_acls = []
         if t and self.use_tacls:
-            # Base query
-            query = ((table.deleted != True) & \
-                     (table.controller == None) & \
-                     (table.function == None) &
-                     (table.tablename == t))
             # Is the table restricted at all?
-            restricted = db(query).select(limitby=(0, 1)).first() is not None
+            restricted = t in self.load_acls().restricted
+            table_acls = [acl for acl in
+                          acls.tables.get(t, {}).get(None, [])
+                          if acl.function is None]
             # Do not use delegated ACLs except for policy 6 and 7
             if self.policy not in (6, 7):
-                query &= ((table.organisation == None) & \
-                          (table.facility == None))
-            # Restrict to available roles
-            if roles:
-                query = (table.group_id.belongs(roles)) & query
-            else:
-                query = (table.group_id == None) & query
-            table_acls = db(query).select(table.ALL)
+                table_acls = [acl for acl in table_acls
+                              if acl.organisation is None and
+                                 acl.facility is None]
             if restricted and table_acls:
                 # if the table is restricted and there are ACLs
                 # available for this set of roles, then deny access
@@ -3591,6 +3695,12 @@ class S3Audit(object):
         else:
             record = None
 
+        if record and operation in ("create", "update", "delete"):
+            # Drop cached representations of this record
+            manager = getattr(current, "manager", None)
+            if manager is not None:
+                manager.represent_cache.invalidate(tablename, record)
+
         if operation in ("list", "read"):
             if settings.audit_read:
                 table.insert(timestmp = now,
@@ -4272,6 +4382,7 @@ class S3RoleManager(S3Method):
                             db(query).update(**acl)
                         elif acl.oacl or acl.uacl:
                             _id = acl_table.insert(**acl)
+                    auth.permission.clear_cache()
 
                 redirect(URL(f="role", vars=request.get_vars))
 
@@ -4321,6 +4432,7 @@ class S3RoleManager(S3Method):
                     query = (acl_table.deleted != True) & \
                             (acl_table.group_id == role_id)
                     db(query).update(deleted=True)
+                    auth.permission.clear_cache()
                     # Remove all memberships:
                     membership_table = db.auth_membership
                     query = (membership_table.deleted != True) & \
@@ -133,10 +133,14 @@ class S3Chart(object):
 
     # -------------------------------------------------------------------------
     def survey_hist(self, title,
-                    data, bins, min, max, xlabel=None, ylabel=None):
+                    data, bins, min, max, xlabel=None, ylabel=None,
+                    weights=None):
         """
             Draw a Histogram
                 - used by the Survey module
+
+            @param weights: the number of occurrences of each value in
+                            data (None for 1 each)
         """
         fig = self.fig
         if not fig:
@@ -146,7 +150,7 @@ class S3Chart(object):
 
         # Draw a histogram
         ax = fig.add_subplot(111)
-        ax.hist(data, bins=bins, range=(min, max))
+        ax.hist(data, bins=bins, range=(min, max), weights=weights)
         left = arange(0, bins + 1)
         if self.asInt:
             label = left * int(max / bins)
@@ -1137,6 +1137,10 @@ class S3CRUD(S3Method):
         # Render as...
         if as_page:
             # ...JSON page (for pagination)
+            manager = self.manager
+            for f in lfields:
+                if f.field:
+                    manager.prefetch_represent(f.field, records=rows)
             items = [[__represent(f, row) for f in lfields] for row in rows]
         elif as_list:
             # ...Python list
@@ -11,11 +11,6 @@
     @status: work in progress
 
     @requires: U{B{I{Python 2.6}} <http://www.python.org>}
-    @requires: U{B{I{SciPy}} <http://www.scipy.org>}
-    @requires: U{B{I{NumPy}} <http://www.numpy.org>}
-    @requires: U{B{I{MatPlotLib}} <http://matplotlib.sourceforge.net>}
-    @requires: U{B{I{PyvtTbl}} <http://code.google.com/p/pyvttbl>}
-    @requires: U{B{I{SQLite3}} <http://www.sqlite.org>}
 
     Permission is hereby granted, free of charge, to any person
     obtaining a copy of this software and associated documentation
@@ -39,7 +34,7 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["S3Cube"]
+__all__ = ["S3Cube", "S3PivotTable"]
 
 import sys
 
@@ -49,11 +44,25 @@ from gluon.html import *
 from s3crud import S3CRUD
 from s3search import S3Search
 
+DEBUG = False
+if DEBUG:
+    print >> sys.stderr, "S3CUBE: DEBUG MODE"
+    def _debug(m):
+        print >> sys.stderr, m
+else:
+    _debug = lambda m: None
+
 # =============================================================================
 
 class S3Cube(S3CRUD):
     """ Module for data analysis """
 
+    # Aggregation methods which can be pushed down to the database
+    DB_AGGREGATES = ("count", "sum", "avg", "min", "max")
+
+    # The aggregation path used for the last pivot ("db" or "python")
+    engine = None
+
     # -------------------------------------------------------------------------
     def apply_method(self, r, **attr):
         """
@@ -99,16 +108,6 @@ class S3Cube(S3CRUD):
 
         table = self.table
 
-        try:
-            from pyvttbl import DataFrame
-            PYVTTBL = True
-        except ImportError:
-            print >> sys.stderr, "WARNING: S3Cube unresolved dependencies: scipy, numpy and matplotlib required for analyses"
-            PYVTTBL = False
-
-        if not PYVTTBL:
-            r.error(501, T("Function not available on this server"))
-
         _vars = r.get_vars
 
         show_form = attr.get("interactive_report", False)
@@ -242,59 +241,29 @@ class S3Cube(S3CRUD):
         lfields, join = self.get_list_fields(table, list_fields)
         lfields = Storage([(f.fieldname, f) for f in lfields])
 
-        # Get the items
-        items = self.sqltable(list_fields,
-                              as_list=True, start=None, limit=None)
-        count = None
-        if items:
-            # Generate the data frame
-            aggregate = self.aggregate == "list" and "group_concat" or \
-                        self.aggregate
-            from pyvttbl import DataFrame
-            df = DataFrame()
-            fmap = Storage()
-            item_list = []
-            for row in items:
-                try:
-                    frow = self.__extract(row, fields, resource, lfields, fmap)
-                except KeyError:
-                    e = sys.exc_info()[1]
-                    if hasattr(e, "message"):
-                        e = e.message
-                    r.error(400, e, next=r.url(vars=[]))
-                frow = self.__expand(frow)
-                for item in frow:
-                    if aggregate in ("group_concat", "count"):
-                        i = Storage(item)
-                        if self.fact != pkey:
-                            del i[pkey]
-                        # De-duplicate
-                        if i not in item_list:
-                            item_list.append(i)
-                            df.insert(aggregate == "count" and i or item)
-                    else:
-                        df.insert(item)
-
-            # In group_concat, always group primary keys, and then use
-            # fmap to link individual fact values to their corresponding
-            # records
-            if aggregate == "group_concat" and fmap:
-                fact = pkey
-            else:
-                # Otherwise group the fact value, and delete fmap
-                fact = self.fact
-                fmap = None
+        aggregate = self.aggregate == "list" and "group_concat" or \
+                    self.aggregate
 
-            # Pivoting
-            try:
-                pt = df.pivot(fact, self.rows, self.cols,
-                              aggregate=aggregate)
-            except:
-                r.error(400, "Could not generate contingency table",
-                        next=r.url(vars=[]))
+        # Aggregation planner: push the aggregation down to the database
+        # where possible, otherwise fall back to the in-Python pivoting
+        pt = None
+        fmap = None
+        count = None
+        if self._pushdown(fields, lfields, aggregate):
+            self.engine = "db"
+            pt, count = self.__pivot_db(resource, lfields, join, aggregate)
+            items = len(pt)
+        else:
+            self.engine = "python"
+            items = self.sqltable(list_fields,
+                                  as_list=True, start=None, limit=None)
+        _debug("S3Cube: pivoting %s by %s (%s)" %
+                    (resource.tablename, aggregate, self.engine))
 
-            if aggregate == "count" or pt.grand_tot is None:
-                count = len(item_list)
+        if items:
+            if pt is None:
+                pt, fmap, count = self.__pivot_python(r, items, fields,
+                                                      lfields, aggregate)
 
             # Generate output table
             items = S3ContingencyTable(r,
@@ -315,6 +284,189 @@ class S3Cube(S3CRUD):
 
         return dict(items=items)
 
+    # -------------------------------------------------------------------------
+    def _pushdown(self, fields, lfields, aggregate):
+        """
+            Check whether the aggregation can be pushed down to the
+            database (GROUP BY), which requires that all rows, cols and
+            the fact are real columns (no virtual fields) of either the
+            master table or a table joined in by a single reference,
+            that no list:type values would need to be expanded, and
+            that there are rows or cols to group by
+
+            @param fields: the fields for the contingency table
+            @param lfields: the list fields (Storage)
+            @param aggregate: the aggregation method
+
+            @returns: True if the aggregation can be pushed down
+        """
+
+        if aggregate not in self.DB_AGGREGATES:
+            return False
+        if not self.rows and not self.cols:
+            # Nothing to group by
+            return False
+        for f in fields:
+            if f not in lfields:
+                return False
+            field = lfields[f].field
+            if field is None or str(field.type).startswith("list:"):
+                return False
+        if aggregate != "count":
+            ftype = str(lfields[self.fact].field.type)
+            if ftype not in ("integer", "double") and \
+               not ftype.startswith("decimal"):
+                return False
+        return True
+
+    # -------------------------------------------------------------------------
+    def __pivot_db(self, resource, lfields, join, aggregate):
+        """
+            Pivot by aggregating in the database
+
+            @param resource: the S3Resource
+            @param lfields: the list fields (Storage)
+            @param join: the joins for the list fields
+            @param aggregate: the aggregation method
+
+            @returns: tuple (S3PivotTable, count)
+        """
+
+        db = current.db
+
+        query = resource.get_query()
+        for j in join.values():
+            query &= j
+
+        dims = self.rows + [c for c in self.cols if c not in self.rows]
+        groupby = [lfields[f].field for f in dims]
+        fact = lfields[self.fact].field
+
+        if aggregate == "count":
+            # Group by the fact value, too, so that the number of groups
+            # per cell is the number of distinct fact values (which is the
+            # same de-duplication as in the in-Python pivoting)
+            if self.fact not in dims:
+                groupby.append(fact)
+            aggregates = []
+        else:
+            aggregates = [fact.count(), fact.sum(), fact.min(), fact.max()]
+
+        select = groupby + aggregates
+        rows = db(query).select(groupby=reduce(lambda x, y: x|y, groupby),
+                                *select)
+
+        value = self.__value
+        cells = {}
+        for row in rows:
+            item = dict([(f, value(row, lfields[f].field)) for f in dims])
+            for f in dims:
+                if item[f] is None:
+                    item[f] = "__NONE__"
+            key = (tuple([item[f] for f in self.rows]),
+                   tuple([item[f] for f in self.cols]))
+            if key not in cells:
+                cells[key] = S3PivotTable._accumulator()
+            acc = cells[key]
+            if aggregate == "count":
+                if value(row, fact) is not None:
+                    acc[0] += 1
+            else:
+                acc[0] += row[aggregates[0]] or 0
+                acc[1:4] = [row[a] for a in aggregates[1:]]
+
+        pt = S3PivotTable(None, self.fact, self.rows, self.cols,
+                          aggregate=aggregate, cells=cells)
+        if aggregate == "count" or pt.grand_tot is None:
+            count = aggregate == "count" and len(rows) or 0
+        else:
+            count = None
+        return pt, count
+
+    # -------------------------------------------------------------------------
+    def __pivot_python(self, r, items, fields, lfields, aggregate):
+        """
+            Pivot by aggregating in Python
+
+            @param r: the S3Request instance
+            @param items: the items as returned from sqltable
+            @param fields: the fields for the contingency table
+            @param lfields: the list fields (Storage)
+            @param aggregate: the aggregation method
+
+            @returns: tuple (S3PivotTable, fmap, count)
+        """
+
+        resource = self.resource
+        pkey = resource.table._id.name
+
+        # Collect the data
+        fmap = Storage()
+        data = []
+        seen = set()
+        for row in items:
+            try:
+                frow = self.__extract(row, fields, resource, lfields, fmap)
+            except KeyError:
+                e = sys.exc_info()[1]
+                if hasattr(e, "message"):
+                    e = e.message
+                r.error(400, e, next=r.url(vars=[]))
+            frow = self.__expand(frow)
+            for item in frow:
+                if aggregate in ("group_concat", "count"):
+                    i = Storage(item)
+                    if self.fact != pkey:
+                        del i[pkey]
+                    # De-duplicate
+                    key = tuple(sorted(i.items()))
+                    if key not in seen:
+                        seen.add(key)
+                        data.append(aggregate == "count" and i or item)
+                else:
+                    data.append(item)
+
+        # In group_concat, always group primary keys, and then use
+        # fmap to link individual fact values to their corresponding
+        # records
+        if aggregate == "group_concat" and fmap:
+            fact = pkey
+        else:
+            # Otherwise group the fact value, and delete fmap
+            fact = self.fact
+            fmap = None
+
+        # Pivoting
+        try:
+            pt = S3PivotTable(data, fact, self.rows, self.cols,
+                              aggregate=aggregate)
+        except:
+            r.error(400, "Could not generate contingency table",
+                    next=r.url(vars=[]))
+
+        count = None
+        if aggregate == "count" or pt.grand_tot is None:
+            count = len(seen)
+        return pt, fmap, count
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __value(row, field):
+        """
+            Helper method to extract a field value from a (joined) Row
+
+            @param row: the Row
+            @param field: the Field
+        """
+
+        tname = field.tablename
+        fname = field.name
+        if tname in row and fname in row[tname]:
+            return row[tname][fname]
+        elif fname in row:
+            return row[fname]
+        return None
+
     # -------------------------------------------------------------------------
     def __extract(self, row, fields, resource, lfields, fmap):
         """
@@ -583,6 +735,200 @@ class S3Cube(S3CRUD):
 
 # =============================================================================
 
+class S3PivotTable(list):
+    """
+        Pivot table (list of rows of aggregated cell values), computed
+        with a hash-based group-by in a single pass over the data.
+
+        Provides the same attributes as pyvttbl's PyvtTbl (rnames,
+        cnames, row_tots, col_tots and grand_tot) so that it can be
+        rendered by S3ContingencyTable. Aggregation follows the
+        semantics of the respective SQL aggregate functions, i.e.
+        None values are ignored, and empty cells are None (count: 0).
+    """
+
+    AGGREGATES = ("count", "sum", "avg", "min", "max", "group_concat")
+
+    # -------------------------------------------------------------------------
+    def __init__(self, data, fact, rows=None, cols=None, aggregate="count",
+                 cells=None):
+        """
+            Constructor
+
+            @param data: the data, list of dicts {fieldname: value}
+            @param fact: the name of the fact field
+            @param rows: list of field names for the row dimensions
+            @param cols: list of field names for the column dimensions
+            @param aggregate: the aggregation method
+            @param cells: pre-aggregated cells instead of data, dict
+                          {(row values, column values): accumulator},
+                          e.g. from a database GROUP BY
+        """
+
+        list.__init__(self)
+
+        if aggregate not in self.AGGREGATES:
+            raise ValueError("Unsupported aggregation method: %s" % aggregate)
+
+        if rows is None:
+            rows = []
+        if cols is None:
+            cols = []
+
+        self.val = fact
+        self.rows = rows
+        self.cols = cols
+        self.aggregate = aggregate
+
+        self.row_tots = None
+        self.col_tots = None
+        self.grand_tot = None
+
+        totals = aggregate != "group_concat"
+
+        # Group-by in a single pass
+        if cells is None:
+            cells = {}
+            add = self._add
+            for item in data:
+                value = item[fact]
+                key = (tuple([item[f] for f in rows]),
+                       tuple([item[f] for f in cols]))
+                if key in cells:
+                    add(cells[key], value)
+                else:
+                    cells[key] = add(self._accumulator(), value)
+
+        # Totals from the cell accumulators
+        rtotals = {}
+        ctotals = {}
+        gtotal = self._accumulator()
+        if totals:
+            merge = self._merge
+            for (rkey, ckey), acc in cells.iteritems():
+                if rkey not in rtotals:
+                    rtotals[rkey] = self._accumulator()
+                merge(rtotals[rkey], acc)
+                if ckey not in ctotals:
+                    ctotals[ckey] = self._accumulator()
+                merge(ctotals[ckey], acc)
+                merge(gtotal, acc)
+
+        # Dimension values
+        rkeys = sorted(set([k[0] for k in cells]))
+        ckeys = sorted(set([k[1] for k in cells]))
+        if rows:
+            self.rnames = [zip(rows, k) for k in rkeys]
+        else:
+            self.rnames = [1]
+        if cols:
+            self.cnames = [zip(cols, k) for k in ckeys]
+        else:
+            self.cnames = [1]
+
+        # Cell values
+        result = self._result
+        for rkey in rkeys:
+            self.append([result(cells.get((rkey, ckey), None))
+                         for ckey in ckeys])
+
+        # Totals
+        if totals:
+            self.grand_tot = result(gtotal)
+            if rows and cols:
+                self.row_tots = [result(rtotals[k]) for k in rkeys]
+                self.col_tots = [result(ctotals[k]) for k in ckeys]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _accumulator():
+        """
+            Create a new accumulator: [count, sum, min, max, values]
+        """
+
+        return [0, None, None, None, []]
+
+    # -------------------------------------------------------------------------
+    def _add(self, acc, value):
+        """
+            Add a value to an accumulator
+
+            @param acc: the accumulator
+            @param value: the value
+
+            @returns: the accumulator
+        """
+
+        if value is None:
+            return acc
+        acc[0] += 1
+        aggregate = self.aggregate
+        if aggregate in ("sum", "avg"):
+            if acc[1] is None:
+                acc[1] = value
+            else:
+                acc[1] += value
+        elif aggregate == "min":
+            if acc[2] is None or value < acc[2]:
+                acc[2] = value
+        elif aggregate == "max":
+            if acc[3] is None or value > acc[3]:
+                acc[3] = value
+        elif aggregate == "group_concat":
+            acc[4].append(value)
+        return acc
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _merge(acc, other):
+        """
+            Merge an accumulator into another (except group_concat values)
+
+            @param acc: the accumulator to merge into
+            @param other: the accumulator to merge
+
+            @returns: the accumulator
+        """
+
+        if not other[0]:
+            return acc
+        acc[0] += other[0]
+        if other[1] is not None:
+            acc[1] = other[1] if acc[1] is None else acc[1] + other[1]
+        if other[2] is not None and (acc[2] is None or other[2] < acc[2]):
+            acc[2] = other[2]
+        if other[3] is not None and (acc[3] is None or other[3] > acc[3]):
+            acc[3] = other[3]
+        return acc
+
+    # -------------------------------------------------------------------------
+    def _result(self, acc):
+        """
+            Get the aggregated value from an accumulator
+
+            @param acc: the accumulator (None for empty cells)
+        """
+
+        aggregate = self.aggregate
+        if acc is None or not acc[0]:
+            if aggregate == "count":
+                return 0
+            return None
+        if aggregate == "count":
+            return acc[0]
+        elif aggregate == "sum":
+            return acc[1]
+        elif aggregate == "avg":
+            return float(acc[1]) / acc[0]
+        elif aggregate == "min":
+            return acc[2]
+        elif aggregate == "max":
+            return acc[3]
+        else:
+            return ",".join([str(v) for v in acc[4]])
+
+# =============================================================================
+
 class S3ContingencyTable(TABLE):
     """
         HTML Helper to generate a contingency table
@@ -36,7 +36,11 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["GIS", "GoogleGeocoder", "YahooGeocoder"]
+__all__ = ["GIS",
+           "S3PointIndex",
+           "S3LocationTree",
+           "GoogleGeocoder",
+           "YahooGeocoder"]
 
 import os
 import re
@@ -44,6 +48,9 @@ import sys
 import copy
 #import logging
 import math             # Needed for greatCircleDistance
+import time             # Needed for point index refresh intervals
+import threading        # Needed for point index updates
+import weakref          # Needed for location tree updates and prepared statements
 #import random          # Needed when feature_queries are passed in without a name
 import urllib           # Needed for urlencoding
 import urllib2          # Needed for quoting & error handling on fetch
@@ -52,7 +59,7 @@ try:
     from cStringIO import StringIO    # Faster, where available
 except:
     from StringIO import StringIO
-from datetime import timedelta  # Needed for Feed Refresh checks
+from datetime import datetime, timedelta  # Needed for Feed Refresh checks
 import zipfile          # Needed to unzip KMZ files
 
 try:
@@ -94,6 +101,13 @@ try:
 except ImportError:
     s3_debug("WARNING: %s: Shapely GIS library not installed" % __name__)
 
+NUMPY = False
+try:
+    import numpy
+    NUMPY = True
+except ImportError:
+    s3_debug("WARNING: %s: NumPy not installed, no in-memory point index" % __name__)
+
 # Map WKT types to db types (multi-geometry types are mapped to single types)
 GEOM_TYPES = {
     "point": 1,
@@ -244,6 +258,13 @@ class GIS(object):
         GIS functions
     """
 
+    # Name of the prepared statement for radius searches in PostGIS
+    PG_RADIUS = "s3_gis_radius"
+
+    # Connections on which the statement has been prepared (weak, so that
+    # closed connections don't stay referenced)
+    pg_prepared = weakref.WeakKeyDictionary()
+
     def __init__(self):
         self.deployment_settings = current.deployment_settings
         self.public_url = current.deployment_settings.get_base_public_url()
@@ -604,49 +625,23 @@ class GIS(object):
 
         return dict(min_lon=min_lon, min_lat=min_lat, max_lon=max_lon, max_lat=max_lat)
 
-    # -------------------------------------------------------------------------
-    def _lookup_parent_path(self, feature_id):
-        """
-            Helper that gets parent and path for a location.
-        """
-
-        db = current.db
-        table = db.gis_location
-
-        query = (table.id == feature_id)
-        feature = db(query).select(table.path,
-                                   table.parent,
-                                   limitby=(0, 1)).first()
-
-        return feature
-
     # -------------------------------------------------------------------------
     def get_children(self, id, level=None):
         """
-            Return a list of IDs of all GIS Features which are children of
-            the requested feature, using Materialized path for retrieving
-            the children
+            Return a list of all GIS Features which are children of
+            the requested feature, looked up in the location tree (see
+            S3LocationTree)
 
-            @author: Aravind Venkatesan and Ajay Kumar Sreenivasan from NCSU
+            @param id: the gis_location record ID
+            @param level: optionally filter by level
 
-            This has been chosen over Modified Preorder Tree Traversal for
-            greater efficiency:
-            http://eden.sahanafoundation.org/wiki/HaitiGISToDo#HierarchicalTrees
-
-            @param: level - optionally filter by level
+            @returns: list of Storage(id, name), breadth-first
         """
 
-        db = current.db
-        table = db.gis_location
-
-        query = (table.deleted == False)
-        if level:
-            query = query & (table.level == level)
-        term = str(id)
-        query = query & ((table.path.like(term + "/%")) | \
-                         (table.path.like("%/" + term + "/%")))
-        children = db(query).select(table.id,
-                                    table.name)
+        tree = S3LocationTree.get()
+        name = tree.name
+        children = [Storage(id=i, name=name(i))
+                    for i in tree.descendants(int(id), level=level)]
         return children
 
     # -------------------------------------------------------------------------
@@ -654,65 +649,47 @@ class GIS(object):
         """
             Returns a list containing ancestors of the requested feature.
 
-            If the caller already has the location row, including path and
-            parent fields, they can supply it via feature to avoid a db lookup.
+            The ancestors are looked up in the location tree (see
+            S3LocationTree), so the feature parameter (the location
+            row) is no longer needed and only kept for compatibility.
 
             If ids_only is false, each element in the list is a gluon.sql.Row
             containing the gis_location record of an ancestor of the specified
             location.
 
             If ids_only is true, just returns a list of ids of the parents.
-            This avoids a db lookup for the parents if the specified feature
-            has a path.
+            This avoids a db lookup altogether.
 
             List elements are in the opposite order as the location path and
             exclude the specified location itself, i.e. element 0 is the parent
             and the last element is the most distant ancestor.
-
-            Assists lazy update of a database without location paths by calling
-            update_location_tree to get the path.
         """
 
         cache = self.cache
         db = current.db
         table = db.gis_location
 
-        if not feature or "path" not in feature or "parent" not in feature:
-            feature = self._lookup_parent_path(feature_id)
-
-        if feature and (feature.path or feature.parent):
-            if feature.path:
-                path = feature.path
-            else:
-                path = self.update_location_tree(feature_id, feature.parent)
-
-            path_list = map(int, path.split("/"))
-            if len(path_list) == 1:
-                # No parents -- path contains only this feature.
-                return None
-
-            # Get path in the desired order, without current feature.
-            reverse_path = path_list[:-1]
-            reverse_path.reverse()
+        tree = S3LocationTree.get()
+        reverse_path = tree.ancestors(int(feature_id))
+        if not reverse_path:
+            # No parents
+            return None
 
-            # If only ids are wanted, stop here.
-            if ids_only:
-                return reverse_path
+        # If only ids are wanted, stop here.
+        if ids_only:
+            return reverse_path
 
-            # Retrieve parents - order in which they're returned is arbitrary.
-            query = (table.id.belongs(reverse_path))
-            fields = [table.id, table.name, table.code, table.level, table.lat, table.lon]
-            unordered_parents = db(query).select(cache=cache, *fields)
+        # Retrieve parents - order in which they're returned is arbitrary.
+        query = (table.id.belongs(reverse_path))
+        fields = [table.id, table.name, table.code, table.level, table.lat, table.lon]
+        unordered_parents = db(query).select(cache=cache, *fields)
 
-            # Reorder parents in order of reversed path.
-            unordered_ids = [row.id for row in unordered_parents]
-            parents = [unordered_parents[unordered_ids.index(path_id)]
-                       for path_id in reverse_path if path_id in unordered_ids]
+        # Reorder parents in order of reversed path.
+        unordered_ids = [row.id for row in unordered_parents]
+        parents = [unordered_parents[unordered_ids.index(path_id)]
+                   for path_id in reverse_path if path_id in unordered_ids]
 
-            return parents
-
-        else:
-            return None
+        return parents
 
     # -------------------------------------------------------------------------
     def get_parent_per_level(self, results, feature_id,
@@ -722,8 +699,9 @@ class GIS(object):
         """
             Adds ancestor of requested feature for each level to supplied dict.
 
-            If the caller already has the location row, including path and
-            parent fields, they can supply it via feature to avoid a db lookup.
+            The ancestors are looked up in the location tree (see
+            S3LocationTree), the feature parameter is only kept for
+            compatibility.
 
             If a dict is not supplied in results, one is created. The results
             dict is returned in either case.
@@ -744,47 +722,27 @@ class GIS(object):
         if not results:
             results = {}
 
-        if not feature or "path" not in feature or "parent" not in feature:
-            feature = self._lookup_parent_path(feature_id)
+        # Look up the ancestors in the location tree
+        tree = S3LocationTree.get()
+        feature_id = int(feature_id)
+        for ancestor in tree.ancestors(feature_id):
+            level = tree.level(ancestor)
+            if level and self.is_level_key(level):
+                if names and ids:
+                    results[level] = Storage()
+                    results[level].name = tree.name(ancestor)
+                    results[level].id = ancestor
+                elif names:
+                    results[level] = tree.name(ancestor)
+                else:
+                    results[level] = ancestor
 
-        if feature and (feature.path or feature.parent):
-            if feature.path:
-                path = feature.path
-            else:
-                path = self.update_location_tree(feature_id, feature.parent)
-
-            # Get ids of ancestors at each level.
-            strict = self.get_strict_hierarchy()
-            if path and strict and not names:
-                # No need to do a db lookup for parents in this case -- we
-                # know the levels of the parents from their position in path.
-                # Note ids returned from db are ints, not strings, so be
-                # consistent with that.
-                path_ids = map(int, path.split("/"))
-                # This skips the last path element, which is the supplied
-                # location.
-                for (i, id) in enumerate(path_ids[:-1]):
-                    results["L%i" % i] = id
-            elif path:
-                ancestors = self.get_parents(feature_id, feature=feature)
-                if ancestors:
-                    for ancestor in ancestors:
-                        if ancestor.level and self.is_level_key(ancestor.level):
-                            if names and ids:
-                                results[ancestor.level] = Storage()
-                                results[ancestor.level].name = ancestor.name
-                                results[ancestor.level].id = ancestor.id
-                            elif names:
-                                results[ancestor.level] = ancestor.name
-                            else:
-                                results[ancestor.level] = ancestor.id
-
-            if names:
-                # We need to have entries for all levels
-                # (both for address onvalidation & new LocationSelector)
-                for key in self.allowed_hierarchy_level_keys:
-                    if not results.has_key(key):
-                        results[key] = None
+        if names and feature_id in tree:
+            # We need to have entries for all levels
+            # (both for address onvalidation & new LocationSelector)
+            for key in self.allowed_hierarchy_level_keys:
+                if not results.has_key(key):
+                    results[key] = None
 
         return results
 
@@ -1534,6 +1492,69 @@ class GIS(object):
 
         return represent
 
+    # -------------------------------------------------------------------------
+    def get_representations(self, field, values):
+        """
+            Return the representations for multiple values of a Field,
+            same as get_representation but with one query per table
+            Used by s3xml's prefetch_popups()
+
+            @param field: the Field
+            @param values: list of values
+
+            @returns: dict {value: representation}
+        """
+
+        db = current.db
+        T = current.T
+        fieldname = field.name
+        tablename = field.tablename
+
+        # Fallback representation is the value itself
+        represent = dict([(v, v) for v in values])
+        if not values:
+            return represent
+
+        # If the field is a FK, then check for specials
+        if (tablename, fieldname) in db.pr_person._referenced_by:
+            ptable = db.pr_person
+            query = (ptable.id.belongs(values)) & (ptable.deleted != True)
+            rows = db(query).select(ptable.id,
+                                    ptable.first_name,
+                                    ptable.middle_name,
+                                    ptable.last_name)
+            represent = dict([(v, "") for v in values])
+            for row in rows:
+                represent[row.id] = s3_fullname(row)
+        elif (tablename, fieldname) in db.hrm_human_resource._referenced_by:
+            # e.g. assess_rat - convert to Organisation
+            htable = db.hrm_human_resource
+            otable = db.org_organisation
+            query = (htable.id.belongs(values)) & \
+                    (otable.id == htable.organisation_id)
+            rows = db(query).select(htable.id, otable.name)
+            for row in rows:
+                represent[row[htable.id]] = row[otable.name]
+        elif fieldname == "type":
+            if tablename in ("hrm_human_resource", "org_office"):
+                # Option fields
+                for v in values:
+                    represent[v] = self.get_representation(field, v)
+        elif field.type[:9] == "reference":
+            try:
+                ktablename = field.type[10:]
+                ktable = db[ktablename]
+                rows = db(ktable.id.belongs(values)).select(ktable.id,
+                                                            ktable.name)
+            except: # @ToDo: provide specific exception
+                # Keep the default from earlier
+                pass
+            else:
+                for row in rows:
+                    represent[row.id] = row.name
+
+        return represent
+
     # -------------------------------------------------------------------------
     def get_features_in_polygon(self, location, tablename=None, category=None):
         """
@@ -1598,6 +1619,16 @@ class GIS(object):
             query = query & (table.deleted == False)
         # @ToDo: Check AAA (do this as a resource filter?)
 
+        if lon_min is not None:
+            index = S3PointIndex.get()
+            if index is not None:
+                # Pre-select the locations within the bbox from the
+                # in-memory point index
+                ids = index.bbox(lon_min, lat_min, lon_max, lat_max)
+                if not ids:
+                    return Rows()
+                query = query & (locations.id.belongs(ids))
+
         features = db(query).select(locations.wkt,
                                     locations.lat,
                                     locations.lon,
@@ -1662,71 +1693,25 @@ class GIS(object):
     def get_features_in_radius(self, lat, lon, radius, tablename=None, category=None):
         """
             Returns Features within a Radius (in km) of a LatLon Location
+
+            @returns: Rows of gis_location (or, if tablename is given,
+                      the joined resource and gis_location)
         """
 
         db = current.db
         deployment_settings = self.deployment_settings
 
+        # @ToDo: Support optional Category (make this a generic filter?)
+
+        # shortcut
+        locations = db.gis_location
+
+        index = None
         if deployment_settings.gis.spatialdb and deployment_settings.database.db_type == "postgres":
             # Use PostGIS routine
             # The ST_DWithin function call will automatically include a bounding box comparison that will make use of any indexes that are available on the geometries.
-            # @ToDo: Support optional Category (make this a generic filter?)
-
-            import psycopg2
-            import psycopg2.extras
-
-            dbname = deployment_settings.database.database
-            username = deployment_settings.database.username
-            password = deployment_settings.database.password
-            host = deployment_settings.database.host
-            port = deployment_settings.database.port or "5432"
-
-            # Convert km to degrees (since we're using the_geom not the_geog)
-            radius = math.degrees(float(radius) / RADIUS_EARTH)
-
-            connection = psycopg2.connect("dbname=%s user=%s password=%s host=%s port=%s" % (dbname, username, password, host, port))
-            cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            info_string = "SELECT column_name, udt_name FROM information_schema.columns WHERE table_name = 'gis_location' or table_name = '%s';" % tablename
-            cursor.execute(info_string)
-            # @ToDo: Look at more optimal queries for just those fields we need
-            if tablename:
-                # Lookup the resource
-                query_string = cursor.mogrify("SELECT * FROM gis_location, %s WHERE %s.location_id = gis_location.id and ST_DWithin (ST_GeomFromText ('POINT (%s %s)', 4326), the_geom, %s);" % (tablename, tablename, lat, lon, radius))
-            else:
-                # Lookup the raw Locations
-                query_string = cursor.mogrify("SELECT * FROM gis_location WHERE ST_DWithin (ST_GeomFromText ('POINT (%s %s)', 4326), the_geom, %s);" % (lat, lon, radius))
-
-            cursor.execute(query_string)
-            # @ToDo: Export Rows?
-            features = []
-            for record in cursor:
-                d = dict(record.items())
-                row = Storage()
-                # @ToDo: Optional support for Polygons
-                if tablename:
-                    row.gis_location = Storage()
-                    row.gis_location.id = d["id"]
-                    row.gis_location.lat = d["lat"]
-                    row.gis_location.lon = d["lon"]
-                    row.gis_location.lat_min = d["lat_min"]
-                    row.gis_location.lon_min = d["lon_min"]
-                    row.gis_location.lat_max = d["lat_max"]
-                    row.gis_location.lon_max = d["lon_max"]
-                    row[tablename] = Storage()
-                    row[tablename].id = d["id"]
-                    row[tablename].name = d["name"]
-                else:
-                    row.name = d["name"]
-                    row.id = d["id"]
-                    row.lat = d["lat"]
-                    row.lon = d["lon"]
-                    row.lat_min = d["lat_min"]
-                    row.lon_min = d["lon_min"]
-                    row.lat_max = d["lat_max"]
-                    row.lon_max = d["lon_max"]
-                features.append(row)
-
-            return features
+            ids = self._postgis_radius(lat, lon, radius)
+            check_distance = False
 
         #elif deployment_settings.database.db_type == "mysql":
             # Do the calculation in MySQL to pull back only the relevant rows
@@ -1743,105 +1728,170 @@ class GIS(object):
 
         else:
             # Calculate in Python
-            # Pull back all the rows within a square bounding box (faster than checking all features manually)
+            # Use the in-memory point index where available, otherwise
+            # pull back all the rows within a square bounding box (faster than checking all features manually)
             # Then check each feature within this subset
             # http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates
-
-            # @ToDo: Support optional Category (make this a generic filter?)
-
-            # shortcuts
-            radians = math.radians
-            degrees = math.degrees
-
-            MIN_LAT = radians(-90)     # -PI/2
-            MAX_LAT = radians(90)      # PI/2
-            MIN_LON = radians(-180)    # -PI
-            MAX_LON = radians(180)     #  PI
-
-            # Convert to radians for the calculation
-            r = float(radius) / RADIUS_EARTH
-            radLat = radians(lat)
-            radLon = radians(lon)
-
-            # Calculate the bounding box
-            minLat = radLat - r
-            maxLat = radLat + r
-
-            if (minLat > MIN_LAT) and (maxLat < MAX_LAT):
-                deltaLon = math.asin(math.sin(r) / math.cos(radLat))
-                minLon = radLon - deltaLon
-                if (minLon < MIN_LON):
-                    minLon += 2 * math.pi
-                maxLon = radLon + deltaLon
-                if (maxLon > MAX_LON):
-                    maxLon -= 2 * math.pi
+            index = S3PointIndex.get()
+            if index is not None:
+                ids = [match[0] for match in index.radius(lat, lon, radius)]
+                check_distance = False
             else:
-                # Special care for Poles & 180 Meridian:
-                # http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates#PolesAnd180thMeridian
-                minLat = max(minLat, MIN_LAT)
-                maxLat = min(maxLat, MAX_LAT)
-                minLon = MIN_LON
-                maxLon = MAX_LON
-
-            # Convert back to degrees
-            minLat = degrees(minLat)
-            minLon = degrees(minLon)
-            maxLat = degrees(maxLat)
-            maxLon = degrees(maxLon)
-
-            # shortcut
-            locations = db.gis_location
-
-            query = (locations.lat > minLat) & (locations.lat < maxLat) & (locations.lon > minLon) & (locations.lon < maxLon)
-            deleted = (locations.deleted == False)
-            empty = (locations.lat != None) & (locations.lon != None)
-            query = deleted & empty & query
+                ids = None
+                check_distance = True
+
+        if ids is not None:
+            if not ids:
+                return Rows()
+            query = (locations.id.belongs(ids)) & \
+                    (locations.deleted == False)
+        else:
+            query = self._radius_bbox_query(lat, lon, radius)
 
+        if tablename:
+            # Lookup the resource
+            table = db[tablename]
+            query = query & (table.location_id == locations.id)
+            records = db(query).select(table.ALL,
+                                       locations.id,
+                                       locations.name,
+                                       locations.level,
+                                       locations.lat,
+                                       locations.lon,
+                                       locations.lat_min,
+                                       locations.lon_min,
+                                       locations.lat_max,
+                                       locations.lon_max)
+        else:
+            # Lookup the raw Locations
+            records = db(query).select(locations.id,
+                                       locations.name,
+                                       locations.level,
+                                       locations.lat,
+                                       locations.lon,
+                                       locations.lat_min,
+                                       locations.lon_min,
+                                       locations.lat_max,
+                                       locations.lon_max)
+        if not check_distance:
+            return records
+
+        features = Rows()
+        for record in records:
+            # Calculate the Great Circle distance
             if tablename:
-                # Lookup the resource
-                table = db[tablename]
-                query = query & (table.location_id == locations.id)
-                records = db(query).select(table.ALL,
-                                           locations.id,
-                                           locations.name,
-                                           locations.level,
-                                           locations.lat,
-                                           locations.lon,
-                                           locations.lat_min,
-                                           locations.lon_min,
-                                           locations.lat_max,
-                                           locations.lon_max)
+                distance = self.greatCircleDistance(lat,
+                                                    lon,
+                                                    record.gis_location.lat,
+                                                    record.gis_location.lon)
             else:
-                # Lookup the raw Locations
-                records = db(query).select(locations.id,
-                                           locations.name,
-                                           locations.level,
-                                           locations.lat,
-                                           locations.lon,
-                                           locations.lat_min,
-                                           locations.lon_min,
-                                           locations.lat_max,
-                                           locations.lon_max)
-            features = Rows()
-            for record in records:
-                # Calculate the Great Circle distance
-                if tablename:
-                    distance = self.greatCircleDistance(lat,
-                                                        lon,
-                                                        record.gis_location.lat,
-                                                        record.gis_location.lon)
-                else:
-                    distance = self.greatCircleDistance(lat,
-                                                        lon,
-                                                        record.lat,
-                                                        record.lon)
-                if distance < radius:
-                    features.records.append(record)
-                else:
-                    # skip
-                    continue
+                distance = self.greatCircleDistance(lat,
+                                                    lon,
+                                                    record.lat,
+                                                    record.lon)
+            if distance < radius:
+                features.records.append(record)
+            else:
+                # skip
+                continue
+
+        return features
+
+    # -------------------------------------------------------------------------
+    def _postgis_radius(self, lat, lon, radius):
+        """
+            Find all locations within a radius with PostGIS ST_DWithin,
+            helper method for get_features_in_radius
+
+            Runs a prepared, parameterized statement on the DAL's (pooled)
+            connection - the statement gets prepared once per connection.
+
+            @param lat: the latitude of the center
+            @param lon: the longitude of the center
+            @param radius: the radius (km)
+
+            @returns: list of gis_location record IDs
+        """
+
+        db = current.db
+        connection = db._adapter.connection
+
+        prepared = GIS.pg_prepared
+        if connection not in prepared:
+            db.executesql("PREPARE %s (float8, float8, float8) AS "
+                          "SELECT id FROM gis_location WHERE ST_DWithin("
+                          "the_geom, ST_SetSRID(ST_MakePoint($1, $2), 4326), $3);" %
+                          self.PG_RADIUS)
+            prepared[connection] = True
+
+        # Convert km to degrees (since we're using the_geom not the_geog)
+        radius = math.degrees(float(radius) / RADIUS_EARTH)
+
+        rows = db.executesql("EXECUTE %s (%%s, %%s, %%s);" % self.PG_RADIUS,
+                             placeholders=(float(lon), float(lat), radius))
+        return [row[0] for row in rows]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _radius_bbox_query(lat, lon, radius):
+        """
+            Query for all locations within a square bounding box around
+            a radius, helper method for get_features_in_radius
+
+            @param lat: the latitude of the center
+            @param lon: the longitude of the center
+            @param radius: the radius (km)
+        """
+
+        # shortcuts
+        radians = math.radians
+        degrees = math.degrees
+
+        MIN_LAT = radians(-90)     # -PI/2
+        MAX_LAT = radians(90)      # PI/2
+        MIN_LON = radians(-180)    # -PI
+        MAX_LON = radians(180)     #  PI
+
+        # Convert to radians for the calculation
+        r = float(radius) / RADIUS_EARTH
+        radLat = radians(lat)
+        radLon = radians(lon)
+
+        # Calculate the bounding box
+        minLat = radLat - r
+        maxLat = radLat + r
+
+        if (minLat > MIN_LAT) and (maxLat < MAX_LAT):
+            deltaLon = math.asin(math.sin(r) / math.cos(radLat))
+            minLon = radLon - deltaLon
+            if (minLon < MIN_LON):
+                minLon += 2 * math.pi
+            maxLon = radLon + deltaLon
+            if (maxLon > MAX_LON):
+                maxLon -= 2 * math.pi
+        else:
+            # Special care for Poles & 180 Meridian:
+            # http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates#PolesAnd180thMeridian
+            minLat = max(minLat, MIN_LAT)
+            maxLat = min(maxLat, MAX_LAT)
+            minLon = MIN_LON
+            maxLon = MAX_LON
+
+        # Convert back to degrees
+        minLat = degrees(minLat)
+        minLon = degrees(minLon)
+        maxLat = degrees(maxLat)
+        maxLon = degrees(maxLon)
+
+        # shortcut
+        locations = current.db.gis_location
+
+        query = (locations.lat > minLat) & (locations.lat < maxLat) & (locations.lon > minLon) & (locations.lon < maxLon)
+        deleted = (locations.deleted == False)
+        empty = (locations.lat != None) & (locations.lon != None)
+        query = deleted & empty & query
 
-            return features
+        return query
 
     # -------------------------------------------------------------------------
     def get_latlon(self, feature_id, filter=False):
@@ -2078,6 +2128,155 @@ class GIS(object):
             distance = RADIUS_EARTH * c
             return distance
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_point_index(location_id, delete=False):
+        """
+            Update the in-memory point index for a location (if loaded),
+            invoked by gis_location onaccept/ondelete
+
+            @param location_id: the gis_location record ID
+            @param delete: the record has been deleted
+        """
+
+        index = S3PointIndex.instance
+        if index is not None:
+            index.update_record(location_id, delete=delete)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def update_location_hierarchy(location_id, delete=False):
+        """
+            Update the location tree for a location (if loaded), invoked
+            by gis_location ondelete (onaccept uses update_location_tree)
+
+            @param location_id: the gis_location record ID
+            @param delete: the record has been deleted
+        """
+
+        tree = S3LocationTree.instance
+        if tree is not None:
+            tree.update_record(location_id, delete=delete)
+
+    # -------------------------------------------------------------------------
+    def get_location_duplicates(self, dupe_distance=50, refresh=False):
+        """
+            Find pairs of locations which are closer together than
+            dupe_distance (and hence possible duplicates)
+
+            The locations are bucketed into a lat/lon grid with cells
+            sized to the dupe distance, so that each location only needs
+            to be compared with the locations in the neighbouring cells.
+            The result is cached, so that paging through it is cheap.
+
+            @param dupe_distance: the maximum distance (in km)
+            @param refresh: discard the cached result and re-calculate
+
+            @returns: list of tuples (distance, id1, name1, id2, name2),
+                      ordered by distance
+        """
+
+        key = "gis_location_duplicates_%s" % dupe_distance
+        cache = current.cache.ram
+        if refresh:
+            cache(key, None)
+        return cache(key,
+                     lambda: self._location_duplicates(dupe_distance),
+                     time_expire=3600)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _location_duplicates(dupe_distance):
+        """
+            Grid-based search for locations closer than dupe_distance,
+            helper method for get_location_duplicates
+
+            @param dupe_distance: the maximum distance (in km)
+        """
+
+        db = current.db
+        table = db.gis_location
+
+        query = (table.deleted != True) & \
+                (table.lat != None) & \
+                (table.lon != None)
+        rows = db(query).select(table.id,
+                                table.name,
+                                table.lat,
+                                table.lon)
+
+        cos = math.cos
+        sin = math.sin
+        acos = math.acos
+        ceil = math.ceil
+        radians = math.radians
+
+        # Cell size in degrees (=dupe distance as angle)
+        size = math.degrees(float(dupe_distance) / RADIUS_EARTH)
+        size = min(max(size, 1e-6), 180.0)
+        delta = radians(size)
+        # Longitude cells must divide the circle evenly for wrap-around
+        lon_cells = int(ceil(360.0 / size))
+        lon_size = 360.0 / lon_cells
+
+        # Bucket the locations
+        grid = {}
+        for row in rows:
+            lat = float(row.lat)
+            lon = float(row.lon)
+            if not -90 <= lat <= 90:
+                continue
+            phi = radians(lat)
+            point = (row.id, row.name, sin(phi), cos(phi), radians(lon))
+            cell = (int((lat + 90) // size),
+                    int((lon + 180) // lon_size) % lon_cells)
+            if cell in grid:
+                grid[cell].append(point)
+            else:
+                grid[cell] = [point]
+
+        # Neighbour cells
+        neighbours = {}
+        def get_neighbours(i, j):
+            # Longitude span to search depends on the highest latitude
+            # in this band: a spherical cap with radius delta around
+            # latitude phi spans asin(sin(delta) / cos(phi)) longitude
+            if i not in neighbours:
+                lat_max = min(max(abs(i * size - 90),
+                                  abs((i + 1) * size - 90)), 90)
+                x = sin(delta) / cos(radians(lat_max))
+                if size >= 90 or x >= 1:
+                    # Cap includes a pole
+                    span = lon_cells
+                else:
+                    span = int(ceil(math.degrees(math.asin(x)) / lon_size))
+                    span = min(span, lon_cells)
+                lon_offsets = set([o % lon_cells
+                                   for o in xrange(-span, span + 1)])
+                neighbours[i] = lon_offsets
+            return [(i + di, (j + dj) % lon_cells)
+                    for di in (-1, 0, 1)
+                    for dj in neighbours[i]]
+
+        # Compare the locations in neighbouring cells
+        duplicates = []
+        append = duplicates.append
+        for (i, j), points in grid.iteritems():
+            cells = [grid[c] for c in get_neighbours(i, j) if c in grid]
+            for id1, name1, sin1, cos1, lon1 in points:
+                for others in cells:
+                    for id2, name2, sin2, cos2, lon2 in others:
+                        if id2 <= id1:
+                            continue
+                        # Spherical Law of Cosines (as in greatCircleDistance)
+                        x = sin1 * sin2 + cos1 * cos2 * cos(lon2 - lon1)
+                        distance = acos(min(max(x, -1.0), 1.0)) * RADIUS_EARTH
+                        if distance < dupe_distance:
+                            append((distance, id1, name1, id2, name2))
+
+        duplicates.sort()
+        return duplicates
+
     # -------------------------------------------------------------------------
     def import_admin_areas(self,
                            source="gadm",
@@ -3102,52 +3301,58 @@ class GIS(object):
             @author: Aravind Venkatesan and Ajay Kumar Sreenivasan from NCSU
             @summary: Using Materialized path for each node in the tree
             http://eden.sahanafoundation.org/wiki/HaitiGISToDo#HierarchicalTrees
-            Do a lazy update of a database that does not have location paths.
-            For convenience of get_parents, return the path.
+
+            The paths are calculated from the location tree (see
+            S3LocationTree). If the parent of the location has changed,
+            the paths of all its descendants get updated as well.
+
+            Without location_id, the paths of all locations are rebuilt
+            in a single pass, and the Bounds/Centroids/WKT calculated
+            for all features which do not have them yet.
+
+            @param location_id: the gis_location record ID
+            @param parent_id: the parent (only used to detect whether
+                              the location needs to be re-read from the
+                              database)
+
+            @returns: the path (if location_id is given)
         """
 
         db = current.db
         table = db.gis_location
 
-        if location_id:
-            if parent_id:
-                query = (table.id == parent_id)
-                parent = db(query).select(table.parent,
-                                          table.path).first()
-            # It is Somebody Else's Problem (see Douglas Adams) to assure that
-            # parent_id points to an actual location.  We just protect ourselves
-            # in case they didn't.
-            if parent_id and parent:
-                if parent.path:
-                    # Parent has a path.
-                    path = "%s/%s" % (str(parent.path), str(location_id))
-                elif parent.parent:
-                    parent_path = self.update_location_tree(parent_id,
-                                                            parent.parent)
-                    # Ok, *now* the parent has a path.
-                    path = "%s/%s" % (str(parent_path), str(location_id))
-                else:
-                    # Parent has no parent.
-                    path = "%s/%s" % (str(parent_id), str(location_id))
-            else:
-                path = str(location_id)
-
-            db(table.id == location_id).update(path=path)
+        tree = S3LocationTree.get(refresh=False)
 
+        if location_id:
+            location_id = int(location_id)
+            known = location_id in tree
+            parent = tree.parent(location_id)
+            if not known or parent != parent_id:
+                tree.update_record(location_id)
+            if known and tree.parent(location_id) != parent:
+                # Moved => update the paths of all descendants too
+                return tree.update_path(location_id)
+            path = tree.path(location_id)
+            tree.write_paths([(location_id, path)])
             return path
 
         else:
             # Do the whole database
-            query = (table.id > 0)
+            tree.rebuild()
+
+            # Also do the Bounds/Centroids/WKT where missing
+            query = (table.deleted != True) & \
+                    ((table.wkt == None) | \
+                     (table.lat_min == None) | \
+                     (table.lat_max == None) | \
+                     (table.lon_min == None) | \
+                     (table.lon_max == None))
             features = db(query).select(table.id,
                                         table.gis_feature_type,
                                         table.lat,
                                         table.lon,
-                                        table.wkt,
-                                        table.parent)
+                                        table.wkt)
             for feature in features:
-                self.update_location_tree(feature.id, feature.parent)
-                # Also do the Bounds/Centroids/WKT
                 form = Storage()
                 form.vars = feature
                 form.errors = Storage()
@@ -4466,6 +4671,822 @@ S3.gis.layers_feature_queries[%i] = {
 
         return html
 
+# =============================================================================
+class S3PointIndex(object):
+    """
+        In-memory index of the points (lat/lon) and bounds of all
+        gis_location records, to answer radius, bbox and k-nearest
+        queries with vectorized calculations (for deployments without
+        a spatial database)
+
+        The index is a process-wide singleton (see get()). It is updated
+        incrementally by gis_location onaccept/ondelete, and reads all
+        records modified since the last refresh at most every
+        REFRESH_INTERVAL seconds to pick up changes from other processes.
+
+        @requires: U{B{I{NumPy}} <http://numpy.scipy.org>}
+    """
+
+    # Minimum interval (seconds) between refreshes from the database
+    REFRESH_INTERVAL = 10
+
+    instance = None
+    # Re-entrant: get() holds the lock while refresh() updates the index
+    lock = threading.RLock()
+
+    # -------------------------------------------------------------------------
+    def __init__(self):
+        """ Constructor, use get() to access the index """
+
+        # Position of the record IDs in the arrays
+        self.positions = {}
+        # Number of invalidated positions
+        self.garbage = 0
+
+        self.data = None
+        self.modified_on = None
+        self.refreshed = None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, refresh=True):
+        """
+            Get the point index, loading it at the first call
+
+            @param refresh: refresh the index from the database if the
+                            REFRESH_INTERVAL has expired
+
+            @returns: the S3PointIndex, or None if NumPy is not available
+        """
+
+        if not NUMPY:
+            return None
+
+        index = cls.instance
+        if index is None:
+            cls.lock.acquire()
+            try:
+                index = cls.instance
+                if index is None:
+                    index = cls()
+                    index.refresh()
+                    cls.instance = index
+            finally:
+                cls.lock.release()
+        elif refresh and \
+             time.time() - index.refreshed > index.REFRESH_INTERVAL:
+            index.refresh()
+        return index
+
+    # -------------------------------------------------------------------------
+    def refresh(self):
+        """
+            Read all records modified since the last refresh
+            (or all records at the first call)
+        """
+
+        db = current.db
+        table = db.gis_location
+
+        self.refreshed = time.time()
+
+        if self.modified_on is None:
+            query = (table.deleted != True) & \
+                    (table.lat != None) & \
+                    (table.lon != None)
+        else:
+            # Re-read records modified in the same instant as the
+            # latest known, which might not all have been committed
+            query = (table.modified_on >= self.modified_on)
+        rows = db(query).select(table.id,
+                                table.deleted,
+                                table.lat,
+                                table.lon,
+                                table.lat_min,
+                                table.lat_max,
+                                table.lon_min,
+                                table.lon_max,
+                                table.modified_on)
+        self.update(rows)
+
+    # -------------------------------------------------------------------------
+    def update_record(self, record_id, delete=False):
+        """
+            Update the index for a gis_location record, invoked by
+            gis_location onaccept/ondelete
+
+            @param record_id: the record ID
+            @param delete: remove the record from the index
+        """
+
+        if delete:
+            self.update([Storage(id=record_id, deleted=True)])
+            return
+
+        db = current.db
+        table = db.gis_location
+        query = (table.id == record_id)
+        rows = db(query).select(table.id,
+                                table.deleted,
+                                table.lat,
+                                table.lon,
+                                table.lat_min,
+                                table.lat_max,
+                                table.lon_min,
+                                table.lon_max,
+                                table.modified_on,
+                                limitby=(0, 1))
+        if rows:
+            self.update(rows)
+        else:
+            self.update([Storage(id=record_id, deleted=True)])
+
+    # -------------------------------------------------------------------------
+    def update(self, rows):
+        """
+            Update the index from gis_location rows
+
+            @param rows: the rows, must contain id, deleted, lat, lon,
+                         lat_min, lat_max, lon_min and lon_max
+
+            @note: queries operate on the arrays which are current when
+                   they start, and updates replace these arrays rather than
+                   changing them in-place (except for invalidation)
+        """
+
+        nan = numpy.nan
+        radians = math.radians
+
+        self.lock.acquire()
+        try:
+            data = self.data
+            positions = self.positions
+            if data is not None:
+                valid = data.valid
+                size = len(data.ids)
+            else:
+                valid = None
+                size = 0
+
+            records = {}
+            for row in rows:
+                record_id = row.id
+                modified_on = row.get("modified_on", None)
+                if modified_on is not None and \
+                   (self.modified_on is None or modified_on > self.modified_on):
+                    self.modified_on = modified_on
+                # Invalidate the previous entry
+                pos = positions.pop(record_id, None)
+                if pos is not None:
+                    valid[pos] = False
+                    self.garbage += 1
+                records.pop(record_id, None)
+                if row.deleted or row.lat is None or row.lon is None:
+                    continue
+                records[record_id] = row
+
+            if records:
+                rows = records.values()
+                def values(fn):
+                    return [row[fn] is None and nan or float(row[fn])
+                            for row in rows]
+                lat = numpy.array([float(row.lat) for row in rows])
+                lon = numpy.array([float(row.lon) for row in rows])
+                new = Storage(ids=numpy.array([row.id for row in rows]),
+                              valid=numpy.ones(len(rows), dtype=bool),
+                              lat=lat,
+                              lon=lon,
+                              lat_r=numpy.radians(lat),
+                              lon_r=numpy.radians(lon),
+                              lat_min=numpy.array(values("lat_min")),
+                              lat_max=numpy.array(values("lat_max")),
+                              lon_min=numpy.array(values("lon_min")),
+                              lon_max=numpy.array(values("lon_max")))
+                new.coslat = numpy.cos(new.lat_r)
+                for i in xrange(len(rows)):
+                    positions[rows[i].id] = size + i
+                if data is not None:
+                    new = Storage([(k, numpy.concatenate((data[k], new[k])))
+                                   for k in new])
+                data = new
+
+            if data is not None and self.garbage > len(data.ids) / 2:
+                # Compact the arrays
+                valid = data.valid
+                data = Storage([(k, data[k][valid]) for k in data])
+                ids = data.ids.tolist()
+                self.positions = positions = \
+                    dict([(ids[i], i) for i in xrange(len(ids))])
+                self.garbage = 0
+
+            self.data = data
+        finally:
+            self.lock.release()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _distance(data, lat, lon, idx=None):
+        """
+            Vectorized Haversine distance
+
+            @param data: the index data
+            @param lat: the latitude of the reference point
+            @param lon: the longitude of the reference point
+            @param idx: the positions to compute the distance for
+                        (default: all)
+
+            @returns: array of distances (km)
+        """
+
+        lat_r = data.lat_r
+        lon_r = data.lon_r
+        coslat = data.coslat
+        if idx is not None:
+            lat_r = lat_r[idx]
+            lon_r = lon_r[idx]
+            coslat = coslat[idx]
+        lat = math.radians(lat)
+        lon = math.radians(lon)
+        a = numpy.sin((lat_r - lat) / 2) ** 2 + \
+            math.cos(lat) * coslat * numpy.sin((lon_r - lon) / 2) ** 2
+        return 2 * RADIUS_EARTH * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+    # -------------------------------------------------------------------------
+    def radius(self, lat, lon, radius):
+        """
+            Find all locations within a radius around a point
+
+            @param lat: the latitude of the point
+            @param lon: the longitude of the point
+            @param radius: the radius (km)
+
+            @returns: list of tuples (location ID, distance), ordered
+                      by distance
+        """
+
+        data = self.data
+        if data is None:
+            return []
+
+        # Pre-select by latitude
+        delta = math.degrees(float(radius) / RADIUS_EARTH)
+        idx = numpy.nonzero(data.valid &
+                            (numpy.abs(data.lat - lat) <= delta))[0]
+        distance = self._distance(data, lat, lon, idx=idx)
+        match = distance < radius
+        idx = idx[match]
+        distance = distance[match]
+        order = numpy.argsort(distance)
+        return zip(data.ids[idx][order].tolist(),
+                   distance[order].tolist())
+
+    # -------------------------------------------------------------------------
+    def nearest(self, lat, lon, k=1):
+        """
+            Find the k locations nearest to a point
+
+            @param lat: the latitude of the point
+            @param lon: the longitude of the point
+            @param k: the number of locations
+
+            @returns: list of tuples (location ID, distance), ordered
+                      by distance
+        """
+
+        data = self.data
+        if data is None:
+            return []
+
+        idx = numpy.nonzero(data.valid)[0]
+        distance = self._distance(data, lat, lon, idx=idx)
+        order = numpy.argsort(distance)[:k]
+        return zip(data.ids[idx][order].tolist(),
+                   distance[order].tolist())
+
+    # -------------------------------------------------------------------------
+    def bbox(self, lon_min, lat_min, lon_max, lat_max, bounds=False):
+        """
+            Find all locations within a bounding box
+
+            @param lon_min: the western boundary
+            @param lat_min: the southern boundary
+            @param lon_max: the eastern boundary (if lower than lon_min,
+                            the box extends across the 180th meridian)
+            @param lat_max: the northern boundary
+            @param bounds: match locations whose bounds intersect with
+                           the box rather than their point (lat/lon)
+
+            @returns: list of location IDs
+        """
+
+        data = self.data
+        if data is None:
+            return []
+
+        if bounds:
+            # Use the point where there are no bounds
+            def bound(fn, point):
+                values = data[fn]
+                return numpy.where(numpy.isnan(values), point, values)
+            south = bound("lat_min", data.lat)
+            north = bound("lat_max", data.lat)
+            west = bound("lon_min", data.lon)
+            east = bound("lon_max", data.lon)
+        else:
+            south = north = data.lat
+            west = east = data.lon
+
+        match = data.valid & (north >= lat_min) & (south <= lat_max)
+        if lon_min <= lon_max:
+            match &= (east >= lon_min) & (west <= lon_max)
+        else:
+            match &= (east >= lon_min) | (west <= lon_max)
+        return data.ids[match].tolist()
+
+# =============================================================================
+class S3LocationTree(object):
+    """
+        In-memory map of the gis_location hierarchy (id => parent, level,
+        name), to answer ancestor, descendant and per-level queries
+        without database lookups, and to rebuild the materialized paths
+        of all locations in a single pass
+
+        The tree is a process-wide singleton (see get()). It is updated
+        by gis_location onaccept/ondelete (see GIS.update_location_tree),
+        and reads all records modified since the last refresh at most
+        every REFRESH_INTERVAL seconds to pick up changes from other
+        processes.
+
+        Changes by onaccept/ondelete are applied before the transaction
+        is committed, so the changed records get re-read from the database
+        once the request has ended (see reread), which undoes changes that
+        have been rolled back.
+    """
+
+    # Minimum interval (seconds) between refreshes from the database
+    REFRESH_INTERVAL = 10
+    # Number of records per UPDATE statement when writing paths
+    UPDATE_CHUNK_SIZE = 500
+    # Maximum depth of the hierarchy (protects against loops)
+    MAX_DEPTH = 32
+
+    instance = None
+    lock = threading.RLock()
+
+    # -------------------------------------------------------------------------
+    def __init__(self):
+        """ Constructor, use get() to access the tree """
+
+        # Record ID => (parent, level, name)
+        self.nodes = {}
+        # Record ID => set of the IDs of the children
+        self.children = {}
+        # Record ID => weak reference to the request which has changed
+        # the record (see update_record)
+        self.changed = {}
+
+        self.modified_on = None
+        self.refreshed = None
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, refresh=True):
+        """
+            Get the location tree, loading it at the first call
+
+            @param refresh: refresh the tree from the database if the
+                            REFRESH_INTERVAL has expired
+        """
+
+        tree = cls.instance
+        if tree is None:
+            cls.lock.acquire()
+            try:
+                tree = cls.instance
+                if tree is None:
+                    tree = cls()
+                    tree.refresh()
+                    cls.instance = tree
+            finally:
+                cls.lock.release()
+        else:
+            if tree.changed:
+                tree.reread()
+            if refresh and \
+               time.time() - tree.refreshed > tree.REFRESH_INTERVAL:
+                tree.refresh()
+        return tree
+
+    # -------------------------------------------------------------------------
+    def refresh(self):
+        """
+            Read all records modified since the last refresh
+            (or all records at the first call)
+        """
+
+        db = current.db
+        table = db.gis_location
+
+        self.refreshed = time.time()
+        if self.modified_on is None:
+            query = (table.deleted != True)
+        else:
+            # Re-read records modified in the same instant as the
+            # latest known, which might not all have been committed
+            query = (table.modified_on >= self.modified_on)
+        self.update(self._select(query))
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _select(query, path=False):
+        """
+            Select the hierarchy fields of gis_location records (as
+            tuples rather than Rows, for speed)
+
+            @param query: the query
+            @param path: also select the path
+
+            @returns: list of tuples (id, deleted, modified_on, parent,
+                      level, name[, path])
+        """
+
+        db = current.db
+        table = db.gis_location
+        fields = [table.id,
+                  table.deleted,
+                  table.modified_on,
+                  table.parent,
+                  table.level,
+                  table.name]
+        if path:
+            fields.append(table.path)
+        sql = db(query)._select(*fields)
+        return db.executesql(sql)
+
+    # -------------------------------------------------------------------------
+    def update_record(self, record_id, delete=False):
+        """
+            Update the tree for a gis_location record, before the current
+            transaction is committed (the record is re-read once the
+            request has ended, see reread)
+
+            @param record_id: the record ID
+            @param delete: remove the record from the tree
+        """
+
+        self.track(record_id)
+        if delete:
+            self.update([(record_id, True, None, None, None, None)],
+                        watermark=False)
+            return
+        db = current.db
+        table = db.gis_location
+        rows = self._select(table.id == record_id)
+        if rows:
+            self.update(rows, watermark=False)
+        else:
+            self.update([(record_id, True, None, None, None, None)],
+                        watermark=False)
+
+    # -------------------------------------------------------------------------
+    def track(self, record_id):
+        """
+            Remember that a record has been changed in the tree by the
+            current request
+
+            @param record_id: the record ID
+        """
+
+        self.lock.acquire()
+        try:
+            self.changed[record_id] = weakref.ref(current.request)
+        finally:
+            self.lock.release()
+
+    # -------------------------------------------------------------------------
+    def reread(self):
+        """
+            Re-read the records which have been changed by requests that
+            have ended meanwhile (i.e. committed or rolled back)
+        """
+
+        changed = self.changed
+        self.lock.acquire()
+        try:
+            ended = [record_id for record_id, request in changed.items()
+                     if request() is None]
+            for record_id in ended:
+                del changed[record_id]
+        finally:
+            self.lock.release()
+        if not ended:
+            return
+
+        db = current.db
+        table = db.gis_location
+        rows = list(self._select(table.id.belongs(ended)))
+        found = set([row[0] for row in rows])
+        rows.extend([(record_id, True, None, None, None, None)
+                     for record_id in ended if record_id not in found])
+        self.update(rows, watermark=False)
+
+    # -------------------------------------------------------------------------
+    def update(self, rows, watermark=True):
+        """
+            Update the tree
+
+            @param rows: tuples (id, deleted, modified_on, parent, level,
+                         name), see _select
+            @param watermark: advance the modification date up to which
+                              the tree is complete (refresh), False for
+                              records which might not be committed yet
+        """
+
+        nodes = self.nodes
+        children = self.children
+
+        self.lock.acquire()
+        try:
+            for row in rows:
+                record_id, deleted, modified_on, parent, level, name = row[:6]
+                if watermark and modified_on is not None:
+                    if isinstance(modified_on, basestring):
+                        # executesql on SQLite returns strings
+                        modified_on = datetime.strptime(modified_on[:19],
+                                                        "%Y-%m-%d %H:%M:%S")
+                    if self.modified_on is None or \
+                       modified_on > self.modified_on:
+                        self.modified_on = modified_on
+                node = nodes.pop(record_id, None)
+                if node is not None and node[0] in children:
+                    siblings = children[node[0]]
+                    siblings.discard(record_id)
+                    if not siblings:
+                        del children[node[0]]
+                if deleted and deleted != "F":
+                    continue
+                nodes[record_id] = (parent, level, name)
+                if parent:
+                    if parent in children:
+                        children[parent].add(record_id)
+                    else:
+                        children[parent] = set([record_id])
+        finally:
+            self.lock.release()
+
+    # -------------------------------------------------------------------------
+    def set_parent(self, record_id, parent):
+        """
+            Set the parent of a location in the tree
+
+            @param record_id: the record ID
+            @param parent: the parent record ID
+        """
+
+        node = self.nodes.get(record_id, None)
+        if node is None:
+            return
+        self.track(record_id)
+        self.update([(record_id, False, None, parent, node[1], node[2])],
+                    watermark=False)
+
+    # -------------------------------------------------------------------------
+    def __contains__(self, record_id):
+
+        return record_id in self.nodes
+
+    # -------------------------------------------------------------------------
+    def parent(self, record_id):
+        """
+            Get the parent of a location
+
+            @param record_id: the record ID
+        """
+
+        node = self.nodes.get(record_id, None)
+        if node is not None:
+            return node[0]
+        return None
+
+    # -------------------------------------------------------------------------
+    def level(self, record_id):
+        """
+            Get the level of a location
+
+            @param record_id: the record ID
+        """
+
+        node = self.nodes.get(record_id, None)
+        if node is not None:
+            return node[1]
+        return None
+
+    # -------------------------------------------------------------------------
+    def name(self, record_id):
+        """
+            Get the name of a location
+
+            @param record_id: the record ID
+        """
+
+        node = self.nodes.get(record_id, None)
+        if node is not None:
+            return node[2]
+        return None
+
+    # -------------------------------------------------------------------------
+    def ancestors(self, record_id):
+        """
+            Get the ancestors of a location
+
+            @param record_id: the record ID
+
+            @returns: list of the IDs of the ancestors, the parent first
+        """
+
+        nodes = self.nodes
+        ancestors = []
+        node = nodes.get(record_id, None)
+        while node is not None and node[0]:
+            parent = node[0]
+            node = nodes.get(parent, None)
+            if node is None:
+                # Parent does not exist (anymore)
+                break
+            if parent == record_id or parent in ancestors or \
+               len(ancestors) >= self.MAX_DEPTH:
+                # Loop
+                break
+            ancestors.append(parent)
+        return ancestors
+
+    # -------------------------------------------------------------------------
+    def path(self, record_id):
+        """
+            Get the materialized path of a location
+
+            @param record_id: the record ID
+
+            @returns: the path as string "id/id/id", the most distant
+                      ancestor first
+        """
+
+        path = [str(i) for i in self.ancestors(record_id)]
+        path.reverse()
+        path.append(str(record_id))
+        return "/".join(path)
+
+    # -------------------------------------------------------------------------
+    def descendants(self, record_id, level=None):
+        """
+            Get the descendants of a location (breadth-first)
+
+            @param record_id: the record ID
+            @param level: only descendants at this level
+
+            @returns: list of the IDs of the descendants
+        """
+
+        nodes = self.nodes
+        children = self.children
+        descendants = []
+        seen = set([record_id])
+        queue = [record_id]
+        while queue:
+            current_level = queue
+            queue = []
+            for i in current_level:
+                for child in children.get(i, ()):
+                    if child in seen:
+                        continue
+                    seen.add(child)
+                    queue.append(child)
+                    if level is None or nodes[child][1] == level:
+                        descendants.append(child)
+        return descendants
+
+    # -------------------------------------------------------------------------
+    def parent_per_level(self, record_id):
+        """
+            Get the ancestors of a location per level
+
+            @param record_id: the record ID
+
+            @returns: dict {level: ancestor ID}
+        """
+
+        nodes = self.nodes
+        results = {}
+        for ancestor in self.ancestors(record_id):
+            if ancestor not in nodes:
+                continue
+            level = nodes[ancestor][1]
+            if level and level not in results:
+                results[level] = ancestor
+        return results
+
+    # -------------------------------------------------------------------------
+    def update_path(self, record_id):
+        """
+            Write the materialized paths of a location and all its
+            descendants to the database
+
+            @param record_id: the record ID
+
+            @returns: the path of the location
+        """
+
+        paths = [(record_id, self.path(record_id))]
+        for i in self.descendants(record_id):
+            paths.append((i, self.path(i)))
+        self.write_paths(paths)
+        return paths[0][1]
+
+    # -------------------------------------------------------------------------
+    def rebuild(self):
+        """
+            Rebuild the tree from the database, and update all
+            materialized paths which have changed, in a single
+            breadth-first pass from the roots of the hierarchy
+
+            @returns: the number of updated paths
+        """
+
+        db = current.db
+        table = db.gis_location
+
+        self.lock.acquire()
+        try:
+            self.nodes = {}
+            self.children = {}
+            self.modified_on = None
+            self.refreshed = time.time()
+            rows = self._select(table.deleted != True, path=True)
+            self.update(rows)
+
+            nodes = self.nodes
+            children = self.children
+            stored = dict([(row[0], row[6]) for row in rows])
+            rows = None
+
+            # Roots = locations without (existing) parent
+            paths = {}
+            queue = []
+            for record_id, node in nodes.iteritems():
+                parent = node[0]
+                if not parent or parent not in nodes:
+                    paths[record_id] = str(record_id)
+                    queue.append(record_id)
+            while queue:
+                current_level = queue
+                queue = []
+                for i in current_level:
+                    path = paths[i]
+                    for child in children.get(i, ()):
+                        if child not in paths:
+                            paths[child] = "%s/%s" % (path, child)
+                            queue.append(child)
+            # Locations in loops are not reachable from any root
+            for record_id in nodes:
+                if record_id not in paths:
+                    paths[record_id] = self.path(record_id)
+
+            changed = [(i, path) for i, path in paths.iteritems()
+                       if stored.get(i) != path]
+        finally:
+            self.lock.release()
+
+        self.write_paths(changed)
+        return len(changed)
+
+    # -------------------------------------------------------------------------
+    def write_paths(self, paths):
+        """
+            Write materialized paths to the database, with one UPDATE
+            statement per UPDATE_CHUNK_SIZE records
+
+            @param paths: list of tuples (record ID, path)
+        """
+
+        db = current.db
+        table = db.gis_location
+        represent = lambda v: db._adapter.represent(v, "string")
+
+        chunk = self.UPDATE_CHUNK_SIZE
+        for i in xrange(0, len(paths), chunk):
+            subset = paths[i:i+chunk]
+            if len(subset) == 1:
+                record_id, path = subset[0]
+                db(table.id == record_id).update(path=path)
+                continue
+            cases = " ".join(["WHEN %s THEN %s" % (int(record_id),
+                                                   represent(path))
+                              for record_id, path in subset])
+            ids = ",".join([str(int(record_id)) for record_id, path in subset])
+            db.executesql("UPDATE %s SET path=(CASE id %s END) "
+                          "WHERE id IN (%s);" % (table, cases, ids))
+        return
+
 # -----------------------------------------------------------------------------
 class Marker(object):
     """ Represents a Map Marker """
@@ -505,6 +505,31 @@ class S3Importer(S3CRUD):
                                              status = 1)
         db.commit()
 
+        chunk_size = self.manager.import_chunk_size
+        if chunk_size:
+            # import and commit the file in chunks
+            result = self._import_chunked(upload_id,
+                                          openFile,
+                                          chunk_size,
+                                          stylesheet=transform)
+            if result is None:
+                if self.error != None:
+                    if session.error == None:
+                        session.error = self.error
+                    else:
+                        session.error += self.error
+            else:
+                msg = "%s : %s %s %s" % (source,
+                                         self.messages.commit_total_records_imported,
+                                         self.messages.commit_total_errors,
+                                         self.messages.commit_total_records_ignored)
+                msg = msg % result
+                if session.flash == None:
+                    session.flash = msg
+                else:
+                    session.flash += msg
+            return
+
         # create the import job
         result = self._generate_import_job(upload_id,
                                            openFile,
@@ -944,6 +969,83 @@ class S3Importer(S3CRUD):
         self.job_id = job_id
         return True
 
+    # -------------------------------------------------------------------------
+    def _import_chunked(self,
+                        upload_id,
+                        openFile,
+                        chunk_size,
+                        stylesheet=None):
+        """
+            Import a CSV file directly (without review) in chunks of
+            chunk_size rows, committing each chunk and recording the
+            progress in the s3_import_upload record after every chunk
+
+            @param upload_id: the s3_import_upload record ID
+            @param openFile: the CSV file (file-like object)
+            @param chunk_size: the number of rows per chunk
+            @param stylesheet: the stylesheet (None for the default)
+
+            @returns: tuple (total imported, total errors, total ignored),
+                      or None if the import failed
+        """
+
+        _debug("S3Importer._import_chunked(%s, %s, %s, %s)" % (upload_id,
+                                                              openFile,
+                                                              chunk_size,
+                                                              stylesheet))
+
+        db = current.db
+        request = self.request
+        resource = request.resource
+        upload_table = self.upload_table
+        query = (upload_table.id == upload_id)
+
+        if stylesheet == None:
+            stylesheet = self._get_stylesheet()
+        if stylesheet == None:
+            db(query).update(status = 2) # in error
+            db.commit()
+            return None
+
+        self.table = self.controller_table
+        self.tablename = self.controller_tablename
+
+        args = Storage()
+        mode = request.get_vars.get("xsltmode", None)
+        if mode is not None:
+            args.update(mode=mode)
+
+        def progress(status):
+            db(query).update(summary_added = status.imported,
+                             summary_error = status.errors,
+                             summary_ignored = status.ignored,
+                             completed_details = "%s chunks, %s rows" % \
+                                                 (status.chunk, status.rows))
+
+        resource.import_xml(openFile,
+                            format="csv",
+                            extra_data=self.csv_extra_data,
+                            stylesheet=stylesheet,
+                            ignore_errors=True,
+                            chunk_size=chunk_size,
+                            progress=progress,
+                            **args)
+
+        errors = self._collect_errors(resource)
+        if errors:
+            current.response.s3.error_report = errors
+
+        row = db(query).select(upload_table.summary_added,
+                               upload_table.summary_error,
+                               upload_table.summary_ignored,
+                               limitby=(0, 1)).first()
+        totalRecords = row.summary_added or 0
+        totalErrors = row.summary_error or 0
+        totalIgnored = row.summary_ignored or 0
+        db(query).update(status = 3)
+        db.commit()
+        return (totalRecords, totalErrors, totalIgnored)
+
     # -------------------------------------------------------------------------
     def _get_stylesheet(self, file_format="csv"):
         """
@@ -1852,7 +1954,7 @@ class S3ImportItem(object):
         self.tablename = table._tablename
 
         if original is None:
-            original = manager.original(table, element)
+            original = self.job.original(table, element)
         data = xml.record(table, element,
                           files=files,
                           original=original,
@@ -1892,12 +1994,23 @@ class S3ImportItem(object):
             return
 
         manager = self.manager
+        db = current.db
         model = manager.model
         xml = manager.xml
         table = self.table
 
         if self.original is not None:
             original = self.original
+        elif self.job.bulk and self.job.tree is not None:
+            # Already checked against the unique keys of the whole job,
+            # except for the records inserted by the job itself
+            record_id = self.job.inserted_record(table, self.data)
+            if record_id is not None:
+                query = (table._id == record_id)
+                original = db(query).select(table.ALL,
+                                            limitby=(0, 1)).first()
+            else:
+                original = None
         else:
             original = manager.original(table, self.data)
 
@@ -2209,6 +2322,12 @@ class S3ImportItem(object):
                 if xml.MCI in table.fields:
                     data.update({xml.MCI:self.mci})
 
+                # Bulk mode: the job inserts the record together
+                # with all other new records of the same batch
+                if self.job.bulk:
+                    self.job.pending.append((self, dict(data)))
+                    return True
+
                 # Insert the new record
                 try:
                     success = table.insert(**dict(data))
@@ -2261,6 +2380,33 @@ class S3ImportItem(object):
                                                self.method))
             return True
 
+        self._postprocess()
+
+        _debug("Success: %s, id=%s %sd" % (self.tablename, self.id,
+                                           self.skip and "skippe" or \
+                                           self.method))
+        return True
+
+    # -------------------------------------------------------------------------
+    def _postprocess(self, onaccept=True):
+        """
+            Audit, super-entity update, record owner and onaccept after
+            a successful commit, and update of referencing items
+
+            @param onaccept: run the onaccept callback (False if the
+                             job runs a bulk_onaccept callback instead)
+
+            @returns: the form (Storage with method and vars) if the
+                      item has been committed, otherwise None
+        """
+
+        manager = self.manager
+        db = current.db
+        model = manager.model
+        table = self.table
+
+        form = None
+
         # Audit + onaccept on successful commits
         if self.committed:
             form = Storage()
@@ -2278,11 +2424,12 @@ class S3ImportItem(object):
             model.update_super(table, form.vars)
             if self.method == self.METHOD.CREATE:
                 manager.auth.s3_set_record_owner(table, self.id)
-            key = "%s_onaccept" % self.method
-            onaccept = model.get_config(tablename, key,
-                       model.get_config(tablename, "onaccept"))
             if onaccept:
-                callback(onaccept, form, tablename=self.tablename)
+                key = "%s_onaccept" % self.method
+                onaccept = model.get_config(tablename, key,
+                           model.get_config(tablename, "onaccept"))
+                if onaccept:
+                    callback(onaccept, form, tablename=self.tablename)
 
         # Update referencing items
         if self.update and self.id:
@@ -2301,10 +2448,7 @@ class S3ImportItem(object):
                 else:
                     item._update_reference(field, self.id)
 
-        _debug("Success: %s, id=%s %sd" % (self.tablename, self.id,
-                                           self.skip and "skippe" or \
-                                           self.method))
-        return True
+        return form
 
     # -------------------------------------------------------------------------
     def _get_update_policy(self, field):
@@ -2572,6 +2716,8 @@ class S3ImportJob():
     JOB_TABLE_NAME = "s3_import_job"
     ITEM_TABLE_NAME = "s3_import_item"
 
+    CHUNK_SIZE = 500 # max number of keys per query in bulk mode
+
     # -------------------------------------------------------------------------
     def __init__(self, manager, table,
                  tree=None,
@@ -2581,7 +2727,9 @@ class S3ImportJob():
                  update_policy=None,
                  conflict_policy=None,
                  last_sync=None,
-                 onconflict=None):
+                 onconflict=None,
+                 bulk=False,
+                 directory=None):
         """
             Constructor
 
@@ -2594,6 +2742,11 @@ class S3ImportJob():
             @param conflict_policy: the conflict resolution policy
             @param last_sync: the last synchronization time stamp (datetime)
             @param onconflict: custom conflict resolver function
+            @param bulk: bulk mode - de-duplicate with one query per table
+                         and unique key, and insert new records in batches
+                         (see commit)
+            @param directory: UID directory carried over from a previous
+                              job (chunked imports, see compact_directory)
         """
 
         self.manager = manager
@@ -2607,7 +2760,16 @@ class S3ImportJob():
         self.table = table
         self.tree = tree
         self.files = files
-        self.directory = Storage()
+        if directory is None:
+            directory = Storage()
+        self.directory = directory
+        self.uidmap = None
+
+        # Bulk mode
+        self.bulk = bulk
+        self.originals = Storage()
+        self.inserted = Storage()
+        self.pending = []
 
         self.elements = Storage()
         self.items = Storage()
@@ -2790,6 +2952,193 @@ class S3ImportJob():
 
         return item.item_id
 
+    # -------------------------------------------------------------------------
+    def original(self, table, element):
+        """
+            Find the original DB record for an element (see
+            S3RequestManager.original). In bulk mode, the originals
+            for all elements of the same table in the import tree are
+            looked up at once, with one query per unique key.
+
+            @param table: the table
+            @param element: the <resource> element
+        """
+
+        manager = self.manager
+        if not self.bulk or self.tree is None:
+            return manager.original(table, element)
+
+        tablename = table._tablename
+        if tablename in self.originals:
+            originals = self.originals[tablename]
+        else:
+            originals = self.__prefetch_originals(table)
+
+        UID = manager.xml.UID
+        pvalues = self.__unique_values(table, element)
+
+        # Try to find exactly one match by non-UID unique keys
+        matches = set()
+        for f in pvalues:
+            if f == UID:
+                continue
+            record_id = originals[f].get(self.__key(pvalues[f]), None)
+            if record_id is not None:
+                matches.add(record_id)
+        if len(matches) == 1:
+            return originals.records[matches.pop()]
+
+        # If no match, then try to find a UID-match
+        if UID in pvalues:
+            uid = manager.xml.import_uid(pvalues[UID])
+            record_id = originals[UID].get(self.__key(uid), None)
+            if record_id is not None:
+                return originals.records[record_id]
+
+        # No match or multiple matches
+        return None
+
+    # -------------------------------------------------------------------------
+    def __prefetch_originals(self, table):
+        """
+            Look up the existing DB records for all elements of a table
+            in the import tree (helper for original)
+
+            @param table: the table
+
+            @returns: a Storage {fieldname: {value: record ID}} for all
+                      unique fields, with the records under "records"
+        """
+
+        db = current.db
+        manager = self.manager
+        xml = manager.xml
+        UID = xml.UID
+
+        tablename = table._tablename
+        originals = Storage(records=Storage())
+        pkeys = [f for f in table.fields if table[f].unique]
+
+        # Collect the unique key values from the tree
+        values = Storage([(f, set()) for f in pkeys])
+        root = self.tree
+        if not isinstance(root, etree._Element):
+            root = root.getroot()
+        for element in root.iterdescendants(tag=xml.TAG.resource):
+            if element.get(xml.ATTRIBUTE.name, None) != tablename:
+                continue
+            pvalues = self.__unique_values(table, element)
+            for f in pvalues:
+                if f == UID:
+                    values[f].add(xml.import_uid(pvalues[f]))
+                else:
+                    values[f].add(pvalues[f])
+
+        # One query per unique key (in chunks)
+        records = originals.records
+        chunk = self.CHUNK_SIZE
+        for f in pkeys:
+            index = originals[f] = {}
+            keys = list(values[f])
+            for i in xrange(0, len(keys), chunk):
+                query = table[f].belongs(keys[i:i+chunk])
+                rows = db(query).select(table.ALL)
+                for row in rows:
+                    record_id = row[table._id.name]
+                    records[record_id] = row
+                    key = self.__key(row[f])
+                    if key in index and index[key] != record_id:
+                        # Ambiguous key
+                        index[key] = None
+                    else:
+                        index[key] = record_id
+
+        self.originals[tablename] = originals
+        return originals
+
+    # -------------------------------------------------------------------------
+    def __unique_values(self, table, element):
+        """
+            Get the values for unique fields from an element (as in
+            S3RequestManager.original)
+
+            @param table: the table
+            @param element: the <resource> element
+        """
+
+        xml = self.manager.xml
+        UID = xml.UID
+
+        pvalues = Storage()
+        for f in table.fields:
+            if not table[f].unique:
+                continue
+            v = None
+            if f == UID or f in xml.ATTRIBUTES_TO_FIELDS:
+                v = element.get(f, None)
+            else:
+                for child in element.iterchildren(tag=xml.TAG.data):
+                    if child.get(xml.ATTRIBUTE.field, None) == f:
+                        v = child.get(xml.ATTRIBUTE.value,
+                                      xml.xml_decode(child.text))
+                        break
+            if v:
+                pvalues[f] = v
+        return pvalues
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __key(value):
+        """
+            Normalize a value for lookups in the originals index
+
+            @param value: the value
+        """
+
+        if isinstance(value, unicode):
+            return value.encode("utf-8")
+        else:
+            return str(value)
+
+    # -------------------------------------------------------------------------
+    def get_uidmap(self, root):
+        """
+            Get the UID directory of an import tree, i.e. a dict
+            {(tablename, attr, uid): element} of all <resource> elements
+            with a UID or TUID in the tree. The directory is built in a
+            single pass over the tree on first access, and then re-used
+            for all lookups in the same tree.
+
+            @param root: the root element of the import tree
+        """
+
+        uidmap = self.uidmap
+        if uidmap is not None and uidmap.root is root:
+            return uidmap.elements
+
+        xml = self.manager.xml
+        UID = xml.UID
+        TUID = xml.ATTRIBUTE.tuid
+        NAME = xml.ATTRIBUTE.name
+
+        elements = {}
+        for element in root.iterdescendants(tag=xml.TAG.resource):
+            tablename = element.get(NAME, None)
+            if not tablename:
+                continue
+            for attr in (UID, TUID):
+                uid = element.get(attr, None)
+                if uid:
+                    key = (tablename, attr, uid)
+                    # First match in document order wins (like xpath)
+                    if key not in elements:
+                        elements[key] = element
+
+        # Keep a reference to the root, so that the element proxy
+        # remains the same while the directory is in use
+        self.uidmap = Storage(root=root, elements=elements)
+        return elements
+
     # -------------------------------------------------------------------------
     def lookahead(self,
                   element,
@@ -2815,11 +3164,13 @@ class S3ImportJob():
         reference_list = []
 
         root = None
+        uidmap = None
         if tree is not None:
             if isinstance(tree, etree._Element):
                 root = tree
             else:
                 root = tree.getroot()
+            uidmap = self.get_uidmap(root)
         references = element.findall("reference")
         for reference in references:
             field = reference.get(xml.ATTRIBUTE.field, None)
@@ -2900,16 +3251,10 @@ class S3ImportJob():
                     if directory is not None:
                         entry = directory.get((tablename, attr, uid), None)
                     if not entry:
-                        expr = './/%s[@%s="%s" and @%s="%s"]' % (
-                                    xml.TAG.resource,
-                                    xml.ATTRIBUTE.name,
-                                    tablename,
-                                    attr,
-                                    uid)
-                        e = root.xpath(expr)
-                        if e:
+                        e = uidmap.get((tablename, attr, uid), None)
+                        if e is not None:
                             # Element in the source => append to relements
-                            relements.append(e[0])
+                            relements.append(e)
                         else:
                             # No element found, see if original record exists
                             _uid = xml.import_uid(uid)
@@ -2950,6 +3295,60 @@ class S3ImportJob():
 
         return reference_list
 
+    # -------------------------------------------------------------------------
+    def compact_directory(self):
+        """
+            Reduce the UID directory to the TUIDs of all records committed
+            by this job, so that the directory can be carried over into the
+            next job of a chunked import: references to elements of earlier
+            chunks then resolve to the committed records, while the element
+            tree of this job can be released. UID references need no entry
+            as they are looked up in the database anyway.
+
+            @returns: the directory
+        """
+
+        xml = self.manager.xml
+        TUID = xml.ATTRIBUTE.tuid
+        DELETE = S3ImportItem.METHOD.DELETE
+
+        items = self.items
+        directory = self.directory
+
+        for key in directory.keys():
+            entry = directory[key]
+            record_id = entry.id
+            if entry.item_id:
+                item = items.get(entry.item_id, None)
+                if item and item.committed and item.method != DELETE:
+                    record_id = item.id
+                else:
+                    record_id = None
+            if key[1] != TUID or not record_id:
+                del directory[key]
+            elif entry.element is not None or entry.item_id:
+                directory[key] = Storage(tablename=entry.tablename,
+                                         element=None,
+                                         uid=entry.uid,
+                                         id=record_id,
+                                         item_id=None)
+
+        for item in items.values():
+            element = item.element
+            if element is None or not item.committed or \
+               not item.id or item.method == DELETE:
+                continue
+            tuid = element.get(TUID, None)
+            if tuid:
+                directory[(item.tablename, TUID, tuid)] = \
+                    Storage(tablename=item.tablename,
+                            element=None,
+                            uid=tuid,
+                            id=item.id,
+                            item_id=None)
+
+        return directory
+
     # -------------------------------------------------------------------------
     def load_item(self, row):
         """
@@ -3014,6 +3413,10 @@ class S3ImportJob():
             if item_id not in import_list:
                 import_list.append(item_id)
         imports = [self.items[_id] for _id in import_list]
+
+        if self.bulk:
+            return self.__commit_bulk(imports, ignore_errors=ignore_errors)
+
         # Commit the items
         for item in imports:
             error = None
@@ -3030,6 +3433,202 @@ class S3ImportJob():
                     return False
         return True
 
+    # -------------------------------------------------------------------------
+    def __commit_bulk(self, imports, ignore_errors=False):
+        """
+            Commit the import job in bulk mode: the items are grouped
+            into batches by dependency level and table, and all new
+            records of a batch are inserted with a single bulk_insert.
+            If the table configures a "bulk_onaccept" callback, then
+            this is called once per batch with the list of forms of all
+            new records (instead of the onaccept callback per record).
+
+            Pending records are invisible for the de-duplication of the
+            following items, so the batch gets flushed before any item
+            with the same unique keys (UID) as a pending record. Tables
+            with a "deduplicate" resolver can configure a
+            "deduplicate_key" function(item) which returns the key under
+            which the resolver would find a duplicate of the item (or None
+            if it wouldn't look for one), so that the batch only gets
+            flushed before an item with the same key as a pending record.
+            Without it, the batch gets flushed before every item of the
+            table.
+
+            @param imports: the items in dependency order
+            @param ignore_errors: skip any items with errors
+                                  (does still report the errors)
+        """
+
+        model = self.manager.model
+
+        # Dependency level of each item (referenced items first)
+        levels = {}
+        items = self.items
+        def level(item):
+            item_id = item.item_id
+            if item_id in levels:
+                return levels[item_id]
+            # Circular references are resolved by item.update
+            levels[item_id] = 0
+            l = 0
+            for reference in item.references:
+                entry = reference.entry
+                if entry and entry.item_id and entry.item_id in items:
+                    l = max(l, level(items[entry.item_id]) + 1)
+            levels[item_id] = l
+            return l
+
+        batches = {}
+        keys = []
+        for item in imports:
+            key = (level(item), item.tablename)
+            if key not in batches:
+                batches[key] = []
+                keys.append(key)
+            batches[key].append(item)
+        keys.sort(key=lambda k: k[0])
+
+        # Commit the batches
+        for key in keys:
+            self.pending = []
+            pkeys = set()
+            resolve = model.get_config(key[1], "deduplicate")
+            resolve_key = model.get_config(key[1], "deduplicate_key")
+            for item in batches[key]:
+                ukeys = self.__unique_keys(item.table, item.data)
+                if resolve and item.data and resolve_key is not None:
+                    rkey = resolve_key(item)
+                    if rkey is not None:
+                        # No fieldname => can't clash with a unique key
+                        ukeys.append((None, rkey))
+                if self.pending and \
+                   (resolve and resolve_key is None or \
+                    pkeys.intersection(ukeys)):
+                    self.__flush()
+                    pkeys = set()
+                    if self.error and not ignore_errors:
+                        return False
+                item.commit(ignore_errors=ignore_errors)
+                if item.error:
+                    self.__item_error(item)
+                    if not ignore_errors:
+                        return False
+                if self.pending and self.pending[-1][0] is item:
+                    pkeys.update(ukeys)
+            if self.pending:
+                self.__flush()
+                if self.error and not ignore_errors:
+                    return False
+        return True
+
+    # -------------------------------------------------------------------------
+    def __flush(self):
+        """
+            Insert all pending new records of a batch (helper for
+            __commit_bulk)
+        """
+
+        model = self.manager.model
+
+        pending = self.pending
+        self.pending = []
+
+        item = pending[0][0]
+        table = item.table
+        tablename = item.tablename
+
+        try:
+            ids = table.bulk_insert([data for item, data in pending])
+        except:
+            # The whole batch fails
+            error = sys.exc_info()[1]
+            for item, data in pending:
+                item.error = error
+                item.skip = True
+                self.__item_error(item)
+            return
+
+        inserted = self.inserted.get(tablename, None)
+        if inserted is None:
+            inserted = self.inserted[tablename] = {}
+
+        bulk_onaccept = model.get_config(tablename, "bulk_onaccept")
+        forms = []
+        for (item, data), record_id in zip(pending, ids):
+            if not record_id:
+                continue
+            for key in self.__unique_keys(table, data):
+                inserted[key] = record_id
+            item.id = record_id
+            item.committed = True
+            form = item._postprocess(onaccept=not bulk_onaccept)
+            if form is not None:
+                forms.append(form)
+        if bulk_onaccept and forms:
+            callback(bulk_onaccept, forms, tablename=tablename)
+        return
+
+    # -------------------------------------------------------------------------
+    def inserted_record(self, table, data):
+        """
+            Find a record which has been inserted by this job in bulk
+            mode, by the unique keys (UID) of the import data
+
+            @param table: the table
+            @param data: the import data of the item
+
+            @returns: the record ID, or None if not found
+        """
+
+        inserted = self.inserted.get(table._tablename, None)
+        if not inserted or not data:
+            return None
+        for key in self.__unique_keys(table, data):
+            if key in inserted:
+                return inserted[key]
+        return None
+
+    # -------------------------------------------------------------------------
+    def __unique_keys(self, table, data):
+        """
+            Get the lookup keys for the unique fields in the import data
+            of an item (helper for __commit_bulk)
+
+            @param table: the table
+            @param data: the import data of the item
+
+            @returns: a list of tuples (fieldname, key)
+        """
+
+        keys = []
+        if not data:
+            return keys
+        for f in table.fields:
+            if not table[f].unique:
+                continue
+            v = data.get(f, None)
+            if v:
+                keys.append((f, self.__key(v)))
+        return keys
+
+    # -------------------------------------------------------------------------
+    def __item_error(self, item):
+        """
+            Add a failed item to the error tree
+
+            @param item: the S3ImportItem
+        """
+
+        xml = self.manager.xml
+
+        self.error = item.error
+        element = item.element
+        if element is not None:
+            if not element.get(xml.ATTRIBUTE.error, False):
+                element.set(xml.ATTRIBUTE.error, str(self.error))
+            self.error_tree.append(deepcopy(element))
+        return
+
     # -------------------------------------------------------------------------
     def __define_tables(self):
         """
@@ -38,16 +38,28 @@
 
 """
 
-__all__ = ["S3Msg"]
+__all__ = ["S3Msg",
+           "S3SMTPPool"]
 
 import sys
 import datetime
 import string
 import urllib
+import smtplib
+import socket
+import threading
+import time
+import Queue
+import multiprocessing.dummy
+from email.Header import Header
+from email.MIMEMultipart import MIMEMultipart
+from email.MIMEText import MIMEText
+from email.Utils import formatdate, make_msgid
 from urllib2 import urlopen
 from s3utils import s3_debug
 
 from gluon import current
+from gluon.storage import Storage
 
 IDENTITYTRANS = ALLCHARS = string.maketrans("", "")
 NOTPHONECHARS = ALLCHARS.translate(IDENTITYTRANS, string.digits)
@@ -57,6 +69,25 @@ TWITTER_MAX_CHARS = 140
 TWITTER_HAS_NEXT_SUFFIX = u' \u2026'
 TWITTER_HAS_PREV_PREFIX = u'\u2026 '
 
+# =============================================================================
+def _send_job(send, job):
+    """
+        Send one Outbox message (in a worker thread of process_outbox)
+
+        @param send: the send function of the sender
+        @param job: tuple (row_id, message_id, recipient, subject, message)
+
+        @returns: True if the message was sent
+    """
+
+    try:
+        return send(*job)
+    except:
+        s3_debug("s3msg", "Sending Outbox message %s failed: %s" % \
+                          (job[0], sys.exc_info()[1]))
+        return False
+
+# =============================================================================
 class S3Msg(object):
     """ Messaging framework """
 
@@ -67,6 +98,9 @@ class S3Msg(object):
         self.mail = current.mail
         self.modem = modem
 
+        # Pool of SMTP sessions to send Email through (None to use Mail)
+        self.smtp = self.__get_smtp_pool()
+
         # http://docs.oasis-open.org/emergency/edxl-have/cs01/xPIL-types.xsd
         # <xs:simpleType name="CommunicationMediaTypeList">
         #  <xs:enumeration value="Cellphone"/>
@@ -119,6 +153,27 @@ class S3Msg(object):
                 "WEB_API": T("Web API")
             }
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __get_smtp_pool():
+        """
+            Get the pool of SMTP sessions for the configured mail server
+
+            @returns: the S3SMTPPool, or None if pooling is disabled
+                      (mail.pool_size = 0) or the server is not SMTP
+        """
+
+        settings = current.deployment_settings
+        size = settings.get_mail_pool_size()
+        server = settings.get_mail_server()
+        if not size or not server or server in ("logging", "gae"):
+            return None
+        return S3SMTPPool.get(server,
+                              settings.get_mail_sender(),
+                              login=settings.get_mail_server_login() or None,
+                              tls=settings.get_mail_server_tls(),
+                              size=size)
+
     # -------------------------------------------------------------------------
     def sanitise_phone(self, phone):
         """
@@ -267,150 +322,344 @@ class S3Msg(object):
             If succesful then move from Outbox to Sent.
             Can be called from Cron
 
+            Messages to groups and organisations are first fanned out to
+            their members, messages to other types of entities are marked
+            as invalid. The messages to persons are then sent in batches:
+            the messages and contacts of a batch are read at once, up to
+            msg.outbox_workers messages are sent concurrently through the
+            gateway, and the results are recorded per batch.
+
             @ToDo: contact_method = "ALL"
         """
 
         db = current.db
         current.manager.load("msg_outbox")
+        settings = current.deployment_settings
 
+        outgoing_sms_handler = None
         if contact_method == "SMS":
             table = db.msg_setting
-            settings = db(table.id > 0).select(table.outgoing_sms_handler,
-                                               limitby=(0, 1)).first()
-            if not settings:
+            row = db(table.id > 0).select(table.outgoing_sms_handler,
+                                          limitby=(0, 1)).first()
+            if not row:
                 raise ValueError("No SMS handler defined!")
-            outgoing_sms_handler = settings.outgoing_sms_handler
-
-        def dispatch_to_pe_id(pe_id):
-            table = db.pr_contact
-            query = (table.pe_id == pe_id) & \
-                    (table.contact_method == contact_method) & \
-                    (table.deleted == False)
-            recipient = db(query).select(table.value,
-                                         orderby = table.priority,
-                                         limitby=(0, 1)).first()
-            if recipient:
-                if contact_method == "EMAIL":
-                    return self.send_email(recipient.value,
-                                           subject,
-                                           message)
-                elif contact_method == "SMS":
-                    if outgoing_sms_handler == "WEB_API":
-                        return self.send_sms_via_api(recipient.value,
-                                                     message)
-                    elif outgoing_sms_handler == "SMTP":
-                        return self.send_sms_via_smtp(recipient.value,
-                                                       message)
-                    elif outgoing_sms_handler == "MODEM":
-                        return self.send_sms_via_modem(recipient.value,
-                                                       message)
-                    elif outgoing_sms_handler == "TROPO":
-                        # NB This does not mean the message is sent
-                        return self.send_text_via_tropo(row.id,
-                                                        message_id,
-                                                        recipient.value,
-                                                        message)
-                    else:
-                        return False
+            outgoing_sms_handler = row.outgoing_sms_handler
 
-                elif contact_method == "TWITTER":
-                    return self.send_text_via_twitter(recipient.value,
-                                                      message)
-            return False
+        # Fan out the messages to groups and organisations
+        self.__fan_out(contact_method)
+        self.__reject_unsupported(contact_method)
 
+        # Messages to persons
+        table = db.msg_outbox
+        petable = db.pr_pentity
+        query = (table.status == 1) & \
+                (table.pr_message_method == contact_method) & \
+                (table.pe_id == petable.id) & \
+                (petable.instance_type == "pr_person")
+        rows = db(query).select(table.id,
+                                table.message_id,
+                                table.pe_id,
+                                table.address,
+                                orderby=table.id)
+        rows = [row for row in rows]
+        if not rows:
+            return
+
+        sender = self.__get_sender(contact_method, outgoing_sms_handler)
+        if sender is None:
+            return
+
+        pool = None
+        workers = settings.get_msg_outbox_workers()
+        if sender.concurrent and workers and workers > 1:
+            pool = multiprocessing.dummy.Pool(workers)
+        batch_size = settings.get_msg_outbox_batch_size()
+        try:
+            for i in xrange(0, len(rows), batch_size):
+                self.__dispatch(rows[i:i + batch_size],
+                                contact_method,
+                                sender,
+                                pool=pool)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return
+
+    # -------------------------------------------------------------------------
+    def __fan_out(self, contact_method):
+        """
+            Replace the pending Outbox messages to groups and organisations
+            by messages to each of their members (system generated), with
+            one query per type of entity and a bulk insert
+
+            @param contact_method: the contact method
+        """
+
+        db = current.db
         table = db.msg_outbox
         ltable = db.msg_log
+        petable = db.pr_pentity
         ptable = db.pr_person
+
+        query = (table.status == 1) & \
+                (table.pr_message_method == contact_method) & \
+                (table.pe_id == petable.id) & \
+                (petable.instance_type.belongs(("pr_group",
+                                                "org_organisation")))
+        rows = db(query).select(table.id,
+                                table.message_id,
+                                table.pe_id,
+                                petable.instance_type)
+        if not rows:
+            return
+
+        group_pe_ids = []
+        org_pe_ids = []
+        for row in rows:
+            if row.pr_pentity.instance_type == "pr_group":
+                group_pe_ids.append(row.msg_outbox.pe_id)
+            else:
+                org_pe_ids.append(row.msg_outbox.pe_id)
+
+        # Look up the members of all groups and organisations at once
+        members = {}
+        if group_pe_ids:
+            gtable = db.pr_group
+            mtable = db.pr_group_membership
+            query = (gtable.pe_id.belongs(group_pe_ids)) & \
+                    (mtable.group_id == gtable.id) & \
+                    (mtable.deleted != True) & \
+                    (ptable.id == mtable.person_id)
+            for row in db(query).select(gtable.pe_id, ptable.pe_id):
+                members.setdefault(row.pr_group.pe_id,
+                                   []).append(row.pr_person.pe_id)
+        if org_pe_ids:
+            otable = db.org_organisation
+            htable = db.hrm_human_resource
+            query = (otable.pe_id.belongs(org_pe_ids)) & \
+                    (htable.organisation_id == otable.id) & \
+                    (htable.deleted != True) & \
+                    (ptable.id == htable.person_id)
+            for row in db(query).select(otable.pe_id, ptable.pe_id):
+                members.setdefault(row.org_organisation.pe_id,
+                                   []).append(row.pr_person.pe_id)
+
+        inserts = []
+        for row in rows:
+            outbox = row.msg_outbox
+            recipients = set()
+            for pe_id in members.get(outbox.pe_id, []):
+                if pe_id in recipients:
+                    continue
+                recipients.add(pe_id)
+                inserts.append(dict(message_id = outbox.message_id,
+                                    pe_id = pe_id,
+                                    pr_message_method = contact_method,
+                                    system_generated = True))
+        if inserts:
+            table.bulk_insert(inserts)
+
+        # Mark the group/organisation messages as processed
+        ids = [row.msg_outbox.id for row in rows]
+        message_ids = list(set([row.msg_outbox.message_id for row in rows]))
+        db(table.id.belongs(ids)).update(status=2)
+        db(ltable.id.belongs(message_ids)).update(actioned=True)
+        # Explicitly commit DB operations when running from Cron
+        db.commit()
+
+    # -------------------------------------------------------------------------
+    def __reject_unsupported(self, contact_method):
+        """
+            Mark the pending Outbox messages to entities which are neither
+            persons, groups nor organisations as invalid (status 4), as
+            they would never be sent
+
+            @param contact_method: the contact method
+        """
+
+        db = current.db
+        table = db.msg_outbox
         petable = db.pr_pentity
 
         query = (table.status == 1) & \
-                (table.pr_message_method == contact_method)
-        rows = db(query).select()
-        chainrun = False # Used to fire process_outbox again - Used when messages are sent to groups
+                (table.pr_message_method == contact_method) & \
+                (table.pe_id == petable.id) & \
+                (~(petable.instance_type.belongs(("pr_person",
+                                                  "pr_group",
+                                                  "org_organisation"))))
+        rows = db(query).select(table.id, petable.instance_type)
+        if not rows:
+            return
+
+        for row in rows:
+            s3_debug("s3msg",
+                     "Outbox message %s: can't send to %s" % \
+                     (row.msg_outbox.id, row.pr_pentity.instance_type))
+        ids = [row.msg_outbox.id for row in rows]
+        db(table.id.belongs(ids)).update(status=4)
+        # Explicitly commit DB operations when running from Cron
+        db.commit()
+
+    # -------------------------------------------------------------------------
+    def __get_sender(self, contact_method, outgoing_sms_handler=None):
+        """
+            Get the function to send a message via the given contact method,
+            with the gateway settings looked up once
+
+            @param contact_method: the contact method
+            @param outgoing_sms_handler: the SMS gateway (for SMS)
+
+            @returns: a Storage with:
+                        prepare - function to prepare the recipient address
+                        send - function (row_id, message_id, recipient,
+                               subject, message) => True if sent
+                        concurrent - whether send can run in several threads
+                        mail - whether each message counts towards mail.limit
+                      or None if there is no gateway for the method
+        """
+
+        db = current.db
+        mail = self.smtp or self.mail
+        sanitise = self.sanitise_phone
+        no_change = lambda recipient: recipient
+
+        if contact_method == "EMAIL":
+            send = lambda row_id, message_id, to, subject, message: \
+                          mail.send(to, subject, message)
+            return Storage(prepare=no_change, send=send,
+                           concurrent=True, mail=True)
+
+        elif contact_method == "SMS":
+            if outgoing_sms_handler == "WEB_API":
+                sms_api = self.__get_sms_api()
+                if not sms_api:
+                    return None
+                post = self.__post_sms_api
+                send = lambda row_id, message_id, mobile, subject, message: \
+                              post(sms_api, mobile, message)
+                return Storage(prepare=sanitise, send=send,
+                               concurrent=True, mail=False)
+
+            elif outgoing_sms_handler == "SMTP":
+                current.manager.load("msg_smtp_to_sms_settings")
+                table = db.msg_smtp_to_sms_settings
+                query = (table.enabled == True)
+                settings = db(query).select(limitby=(0, 1)).first()
+                if not settings:
+                    return None
+                address = settings.address
+                prepare = lambda mobile: "%s@%s" % (sanitise(mobile), address)
+                send = lambda row_id, message_id, to, subject, message: \
+                              mail.send(to, "", message)
+                return Storage(prepare=prepare, send=send,
+                               concurrent=True, mail=True)
+
+            elif outgoing_sms_handler == "MODEM":
+                send = lambda row_id, message_id, mobile, subject, message: \
+                              self.send_sms_via_modem(mobile, message)
+                return Storage(prepare=no_change, send=send,
+                               concurrent=False, mail=False)
+
+            elif outgoing_sms_handler == "TROPO":
+                # NB This does not mean the message is sent
+                send = lambda row_id, message_id, mobile, subject, message: \
+                              self.send_text_via_tropo(row_id,
+                                                       message_id,
+                                                       mobile,
+                                                       message)
+                return Storage(prepare=no_change, send=send,
+                               concurrent=False, mail=False)
+
+        elif contact_method == "TWITTER":
+            send = lambda row_id, message_id, recipient, subject, message: \
+                          self.send_text_via_twitter(recipient, message)
+            return Storage(prepare=no_change, send=send,
+                           concurrent=False, mail=False)
+
+        return None
+
+    # -------------------------------------------------------------------------
+    def __dispatch(self, rows, contact_method, sender, pool=None):
+        """
+            Send a batch of Outbox messages to persons
+
+            @param rows: the msg_outbox rows
+            @param contact_method: the contact method
+            @param sender: the sender, as returned by __get_sender()
+            @param pool: thread pool to send the messages concurrently
+        """
+
+        db = current.db
+        table = db.msg_outbox
+        ltable = db.msg_log
+        ctable = db.pr_contact
+
+        # Get the messages of the batch
+        message_ids = list(set([row.message_id for row in rows]))
+        query = (ltable.id.belongs(message_ids))
+        messages = dict([(r.id, r)
+                         for r in db(query).select(ltable.id,
+                                                   ltable.subject,
+                                                   ltable.message)])
+
+        # Get the contacts of the batch (first by priority)
+        contacts = {}
+        pe_ids = list(set([row.pe_id for row in rows if not row.address]))
+        if pe_ids:
+            query = (ctable.pe_id.belongs(pe_ids)) & \
+                    (ctable.contact_method == contact_method) & \
+                    (ctable.deleted == False)
+            for r in db(query).select(ctable.pe_id,
+                                      ctable.value,
+                                      orderby=ctable.priority):
+                if r.pe_id not in contacts:
+                    contacts[r.pe_id] = r.value
+
+        jobs = []
         for row in rows:
-            status = True
-            message_id = row.message_id
-            query = (ltable.id == message_id)
-            logrow = db(query).select(limitby=(0, 1)).first()
+            logrow = messages.get(row.message_id, None)
             if not logrow:
                 s3_debug("s3msg", "logrow not found")
                 continue
-            # Get message from msg_log
-            message = logrow.message
-            subject = logrow.subject
-            sender_pe_id = logrow.pe_id
-            # Determine list of users
-            entity = row.pe_id
-            query = petable.id == entity
-            entity_type = db(query).select(petable.instance_type,
-                                           limitby=(0, 1)).first()
-            if entity_type:
-                entity_type = entity_type.instance_type
-            else:
-                s3_debug("s3msg", "Entity type unknown")
-
-            if entity_type == "pr_group":
-                # Take the entities of it and add in the messaging queue - with
-                # sender as the original sender and marks group email processed
-                # Set system generated = True
-                table3 = db.pr_group
-                query = (table3.pe_id == entity)
-                group_id = db(query).select(table3.id,
-                                            limitby=(0, 1)).first().id
-                table4 = db.pr_group_membership
-                query = (table4.group_id == group_id)
-                recipients = db(query).select(table4.person_id)
-                for recipient in recipients:
-                    person_id = recipient.person_id
-                    query = (ptable.id == person_id)
-                    pe_id = db(query).select(ptable.pe_id,
-                                             limitby=(0, 1)).first().pe_id
-                    table.insert(message_id = message_id,
-                                 pe_id = pe_id,
-                                 pr_message_method = contact_method,
-                                 system_generated = True)
-                status = True
-                chainrun = True
-
-            elif entity_type == "org_organisation":
-                # Take the entities of it and add in the messaging queue - with
-                # sender as the original sender and marks group email processed
-                # Set system generated = True
-                table3 = db.org_organisation
-                query = (table3.pe_id == entity)
-                org_id = db(query).select(table3.id, limitby=(0, 1)).first().id
-                table4 = db.hrm_human_resource
-                query = (table4.organisation_id == org_id)
-                recipients = db(query).select(table4.person_id)
-                for recipient in recipients:
-                    person_id = recipient.person_id
-                    uery = (ptable.id == person_id)
-                    pe_id = db(query).select(ptable.pe_id,
-                                             limitby=(0, 1)).first().pe_id
-                    table.insert(message_id = message_id,
-                                 pe_id = pe_id,
-                                 pr_message_method = contact_method,
-                                 system_generated = True)
-                status = True
-                chainrun = True
-
-            if entity_type == "pr_person":
-                # Person
-                status = dispatch_to_pe_id(entity)
-
-            if status:
-                # Update status to sent in Outbox
-                db(table.id == row.id).update(status=2)
-                # Set message log to actioned
-                db(ltable.id == message_id).update(actioned=True)
-                # Explicitly commit DB operations when running from Cron
-                db.commit()
-
-        if chainrun :
-            self.process_outbox(contact_method)
+            recipient = row.address or contacts.get(row.pe_id, None)
+            if not recipient:
+                # No contact for this method => leave unsent
+                continue
+            jobs.append((row.id,
+                         row.message_id,
+                         sender.prepare(recipient),
+                         logrow.subject,
+                         logrow.message))
 
-        return
+        # Respect the daily mail limit
+        limit = current.deployment_settings.get_mail_limit()
+        if sender.mail and limit:
+            day = datetime.timedelta(hours=24)
+            cutoff = current.request.utcnow - day
+            query = (db.msg_limit.created_on > cutoff)
+            remaining = max(limit - db(query).count(), 0)
+            jobs = jobs[:remaining]
+        if not jobs:
+            return
 
+        send = lambda job: _send_job(sender.send, job)
+        if pool is not None:
+            results = pool.map(send, jobs)
+        else:
+            results = map(send, jobs)
+
+        # Record the results
+        sent = [job for (job, result) in zip(jobs, results) if result]
+        if sent:
+            db(table.id.belongs([job[0] for job in sent])).update(status=2)
+            message_ids = list(set([job[1] for job in sent]))
+            db(ltable.id.belongs(message_ids)).update(actioned=True)
+            if sender.mail and limit:
+                db.msg_limit.bulk_insert([{} for job in sent])
+        # Explicitly commit DB operations when running from Cron
+        db.commit()
 
     # -------------------------------------------------------------------------
     # Send Email
@@ -448,7 +697,8 @@ class S3Msg(object):
             # Log the sending
             table.insert()
 
-        result = self.mail.send(to,
+        transport = self.smtp or self.mail
+        result = transport.send(to,
                                 subject,
                                 message,
                                 attachments,
@@ -456,7 +706,7 @@ class S3Msg(object):
                                 bcc,
                                 reply_to,
                                 encoding
-                                )
+                               )
 
         return result
 
@@ -559,6 +809,23 @@ class S3Msg(object):
             Function to send SMS via Web API
         """
 
+        sms_api = self.__get_sms_api()
+        if not sms_api:
+            return False
+
+        mobile = self.sanitise_phone(mobile)
+
+        return self.__post_sms_api(sms_api, mobile, text)
+
+    # -------------------------------------------------------------------------
+    def __get_sms_api(self):
+        """
+            Get the configuration of the enabled SMS Web API
+
+            @returns: the msg_api_settings record, with the parsed
+                      parameters in post_config, or None
+        """
+
         db = current.db
         current.manager.load("msg_api_settings")
         table = db.msg_api_settings
@@ -567,7 +834,7 @@ class S3Msg(object):
         query = (table.enabled == True)
         sms_api = db(query).select(limitby=(0, 1)).first()
         if not sms_api:
-            return False
+            return None
 
         sms_api_post_config = {}
 
@@ -575,9 +842,23 @@ class S3Msg(object):
         for tmp_parameter in tmp_parameters:
             sms_api_post_config[tmp_parameter.split("=")[0]] = \
                                         tmp_parameter.split("=")[1]
+        sms_api.post_config = sms_api_post_config
 
-        mobile = self.sanitise_phone(mobile)
+        return sms_api
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __post_sms_api(sms_api, mobile, text=""):
+        """
+            Post an SMS to the Web API (without database access, so that
+            it can run in a worker thread)
 
+            @param sms_api: the configuration, as returned by __get_sms_api()
+            @param mobile: the (sanitised) mobile phone number
+            @param text: the message
+        """
+
+        sms_api_post_config = dict(sms_api.post_config)
         try:
             sms_api_post_config[sms_api.message_variable] = text
             sms_api_post_config[sms_api.to_variable] = str(mobile)
@@ -885,5 +1166,319 @@ class S3Msg(object):
 
         return True
 
+# =============================================================================
+class S3SMTPPool(object):
+    """
+        Mail transport keeping a small pool of open (and authenticated)
+        SMTP sessions, so that many messages can be sent through the same
+        session instead of connecting, starting TLS and logging in for
+        every message as gluon.tools.Mail does.
+
+        The send() method takes the same arguments as Mail.send(), and
+        can be called from several threads at once: each call takes an
+        idle session from the pool (or opens a new one, up to size), and
+        returns it after sending. Sessions which have been dropped by the
+        server are re-opened, and the message is sent again once.
+    """
+
+    # Pools by configuration, shared by all S3Msg instances of the process
+    pools = {}
+    lock = threading.Lock()
+
+    def __init__(self,
+                 server,
+                 sender,
+                 login=None,
+                 tls=False,
+                 size=2,
+                 max_messages=100,
+                 max_idle=30,
+                 timeout=30):
+        """
+            Constructor
+
+            @param server: the SMTP server as "host:port"
+            @param sender: the From address
+            @param login: the login as "username:password"
+            @param tls: whether to use STARTTLS
+            @param size: maximum number of open sessions
+            @param max_messages: number of messages after which a session
+                                 is closed and re-opened
+            @param max_idle: number of seconds after which an idle session
+                             is checked (NOOP) before it is used again
+            @param timeout: socket timeout in seconds
+        """
+
+        if ":" in server:
+            host, port = server.rsplit(":", 1)
+            self.host = host
+            self.port = int(port)
+        else:
+            self.host = server
+            self.port = 25
+        self.sender = sender
+        self.login = login
+        self.tls = tls
+        self.size = max(size, 1)
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self.timeout = timeout
+
+        self.idle = Queue.LifoQueue()
+        self.open = 0
+        self.counter = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, server, sender, login=None, tls=False, size=2):
+        """
+            Get the pool for a configuration (created on first use)
+
+            @param server: the SMTP server as "host:port"
+            @param sender: the From address
+            @param login: the login as "username:password"
+            @param tls: whether to use STARTTLS
+            @param size: maximum number of open sessions
+        """
+
+        key = (server, sender, login, tls, size)
+        cls.lock.acquire()
+        try:
+            pool = cls.pools.get(key, None)
+            if pool is None:
+                pool = cls(server, sender, login=login, tls=tls, size=size)
+                cls.pools[key] = pool
+        finally:
+            cls.lock.release()
+        return pool
+
+    # -------------------------------------------------------------------------
+    def send(self,
+             to,
+             subject="None",
+             message="None",
+             attachments=None,
+             cc=None,
+             bcc=None,
+             reply_to=None,
+             encoding="utf-8"):
+        """
+            Send an Email
+
+            @param to: the recipient address, or a list of addresses
+            @param subject: the subject
+            @param message: the message text, a HTML document, or a tuple
+                            (text, html)
+            @param attachments: list of gluon.tools.Mail.Attachment
+            @param cc: address or list of addresses to copy to
+            @param bcc: address or list of addresses to blind copy to
+            @param reply_to: the Reply-To address
+            @param encoding: the encoding of the message
+
+            @returns: True if the message has been accepted by the server
+        """
+
+        to = self.__addresses(to)
+        cc = self.__addresses(cc)
+        bcc = self.__addresses(bcc)
+        recipients = to + cc + bcc
+        if not recipients:
+            return False
+        payload = self.__message(to, subject, message,
+                                 attachments=attachments,
+                                 cc=cc,
+                                 reply_to=reply_to,
+                                 encoding=encoding).as_string()
+
+        for attempt in (0, 1):
+            try:
+                session = self.__acquire()
+            except (smtplib.SMTPException, socket.error), e:
+                s3_debug("S3SMTPPool", "Unable to connect: %s" % e)
+                return False
+            try:
+                session.sendmail(self.sender, recipients, payload)
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                # Dropped by the server => re-open and try again
+                self.__discard(session)
+                continue
+            except smtplib.SMTPException, e:
+                # Message refused: the session can be used further
+                s3_debug("S3SMTPPool", "Message refused: %s" % e)
+                try:
+                    session.rset()
+                except (smtplib.SMTPException, socket.error):
+                    self.__discard(session)
+                else:
+                    self.__release(session)
+                return False
+            session.messages += 1
+            self.__release(session)
+            return True
+        return False
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """ Close all idle sessions """
+
+        while True:
+            try:
+                session = self.idle.get_nowait()
+            except Queue.Empty:
+                break
+            self.__discard(session)
+
+    # -------------------------------------------------------------------------
+    def __acquire(self):
+        """ Take an idle session from the pool, or open a new one """
+
+        while True:
+            try:
+                session = self.idle.get_nowait()
+            except Queue.Empty:
+                self.counter.acquire()
+                try:
+                    if self.open < self.size:
+                        self.open += 1
+                        opening = True
+                    else:
+                        opening = False
+                finally:
+                    self.counter.release()
+                if opening:
+                    try:
+                        return self.__connect()
+                    except:
+                        self.__closed()
+                        raise
+                # Wait for a session to be released (or closed, so
+                # that a new one can be opened)
+                try:
+                    session = self.idle.get(timeout=1)
+                except Queue.Empty:
+                    continue
+
+            if time.time() - session.last_used > self.max_idle:
+                # Check that the server has not dropped the session
+                try:
+                    if session.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected
+                except (smtplib.SMTPException, socket.error):
+                    self.__discard(session)
+                    continue
+            return session
+
+    # -------------------------------------------------------------------------
+    def __release(self, session):
+        """ Return a session to the pool """
+
+        if session.messages >= self.max_messages:
+            self.__discard(session)
+        else:
+            session.last_used = time.time()
+            self.idle.put(session)
+
+    # -------------------------------------------------------------------------
+    def __discard(self, session):
+        """ Close a session and free its place in the pool """
+
+        try:
+            session.quit()
+        except:
+            try:
+                session.close()
+            except:
+                pass
+        self.__closed()
+
+    # -------------------------------------------------------------------------
+    def __closed(self):
+        """ Count a session as closed """
+
+        self.counter.acquire()
+        try:
+            self.open -= 1
+        finally:
+            self.counter.release()
+
+    # -------------------------------------------------------------------------
+    def __connect(self):
+        """ Open and authenticate a new session """
+
+        session = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.tls:
+            session.ehlo()
+            session.starttls()
+            session.ehlo()
+        if self.login:
+            username, password = self.login.split(":", 1)
+            session.login(username, password)
+        session.messages = 0
+        session.last_used = time.time()
+        return session
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __addresses(addresses):
+        """ Get a list of addresses """
+
+        if not addresses:
+            return []
+        elif isinstance(addresses, (list, tuple)):
+            return list(addresses)
+        else:
+            return [addresses]
+
+    # -------------------------------------------------------------------------
+    def __message(self,
+                  to,
+                  subject,
+                  message,
+                  attachments=None,
+                  cc=None,
+                  reply_to=None,
+                  encoding="utf-8"):
+        """ Build the MIME message """
+
+        def text(body, subtype):
+            if isinstance(body, unicode):
+                body = body.encode(encoding)
+            return MIMEText(body, subtype, encoding)
+
+        if isinstance(message, (list, tuple)):
+            body = MIMEMultipart("alternative")
+            plain, html = message
+            if plain:
+                body.attach(text(plain, "plain"))
+            if html:
+                body.attach(text(html, "html"))
+        else:
+            stripped = message.strip()
+            if stripped.startswith("<html") and stripped.endswith("</html>"):
+                body = text(message, "html")
+            else:
+                body = text(message, "plain")
+
+        if attachments:
+            payload = MIMEMultipart("mixed")
+            payload.attach(body)
+            for attachment in attachments:
+                payload.attach(attachment)
+        else:
+            payload = body
+
+        if isinstance(subject, str):
+            subject = subject.decode(encoding)
+        payload["Subject"] = Header(subject, encoding)
+        payload["From"] = self.sender
+        payload["To"] = ", ".join(to)
+        if cc:
+            payload["Cc"] = ", ".join(cc)
+        if reply_to:
+            payload["Reply-To"] = reply_to
+        payload["Date"] = formatdate(localtime=True)
+        payload["Message-Id"] = make_msgid()
+        return payload
+
 # END -------------------------------------------------------------------------
 
@@ -34,14 +34,18 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["S3PDF"]
+__all__ = ["S3PDF",
+           "S3OCRImageParser"]
 
 import re
 import os
 import sys
 import math
 import json
+import shutil
 import subprocess
+import multiprocessing
+import multiprocessing.dummy
 import unicodedata
 try:
     from cStringIO import StringIO    # Faster, where available
@@ -65,6 +69,7 @@ except ImportError:
 
 from s3method import S3Method
 from s3tools import S3DateTime
+from s3utils import s3_debug
 
 try:
     from PIL import Image
@@ -80,6 +85,12 @@ except(ImportError):
     except(ImportError):
         print >> sys.stderr, "S3 Debug: S3PDF: Python Image Library not installed"
         PILImported = False
+try:
+    import numpy
+    numpyImported = True
+except ImportError:
+    print >> sys.stderr, "S3 Debug: S3PDF: NumPy not installed"
+    numpyImported = False
 try:
     from reportlab.lib.enums import TA_CENTER, TA_RIGHT
     from reportlab.pdfbase import pdfmetrics
@@ -649,7 +660,19 @@ class S3PDF(S3Method):
                     table = db.ocr_data_xml
                     row = db(table.image_set_uuid == setuuid).select().first()
                     if not row:
-                        r.error(501, self.manager.ERROR.BAD_RECORD)
+                        # OCR still in progress?
+                        payloadtable = db.ocr_payload
+                        query = (payloadtable.image_set_uuid == setuuid)
+                        pages = db(query).count()
+                        if not pages:
+                            r.error(501, self.manager.ERROR.BAD_RECORD)
+                        error = S3OCRImageParser.error(setuuid)
+                        query &= (payloadtable.processed == True)
+                        processed = db(query).count()
+                        return response.render("_ocr_progress.html",
+                                               dict(pages=pages,
+                                                    processed=processed,
+                                                    error=error))
 
                     data_file = open(os.path.join(r.folder,
                                                   "uploads",
@@ -991,17 +1014,26 @@ class S3PDF(S3Method):
                 else:
                     r.error(501, self.ERROR.INVALID_IMAGE_TYPE)
 
-                # OCR it
-                s3ocrimageparser = S3OCRImageParser(self, r)
-                output = s3ocrimageparser.parse(formuuid, setuuid)
-
-                table = db.ocr_data_xml
-                table.insert(image_set_uuid=setuuid,
-                             data_file=table["data_file"].store(
-                                                    StringIO(output),
-                                                    "%s-data.xml" % setuuid),
-                             form_uuid=formuuid,
-                             )
+                # OCR it (asynchronously if there is a worker alive)
+                is_component = len(r.resource.components) == 1
+                timeout = 300 + S3OCRImageParser.TIMEOUT_PER_PAGE * numpages
+                s3task = current.s3task
+                task = False
+                if s3task._is_alive():
+                    task = s3task.async("ocr_parse",
+                                        args=[str(formuuid),
+                                              str(setuuid),
+                                              int(is_component)],
+                                        timeout=timeout)
+                if task is False:
+                    # No worker alive or task not available => run it
+                    # in this request (in threads: don't fork the web
+                    # server)
+                    s3ocrimageparser = S3OCRImageParser(self, r)
+                    s3ocrimageparser.process(formuuid,
+                                             setuuid,
+                                             is_component=is_component,
+                                             threads=True)
 
                 if r.component:
                     request_args = current.request.get("args", ["", ""])
@@ -3011,6 +3043,15 @@ class S3PDFDataSource:
         """
 
         manager = current.manager
+        # Look up the labels of all rows at once
+        records = self.records
+        if records:
+            if self.report_groupby != None:
+                manager.prefetch_represent(self.report_groupby,
+                                           records=records)
+            for field in self.fields:
+                if field.field:
+                    manager.prefetch_represent(field.field, records=records)
         # Build the data list
         data = []
         currentGroup = None
@@ -3937,6 +3978,45 @@ cast2ascii = lambda m: m if isinstance(m, str) else\
                                     "ignore")
 
 
+# =============================================================================
+# OCR worker functions (run in the pool of S3OCRImageParser.parse)
+
+def _ocr_transform_page(source, target):
+    """
+        Transform a scanned page
+
+        @param source: path of the scanned page image
+        @param target: path to save the transformed (binary) page to
+
+        @returns: dict with the markers, orientation and scalefactor
+                  of the page
+    """
+
+    page = S3OCRImageParser.transformPage(Image.open(source))
+    page.pop("image").save(target)
+    return page
+
+def _ocr_tesseract(inputpath, outputpath):
+    """
+        Read a text box with tesseract
+
+        @param inputpath: path of the text box image
+        @param outputpath: path for the tesseract output (without .txt)
+
+        @returns: the text, or None if tesseract failed
+    """
+
+    success = subprocess.call(["tesseract", inputpath, outputpath])
+    if success != 0:
+        return None
+    outputpath = "%s.txt" % outputpath
+    outputfile = open(outputpath)
+    outputtext = outputfile.read()
+    outputfile.close()
+    os.remove(outputpath)
+    os.remove(inputpath)
+    return outputtext.replace("\n", " ")
+
 # =============================================================================
 # S3OCRImageParser
 
@@ -3945,73 +4025,226 @@ class S3OCRImageParser(object):
         Image Parsing and OCR Utility
     """
 
-    def __init__(self, s3method, r):
-        """ Instialise it with environment variables and functions """
+    # Seconds the OCR task may take per page (for the task timeout)
+    TIMEOUT_PER_PAGE = 120
+
+    def __init__(self, s3method, r=None):
+        """
+            Instialise it with environment variables and functions
+
+            @param s3method: the S3PDF method handler (if run in a request)
+            @param r: the S3Request (if run in a request), None if
+                      run as a task
+        """
 
         self.r = r
         self.request = current.request
-        checkDependencies(r)
+        self.folder = current.request.folder
+        if r is not None:
+            checkDependencies(r)
+        elif not PILImported:
+            self.__error(current.T("PIL (Python Image Library) not installed"))
+        if not numpyImported:
+            self.__error(current.T("NumPy not installed"))
+
+    def __error(self, message):
+        """ Abort with an error (raised as HTTP 501) """
+
+        if self.r is not None:
+            self.r.error(501, message)
+        else:
+            raise HTTP(501, message)
+
+    def process(self, form_uuid, set_uuid, is_component=None, threads=False):
+        """
+            Perform OCR on a given set of pages and store the resulting
+            S3XML for review (this can be run as task, see models/ocr.py)
 
-    def parse(self, form_uuid, set_uuid, **kwargs):
-        """ performs OCR on a given set of pages """
+            @param form_uuid: the UUID of the OCR form
+            @param set_uuid: the UUID of the set of uploaded pages
+            @param is_component: whether the form is for a component
+                                 (None to determine from the request)
+            @param threads: use threads instead of processes for OCR
 
-        raw_images = {}
-        images = {}
+            @returns: the S3XML, or None if the OCR failed (the error
+                      is then stored in ocr_payload.error, see error())
+        """
+
+        db = current.db
+        # Keep the uploaded pages if the OCR fails (rollback)
+        db.commit()
+        try:
+            output = self.parse(form_uuid,
+                                set_uuid,
+                                is_component=is_component,
+                                threads=threads)
+        except HTTP:
+            raise
+        except Exception, e:
+            db.rollback()
+            message = "%s: %s" % (e.__class__.__name__, e)
+            s3_debug("OCR of %s failed" % set_uuid, message)
+            table = db.ocr_payload
+            db(table.image_set_uuid == set_uuid).update(error=message)
+            db.commit()
+            return None
+
+        table = db.ocr_data_xml
+        table.insert(image_set_uuid=set_uuid,
+                     data_file=table["data_file"].store(
+                                            StringIO(output),
+                                            "%s-data.xml" % set_uuid),
+                     form_uuid=form_uuid,
+                     )
+        return output
+
+    @staticmethod
+    def error(set_uuid):
+        """
+            The error of a failed OCR of a set of pages
+
+            @param set_uuid: the UUID of the set of uploaded pages
+
+            @returns: the error message, or None if the OCR has not
+                      failed (yet)
+        """
+
+        db = current.db
+
+        table = db.ocr_payload
+        query = (table.image_set_uuid == set_uuid) & \
+                (table.error != None)
+        row = db(query).select(table.error, limitby=(0, 1)).first()
+        if row:
+            return row.error
+
+        # Task killed by the scheduler (e.g. timeout)?
+        if "scheduler_task" in db.tables:
+            ttable = db.scheduler_task
+            query = (ttable.function_name == "ocr_parse") & \
+                    (ttable.args.contains(set_uuid)) & \
+                    (ttable.status.belongs(["FAILED", "TIMEOUT", "EXPIRED"]))
+            row = db(query).select(ttable.status,
+                                   orderby=~ttable.id,
+                                   limitby=(0, 1)).first()
+            if row:
+                return "OCR task %s" % row.status
+        return None
+
+    def parse(self,
+              form_uuid,
+              set_uuid,
+              is_component=None,
+              threads=False,
+              **kwargs):
+        """
+            Performs OCR on a given set of pages: the pages are transformed
+            and the text boxes read by tesseract in a pool of worker
+            processes (see get_pdf_ocr_processes), and the progress is
+            recorded per page in ocr_payload.processed
+
+            @param form_uuid: the UUID of the OCR form
+            @param set_uuid: the UUID of the set of uploaded pages
+            @param is_component: whether the form is for a component
+                                 (None to determine from the request)
+            @param threads: use threads instead of processes, e.g. when
+                            running inside the web server
+        """
 
         self.set_uuid = set_uuid
         db = current.db
-        T = current.T
-        request = self.request
 
         # Get metadata of the form
         metatable = "ocr_meta"
         query = (db[metatable]["form_uuid"] == form_uuid)
         row = db(query).select(limitby=(0, 1)).first()
-        revision = row["revision"]
         resourcename = row["resource_name"]
         layoutfilename = row["layout_file"]
         pages = int(row["pages"])
-        is_component = True if len(self.r.resource.components) == 1 else False
+        if is_component is None:
+            is_component = len(self.r.resource.components) == 1
+
+        # Temporary files of this set
+        self.temp_dir = os.path.join(self.folder,
+                                     "uploads",
+                                     "ocr_temp",
+                                     str(set_uuid))
+        try:
+            os.makedirs(self.temp_dir)
+        except(OSError):
+            pass
+
+        processes = current.deployment_settings.get_pdf_ocr_processes()
+        if threads or processes == 1:
+            # Don't fork (e.g. when running inside the web server)
+            self.pool = multiprocessing.dummy.Pool(processes or None)
+        else:
+            try:
+                self.pool = multiprocessing.Pool(processes or None)
+            except AssertionError:
+                # Daemonic processes (like scheduler workers) can not
+                # have children => use threads instead (tesseract runs
+                # in separate processes anyway)
+                self.pool = multiprocessing.dummy.Pool(processes or None)
 
-        # Open each page
+        try:
+            output = self.__parse(form_uuid,
+                                  resourcename,
+                                  layoutfilename,
+                                  pages,
+                                  is_component)
+        finally:
+            self.pool.close()
+            self.pool.join()
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+        return output
+
+    def __parse(self,
+                form_uuid,
+                resourcename,
+                layoutfilename,
+                pages,
+                is_component):
+        """ performs OCR on a given set of pages (see parse) """
+
+        images = {}
+
+        set_uuid = self.set_uuid
+        db = current.db
+        T = current.T
+        pool = self.pool
+        payloadtable = db.ocr_payload
+
+        # Transform the pages in the pool
+        transformed = {}
         for eachpage in xrange(1, pages+1):
-            payloadtable = "ocr_payload"
-            row =\
-                db((db[payloadtable]["image_set_uuid"]==set_uuid) &\
-                       (db[payloadtable]["page_number"]==eachpage)
-                   ).select().first()
-
-            pageimagefile = row["image_file"]
-            raw_images[eachpage] =\
-                Image.open(os.path.join(self.r.folder,
-                                        "uploads",
-                                        "ocr_payload",
-                                        pageimagefile))
-
-        # Transform each image
-        for each_img_index in raw_images.keys():
-            _debug("Transforming Page %s/%s" % (each_img_index,
-                                                pages))
-            images[each_img_index] = {}
-            images[each_img_index]["image"] =\
-                self.__convertImage2binary(raw_images[each_img_index])
-            images[each_img_index]["markers"] =\
-                self.__getMarkers(images[each_img_index]["image"])
-            images[each_img_index]["orientation"] =\
-                self.__getOrientation(images[each_img_index]["markers"])
-            if images[each_img_index]["orientation"] != 0.0:
-                images[each_img_index]["image"] =\
-                    images[each_img_index]["image"].rotate(images[each_img_index]["orientation"])
-                images[each_img_index]["markers"] =\
-                    self.__getMarkers(images[each_img_index]["image"])
-                images[each_img_index]["orientation"] =\
-                    self.__getOrientation(images[each_img_index]["markers"])
-
-            images[each_img_index]["scalefactor"] =\
-                self.__scaleFactor(images[each_img_index]["markers"])
+            query = (payloadtable.image_set_uuid == set_uuid) & \
+                    (payloadtable.page_number == eachpage)
+            row = db(query).select(payloadtable.image_file,
+                                   limitby=(0, 1)).first()
+            if not row:
+                continue
+            source = os.path.join(self.folder,
+                                  "uploads",
+                                  "ocr_payload",
+                                  row.image_file)
+            target = os.path.join(self.temp_dir, "page-%s.png" % eachpage)
+            transformed[eachpage] = (target,
+                                     pool.apply_async(_ocr_transform_page,
+                                                      (source, target)))
+
+        for eachpage in sorted(transformed):
+            _debug("Transforming Page %s/%s" % (eachpage, pages))
+            target, result = transformed[eachpage]
+            page = result.get()
+            image = Image.open(target)
+            image.load()
+            page["image"] = image
+            images[eachpage] = page
 
         # Get layout file, convert it to etree
-        layout_file = open(os.path.join(self.r.folder,
+        layout_file = open(os.path.join(self.folder,
                                         "uploads",
                                         "ocr_meta",
                                         layoutfilename),
@@ -4020,6 +4253,40 @@ class S3OCRImageParser(object):
         layout_file.close()
         layout_etree = etree.fromstring(layout_xml)
 
+        # Read all text boxes in the pool
+        self.ocr_results = {}
+        pagejobs = dict((page, []) for page in images)
+        for eachresource in layout_etree:
+            resource_table = eachresource.attrib.get("name")
+            for eachfield in eachresource:
+                field_name = eachfield.attrib.get("name", None)
+                comp_count = 1
+                for eachcomponent in eachfield:
+                    if eachcomponent.tag != "textbox":
+                        break
+                    comp_page, crop_box = self.__textboxCrop(images,
+                                                             eachcomponent)
+                    inputpath = os.path.join(self.temp_dir,
+                                             "%s_%s_%s.tif" % (resource_table,
+                                                               field_name,
+                                                               comp_count))
+                    images[comp_page]["image"].crop(crop_box).save(inputpath)
+                    result = pool.apply_async(_ocr_tesseract,
+                                              (inputpath, inputpath[:-4]))
+                    key = (resource_table, field_name, comp_count)
+                    self.ocr_results[key] = result
+                    pagejobs[comp_page].append(result)
+                    comp_count += 1
+
+        # Report the progress per page
+        for eachpage in sorted(pagejobs):
+            for result in pagejobs[eachpage]:
+                result.wait()
+            query = (payloadtable.image_set_uuid == set_uuid) & \
+                    (payloadtable.page_number == eachpage)
+            db(query).update(processed=True)
+            db.commit()
+
         # Data etree
         s3xml_root_etree = etree.Element("s3xml")
         parent_resource_exist = False
@@ -4097,8 +4364,7 @@ class S3OCRImageParser(object):
                                  try:
                                     page_origin = images[comp_page]["markers"]
                                  except(KeyError):
-                                     self.r.error(501,
-                                                  T("insufficient number of pages provided"))
+                                     self.__error(T("insufficient number of pages provided"))
                                  crop_box = (
                                      int(page_origin[0][0]+\
                                              (comp_x*\
@@ -4117,7 +4383,6 @@ class S3OCRImageParser(object):
                                                   images[comp_page]["scalefactor"]["y"])+\
                                              comp_radius*images[comp_page]["scalefactor"]["y"]),
                                      )
-                                 temp_image = images[comp_page]["image"].crop(crop_box)
                                  cropped_image = images[comp_page]["image"].crop(crop_box)
                                  result = self.__ocrIt(cropped_image,
                                                        form_uuid,
@@ -4156,33 +4421,9 @@ class S3OCRImageParser(object):
                                 OCRedValues = {}
                                 comp_count = 1
                                 for eachcomponent in components:
-                                    comp_x = float(eachcomponent.attrib.get("x"))
-                                    comp_y = float(eachcomponent.attrib.get("y"))
-                                    comp_boxes = int(eachcomponent.attrib.get("boxes"))
-                                    comp_side = float(eachcomponent.attrib.get("side"))
-                                    comp_page = int(eachcomponent.attrib.get("page"))
                                     comp_meta = str(eachcomponent.text)
-                                    try:
-                                        page_origin = images[comp_page]["markers"]
-                                    except(KeyError):
-                                        self.r.error(501,
-                                                     T("insufficient number of pages provided"))
-                                    crop_box = (
-                                        int(page_origin[0][0]+\
-                                                (comp_x*\
-                                                     images[comp_page]["scalefactor"]["x"])),
-                                        int(page_origin[0][1]+\
-                                                (comp_y*\
-                                                     images[comp_page]["scalefactor"]["y"])),
-                                        int(page_origin[0][0]+\
-                                                (comp_x*\
-                                                     images[comp_page]["scalefactor"]["x"])+\
-                                                comp_side*comp_boxes*images[comp_page]["scalefactor"]["x"]),
-                                        int(page_origin[0][1]+\
-                                                (comp_y*\
-                                                     images[comp_page]["scalefactor"]["y"])+\
-                                                comp_side*images[comp_page]["scalefactor"]["y"]),
-                                        )
+                                    comp_page, crop_box =\
+                                        self.__textboxCrop(images, eachcomponent)
                                     cropped_image = images[comp_page]["image"].crop(crop_box)
                                     output = self.__ocrIt(cropped_image,
                                                           form_uuid,
@@ -4266,33 +4507,9 @@ class S3OCRImageParser(object):
                                 ocrText = ""
                                 comp_count = 1
                                 for eachcomponent in components:
-                                    comp_x = float(eachcomponent.attrib.get("x"))
-                                    comp_y = float(eachcomponent.attrib.get("y"))
-                                    comp_boxes = int(eachcomponent.attrib.get("boxes"))
-                                    comp_side = float(eachcomponent.attrib.get("side"))
-                                    comp_page = int(eachcomponent.attrib.get("page"))
                                     comp_meta = str(eachcomponent.text)
-                                    try:
-                                        page_origin = images[comp_page]["markers"]
-                                    except(KeyError):
-                                        self.r.error(501,
-                                                     T("insufficient number of pages provided"))
-                                    crop_box = (
-                                        int(page_origin[0][0]+\
-                                                (comp_x*\
-                                                     images[comp_page]["scalefactor"]["x"])),
-                                        int(page_origin[0][1]+\
-                                                (comp_y*\
-                                                     images[comp_page]["scalefactor"]["y"])),
-                                        int(page_origin[0][0]+\
-                                                (comp_x*\
-                                                     images[comp_page]["scalefactor"]["x"])+\
-                                                comp_side*comp_boxes*images[comp_page]["scalefactor"]["x"]),
-                                        int(page_origin[0][1]+\
-                                                (comp_y*\
-                                                     images[comp_page]["scalefactor"]["y"])+\
-                                                comp_side*images[comp_page]["scalefactor"]["y"]),
-                                        )
+                                    comp_page, crop_box =\
+                                        self.__textboxCrop(images, eachcomponent)
                                     cropped_image = images[comp_page]["image"].crop(crop_box)
                                     output = self.__ocrIt(cropped_image,
                                                           form_uuid,
@@ -4385,7 +4602,11 @@ class S3OCRImageParser(object):
                 linenum,
                 content_type="textbox",
                 **kwargs):
-        """ put Tesseract to work, actual OCRing will be done here """
+        """
+            Store the crop of a field and return its content: whether
+            an option box is checked, or the text of a text box (as read
+            by tesseract in the pool, see __parse)
+        """
 
         db = current.db
         ocr_field_crops = "ocr_field_crops"
@@ -4399,17 +4620,8 @@ class S3OCRImageParser(object):
                                              form_uuid,
                                              resourcename,
                                              linenum)
-        outputfilename = "%s_%s_%s_%s_text" % (uniqueuuid,
-                                               form_uuid,
-                                               resourcename,
-                                               linenum)
-
-        ocr_temp_dir = os.path.join(self.r.folder, "uploads", "ocr_temp")
 
-        try:
-            os.mkdir(ocr_temp_dir)
-        except(OSError):
-            pass
+        ocr_temp_dir = self.temp_dir
 
         if content_type == "optionbox":
             field_value = kwargs.get("field_value")
@@ -4426,9 +4638,8 @@ class S3OCRImageParser(object):
             imgfile.close()
             os.remove(imgpath)
 
-            stat = ImageStat.Stat(image)
             #print resource_table, field_name, field_value
-            if stat.mean[0] < 96 :
+            if numpy.asarray(image).mean() < 96:
                 return True
             else:
                 return None
@@ -4436,20 +4647,11 @@ class S3OCRImageParser(object):
         elif content_type == "textbox":
             field_seq = kwargs.get("field_seq")
 
-            inputpath = os.path.join(ocr_temp_dir, inputfilename)
-            image.save(inputpath)
-
-            success =\
-                subprocess.call(["tesseract", inputpath,
-                                 os.path.join(ocr_temp_dir, outputfilename)])
-            if success != 0:
-                self.r.error(501, ERROR.TESSERACT_ERROR)
-            outputpath = os.path.join(ocr_temp_dir, "%s.txt" % outputfilename)
-            outputfile = open(outputpath)
-            outputtext = outputfile.read()
-            outputfile.close()
-            output = outputtext.replace("\n", " ")
-            os.remove(outputpath)
+            output = self.ocr_results[(resource_table,
+                                       field_name,
+                                       field_seq)].get()
+            if output is None:
+                self.__error(current.T("%(app)s not installed. Ask the Server Administrator to install on Server.") % dict(app="Tesseract 3.01"))
             imgfilename = "%s.png" % inputfilename[:-3]
             imgpath = os.path.join(ocr_temp_dir, imgfilename)
             image.save(imgpath)
@@ -4462,110 +4664,184 @@ class S3OCRImageParser(object):
                                        sequence=field_seq)
             imgfile.close()
             os.remove(imgpath)
-            os.remove(inputpath)
 
             #print resource_table, field_name, field_seq
 
-            try:
-                os.rmdir(ocr_temp_dir)
-            except(OSError):
-                import shutil
-                shutil.rmtree(ocr_temp_dir)
             return output
 
-    def __convertImage2binary(self, image, threshold = 180):
-        """ Converts the image into binary based on a threshold. here it is 180"""
-        image = ImageOps.grayscale(image)
-        image.convert("L")
+    def __textboxCrop(self, images, component):
+        """
+            Get the crop box of a text box on its (transformed) page
 
-        width, height = image.size
+            @param images: the transformed pages {page number: page}
+            @param component: the textbox element of the layout
 
-        for x in xrange(width):
-            for y in xrange(height):
-                if image.getpixel((x,y)) < 180 :
-                    image.putpixel((x,y), 0)
-                else:
-                    image.putpixel((x,y), 255)
-        return image
+            @returns: tuple (page number, crop box)
+        """
 
-    def __findRegions(self, im):
+        comp_x = float(component.attrib.get("x"))
+        comp_y = float(component.attrib.get("y"))
+        comp_boxes = int(component.attrib.get("boxes"))
+        comp_side = float(component.attrib.get("side"))
+        comp_page = int(component.attrib.get("page"))
+        try:
+            page = images[comp_page]
+        except(KeyError):
+            self.__error(current.T("insufficient number of pages provided"))
+        page_origin = page["markers"]
+        scalefactor = page["scalefactor"]
+        crop_box = (
+            int(page_origin[0][0]+\
+                    (comp_x*scalefactor["x"])),
+            int(page_origin[0][1]+\
+                    (comp_y*scalefactor["y"])),
+            int(page_origin[0][0]+\
+                    (comp_x*scalefactor["x"])+\
+                    comp_side*comp_boxes*scalefactor["x"]),
+            int(page_origin[0][1]+\
+                    (comp_y*scalefactor["y"])+\
+                    comp_side*scalefactor["y"]),
+            )
+        return comp_page, crop_box
+
+    @staticmethod
+    def transformPage(image):
         """
-        Return the list of regions which are found by the following algorithm.
-
-        -----------------------------------------------------------
-        Raster Scanning Algorithm for Connected Component Analysis:
-        -----------------------------------------------------------
-
-        On the first pass:
-        =================
-        1. Iterate through each element of the data by column, then by row (Raster Scanning)
-        2. If the element is not the background
-            1. Get the neighboring elements of the current element
-            2. If there are no neighbors, uniquely label the current element and continue
-            3. Otherwise, find the neighbor with the smallest label and assign it to the current element
-            4. Store the equivalence between neighboring labels
-
-        On the second pass:
-        ===================
-        1. Iterate through each element of the data by column, then by row
-        2. If the element is not the background
-           1. Relabel the element with the lowest equivalent label
-        ( source: http://en.wikipedia.org/wiki/Connected_Component_Labeling )
+            Binarise a scanned page, find its markers and correct the
+            orientation
+
+            @param image: the scanned page (PIL Image)
+
+            @returns: dict with the binary "image" (PIL Image) and the
+                      "markers", "orientation" and "scalefactor" of the page
         """
 
-        width, height  = im.size
-        ImageOps.grayscale(im)
-        im = im.convert("L")
-
-        regions = {}
-        pixel_region = [[0 for y in xrange(height)] for x in xrange(width)]
-        equivalences = {}
-        n_regions = 0
-
-        #first pass. find regions.
-        for x in xrange(width):
-            for y in xrange(height):
-                #look for a black pixel
-                if im.getpixel((x, y)) == 0 : #BLACK
-                    # get the region number from north or west or create new region
-                    region_n = pixel_region[x-1][y] if x > 0 else 0
-                    region_w = pixel_region[x][y-1] if y > 0 else 0
-                    #region_nw = pixel_region[x-1][y-1] if x > 0 and y > 0 else 0
-                    #region_ne = pixel_region[x-1][y+1] if x > 0 else 0
-
-                    max_region = max(region_n, region_w)
-
-                    if max_region > 0:
-                        #a neighbour already has a region, new region is the smallest > 0
-                        new_region = min(filter(lambda i: i > 0, (region_n, region_w)))
-                        #update equivalences
-                        if max_region > new_region:
-                            if max_region in equivalences:
-                                equivalences[max_region].add(new_region)
-                            else:
-                                equivalences[max_region] = set((new_region, ))
-                    else:
-                        n_regions += 1
-                        new_region = n_regions
+        parser = S3OCRImageParser
 
-                    pixel_region[x][y] = new_region
+        binary = parser.convertImage2binary(image)
+        markers = parser.getMarkers(binary)
+        orientation = parser.__getOrientation(markers)
+        image = Image.fromarray(binary)
+        if orientation != 0.0:
+            image = image.rotate(orientation)
+            markers = parser.getMarkers(numpy.asarray(image))
+            orientation = parser.__getOrientation(markers)
 
-        #Scan image again, assigning all equivalent regions the same region value.
-        for x in xrange(width):
-            for y in xrange(height):
-                r = pixel_region[x][y]
-                if r > 0:
-                    while r in equivalences:
-                        r = min(equivalences[r])
+        return {"image": image,
+                "markers": markers,
+                "orientation": orientation,
+                "scalefactor": parser.__scaleFactor(markers)}
 
-                    if r in regions:
-                        regions[r].add(x, y)
-                    else:
-                        regions[r] = self.__Region(x, y)
+    @staticmethod
+    def convertImage2binary(image, threshold=180):
+        """
+            Converts the image into binary based on a threshold
+
+            @param image: the image (PIL Image)
+            @param threshold: the grey level below which pixels turn black
 
-        return list(regions.itervalues())
+            @returns: the binary image as array of rows (0=black, 255=white)
+        """
+
+        pixels = numpy.asarray(ImageOps.grayscale(image))
+        binary = numpy.where(pixels < threshold, 0, 255)
+        return binary.astype(numpy.uint8)
+
+    @staticmethod
+    def findRegions(binary):
+        """
+            Find the regions of connected black pixels in a binary image
+            (4-connectivity):
 
-    def __getOrientation(self, markers):
+            1. Find all horizontal runs of black pixels in each row
+            2. Link the runs which touch each other in adjacent rows
+            3. Merge the linked runs into regions (union-find over an array
+               of parent run numbers, hooking the higher root to the lower
+               one and then flattening all paths, until no link is left
+               between different regions)
+
+            @param binary: the binary image as array of rows (0=black)
+
+            @returns: Storage of arrays with the area and the bounding box
+                      (min_x, max_x, min_y, max_y) of each region
+        """
+
+        black = (numpy.asarray(binary) == 0)
+        height, width = black.shape
+
+        # Horizontal runs: row, first column and last column + 1
+        edges = numpy.zeros((height, width + 2), dtype=numpy.int8)
+        edges[:, 1:-1] = black
+        edges = numpy.diff(edges, axis=1)
+        rows, starts = numpy.nonzero(edges == 1)
+        ends = numpy.nonzero(edges == -1)[1]
+        del edges
+
+        n = len(starts)
+        if not n:
+            empty = numpy.zeros(0, dtype=int)
+            return Storage(area=empty,
+                           min_x=empty, max_x=empty,
+                           min_y=empty, max_y=empty)
+
+        # Run number (1..n) of each black pixel
+        runs = numpy.zeros(height * width, dtype=numpy.int32)
+        runs[rows * width + starts] = 1
+        runs = numpy.cumsum(runs, dtype=numpy.int32).reshape(height, width)
+        runs *= black
+
+        # Links between runs touching each other in adjacent rows
+        upper = runs[:-1]
+        lower = runs[1:]
+        linked = (upper > 0) & (lower > 0)
+        links = numpy.unique(upper[linked].astype(numpy.int64) * (n + 1) +
+                             lower[linked])
+        del runs, upper, lower, linked
+        a = links // (n + 1)
+        b = links % (n + 1)
+
+        # Union-find
+        parent = numpy.arange(n + 1)
+        while len(a):
+            root_a = parent[a]
+            root_b = parent[b]
+            open_links = root_a != root_b
+            if not open_links.any():
+                break
+            a = a[open_links]
+            b = b[open_links]
+            root_a = root_a[open_links]
+            root_b = root_b[open_links]
+            numpy.minimum.at(parent,
+                             numpy.maximum(root_a, root_b),
+                             numpy.minimum(root_a, root_b))
+            while True:
+                grandparent = parent[parent]
+                if (grandparent == parent).all():
+                    break
+                parent = grandparent
+
+        # Area and bounding box of each region
+        index = numpy.unique(parent[1:], return_inverse=True)[1]
+        count = index.max() + 1
+        area = numpy.bincount(index, weights=ends - starts).astype(int)
+        min_x = numpy.empty(count, dtype=int)
+        min_x.fill(width)
+        numpy.minimum.at(min_x, index, starts)
+        max_x = numpy.zeros(count, dtype=int)
+        numpy.maximum.at(max_x, index, ends - 1)
+        min_y = numpy.empty(count, dtype=int)
+        min_y.fill(height)
+        numpy.minimum.at(min_y, index, rows)
+        max_y = numpy.zeros(count, dtype=int)
+        numpy.maximum.at(max_y, index, rows)
+
+        return Storage(area=area,
+                       min_x=min_x, max_x=max_x,
+                       min_y=min_y, max_y=max_y)
+
+    @staticmethod
+    def __getOrientation(markers):
         """ Returns orientation of the sheet in radians """
         x1, y1 = markers[0]
         x2, y2 = markers[2]
@@ -4575,35 +4851,46 @@ class S3OCRImageParser(object):
             slope = 999999999999999999999999999
         return math.atan(slope)*(180.0/math.pi)*(-1)
 
-    def __scaleFactor(self, markers):
+    @staticmethod
+    def __scaleFactor(markers):
         """ Returns the scale factors lengthwise and breadthwise """
         stdWidth = sum((596, -60))
         stdHeight = sum((842, -60))
         li = [markers[0], markers[2]]
-        sf_y = self.__distance(li)/stdHeight
+        sf_y = S3OCRImageParser.__distance(li)/stdHeight
         li = [markers[6], markers[2]]
-        sf_x = self.__distance(li)/stdWidth
+        sf_x = S3OCRImageParser.__distance(li)/stdWidth
         return {"x":sf_x, "y":sf_y}
 
-    def __distance(self, li):
+    @staticmethod
+    def __distance(li):
         """ returns the euclidean distance if the input is of the form [(x1, y1), (x2, y2)]"""
         return math.sqrt(math.fsum((math.pow(math.fsum((int(li[1][0]), -int(li[0][0]))), 2), math.pow(math.fsum((int(li[1][1]), -int(li[0][1]))), 2))))
 
+    @staticmethod
+    def getMarkers(binary):
+        """
+            Gets the markers on the OCR image
+
+            @param binary: the binary image as array of rows (0=black)
 
-    def __getMarkers(self, image):
-        """ Gets the markers on the OCR image """
-        centers = {}
-        present = 0
+            @returns: list of the (x, y) centers of the markers
+        """
 
-        regions = self.__findRegions(image)
+        regions = S3OCRImageParser.findRegions(binary)
 
-        for r in regions:
-            if r.area > 320 and r.aspectratio() < 1.5 and r.aspectratio() > 0.67:
-                present += 1
-                centers[present] = r.centroid()
+        # Markers are large, roughly square regions
+        width = regions.max_x - regions.min_x
+        length = regions.max_y - regions.min_y
+        candidates = (regions.area > 320) & (length > 0)
+        aspectratio = width[candidates] / length[candidates].astype(float)
+        select = numpy.flatnonzero(candidates)[(aspectratio < 1.5) &
+                                               (aspectratio > 0.67)]
+        center_x = (regions.min_x[select] + regions.max_x[select]) // 2
+        center_y = (regions.min_y[select] + regions.max_y[select]) // 2
 
         # This is the list of all the markers on the form.
-        markers = list(centers.itervalues())
+        markers = zip(center_x.tolist(), center_y.tolist())
         markers.sort()
         l1 = sorted(markers[0:3], key=lambda y: y[1])
         l2 = markers[3:4]
@@ -4616,39 +4903,5 @@ class S3OCRImageParser(object):
         #_debug(markers)
         return markers
 
-    class __Region():
-        """ Self explainatory """
-        def __init__(self, x, y):
-            """ Initialize the region """
-            self._pixels = [(x, y)]
-            self._min_x = x
-            self._max_x = x
-            self._min_y = y
-            self._max_y = y
-            self.area = 1
-
-        def add(self, x, y):
-            """ Add a pixel to the region """
-            self._pixels.append((x, y))
-            self.area += 1
-            self._min_x = min(self._min_x, x)
-            self._max_x = max(self._max_x, x)
-            self._min_y = min(self._min_y, y)
-            self._max_y = max(self._max_y, y)
-
-        def centroid(self):
-            """ Returns the centroid of the bounding box """
-            return ((self._min_x + self._max_x)/2 , (self._min_y + self._max_y)/2)
-
-        def box(self):
-            """ Returns the bounding box of the region """
-            return [ (self._min_x, self._min_y) , (self._max_x, self._max_y)]
-
-        def aspectratio(self):
-            """ Calculating the aspect ratio of the region """
-            width = self._max_x - self._min_x
-            length = self._max_y - self._min_y
-            return float(width)/float(length)
-
 # end S3OCRImageParser
 # END =========================================================================
@@ -38,11 +38,14 @@
 __all__ = ["S3RequestManager",
            "S3Request",
            "S3QueryBuilder",
-           "S3Resource"]
+           "S3Resource",
+           "S3RepresentCache"]
 
 import sys
 import datetime
+import tempfile
 import time
+import threading
 try:
     from cStringIO import StringIO    # Faster, where available
 except:
@@ -61,7 +64,7 @@ from gluon.tools import callback
 import gluon.contrib.simplejson as json
 
 from s3validators import IS_ONE_OF
-from s3xml import S3XML
+from s3xml import S3XML, S3XMLWriter
 from s3model import S3Model, S3RecordLinker
 from s3export import S3Exporter
 from s3method import S3Method
@@ -142,6 +145,13 @@ class S3RequestManager(object):
         self.show_urls = True
         self.show_ids = False
 
+        # Use bulk mode for imports (see S3ImportJob)
+        self.bulk_import = False
+
+        # Import CSV files uploaded for direct import in chunks of this
+        # many rows (see S3Importer), None to import them in one job
+        self.import_chunk_size = None
+
         # Errors
         self.error = None
 
@@ -150,6 +160,9 @@ class S3RequestManager(object):
         self.auth = current.auth
         self.gis = current.gis
 
+        # Representation cache
+        self.represent_cache = S3RepresentCache.get_instance()
+
         # Helpers
         self.query_builder = S3QueryBuilder(self)
 
@@ -361,7 +374,6 @@ class S3RequestManager(object):
         """
 
         NONE = str(current.T("None")).decode("utf-8")
-        cache = current.cache
         fname = field.name
 
         # Get the value
@@ -388,15 +400,16 @@ class S3RequestManager(object):
 
         # Get text representation
         if field.represent:
-            try:
-                key = "%s_repr_%s" % (field, val)
-                unicode(key)
-            except (UnicodeEncodeError, UnicodeDecodeError):
+            cache = self.represent_cache
+            text = cache.get(field, val)
+            if text is None:
                 text = field.represent(val)
-            else:
-                text = str(cache.ram(key,
-                                     lambda: field.represent(val),
-                                     time_expire=5))
+                try:
+                    text = str(text)
+                except (UnicodeEncodeError, UnicodeDecodeError):
+                    pass
+                else:
+                    cache.set(field, val, text)
         else:
             if val is None:
                 text = NONE
@@ -440,6 +453,67 @@ class S3RequestManager(object):
 
         return text
 
+    # -------------------------------------------------------------------------
+    def prefetch_represent(self, field, values=None, records=None):
+        """
+            Look up the labels for all values of a field with a single
+            call of the batch form of its represent function, and store
+            them in the representation cache (so that subsequent calls
+            of represent() for these values do not query the database)
+
+            A represent function declares its batch form as attribute
+            "bulk", which must be a function taking a list of values
+            and returning a dict {value: label}; values missing in the
+            dict will be represented one by one as before.
+
+            @param field: the Field
+            @param values: list of values
+            @param records: records to collect the values from (instead
+                            of values)
+        """
+
+        represent = field.represent
+        bulk = getattr(represent, "bulk", None)
+        if bulk is None:
+            return
+        if str(field.type) in ("string", "text", "list:string"):
+            # Values get XML-escaped before representation
+            return
+
+        if records is not None:
+            tablename = field.tablename
+            fname = field.name
+            values = []
+            for record in records:
+                if tablename in record and \
+                   isinstance(record[tablename], Row):
+                    values.append(record[tablename][fname])
+                elif fname in record:
+                    values.append(record[fname])
+        if not values:
+            return
+
+        cache = self.represent_cache
+        missing = set()
+        for v in values:
+            if v is None or isinstance(v, (list, tuple)):
+                continue
+            if v not in missing and cache.get(field, v) is None:
+                missing.add(v)
+        if not missing:
+            return
+
+        labels = bulk(list(missing))
+        for v in missing:
+            if v in labels:
+                text = labels[v]
+                try:
+                    text = str(text)
+                except (UnicodeEncodeError, UnicodeDecodeError):
+                    continue
+                cache.set(field, v, text)
+        return
+
     # -------------------------------------------------------------------------
     def original(self, table, record):
         """
@@ -564,6 +638,9 @@ class S3Request(object):
         self.XSLT_PATH = "static/formats"
         self.XSLT_EXTENSION = "xsl"
 
+        # Formats which can be exported without XSLT (streaming export)
+        self.STREAM_FORMATS = ("xml", "s3json")
+
         # Attached files
         self.files = Storage()
 
@@ -1243,6 +1320,20 @@ class S3Request(object):
             default = "text/xml"
         headers["Content-Type"] = content_type.get(representation, default)
 
+        # Streaming export (only for formats without transformation)
+        stream = _vars.get("stream", None)
+        if stream and str(stream).lower() == "true" and \
+           representation in r.STREAM_FORMATS and "transform" not in r.vars:
+            chunks = resource.export_chunks(start=start,
+                                            limit=limit,
+                                            msince=msince,
+                                            marker=marker,
+                                            dereference=True,
+                                            mcomponents=mcomponents,
+                                            rcomponents=rcomponents,
+                                            as_json=as_json)
+            return r.stream_chunks(chunks)
+
         # Export the resource
         output = resource.export_xml(start=start,
                                      limit=limit,
@@ -1260,6 +1351,47 @@ class S3Request(object):
 
         return output
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def stream_chunks(chunks):
+        """
+            Stream a generated response body: the chunks are generated
+            while web2py sends the response, i.e. after web2py has
+            committed the DB connection of the request and returned it
+            to the connection pool. The generator therefore reads through
+            a dedicated cursor on the connection captured here, while
+            commit and recycling of the connection are left to web2py.
+            Without a connection pool, web2py closes the connection
+            before sending the response, so the output gets spooled to
+            a temporary file and streamed from there instead.
+
+            @param chunks: the body generator (e.g. export_chunks)
+
+            @returns: the response body
+        """
+
+        adapter = current.db._adapter
+        connection = adapter.connection
+
+        if not adapter.pool_size or connection is None:
+            spool = tempfile.TemporaryFile()
+            for chunk in chunks:
+                spool.write(chunk)
+            spool.seek(0)
+            return current.response.stream(spool)
+
+        def body():
+            cursor = connection.cursor()
+            adapter.connection = connection
+            adapter.cursor = cursor
+            try:
+                for chunk in chunks:
+                    if chunk:
+                        yield chunk
+            finally:
+                cursor.close()
+        return body()
+
     # -------------------------------------------------------------------------
     @staticmethod
     def put_tree(r, **attr):
@@ -2382,6 +2514,8 @@ class S3Resource(object):
         API for resources
     """
 
+    EXPORT_CHUNK_SIZE = 500 # records per chunk in export_stream
+
     # -------------------------------------------------------------------------
     # Constructor
     # -------------------------------------------------------------------------
@@ -3375,23 +3509,13 @@ class S3Resource(object):
         # Load slice
         self.load(start=start, limit=limit)
 
+        # Resolve all references of the slice in bulk
+        xml.clear_references()
+        xml.prefetch_references(table, self, rfields)
+
         # See if we're being called as a GIS Feature Layer
-        popup_fields = None
-        popup_label = None
-        if "layer" in current.request.vars:
-            layer_id = current.request.vars.layer
-            db = current.db
-            ltable = db.gis_layer_feature
-            query = (ltable.id == layer_id)
-            layer = db(query).select(ltable.popup_label,
-                                     ltable.popup_fields,
-                                     limitby=(0, 1)).first()
-            if layer:
-                popup_label = layer.popup_label
-                popup_fields = layer.popup_fields
-            else:
-                popup_label = ""
-                popup_fields = "name"
+        popup_label, popup_fields = self.__layer_popup()
+        xml.prefetch_popups(table, self, popup_fields)
 
         # Build the tree
         root = etree.Element(xml.TAG.root)
@@ -3451,6 +3575,7 @@ class S3Resource(object):
                     url = "/%s/%s" % (prefix, name)
                 rfields, dfields = rresource.split_fields(skip=skip)
                 rresource.load()
+                xml.prefetch_references(table, rresource, rfields)
                 for record in rresource:
                     element = rresource.__export_resource(
                                             record,
@@ -3478,6 +3603,298 @@ class S3Resource(object):
                         start=start,
                         limit=limit)
 
+    # -------------------------------------------------------------------------
+    def export_stream(self, stream, **attr):
+        """
+            Export the resource as S3XML (or native JSON) incrementally
+            to an output stream (see export_chunks)
+
+            @param stream: the output stream (file-like object)
+            @param attr: the export parameters (see export_chunks)
+
+            @returns: the number of matching records
+        """
+
+        for chunk in self.export_chunks(**attr):
+            stream.write(chunk)
+        return self.count()
+
+    # -------------------------------------------------------------------------
+    def export_chunks(self,
+                      start=None,
+                      limit=None,
+                      skip=[],
+                      msince=None,
+                      marker=None,
+                      dereference=True,
+                      mcomponents=None,
+                      rcomponents=None,
+                      as_json=False,
+                      pretty_print=False,
+                      chunk_size=None):
+        """
+            Export the resource as S3XML (or native JSON) incrementally:
+            records are loaded in chunks, and the output for each chunk
+            is yielded as soon as it has been built, so that memory use
+            does not grow with the number of records, and the output can
+            be sent while the export is still running.
+
+            No XSLT transformation can be applied to the output, and the
+            "results" attribute is the number of matching records (which
+            can include records which are skipped due to msince).
+
+            @param start: index of the first record to export
+            @param limit: maximum number of records to export
+            @param skip: list of fieldnames to skip
+            @param msince: minimum modification date of the records
+            @param marker: URL of the default marker
+            @param dereference: also export referenced records
+            @param mcomponents: components of the master resource to
+                                include (list of tablenames), empty list
+                                for all
+            @param rcomponents: components of referenced resources to
+                                include (list of tablenames), empty list
+                                for all
+            @param as_json: write native JSON instead of XML
+            @param pretty_print: insert newlines/indentation in the output
+            @param chunk_size: number of records to load at a time
+
+            @returns: a generator of strings (the output of each chunk)
+        """
+
+        db = current.db
+        manager = self.manager
+        xml = manager.xml
+
+        if chunk_size is None:
+            chunk_size = self.EXPORT_CHUNK_SIZE
+
+        if manager.show_urls:
+            base_url = manager.s3.base_url
+        else:
+            base_url = None
+
+        # Filter for MCI>=0 (setting)
+        table = self.table
+        if xml.filter_mci and "mci" in table.fields:
+            mci_filter = (table.mci >= 0)
+            self.add_filter(mci_filter)
+
+        # Total number of results
+        results = self.count()
+
+        # See if we're being called as a GIS Feature Layer
+        popup_label, popup_fields = self.__layer_popup()
+
+        # Write the document header
+        root = xml.tree(None,
+                        root=etree.Element(xml.TAG.root),
+                        domain=manager.domain,
+                        url=base_url,
+                        results=results,
+                        start=start,
+                        limit=limit).getroot()
+        root.set(xml.ATTRIBUTE.success, json.dumps(results > 0))
+        writer = S3XMLWriter(StringIO(), root,
+                             as_json=as_json,
+                             pretty_print=pretty_print)
+        def flush():
+            output = writer.stream.getvalue()
+            writer.stream = StringIO()
+            return output
+        writer.open(self.tablename)
+        yield flush()
+
+        export_map = Storage()
+        pending = Storage()
+
+        # Export the master records, chunk by chunk (keyset pagination)
+        query = self.get_query()
+        pkey = table._id
+        limitby = self.limitby(start=start, limit=limit)
+        if limitby:
+            offset, remaining = limitby[0], limitby[1] - limitby[0]
+        else:
+            offset, remaining = 0, None
+        last_id = None
+        while remaining is None or remaining > 0:
+            if remaining is not None:
+                size = min(chunk_size, remaining)
+            else:
+                size = chunk_size
+            if last_id is None:
+                rows = db(query).select(pkey,
+                                        orderby=pkey,
+                                        limitby=(offset, offset + size))
+            else:
+                rows = db(query & (pkey > last_id)).select(pkey,
+                                                           orderby=pkey,
+                                                           limitby=(0, size))
+            ids = [row[pkey.name] for row in rows]
+            if not ids:
+                break
+            last_id = ids[-1]
+            if remaining is not None:
+                remaining -= len(ids)
+
+            resource = manager.define_resource(self.prefix, self.name,
+                                               id=ids,
+                                               vars=self.vars,
+                                               include_deleted=self.include_deleted)
+            # Retain the component filters
+            for alias in resource.components:
+                if alias in self.components:
+                    component = resource.components[alias]
+                    component.filter = self.components[alias].filter
+            resource.__export_chunk(writer,
+                                    base_url=base_url,
+                                    export_map=export_map,
+                                    pending=pending,
+                                    components=mcomponents,
+                                    skip=skip,
+                                    msince=msince,
+                                    marker=marker,
+                                    popup_label=popup_label,
+                                    popup_fields=popup_fields)
+            yield flush()
+
+        # Export referenced records, chunk by chunk
+        depth = dereference and manager.MAX_DEPTH or 0
+        while pending and depth:
+            depth -= 1
+            load_map = pending
+            pending = Storage()
+            for tablename in load_map:
+                exported = export_map.get(tablename, set())
+                ids = [i for i in load_map[tablename] if i not in exported]
+                prefix, name = tablename.split("_", 1)
+                for i in xrange(0, len(ids), chunk_size):
+                    rresource = manager.define_resource(prefix, name,
+                                                        id=ids[i:i+chunk_size],
+                                                        components=[])
+                    rresource.__export_chunk(writer,
+                                             base_url=base_url,
+                                             export_map=export_map,
+                                             pending=pending,
+                                             components=rcomponents,
+                                             skip=skip,
+                                             msince=msince,
+                                             marker=marker,
+                                             ref=True)
+                    yield flush()
+
+        # Write the document trailer
+        writer.close()
+        yield flush()
+
+    # -------------------------------------------------------------------------
+    def __export_chunk(self, writer,
+                       base_url=None,
+                       export_map=None,
+                       pending=None,
+                       components=None,
+                       skip=[],
+                       msince=None,
+                       marker=None,
+                       popup_label=None,
+                       popup_fields=None,
+                       ref=False):
+        """
+            Load all records of this resource and write them to an
+            incremental S3XML writer (helper for export_stream)
+
+            @param writer: the S3XMLWriter
+            @param base_url: the base URL of the resource
+            @param export_map: the export map of the request
+            @param pending: dict of sets of record IDs per table name,
+                            to be updated with the IDs of all referenced
+                            records which have not yet been exported
+            @param components: list of components to include
+                               (tablenames)
+            @param skip: fields to skip
+            @param msince: the minimum update datetime for exported records
+            @param marker: the GIS default marker URL
+            @param popup_label: the popup label for GIS encoding
+            @param popup_fields: the popup fields for GIS encoding
+            @param ref: mark the elements as referenced elements
+        """
+
+        xml = self.manager.xml
+        tablename = self.tablename
+
+        rfields, dfields = self.split_fields(skip=skip)
+        self.load()
+
+        # The reference cache is only needed for this chunk
+        xml.clear_references()
+        xml.prefetch_references(self.table, self, rfields)
+        xml.prefetch_popups(self.table, self, popup_fields)
+
+        reference_map = []
+        for record in self:
+            element = self.__export_resource(record,
+                                             rfields=rfields,
+                                             dfields=dfields,
+                                             base_url=base_url,
+                                             reference_map=reference_map,
+                                             export_map=export_map,
+                                             components=components,
+                                             skip=skip,
+                                             msince=msince,
+                                             marker=marker,
+                                             popup_label=popup_label,
+                                             popup_fields=popup_fields)
+            if element is not None:
+                if ref:
+                    # Mark as referenced element (for XSLT)
+                    element.set(xml.ATTRIBUTE.ref, "True")
+                writer.write(tablename, element)
+
+        # Collect the references
+        for r in reference_map:
+            if "table" in r and "id" in r:
+                tname = r["table"]
+                ids = r["id"]
+                if not isinstance(ids, list):
+                    ids = [ids]
+                exported = export_map.get(tname, ())
+                ids = [i for i in ids if i not in exported]
+                if not ids:
+                    continue
+                if tname in pending:
+                    pending[tname].update(ids)
+                else:
+                    pending[tname] = set(ids)
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __layer_popup():
+        """
+            Get the popup label and popup fields if the resource is
+            being requested as a GIS Feature Layer
+
+            @returns: tuple (popup_label, popup_fields)
+        """
+
+        popup_fields = None
+        popup_label = None
+        if "layer" in current.request.vars:
+            layer_id = current.request.vars.layer
+            db = current.db
+            ltable = db.gis_layer_feature
+            query = (ltable.id == layer_id)
+            layer = db(query).select(ltable.popup_label,
+                                     ltable.popup_fields,
+                                     limitby=(0, 1)).first()
+            if layer:
+                popup_label = layer.popup_label
+                popup_fields = layer.popup_fields
+            else:
+                popup_label = ""
+                popup_fields = "name"
+        return (popup_label, popup_fields)
+
     # -------------------------------------------------------------------------
     def __export_resource(self,
                           record,
@@ -3561,6 +3978,7 @@ class S3Resource(object):
                 # Load records if necessary
                 if component._rows is None:
                     component.load()
+                    xml.prefetch_references(ctable, component, crfields)
 
                 # Construct the component base URL
                 if record_url:
@@ -3694,9 +4112,9 @@ class S3Resource(object):
         if rmap:
             reference_map.extend(rmap)
         if export_map.get(self.tablename, None):
-            export_map[self.tablename].append(record.id)
+            export_map[self.tablename].add(record.id)
         else:
-            export_map[self.tablename] = [record.id]
+            export_map[self.tablename] = set([record.id])
         return
 
     # -------------------------------------------------------------------------
@@ -3717,6 +4135,9 @@ class S3Resource(object):
                    conflict_policy=None,
                    last_sync=None,
                    onconflict=None,
+                   bulk=None,
+                   chunk_size=None,
+                   progress=None,
                    **args):
         """
             XML Importer
@@ -3738,6 +4159,15 @@ class S3Resource(object):
             @param conflict_policy: policy for conflict resolution (sync)
             @param last_sync: last synchronization datetime (sync)
             @param onconflict: callback hook for conflict resolution (sync)
+            @param bulk: use bulk mode for the import job (default: as
+                         configured in manager.bulk_import)
+            @param chunk_size: for CSV imports, import and commit the source
+                               in chunks of this many rows (e.g. as
+                               configured in manager.import_chunk_size),
+                               only applies if commit_job is True; None
+                               to import (and commit) the source at once
+            @param progress: for chunked imports, callback to report the
+                             progress after each chunk (see import_chunked)
             @param args: parameters to pass to the transformation stylesheet
         """
 
@@ -3747,6 +4177,9 @@ class S3Resource(object):
 
         tree = None
 
+        chunked = format == "csv" and chunk_size and \
+                  commit_job and not job_id and not id
+
         self.job = None
 
         # Check permission for the resource
@@ -3772,6 +4205,22 @@ class S3Resource(object):
                         name=name,
                         utcnow=utcnow)
 
+        if chunked:
+            success = self.import_chunked(source, chunk_size,
+                                          stylesheet=stylesheet,
+                                          extra_data=extra_data,
+                                          ignore_errors=ignore_errors,
+                                          strategy=strategy,
+                                          update_policy=update_policy,
+                                          conflict_policy=conflict_policy,
+                                          last_sync=last_sync,
+                                          onconflict=onconflict,
+                                          bulk=bulk,
+                                          progress=progress,
+                                          **args)
+
+        elif not job_id:
+
             # Build import tree
             if not isinstance(source, (list, tuple)):
                 source = [source]
@@ -3817,16 +4266,18 @@ class S3Resource(object):
             # job ID given
             pass
 
-        success = self.import_tree(id, tree,
-                                   ignore_errors=ignore_errors,
-                                   job_id=job_id,
-                                   commit_job=commit_job,
-                                   delete_job=delete_job,
-                                   strategy=strategy,
-                                   update_policy=update_policy,
-                                   conflict_policy=conflict_policy,
-                                   last_sync=last_sync,
-                                   onconflict=onconflict)
+        if not chunked:
+            success = self.import_tree(id, tree,
+                                       ignore_errors=ignore_errors,
+                                       job_id=job_id,
+                                       commit_job=commit_job,
+                                       delete_job=delete_job,
+                                       strategy=strategy,
+                                       update_policy=update_policy,
+                                       conflict_policy=conflict_policy,
+                                       last_sync=last_sync,
+                                       onconflict=onconflict,
+                                       bulk=bulk)
 
         self.files = Storage()
 
@@ -3848,6 +4299,135 @@ class S3Resource(object):
             return xml.json_message(False, 400,
                                     message=self.error, tree=tree)
 
+    # -------------------------------------------------------------------------
+    def import_chunked(self, source, chunk_size,
+                       stylesheet=None,
+                       extra_data=None,
+                       ignore_errors=False,
+                       strategy=None,
+                       update_policy=None,
+                       conflict_policy=None,
+                       last_sync=None,
+                       onconflict=None,
+                       bulk=None,
+                       progress=None,
+                       **args):
+        """
+            Import CSV sources in chunks: reads chunk_size rows at a time,
+            transforms them and imports and commits them as a separate job,
+            so that neither the CSV tree nor the S3XML tree of the whole
+            source have to be held in memory. The UID directory is carried
+            over from one job to the next, so that references to records
+            from earlier chunks (by TUID) still resolve.
+
+            @param source: the CSV source(s), as in import_xml
+            @param chunk_size: the maximum number of rows per chunk
+            @param stylesheet: stylesheet to use for transformation
+            @param extra_data: dict of extra cols to add to each row
+            @param ignore_errors: skip invalid records silently
+            @param strategy: tuple of allowed import methods (create/update/delete)
+            @param update_policy: policy for updates (sync)
+            @param conflict_policy: policy for conflict resolution (sync)
+            @param last_sync: last synchronization datetime (sync)
+            @param onconflict: callback hook for conflict resolution (sync)
+            @param bulk: use bulk mode for the import jobs
+            @param progress: callback function to report the progress,
+                             called after every chunk (before the commit)
+                             with a Storage of chunk (number), rows (CSV
+                             rows so far), imported, errors and ignored
+                             (records of this resource so far)
+            @param args: parameters to pass to the transformation stylesheet
+
+            @returns: True if successful, otherwise False (the chunk
+                      with the error is not committed, but all previous
+                      chunks are)
+        """
+
+        db = current.db
+        xml = self.manager.xml
+        tablename = self.tablename
+
+        directory = Storage()
+        status = Storage(chunk=0, rows=0, imported=0, errors=0, ignored=0)
+        error = None
+        error_tree = None
+
+        if not isinstance(source, (list, tuple)):
+            source = [source]
+        for item in source:
+            if isinstance(item, (list, tuple)):
+                resourcename, s = item[:2]
+            else:
+                resourcename, s = None, item
+            trees = xml.csv2trees(s,
+                                  resourcename=resourcename,
+                                  extra_data=extra_data,
+                                  chunk_size=chunk_size)
+            for t in trees:
+                rows = len(t.getroot())
+                if not rows:
+                    continue
+                if stylesheet is not None:
+                    t = xml.transform(t, stylesheet, **args)
+                    if not t:
+                        raise SyntaxError(xml.error)
+                tree = t.getroot()
+                del t
+                total = len(xml.select_resources(tree, tablename))
+
+                success = self.import_tree(None, tree,
+                                           ignore_errors=ignore_errors,
+                                           strategy=strategy,
+                                           update_policy=update_policy,
+                                           conflict_policy=conflict_policy,
+                                           last_sync=last_sync,
+                                           onconflict=onconflict,
+                                           bulk=bulk,
+                                           directory=directory)
+                del tree
+
+                # Items skipped without error (e.g. by strategy or policy)
+                ignored = 0
+                if self.job is not None:
+                    for item in self.job.items.values():
+                        if item.tablename == tablename and \
+                           item.skip and not item.error:
+                            ignored += 1
+                    self.job = None
+
+                # Collect the errors of all chunks
+                errors = 0
+                if self.error:
+                    error = self.error
+                if self.error_tree is not None:
+                    expr = "%s[@%s='%s']" % (xml.TAG.resource,
+                                             xml.ATTRIBUTE.name,
+                                             tablename)
+                    errors = len(self.error_tree.findall(expr))
+                    if error_tree is None:
+                        error_tree = self.error_tree
+                    else:
+                        error_tree.extend(list(self.error_tree))
+
+                if not success:
+                    db.rollback()
+                    self.error = error
+                    self.error_tree = error_tree
+                    return False
+
+                status.chunk += 1
+                status.rows += rows
+                status.imported += max(total - errors - ignored, 0)
+                status.errors += errors
+                status.ignored += ignored
+                if progress is not None:
+                    progress(status)
+                db.commit()
+
+        self.error = error
+        self.error_tree = error_tree
+        return True
+
     # -------------------------------------------------------------------------
     def import_tree(self, id, tree,
                     job_id=None,
@@ -3858,7 +4438,9 @@ class S3Resource(object):
                     update_policy=None,
                     conflict_policy=None,
                     last_sync=None,
-                    onconflict=None):
+                    onconflict=None,
+                    bulk=None,
+                    directory=None):
         """
             Import data from an S3XML element tree.
 
@@ -3869,6 +4451,11 @@ class S3Resource(object):
             @param job_id: restore a job from the job table (ID or UID)
             @param delete_job: delete the import job from the job table
             @param commit_job: commit the job (default)
+            @param bulk: use bulk mode for the import job (default: as
+                         configured in manager.bulk_import)
+            @param directory: UID directory to carry over from one job to
+                              the next (chunked imports, see import_chunked),
+                              only used when creating a new job
 
             @todo: update for link table support
         """
@@ -3881,6 +4468,9 @@ class S3Resource(object):
         tablename = self.tablename
         table = self.table
 
+        if bulk is None:
+            bulk = manager.bulk_import
+
         if job_id is not None:
 
             # Restore a job from the job table
@@ -3893,7 +4483,8 @@ class S3Resource(object):
                                          update_policy=update_policy,
                                          conflict_policy=conflict_policy,
                                          last_sync=last_sync,
-                                         onconflict=onconflict)
+                                         onconflict=onconflict,
+                                         bulk=bulk)
             except:
                 self.error = self.ERROR.BAD_SOURCE
                 return False
@@ -3963,6 +4554,12 @@ class S3Resource(object):
 
             # Select the elements for this table
             elements = xml.select_resources(tree, tablename)
+            if directory:
+                # Skip elements committed in a previous chunk
+                TUID = xml.ATTRIBUTE.tuid
+                elements = [e for e in elements
+                            if (tablename, TUID, e.get(TUID, None))
+                               not in directory]
             if not elements:
                 # nothing to import => still ok
                 return True
@@ -4002,7 +4599,9 @@ class S3Resource(object):
                                      update_policy=update_policy,
                                      conflict_policy=conflict_policy,
                                      last_sync=last_sync,
-                                     onconflict=onconflict)
+                                     onconflict=onconflict,
+                                     bulk=bulk,
+                                     directory=directory)
             for element in elements:
                 success = import_job.add_item(element=element,
                                               components=self.components)
@@ -4027,6 +4626,10 @@ class S3Resource(object):
             # Remove the job when committed
             if job_id is not None:
                 import_job.delete()
+            elif directory is not None:
+                import_job.compact_directory()
+                # Keep the job for import_chunked to count its items
+                self.job = import_job
 
         return self.error is None or ignore_errors
 
@@ -4406,3 +5009,214 @@ class S3Resource(object):
         return link_id
 
 # =============================================================================
+
+class S3RepresentCache(object):
+    """
+        Size-bounded LRU cache for field representations, shared by all
+        requests in the process. Labels are held per (tablename,
+        fieldname, represent function, language) and value - a field
+        whose represent gets overridden (e.g. in a prep hook) does not
+        share labels with the model default. The labels of reference
+        fields (and of the id field) are dropped whenever the record
+        they represent gets created, updated or deleted in this process
+        (see invalidate). Labels depending on other records, or on
+        writes in other processes, are only refreshed after the TTL.
+    """
+
+    SIZE = 20000    # max number of labels
+    TTL = 30        # max age of a label (seconds), bounds the staleness
+                    # of labels of records updated in other processes
+
+    instance = None
+    lock = threading.RLock()
+
+    # -------------------------------------------------------------------------
+    def __init__(self, size=None, ttl=None):
+        """
+            Constructor
+
+            @param size: max number of labels
+            @param ttl: max age of a label in seconds
+        """
+
+        self.size = size or self.SIZE
+        self.ttl = ttl or self.TTL
+
+        # key -> [prev, next, key, label, timestamp, record]
+        self.entries = {}
+        root = self.root = []
+        root[:] = [root, root, None, None, None, None]
+
+        # (ktablename, record ID) -> set of keys of labels representing it
+        self.records = {}
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get_instance(cls):
+        """
+            Get the process-wide instance of the cache
+        """
+
+        if cls.instance is None:
+            cls.lock.acquire()
+            try:
+                if cls.instance is None:
+                    cls.instance = cls()
+            finally:
+                cls.lock.release()
+        return cls.instance
+
+    # -------------------------------------------------------------------------
+    def key(self, field, value):
+        """
+            Get the cache key for a field value
+
+            @param field: the Field
+            @param value: the value
+
+            @returns: the key, or None if the value can not be cached
+        """
+
+        try:
+            hash(value)
+        except TypeError:
+            return None
+        language = current.T.accepted_language
+        return (field.tablename, field.name, field.represent, language, value)
+
+    # -------------------------------------------------------------------------
+    def get(self, field, value):
+        """
+            Look up the label of a field value, moves the entry to
+            the front of the LRU list
+
+            @param field: the Field
+            @param value: the value
+
+            @returns: the label, or None if not cached
+        """
+
+        key = self.key(field, value)
+        if key is None:
+            return None
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            if time.time() - entry[4] > self.ttl:
+                self.__unlink(key)
+                return None
+            # Move to front
+            prev, next = entry[0], entry[1]
+            prev[1] = next
+            next[0] = prev
+            root = self.root
+            last = root[0]
+            last[1] = root[0] = entry
+            entry[0], entry[1] = last, root
+            return entry[3]
+        finally:
+            self.lock.release()
+
+    # -------------------------------------------------------------------------
+    def set(self, field, value, label):
+        """
+            Store the label of a field value, drops the least recently
+            used entries if the cache is full
+
+            @param field: the Field
+            @param value: the value
+            @param label: the label
+        """
+
+        key = self.key(field, value)
+        if key is None:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self.__unlink(key)
+            ftype = str(field.type)
+            if ftype[:10] == "reference ":
+                record = (ftype[10:], value)
+            elif ftype == "id":
+                record = (field.tablename, value)
+            else:
+                record = None
+            if record:
+                if record in self.records:
+                    self.records[record].add(key)
+                else:
+                    self.records[record] = set([key])
+
+            root = self.root
+            last = root[0]
+            entry = [last, root, key, label, time.time(), record]
+            last[1] = root[0] = self.entries[key] = entry
+
+            while len(self.entries) > self.size:
+                self.__unlink(root[1][2])
+        finally:
+            self.lock.release()
+
+    # -------------------------------------------------------------------------
+    def invalidate(self, tablename, record_id):
+        """
+            Drop the labels of a record, i.e. of its id and all
+            references to it
+
+            @param tablename: the name of the referenced table
+            @param record_id: the record ID
+        """
+
+        self.lock.acquire()
+        try:
+            keys = self.records.get((tablename, record_id), None)
+            if keys:
+                for key in list(keys):
+                    self.__unlink(key)
+        finally:
+            self.lock.release()
+
+    # -------------------------------------------------------------------------
+    def clear(self):
+        """
+            Drop all labels
+        """
+
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.records = {}
+            root = self.root
+            root[:] = [root, root, None, None, None, None]
+        finally:
+            self.lock.release()
+
+    # -------------------------------------------------------------------------
+    def __unlink(self, key):
+        """
+            Remove an entry (caller must hold the lock)
+
+            @param key: the cache key
+        """
+
+        entry = self.entries.pop(key)
+        prev, next = entry[0], entry[1]
+        prev[1] = next
+        next[0] = prev
+
+        record = entry[5]
+        if record:
+            keys = self.records[record]
+            keys.discard(key)
+            if not keys:
+                del self.records[record]
+
+    # -------------------------------------------------------------------------
+    def __len__(self):
+
+        return len(self.entries)
+
+# =============================================================================
@@ -34,10 +34,15 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import os
 import re
+import time
+import threading
 import gluon.contrib.simplejson as jsonlib
 import cPickle
 
+from array import array
+
 from gluon.storage import Storage
 from gluon import *
 from gluon.serializers import json
@@ -57,7 +62,8 @@ __all__ = ["S3SearchWidget",
            "S3LocationSearch",
            "S3OrganisationSearch",
            "S3PersonSearch",
-           "S3PentitySearch"]
+           "S3PentitySearch",
+           "S3TextIndex"]
 
 MAX_RESULTS = 1000
 MAX_SEARCH_RESULTS = 200
@@ -1737,6 +1743,113 @@ class S3Search(S3CRUD):
 
         return output
 
+    # -------------------------------------------------------------------------
+    def _index_search(self, index, clauses, key, query=None, limit=None):
+        """
+            Search with a text index (see S3TextIndex), and filter the
+            ranked matches by the resource query
+
+            @param index: the S3TextIndex
+            @param clauses: the search clauses (see S3TextIndex.search)
+            @param key: the primary key of the indexed table
+            @param query: additional filter query
+            @param limit: maximum number of results (None for all)
+
+            @returns: list of the matching record IDs, ranked
+        """
+
+        db = current.db
+
+        q = self.resource.get_query()
+        if query is not None:
+            q &= query
+        ids = index.search(clauses, query=q)
+        if limit is None:
+            limit = len(ids)
+
+        # Filter in chunks of growing size, only as many as needed
+        result = []
+        chunk = max(limit, 50)
+        i = 0
+        while i < len(ids) and len(result) < limit:
+            subset = ids[i:i+chunk]
+            i += chunk
+            sql = db(q & key.belongs(subset))._select(key)
+            found = set([row[0] for row in db.executesql(sql)])
+            result.extend([k for k in subset if k in found])
+            chunk = min(chunk * 2, 5000)
+        return result[:limit]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _person_clauses(value):
+        """
+            Text index search clauses for person names: "first last"
+            matches the first name and the middle or last name, other
+            terms match any of the names
+
+            @param value: the search term
+        """
+
+        if " " in value:
+            value1, value2 = value.split(" ", 1)
+            return [(value1, ["first_name"]),
+                    (value2, ["middle_name", "last_name"])]
+        else:
+            return [(value, ["first_name", "middle_name", "last_name"])]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _index_json(table, ids, fields):
+        """
+            Export records as JSON, in the order of the record IDs
+
+            @param table: the table
+            @param ids: the record IDs
+            @param fields: the fields to export
+        """
+
+        if not ids:
+            return json([])
+        db = current.db
+        rows = db(table._id.belongs(ids)).select(*fields)
+        rank = dict([(k, i) for i, k in enumerate(ids)])
+        rows = rows.sort(lambda row: rank[row[table._id.name]])
+        return rows.json()
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _index_pe_ids(table, ids):
+        """
+            Get the person entity IDs for records, in the order of
+            the record IDs
+
+            @param table: the instance table
+            @param ids: the record IDs
+        """
+
+        if not ids:
+            return []
+        db = current.db
+        rows = db(table._id.belongs(ids)).select(table._id, table.pe_id)
+        pe_ids = dict([(row[table._id.name], row.pe_id) for row in rows])
+        return [pe_ids[k] for k in ids if k in pe_ids]
+
+    # -------------------------------------------------------------------------
+    def _index_limit(self, limit):
+        """
+            Number of matches needed to answer an autocomplete search
+            with the given limit (one more than MAX_SEARCH_RESULTS if
+            "too many results" shall be reported instead)
+
+            @param limit: the limit requested by the client (0 for none)
+        """
+
+        if limit and limit <= MAX_SEARCH_RESULTS:
+            return limit
+        else:
+            return MAX_SEARCH_RESULTS + 1
+
     # -------------------------------------------------------------------------
     def _check_search_autcomplete_search_simple_widget(self, widget):
         """
@@ -2036,6 +2149,10 @@ class S3LocationSearch(S3Search):
         fields = []
         field = table.id
 
+        # Text index and search clauses (see S3TextIndex)
+        index = None
+        clauses = None
+
         if _vars.field and _vars.filter and value:
             fieldname = str.lower(_vars.field)
             field = table[fieldname]
@@ -2100,18 +2217,34 @@ class S3LocationSearch(S3Search):
                 if children:
                     # New LocationSelector
                     children = gis.get_children(children, level=level)
-                    #children = children.find(lambda row: \
-                    #                         value in str.lower(row.name))
-                    output = children.json()
+                    output = json(children)
                     response.headers["Content-Type"] = "application/json"
                     return output
 
+                if field2:
+                    fieldnames = [field.name, field2.name]
+                else:
+                    fieldnames = [field.name]
+                index = S3TextIndex.get(table._tablename)
+                if index is not None and \
+                   [fn for fn in fieldnames if fn not in index.fields]:
+                    index = None
+
                 if exclude_field and exclude_value:
                     # Old LocationSelector
                     # Filter out poor-quality data, such as from Ushahidi
-                    query = (field.lower().like("%" + value + "%")) & \
-                            ((table[exclude_field].lower() != exclude_value) | \
-                             (table[exclude_field] == None))
+                    exclude = ((table[exclude_field].lower() != exclude_value) | \
+                               (table[exclude_field] == None))
+                    if index is not None:
+                        clauses = [(value, [field.name])]
+                        query = exclude
+                    else:
+                        query = (field.lower().like("%" + value + "%")) & \
+                                exclude
+
+                elif index is not None:
+                    # Search the text index
+                    clauses = [(value, fieldnames)]
 
                 elif field2:
                     # New LocationSelector
@@ -2179,10 +2312,20 @@ class S3LocationSearch(S3Search):
         resource.add_filter(query)
 
         if filter == "~":
-            if (not limit or limit > MAX_SEARCH_RESULTS) and resource.count() > MAX_SEARCH_RESULTS:
+            if clauses:
+                ids = self._index_search(index, clauses, table._id,
+                                         limit=self._index_limit(limit))
+                count = len(ids)
+            elif not limit or limit > MAX_SEARCH_RESULTS:
+                count = resource.count()
+            else:
+                count = 0
+            if (not limit or limit > MAX_SEARCH_RESULTS) and count > MAX_SEARCH_RESULTS:
                output = json([dict(id="",
                                    name="Search results are over %d. Please input more characters." \
                                    % MAX_SEARCH_RESULTS)])
+            elif clauses:
+                output = self._index_json(table, ids, fields)
         elif not parent:
            if (not limit or limit > MAX_RESULTS) and resource.count() > MAX_RESULTS:
                output = json([])
@@ -2238,6 +2381,10 @@ class S3OrganisationSearch(S3Search):
         filter = _vars.filter
         limit = int(_vars.limit or 0)
 
+        # Search clauses for the text index (see S3TextIndex)
+        clauses = None
+        query = None
+
         if filter and value:
 
             field = table.name
@@ -2248,13 +2395,21 @@ class S3OrganisationSearch(S3Search):
 
             if filter == "~":
                 # pr_person Autocomplete
+                index = S3TextIndex.get(table._tablename)
                 if " " in value:
                     value1, value2 = value.split(" ", 1)
-                    query = (field.lower().like("%" + value1 + "%")) & \
-                            (field2.lower().like("%" + value2 + "%"))
+                    if index is not None:
+                        clauses = [(value1, [field.name]),
+                                   (value2, [field2.name])]
+                    else:
+                        query = (field.lower().like("%" + value1 + "%")) & \
+                                (field2.lower().like("%" + value2 + "%"))
                 else:
-                    query = (field.lower().like("%" + value + "%")) | \
-                            (field2.lower().like("%" + value + "%"))
+                    if index is not None:
+                        clauses = [(value, [field.name, field2.name])]
+                    else:
+                        query = (field.lower().like("%" + value + "%")) | \
+                                (field2.lower().like("%" + value + "%"))
 
             else:
                 output = xml.json_message(False,
@@ -2265,10 +2420,20 @@ class S3OrganisationSearch(S3Search):
         resource.add_filter(query)
 
         if filter == "~":
-            if (not limit or limit > MAX_SEARCH_RESULTS) and resource.count() > MAX_SEARCH_RESULTS:
+            if clauses:
+                ids = self._index_search(index, clauses, table._id,
+                                         limit=self._index_limit(limit))
+                count = len(ids)
+            elif not limit or limit > MAX_SEARCH_RESULTS:
+                count = resource.count()
+            else:
+                count = 0
+            if (not limit or limit > MAX_SEARCH_RESULTS) and count > MAX_SEARCH_RESULTS:
                output = json([dict(id="",
                                    name="Search results are over %d. Please input more characters." \
                                    % MAX_SEARCH_RESULTS)])
+            elif clauses:
+                output = self._index_json(table, ids, fields)
 
         if output is None:
             output = resource.exporter.json(resource,
@@ -2320,6 +2485,10 @@ class S3PersonSearch(S3Search):
         filter = _vars.filter
         limit = int(_vars.limit or 0)
 
+        # Search clauses for the text index (see S3TextIndex)
+        clauses = None
+        query = None
+
         if filter and value:
 
             field = table.first_name
@@ -2331,7 +2500,10 @@ class S3PersonSearch(S3Search):
 
             if filter == "~":
                 # pr_person Autocomplete
-                if " " in value:
+                index = S3TextIndex.get(table._tablename)
+                if index is not None:
+                    clauses = self._person_clauses(value)
+                elif " " in value:
                     value1, value2 = value.split(" ", 1)
                     query = (field.lower().like("%" + value1 + "%")) & \
                             (field2.lower().like("%" + value2 + "%")) | \
@@ -2350,10 +2522,20 @@ class S3PersonSearch(S3Search):
         resource.add_filter(query)
 
         if filter == "~":
-            if (not limit or limit > MAX_SEARCH_RESULTS) and resource.count() > MAX_SEARCH_RESULTS:
+            if clauses:
+                ids = self._index_search(index, clauses, table._id,
+                                         limit=self._index_limit(limit))
+                count = len(ids)
+            elif not limit or limit > MAX_SEARCH_RESULTS:
+                count = resource.count()
+            else:
+                count = 0
+            if (not limit or limit > MAX_SEARCH_RESULTS) and count > MAX_SEARCH_RESULTS:
                output = json([dict(id="",
                                    name="Search results are over %d. Please input more characters." \
                                    % MAX_SEARCH_RESULTS)])
+            elif clauses:
+                output = self._index_json(table, ids, fields)
 
         if output is None:
             output = resource.exporter.json(resource,
@@ -2406,6 +2588,14 @@ class S3PentitySearch(S3Search):
         filter = _vars.filter
         limit = int(_vars.limit or 0)
 
+        db = current.db
+        ptable = db.pr_person
+        gtable = db.pr_group
+
+        # Text indexes for persons and groups (see S3TextIndex)
+        index = None
+        query = None
+
         # Fields to return
         if filter and value:
 
@@ -2415,48 +2605,666 @@ class S3PentitySearch(S3Search):
 
             if filter == "~":
                 # pr_person Autocomplete
-                if " " in value:
-                    value1, value2 = value.split(" ", 1)
-                    query = (field.lower().like("%" + value1 + "%")) & \
-                            (field2.lower().like("%" + value2 + "%")) | \
-                            (field3.lower().like("%" + value2 + "%"))
-                else:
-                    query = ((field.lower().like("%" + value + "%")) | \
-                            (field2.lower().like("%" + value + "%")) | \
-                            (field3.lower().like("%" + value + "%")))
+                index = S3TextIndex.get("pr_person")
+                if index is None:
+                    if " " in value:
+                        value1, value2 = value.split(" ", 1)
+                        query = (field.lower().like("%" + value1 + "%")) & \
+                                (field2.lower().like("%" + value2 + "%")) | \
+                                (field3.lower().like("%" + value2 + "%"))
+                    else:
+                        query = ((field.lower().like("%" + value + "%")) | \
+                                (field2.lower().like("%" + value + "%")) | \
+                                (field3.lower().like("%" + value + "%")))
             else:
                 output = xml.json_message(False,
                                           400,
                                           "Unsupported filter! Supported filters: ~")
                 raise HTTP(400, body=output)
 
-        resource.add_filter(query)
-        resource.add_filter(current.db.pr_person.pe_id == table.pe_id)
+        if index is not None:
+            ids = self._index_search(index,
+                                     self._person_clauses(value),
+                                     ptable._id,
+                                     query=(ptable.pe_id == table.pe_id),
+                                     limit=limit or None)
+            items = self._index_pe_ids(ptable, ids)
+        else:
+            resource.add_filter(query)
+            resource.add_filter(current.db.pr_person.pe_id == table.pe_id)
 
-        output = resource.exporter.json(resource, start=0, limit=limit,
-                                        fields=[table.pe_id], orderby=field)
-        items = jsonlib.loads(output)
+            output = resource.exporter.json(resource, start=0, limit=limit,
+                                            fields=[table.pe_id], orderby=field)
+            items = [item[u'pe_id'] for item in jsonlib.loads(output)]
 
         # AT: group
         if filter and value:
-            field = current.db.pr_group.name
-            query = field.lower().like("%" + value + "%")
             resource.clear_query()
-            resource.add_filter(query)
-            resource.add_filter(current.db.pr_group.pe_id == table.pe_id)
-            output = resource.exporter.json(resource,
-                                            start=0,
-                                            limit=limit,
-                                            fields=[table.pe_id],
-                                            orderby=field)
-            items += jsonlib.loads(output)
+            index = S3TextIndex.get("pr_group")
+            if index is not None:
+                ids = self._index_search(index,
+                                         [(value, ["name"])],
+                                         gtable._id,
+                                         query=(gtable.pe_id == table.pe_id),
+                                         limit=limit or None)
+                items += self._index_pe_ids(gtable, ids)
+            else:
+                field = current.db.pr_group.name
+                query = field.lower().like("%" + value + "%")
+                resource.add_filter(query)
+                resource.add_filter(current.db.pr_group.pe_id == table.pe_id)
+                output = resource.exporter.json(resource,
+                                                start=0,
+                                                limit=limit,
+                                                fields=[table.pe_id],
+                                                orderby=field)
+                items += [item[u'pe_id'] for item in jsonlib.loads(output)]
 
-        items = [ { "id" : item[u'pe_id'],
-                    "name" : self.pentity_represent(item[u'pe_id']) }
-                  for item in items ]
+        items = [ { "id" : pe_id,
+                    "name" : self.pentity_represent(pe_id) }
+                  for pe_id in items ]
         output = jsonlib.dumps(items)
 
         response.headers["Content-Type"] = "application/json"
         return output
 
 # =============================================================================
+
+class S3TextIndex(object):
+    """
+        Text index for the autocomplete searches (search_json), to find
+        the records matching a search term without scanning the table
+        with lower(field) LIKE '%term%'
+
+        On PostgreSQL with the pg_trgm extension installed, the index
+        is kept in the database (trigram GIN indexes on the lower-case
+        fields, see create_indexes), otherwise it is kept in memory:
+        a trigram index for
+        terms with 3 or more characters, and a word prefix index for
+        shorter terms. The in-memory index is a process-wide singleton
+        per table (see get()), which is updated by the onaccept/ondelete
+        callbacks of the indexed tables (see update_record()), reads all
+        records modified since the last refresh at most every
+        REFRESH_INTERVAL seconds to pick up changes from other processes,
+        and gets saved to the cache folder to be loaded at the next start.
+
+        Matches are ranked: exact matches first, then matches at the
+        beginning of the field, then matches at the beginning of a word,
+        then other matches - each by length and then alphabetically.
+    """
+
+    # Indexed fields per table
+    FIELDS = {"gis_location": ("name", "addr_street"),
+              "org_organisation": ("name", "acronym"),
+              "pr_person": ("first_name", "middle_name", "last_name"),
+              "pr_group": ("name",)}
+
+    # Minimum interval (seconds) between refreshes from the database
+    REFRESH_INTERVAL = 10
+    # Minimum interval (seconds) between saving the index to disk
+    SAVE_INTERVAL = 300
+    # Maximum number of matches returned by the database backend
+    MAX_MATCHES = 5000
+
+    indexes = {}
+    lock = threading.RLock()
+
+    # -------------------------------------------------------------------------
+    def __init__(self, tablename):
+        """
+            Constructor, use get() to access the index
+
+            @param tablename: the name of the indexed table
+        """
+
+        self.tablename = tablename
+        self.fields = self.FIELDS[tablename]
+
+        # Record ID => tuple of the lower-case field values
+        self.docs = {}
+        # Trigram => array of record IDs
+        self.grams = {}
+        # Word prefix (1 or 2 characters) => array of record IDs
+        self.prefixes = {}
+        # Number of postings of updated or deleted records
+        self.garbage = 0
+
+        self.backend = None
+        self.modified_on = None
+        self.refreshed = None
+        self.saved = 0
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, tablename, refresh=True):
+        """
+            Get the index for a table, loading it at the first call
+
+            @param tablename: the table name
+            @param refresh: refresh the in-memory index from the database
+                            if the REFRESH_INTERVAL has expired
+
+            @returns: the S3TextIndex, or None if the table is not indexed
+                      or the index is disabled in deployment settings
+        """
+
+        if tablename not in cls.FIELDS:
+            return None
+        settings = current.deployment_settings
+        if not settings.get_ui_autocomplete_index():
+            return None
+
+        index = cls.indexes.get(tablename, None)
+        if index is None:
+            cls.lock.acquire()
+            try:
+                index = cls.indexes.get(tablename, None)
+                if index is None:
+                    index = cls(tablename)
+                    if index.postgres():
+                        index.backend = "postgres"
+                    else:
+                        index.backend = "memory"
+                        index.load()
+                        index.refresh()
+                    cls.indexes[tablename] = index
+            finally:
+                cls.lock.release()
+        elif refresh and index.backend == "memory" and \
+             time.time() - index.refreshed > index.REFRESH_INTERVAL:
+            index.refresh()
+        return index
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def update_index(cls, tablename, record_id, delete=False):
+        """
+            Update the in-memory index of a table for a record (if the
+            index has been loaded), to be invoked by onaccept/ondelete
+
+            @param tablename: the table name
+            @param record_id: the record ID
+            @param delete: remove the record from the index
+        """
+
+        index = cls.indexes.get(tablename, None)
+        if index is not None and index.backend == "memory":
+            index.update_record(record_id, delete=delete)
+        return
+
+    # -------------------------------------------------------------------------
+    def postgres(self):
+        """
+            Check whether the database backend can be used, i.e.
+            PostgreSQL with pg_trgm and valid trigram indexes for all
+            fields (see create_indexes)
+
+            @returns: True if the database backend can be used
+        """
+
+        db = current.db
+        if db._dbname != "postgres":
+            return False
+        tablename = self.tablename
+        try:
+            if not db.executesql("SELECT 1 FROM pg_extension "
+                                 "WHERE extname='pg_trgm';"):
+                return False
+            names = [self.index_name(tablename, fn) for fn in self.fields]
+            indexes = self.trgm_indexes(names)
+        except:
+            db.rollback()
+            return False
+        missing = [name for name in names if not indexes.get(name, False)]
+        if missing:
+            s3_debug("S3TextIndex: missing trigram indexes %s "
+                     "(see S3TextIndex.create_indexes)" % ", ".join(missing))
+            return False
+        return True
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def index_name(tablename, fieldname):
+        """
+            Name of the trigram index for a field
+
+            @param tablename: the table name
+            @param fieldname: the field name
+        """
+
+        return "s3_trgm_%s_%s" % (tablename, fieldname)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def trgm_indexes(names):
+        """
+            Look up trigram indexes in PostgreSQL
+
+            @param names: the index names
+
+            @returns: dict {name: valid} of the existing indexes, invalid
+                      indexes being left behind by a failed CREATE INDEX
+                      CONCURRENTLY
+        """
+
+        rows = current.db.executesql("SELECT c.relname, i.indisvalid "
+                                     "FROM pg_class c, pg_index i "
+                                     "WHERE c.oid=i.indexrelid "
+                                     "AND c.relname IN (%s);" %
+                                     ",".join(["'%s'" % n for n in names]))
+        return dict([(name, valid) for name, valid in rows])
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def create_indexes(cls):
+        """
+            Create the trigram indexes for all indexed tables (PostgreSQL
+            with pg_trgm only). Not to be run during requests: this runs
+            at the first run and in the s3_text_index task, and creates
+            the indexes CONCURRENTLY so that the tables can still be
+            written meanwhile (which requires autocommit mode, and so
+            commits the current transaction first).
+
+            @returns: list of the names of the created indexes
+        """
+
+        db = current.db
+        manager = current.manager
+
+        created = []
+        if db._dbname != "postgres":
+            return created
+        if not db.executesql("SELECT 1 FROM pg_extension "
+                             "WHERE extname='pg_trgm';"):
+            return created
+
+        db.commit()
+        connection = db._adapter.connection
+        isolation_level = connection.isolation_level
+        connection.set_isolation_level(0) # autocommit
+        try:
+            for tablename, fields in cls.FIELDS.items():
+                manager.load(tablename)
+                names = dict([(cls.index_name(tablename, fn), fn)
+                              for fn in fields])
+                indexes = cls.trgm_indexes(names.keys())
+                for name, fn in names.items():
+                    if indexes.get(name, False):
+                        continue
+                    if name in indexes:
+                        # Left behind by a failed attempt
+                        db.executesql("DROP INDEX %s;" % name)
+                    s3_debug("S3TextIndex: creating index %s" % name)
+                    db.executesql("CREATE INDEX CONCURRENTLY %s ON %s "
+                                  "USING gin (lower(%s) gin_trgm_ops);" %
+                                  (name, tablename, fn))
+                    created.append(name)
+        finally:
+            connection.set_isolation_level(isolation_level)
+
+        # Switch to the database backend with the next get()
+        cls.lock.acquire()
+        try:
+            for tablename in cls.FIELDS:
+                index = cls.indexes.get(tablename, None)
+                if index is not None and index.backend == "memory":
+                    del cls.indexes[tablename]
+        finally:
+            cls.lock.release()
+        return created
+
+    # -------------------------------------------------------------------------
+    def path(self):
+        """ Path of the file to save the in-memory index to """
+
+        return os.path.join(current.request.folder, "cache",
+                            "s3_text_index_%s.pkl" % self.tablename)
+
+    # -------------------------------------------------------------------------
+    def load(self):
+        """ Load the in-memory index from disk """
+
+        path = self.path()
+        if not os.path.exists(path):
+            return
+        try:
+            f = open(path, "rb")
+            try:
+                data = cPickle.load(f)
+            finally:
+                f.close()
+        except:
+            s3_debug("S3TextIndex: could not load %s" % path)
+            return
+        if data.get("fields", None) != self.fields:
+            return
+        self.docs = data["docs"]
+        self.grams = data["grams"]
+        self.prefixes = data["prefixes"]
+        self.garbage = data["garbage"]
+        self.modified_on = data["modified_on"]
+        self.saved = time.time()
+        return
+
+    # -------------------------------------------------------------------------
+    def save(self):
+        """ Save the in-memory index to disk """
+
+        path = self.path()
+        if not os.access(os.path.dirname(path), os.W_OK):
+            return
+        self.saved = time.time()
+        data = dict(fields=self.fields,
+                    docs=self.docs,
+                    grams=self.grams,
+                    prefixes=self.prefixes,
+                    garbage=self.garbage,
+                    modified_on=self.modified_on)
+        tmp = "%s.%s" % (path, os.getpid())
+        try:
+            f = open(tmp, "wb")
+            try:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            s3_debug("S3TextIndex: could not save %s" % path)
+        return
+
+    # -------------------------------------------------------------------------
+    def refresh(self):
+        """
+            Read all records modified since the last refresh
+            (or all records at the first call)
+        """
+
+        db = current.db
+        table = db[self.tablename]
+
+        self.refreshed = time.time()
+        if self.modified_on is None:
+            query = (table.deleted != True)
+        else:
+            # Re-read records modified in the same instant as the
+            # latest known, which might not all have been committed
+            query = (table.modified_on >= self.modified_on)
+        fields = [table._id, table.deleted, table.modified_on] + \
+                 [table[fn] for fn in self.fields]
+        rows = db(query).select(*fields)
+        full = self.modified_on is None
+        self.update(rows)
+        if rows and (full or time.time() - self.saved > self.SAVE_INTERVAL):
+            self.save()
+        return
+
+    # -------------------------------------------------------------------------
+    def update_record(self, record_id, delete=False):
+        """
+            Update the index for a record
+
+            @param record_id: the record ID
+            @param delete: remove the record from the index
+        """
+
+        if delete:
+            self.update([Storage(id=record_id, deleted=True)])
+            return
+
+        db = current.db
+        table = db[self.tablename]
+        fields = [table._id, table.deleted, table.modified_on] + \
+                 [table[fn] for fn in self.fields]
+        rows = db(table._id == record_id).select(limitby=(0, 1), *fields)
+        if rows:
+            self.update(rows)
+        else:
+            self.update([Storage(id=record_id, deleted=True)])
+        return
+
+    # -------------------------------------------------------------------------
+    def update(self, rows):
+        """
+            Update the in-memory index from rows
+
+            @param rows: the rows, must contain id, deleted and the
+                         indexed fields
+
+            @note: postings of updated or deleted records remain in the
+                   index (matches are verified against the current field
+                   values), the index gets rebuilt when they make up half
+                   of all postings
+        """
+
+        fields = self.fields
+
+        self.lock.acquire()
+        try:
+            docs = self.docs
+            grams = self.grams
+            prefixes = self.prefixes
+            for row in rows:
+                record_id = row.id
+                modified_on = row.get("modified_on", None)
+                if modified_on is not None and \
+                   (self.modified_on is None or modified_on > self.modified_on):
+                    self.modified_on = modified_on
+                previous = docs.pop(record_id, None)
+                if row.deleted:
+                    if previous is not None:
+                        self.garbage += 1
+                    continue
+                doc = tuple([self.normalize(row[fn]) for fn in fields])
+                docs[record_id] = doc
+                if doc != previous:
+                    if previous is not None:
+                        self.garbage += 1
+                    self.add(grams, prefixes, record_id, doc)
+            if self.garbage > len(docs):
+                self.rebuild()
+        finally:
+            self.lock.release()
+        return
+
+    # -------------------------------------------------------------------------
+    def rebuild(self):
+        """ Rebuild the postings from the current field values """
+
+        grams = {}
+        prefixes = {}
+        add = self.add
+        for record_id, doc in self.docs.iteritems():
+            add(grams, prefixes, record_id, doc)
+        self.grams = grams
+        self.prefixes = prefixes
+        self.garbage = 0
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def add(grams, prefixes, record_id, doc):
+        """
+            Add the postings for a record
+
+            @param grams: the trigram postings
+            @param prefixes: the word prefix postings
+            @param record_id: the record ID
+            @param doc: the lower-case field values
+        """
+
+        keys = set()
+        words = set()
+        for text in doc:
+            if not text:
+                continue
+            for i in xrange(len(text) - 2):
+                keys.add(text[i:i+3])
+            for word in text.split():
+                words.add(word[:1])
+                words.add(word[:2])
+        for postings, keys in ((grams, keys), (prefixes, words)):
+            for key in keys:
+                if key in postings:
+                    postings[key].append(record_id)
+                else:
+                    postings[key] = array("l", [record_id])
+        return
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def normalize(value):
+        """
+            Normalize a value for indexing and search
+
+            @param value: the value (str or unicode)
+
+            @returns: the lower-case unicode string
+        """
+
+        if value is None:
+            return u""
+        if not isinstance(value, unicode):
+            value = str(value).decode("utf-8", "ignore")
+        return value.lower().strip()
+
+    # -------------------------------------------------------------------------
+    def search(self, clauses, query=None):
+        """
+            Find the records matching all clauses
+
+            @param clauses: list of tuples (term, fieldnames), a record
+                            matches a clause if any of the fields contains
+                            the term, the first clause is used for ranking
+            @param query: additional filter query (database backend only)
+
+            @returns: list of the matching record IDs, ranked
+        """
+
+        clauses = [(self.normalize(term), fns) for term, fns in clauses]
+        clauses = [(term, fns) for term, fns in clauses if term]
+        if not clauses:
+            return []
+        if self.backend == "postgres":
+            return self._search_postgres(clauses, query=query)
+
+        fields = self.fields
+        clauses = [(term, [fields.index(fn) for fn in fns])
+                   for term, fns in clauses]
+
+        # Candidates from the postings of the longest term
+        term = max([c[0] for c in clauses], key=len)
+        if len(term) < 3:
+            postings = self.prefixes.get(term[:2], None)
+        else:
+            postings = None
+            for i in xrange(len(term) - 2):
+                p = self.grams.get(term[i:i+3], None)
+                if p is None:
+                    return []
+                if postings is None or len(p) < len(postings):
+                    postings = p
+        if not postings:
+            return []
+
+        # Verify against the current field values and rank
+        docs = self.docs
+        rank = self.rank
+        term, positions = clauses[0]
+        matches = []
+        for record_id in set(postings):
+            doc = docs.get(record_id, None)
+            if doc is None:
+                continue
+            for t, p in clauses:
+                for i in p:
+                    if t in doc[i]:
+                        break
+                else:
+                    break
+            else:
+                matches.append((min([rank(doc[i], term) for i in positions]),
+                                record_id))
+        matches.sort()
+        return [m[1] for m in matches]
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def rank(text, term):
+        """
+            Rank of a term match in a field value
+
+            @param text: the field value
+            @param term: the search term
+
+            @returns: sortable rank
+        """
+
+        if text == term:
+            r = 0
+        elif text.startswith(term):
+            r = 1
+        elif (" %s" % term) in text:
+            r = 2
+        elif term in text:
+            r = 3
+        else:
+            r = 4
+        return (r, len(text), text)
+
+    # -------------------------------------------------------------------------
+    def _search_postgres(self, clauses, query=None):
+        """
+            Find the records matching all clauses in the database
+            (using the trigram indexes)
+
+            @param clauses: list of tuples (term, fieldnames)
+            @param query: additional filter query
+
+            @returns: list of the matching record IDs, ranked
+        """
+
+        db = current.db
+        table = db[self.tablename]
+        represent = lambda v: db._adapter.represent(v, "string")
+
+        q = (table.deleted != True)
+        for term, fns in clauses:
+            like = "%%%s%%" % term.encode("utf-8")
+            subquery = None
+            for fn in fns:
+                subquery = subquery is None and \
+                           table[fn].lower().like(like) or \
+                           subquery | table[fn].lower().like(like)
+            q &= subquery
+        if query is not None:
+            q &= query
+
+        # Rank
+        term, fns = clauses[0]
+        term = term.encode("utf-8")
+        ranks = []
+        for fn in fns:
+            ranks.append("CASE WHEN lower(%(f)s)=%(exact)s THEN 0 "
+                          "WHEN lower(%(f)s) LIKE %(start)s THEN 1 "
+                          "WHEN lower(%(f)s) LIKE %(word)s THEN 2 "
+                          "WHEN lower(%(f)s) LIKE %(any)s THEN 3 "
+                          "ELSE 4 END" %
+                          dict(f=table[fn],
+                               exact=represent(term),
+                               start=represent("%s%%" % term),
+                               word=represent("%% %s%%" % term),
+                               any=represent("%%%s%%" % term)))
+        if len(ranks) > 1:
+            orderby = "LEAST(%s)" % ",".join(ranks)
+        else:
+            orderby = ranks[0]
+        orderby = "%s, length(%s), lower(%s)" % (orderby,
+                                                 table[fns[0]],
+                                                 table[fns[0]])
+
+        sql = db(q)._select(table._id,
+                            orderby=orderby,
+                            limitby=(0, self.MAX_MATCHES))
+        return [row[0] for row in db.executesql(sql)]
+
+# =============================================================================
@@ -545,21 +545,26 @@ class S3QuestionTypeAbstractWidget(FormWidget):
     ######################################################################
     # Functions not fully implemented or used
     ######################################################################
-    def validate(self, valueList, qstn_id):
+    def validate(self, valueList, qstn_id=None):
         """
             This will validate the data passed in to the widget
 
-            NOTE: Not currently used but will be used when the UI supports the
-                  validation of data entered in to the web form
+            It is used when answers are imported, see models/survey.py
+            importAnswers(), and will be used when the UI supports the
+            validation of data entered in to the web form
         """
         if len(valueList) == 0:
             return self.ANSWER_MISSING
-        data = value(valueList, 0)
-        if data == None:
+        data = valueList[0]
+        if data == None or data == "":
             return self.ANSWER_MISSING
+        self._store_metadata(qstn_id)
         length = self.get("Length")
-        if length != None and length(data) > length:
-            return ANSWER_PARTLY_VALID
+        try:
+            if length != None and len(data) > int(length):
+                return self.ANSWER_PARTLY_VALID
+        except ValueError:
+            pass
         return self.ANSWER_VALID
 
     def metadata(self, **attr):
@@ -697,24 +702,18 @@ class S3QuestionTypeNumericWidget(S3QuestionTypeAbstractWidget):
     ######################################################################
     # Functions not fully implemented or used
     ######################################################################
-    def validate(self, valueList, qstn_id):
+    def validate(self, valueList, qstn_id=None):
         """
             This will validate the data passed in to the widget
         """
-        result = S3QuestionTypeAbstractWidget.validate(self, valueList)
-        if result != ANSWER_VALID:
+        result = S3QuestionTypeAbstractWidget.validate(self, valueList, qstn_id)
+        if result == self.ANSWER_MISSING:
             return result
-        length = self.get("length", 10)
-        format = self.get("format")
-        data = value(valueList, 0)
-        if format != None:
-            try:
-                self.formattedValue(data, format)
-                return self.ANSWER_VALID
-            except exceptions.ValueError:
-                return self.ANSWER_INVALID
-
-        return self.ANSWER_VALID
+        try:
+            float(valueList[0])
+        except ValueError:
+            return self.ANSWER_INVALID
+        return result
 
 ##########################################################################
 # Class S3QuestionTypeDateWidget
@@ -833,24 +832,11 @@ class S3QuestionTypeDateWidget(S3QuestionTypeAbstractWidget):
     ######################################################################
     # Functions not fully implemented or used
     ######################################################################
-    def validate(self, valueList, qstn_id):
+    def validate(self, valueList, qstn_id=None):
         """
             This will validate the data passed in to the widget
         """
-        result = S3QuestionTypeAbstractWidget.validate(self, valueList)
-        if result != ANSWER_VALID:
-            return result
-        length = self.get("length", 10)
-        format = self.get("format")
-        data = value(valueList, 0)
-        if format != None:
-            try:
-                self.formattedValue(data, format)
-                return self.ANSWER_VALID
-            except exceptions.ValueError:
-                return self.ANSWER_INVALID
-
-        return self.ANSWER_VALID
+        return S3QuestionTypeAbstractWidget.validate(self, valueList, qstn_id)
 
 ##########################################################################
 # Class S3QuestionTypeOptionWidget
@@ -969,7 +955,7 @@ class S3QuestionTypeOptionWidget(S3QuestionTypeAbstractWidget):
     ######################################################################
     # Functions not fully implemented or used
     ######################################################################
-    def validate(self, valueList, qstn_id):
+    def validate(self, valueList, qstn_id=None):
         """
             This will validate the data passed in to the widget
         """
@@ -1446,24 +1432,11 @@ class S3QuestionTypeLocationWidget(S3QuestionTypeAbstractWidget):
     ######################################################################
     # Functions not fully implemented or used
     ######################################################################
-    def validate(self, valueList, qstn_id):
+    def validate(self, valueList, qstn_id=None):
         """
             This will validate the data passed in to the widget
         """
-        result = S3QuestionTypeAbstractWidget.validate(self, valueList)
-        if result != ANSWER_VALID:
-            return result
-        length = self.get("length", 10)
-        format = self.get("format")
-        data = value(valueList, 0)
-        if format != None:
-            try:
-                self.formattedValue(data, format)
-                return self.ANSWER_VALID
-            except exceptions.ValueError:
-                return self.ANSWER_INVALID
-
-        return self.ANSWER_VALID
+        return S3QuestionTypeAbstractWidget.validate(self, valueList, qstn_id)
 
 
 ##########################################################################
@@ -1516,6 +1489,9 @@ class S3QuestionTypeLinkWidget(S3QuestionTypeAbstractWidget):
             Method to format the value that has just been put on the database
         """
         type = self.get("Type")
+        if type not in survey_question_type:
+            # Linked type unknown => keep the value as it is
+            return value
         realWidget = survey_question_type[type]()
         return realWidget.onaccept(value)
 
@@ -1536,12 +1512,15 @@ class S3QuestionTypeLinkWidget(S3QuestionTypeAbstractWidget):
     ######################################################################
     # Functions not fully implemented or used
     ######################################################################
-    def validate(self, valueList, qstn_id):
+    def validate(self, valueList, qstn_id=None):
         """
             This will validate the data passed in to the widget
         """
-        result = S3QuestionTypeAbstractWidget.validate(self, valueList)
+        result = S3QuestionTypeAbstractWidget.validate(self, valueList, qstn_id)
         type = self.get("Type")
+        if type not in survey_question_type:
+            # Linked type unknown => only the basic validation
+            return result
         realWidget = survey_question_type[type]()
         return realWidget.validate(valueList, qstn_id)
 
@@ -1994,7 +1973,11 @@ class S3AbstractAnalysis():
         answerList     - A list of answers, taken from the survey_answer
                          id, complete_id and value
                          See models/survey.py getAllAnswersForQuestionInSeries() 
+                         or the stored value counts, which also have a count
+                         See models/survey.py getQuestionAnalysis()
         valueList      - A list of validated & sanitised values 
+        countList      - The number of replies for each value in valueList
+        replies        - The number of replies (valid or not)
         result         - A list of results before formatting
         type           - The question type
         qstnWidget     - The question Widget for this question
@@ -2009,6 +1992,8 @@ class S3AbstractAnalysis():
         self.question_id = question_id
         self.answerList = answerList
         self.valueList = []
+        self.countList = []
+        self.replies = 0
         self.result = []
         self.type = type
         self.qstnWidget = survey_question_type[self.type](question_id = question_id)
@@ -2016,13 +2001,18 @@ class S3AbstractAnalysis():
         self.priorityGroups = {"default" : [-1, -0.5, 0, 0.5, 1],
                                "standard" : [-2, -1, 0, 1, 2],
                                }
+        # Answers taken from the stored analysis (survey_analysis) have no
+        # complete_id, but the number of replies with that value as count
         for answer in self.answerList:
+            count = answer.get("count", 1)
+            self.replies += count
             if self.valid(answer):
                 try:
                     cast = self.castRawAnswer(answer["complete_id"],
                                               answer["value"])
                     if cast != None:
                         self.valueList.append(cast)
+                        self.countList.append(count)
                 except:
                     if DEBUG:
                         raise
@@ -2102,7 +2092,7 @@ class S3AbstractAnalysis():
             
             Where necessary, this will function be overridden.
         """
-        self.result.append(([current.T("Replies")], len(self.answerList))) 
+        self.result.append(([current.T("Replies")], self.replies))
         return self.format()
     
     def format(self):
@@ -2119,11 +2109,11 @@ class S3AbstractAnalysis():
             Calculate the number of occurances of each value
         """
         map = {}
-        for answer in self.valueList:
+        for (answer, count) in zip(self.valueList, self.countList):
             if answer in map:
-                map[answer] += 1
+                map[answer] += count
             else:
-                map[answer] = 1
+                map[answer] = count
         return map
 
     def groupData(self, groupAnswer):
@@ -2232,7 +2222,7 @@ class S3NumericAnalysis(S3AbstractAnalysis):
 
     def count(self):
         T = current.T
-        self.result.append((T("Replies"), len(self.answerList)))
+        self.result.append((T("Replies"), self.replies))
         self.result.append((T("Valid"), self.cnt))
         return self.format()
 
@@ -2247,9 +2237,9 @@ class S3NumericAnalysis(S3AbstractAnalysis):
         self.sum = 0
         self.max = self.valueList[0]
         self.min = self.valueList[0]
-        for answer in self.valueList:
-            self.cnt += 1
-            self.sum += answer
+        for (answer, count) in zip(self.valueList, self.countList):
+            self.cnt += count
+            self.sum += answer * count
             if answer > self.max:
                 self.max = answer
             if answer < self.min:
@@ -2258,13 +2248,14 @@ class S3NumericAnalysis(S3AbstractAnalysis):
 
     def advancedResults(self):
         try:
-            from numpy import array
+            from numpy import array, average, sqrt
         except:
             print >> sys.stderr, "ERROR: S3Survey requires numpy library installed."
 
-        array = array(self.valueList)
-        self.std = array.std()
-        self.mean = array.mean()
+        values = array(self.valueList)
+        weights = array(self.countList)
+        self.mean = average(values, weights=weights)
+        self.std = sqrt(average((values - self.mean) ** 2, weights=weights))
         self.zscore = {}
         for answer in self.answerList:
             complete_id = answer["complete_id"]
@@ -2297,7 +2288,7 @@ class S3NumericAnalysis(S3AbstractAnalysis):
         return band
 
     def chartButton(self, series_id):
-        if len(self.valueList) < self.histCutoff:
+        if self.cnt < self.histCutoff:
             return None
         return S3AbstractAnalysis.chartButton(self, series_id)
 
@@ -2312,7 +2303,8 @@ class S3NumericAnalysis(S3AbstractAnalysis):
                               0,
                               self.max,
                               xlabel = self.qstnWidget.question.name,
-                              ylabel = current.T("Count")
+                              ylabel = current.T("Count"),
+                              weights = self.countList
                              )
         else:
             chart.survey_bar(self.qstnWidget.question.name,
@@ -2350,12 +2342,12 @@ class S3OptionAnalysis(S3AbstractAnalysis):
     def basicResults(self):
         self.cnt = 0
         self.list = {}
-        for answer in self.valueList:
-            self.cnt += 1
+        for (answer, count) in zip(self.valueList, self.countList):
+            self.cnt += count
             if answer in self.list:
-                self.list[answer] += 1
+                self.list[answer] += count
             else:
-                self.list[answer] = 1
+                self.list[answer] = count
         self.listp = {}
         if self.cnt != 0:
             for (key, value) in self.list.items():
@@ -2479,17 +2471,17 @@ class S3MultiOptionAnalysis(S3OptionAnalysis):
     def basicResults(self):
         self.cnt = 0
         self.list = {}
-        for answer in self.valueList:
+        for (answer, count) in zip(self.valueList, self.countList):
             if isinstance(answer, list):
                 answerList = answer
             else:
                 answerList = [answer]
-            self.cnt += 1
+            self.cnt += count
             for answer in answerList:
                 if answer in self.list:
-                    self.list[answer] += 1
+                    self.list[answer] += count
                 else:
-                    self.list[answer] = 1
+                    self.list[answer] = count
         self.listp = {}
         if self.cnt != 0:
             for (key, value) in self.list.items():
@@ -2556,7 +2548,7 @@ class S3LocationAnalysis(S3AbstractAnalysis):
             Returns a table of basic results
         """
         T = current.T
-        self.result.append((T("Total Locations"), len(self.valueList)))
+        self.result.append((T("Total Locations"), sum(self.countList)))
         self.result.append((T("Unique Locations"), self.cnt))
         return self.format()
 
@@ -2588,16 +2580,16 @@ class S3LocationAnalysis(S3AbstractAnalysis):
         self.duplicates = {}
         self.known = {}
         self.complete_id = {}
-        for answer in self.valueList:
+        for (answer, count) in zip(self.valueList, self.countList):
             if answer != None:
                 if isinstance(answer, dict):
                     key = answer.key
                 else:
                     key = answer
                 if key in self.locationList:
-                    self.locationList[key] += 1
+                    self.locationList[key] += count
                 else:
-                    self.locationList[key] = 1
+                    self.locationList[key] = count
                     if key in self.complete_id:
                         self.complete_id[key].append(answer.complete_id)
                     else:
@@ -2629,11 +2621,11 @@ class S3LocationAnalysis(S3AbstractAnalysis):
             Calculate the number of occurances of each value
         """
         map = {}
-        for answer in self.valueList:
+        for (answer, count) in zip(self.valueList, self.countList):
             if answer.key in map:
-                map[answer.key] += 1
+                map[answer.key] += count
             else:
-                map[answer.key] = 1
+                map[answer.key] = count
         return map
 
 # -----------------------------------------------------------------------------
@@ -2698,6 +2690,7 @@ class S3GridChildAnalysis(S3AbstractAnalysis):
                 try:
                     self.valueList.append(trueType.castRawAnswer(answer["complete_id"],
                                                                  answer["value"]))
+                    self.countList.append(answer.get("count", 1))
                 except:
                     pass
         self.widget = survey_analysis_type[trueType](question_id, self.answerList)
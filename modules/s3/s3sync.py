@@ -30,13 +30,21 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["S3Sync", "S3SyncLog"]
+__all__ = ["S3Sync", "S3SyncLog", "S3SyncHTTPHandler"]
 
 import sys
 import json
 import urllib2
+import httplib
+import socket
 import datetime
 import time
+import threading
+import zlib
+import gzip
+import Queue
+import multiprocessing.dummy
+from cStringIO import StringIO
 
 try:
     from lxml import etree
@@ -61,9 +69,69 @@ else:
 
 # =============================================================================
 
+def _fetch(job):
+    """
+        Send a request to a peer repository (in a worker thread of
+        S3Sync.synchronize_all, hence without database access)
+
+        @param job: tuple (job, request), request as returned by
+                    S3Sync.__request, or None if there is nothing to send
+
+        @returns: tuple (job, response), response being None if there
+                  was nothing to send, or a Storage with:
+                    body - the response body (decompressed)
+                    code - the HTTP status code
+                    cursor - the position of the next chunk (None if
+                             this was the last chunk)
+                    error - the error message (None if successful)
+                    remote - whether the error was reported by the peer
+    """
+
+    job, request = job
+    if request is None:
+        return (job, None)
+
+    response = Storage(body=None,
+                       code=None,
+                       cursor=None,
+                       error=None,
+                       remote=False)
+    try:
+        try:
+            f = request.opener.open(request.request)
+        except urllib2.HTTPError, e:
+            if e.code in (400, 415) and request.fallback is not None:
+                # Peer does not accept compressed data => send uncompressed
+                request.opener.compress = False
+                f = request.opener.open(request.fallback)
+            else:
+                raise
+        response.body = f.read()
+        response.code = f.code
+        info = f.info()
+        if info.get("Content-Encoding", None) == "gzip":
+            response.body = zlib.decompress(response.body,
+                                            16 + zlib.MAX_WBITS)
+        response.cursor = info.get("X-Sync-Next", None)
+    except urllib2.HTTPError, e:
+        response.code = e.code
+        response.error = e.read()
+        response.remote = True
+    except:
+        response.code = 400
+        response.error = sys.exc_info()[1]
+    return (job, response)
+
+# =============================================================================
+
 class S3Sync(S3Method):
     """ S3 Synchronization Toolkit """
 
+    # URL openers and locks by repository, shared by all instances
+    openers = dict()
+    locks = dict()
+    lock = threading.Lock()
+
     # -------------------------------------------------------------------------
     def __init__(self):
         """
@@ -102,9 +170,11 @@ class S3Sync(S3Method):
         return output
 
     # -------------------------------------------------------------------------
-    def get_status(self):
+    def get_status(self, repository_id=None):
         """
             Read the current sync status
+
+            @param repository_id: the repository (None for the global status)
         """
 
         db = current.db
@@ -113,15 +183,18 @@ class S3Sync(S3Method):
         tablename = "sync_status"
         manager.load(tablename)
         table = db[tablename]
-        row = db().select(table.ALL, limitby=(0, 1)).first()
+        query = (table.repository_id == repository_id)
+        row = db(query).select(table.ALL, limitby=(0, 1)).first()
         if not row:
             row = Storage()
         return row
 
     # -------------------------------------------------------------------------
-    def set_status(self, **attr):
+    def set_status(self, repository_id=None, **attr):
         """
             Update the current sync status
+
+            @param repository_id: the repository (None for the global status)
         """
 
         db = current.db
@@ -133,10 +206,12 @@ class S3Sync(S3Method):
 
         data = Storage([(k, attr[k]) for k in attr if k in table.fields])
         data.update(timestmp = datetime.datetime.utcnow())
-        row = db().select(table._id, limitby=(0, 1)).first()
+        query = (table.repository_id == repository_id)
+        row = db(query).select(table._id, limitby=(0, 1)).first()
         if row:
             row.update_record(**data)
         else:
+            data.update(repository_id = repository_id)
             table.insert(**data)
             row = data
         return row
@@ -162,142 +237,571 @@ class S3Sync(S3Method):
         return self.config
 
     # -------------------------------------------------------------------------
-    def synchronize(self, repository):
+    def synchronize(self, repository, manual=False):
         """
             Synchronize a repository
 
             @param repository: a sync_repository row
+            @param manual: whether this is a manual synchronization
+
+            @returns: a JSON message
         """
 
-        _debug("S3Sync.synchronize(%s)" % repository.url)
+        results = self.synchronize_all([repository], manual=manual)
+        return results[repository.id]
+
+    # -------------------------------------------------------------------------
+    def synchronize_all(self, repositories, manual=False):
+        """
+            Synchronize several repositories in parallel: the requests to
+            the peers run in a thread pool (sync.workers threads), and the
+            responses are imported in this thread, so that a slow peer does
+            not delay the others. The first chunks of all pull tasks are
+            requested at once. A task whose table references the table of
+            another task of the same repository (e.g. org_office ->
+            org_organisation) waits for that task to complete, so that
+            referenced records get imported first, while independent tasks
+            proceed concurrently. Repositories which are being synchronized
+            by another run are skipped.
+
+            The records are transferred in chunks of sync.chunk_size
+            records, each of which is committed together with a checkpoint
+            in the task, so that an interrupted transfer resumes after the
+            last complete chunk.
+
+            @param repositories: the sync_repository rows
+            @param manual: whether this is a manual synchronization
+
+            @returns: dict {repository_id: JSON message}
+        """
 
         db = current.db
         xml = current.manager.xml
 
-        if not repository.url:
-            message = "No URL set for repository"
-            self.log.write(repository_id=repository.id,
-                           resource_name=None,
-                           transmission=None,
-                           mode=None,
-                           action="connect",
-                           remote=False,
-                           result=self.log.FATAL,
-                           message=message)
-            return xml.json_message(False, 400, message=message)
-
-        rtable = db.sync_task
-        query = (rtable.repository_id == repository.id) & \
-                (rtable.deleted != True)
-        tasks = db(query).select()
-        for task in tasks:
-            now = datetime.datetime.utcnow()
-            if task.mode in (1, 3):
-                error = self.__pull(repository, task)
-            if error:
-                _debug("S3Sync.synchronize: %s PULL error %s" %
-                                    (task.resource_name, error))
-                continue
-            if task.mode in (2, 3):
-                error = self.__push(repository, task)
-            if error:
-                _debug("S3Sync.synchronize: %s PUSH error %s" %
-                                    (task.resource_name, error))
+        results = dict()
+        locked = []
+        jobs = []
+
+        try:
+            rtable = db.sync_task
+            for repository in repositories:
+
+                _debug("S3Sync.synchronize(%s)" % repository.url)
+
+                if not repository.url:
+                    message = "No URL set for repository"
+                    self.log.write(repository_id=repository.id,
+                                   resource_name=None,
+                                   transmission=None,
+                                   mode=None,
+                                   action="connect",
+                                   remote=False,
+                                   result=self.log.FATAL,
+                                   message=message)
+                    results[repository.id] = xml.json_message(False, 400,
+                                                              message=message)
+                    continue
+
+                if not self.__lock(repository, manual=manual):
+                    message = "Synchronization already active - skipping run"
+                    self.log.write(repository_id=repository.id,
+                                   resource_name=None,
+                                   transmission=None,
+                                   mode=None,
+                                   action="check",
+                                   remote=False,
+                                   result=self.log.ERROR,
+                                   message=message)
+                    results[repository.id] = xml.json_message(False, 409,
+                                                              message=message)
+                    continue
+                locked.append(repository)
+
+                query = (rtable.repository_id == repository.id) & \
+                        (rtable.deleted != True)
+                tasks = db(query).select(orderby=rtable.id)
+                rjobs = []
+                for task in tasks:
+                    job = Storage(repository=repository,
+                                  task=task,
+                                  now=datetime.datetime.utcnow(),
+                                  mode=None,
+                                  chunks=0,
+                                  cursor=None,
+                                  received=False,
+                                  response=None,
+                                  error=None,
+                                  done=task.mode not in (1, 2, 3),
+                                  depends=[],
+                                  dependents=[])
+                    rjobs.append(job)
+                self.__dependencies(rjobs)
+                jobs.extend(rjobs)
+
+            if jobs:
+                workers = current.deployment_settings.get_sync_workers()
+                pool = multiprocessing.dummy.Pool(max(1, min(workers,
+                                                             len(jobs))))
+                responses = Queue.Queue()
+                def submit(job, request):
+                    pool.apply_async(_fetch, ((job, request),),
+                                     callback=responses.put)
+                def advance(job):
+                    """
+                        Process the received response of a job and request
+                        its next chunk, or, if the job is complete, start
+                        the jobs which have been waiting for it
+
+                        @returns: the number of requests submitted
+                    """
+                    if job.done:
+                        return 0
+                    for dependency in job.depends:
+                        if not dependency.done:
+                            return 0
+                    if not job.received:
+                        if job.mode is None:
+                            # Push-only task
+                            job.mode = self.log.PUSH
+                            submit(job, self.__push_request(job))
+                            return 1
+                        return 0
+                    response = job.response
+                    job.received = False
+                    job.response = None
+                    if job.mode == self.log.PULL:
+                        job.error, more = self.__pull_import(job, response)
+                        if job.error:
+                            _debug("S3Sync.synchronize: %s PULL error %s" %
+                                   (job.task.resource_name, job.error))
+                        elif more:
+                            submit(job, self.__pull_request(job))
+                            return 1
+                        elif job.task.mode == 3:
+                            # Pull complete => push
+                            job.mode = self.log.PUSH
+                            submit(job, self.__push_request(job))
+                            return 1
+                    else:
+                        job.error, more = self.__push_result(job, response)
+                        if job.error:
+                            _debug("S3Sync.synchronize: %s PUSH error %s" %
+                                   (job.task.resource_name, job.error))
+                        elif more:
+                            submit(job, self.__push_request(job))
+                            return 1
+                    # Task complete => continue the tasks waiting for it
+                    job.done = True
+                    submitted = 0
+                    for dependent in job.dependents:
+                        submitted += advance(dependent)
+                    return submitted
+
+                try:
+                    # Request the first chunks of all pulls at once
+                    active = 0
+                    for job in jobs:
+                        if job.task.mode in (1, 3):
+                            job.mode = self.log.PULL
+                            submit(job, self.__pull_request(job))
+                            active += 1
+                    for job in jobs:
+                        active += advance(job)
+
+                    # Process the chunks as they arrive
+                    while active:
+                        job, response = responses.get()
+                        active -= 1
+                        job.received = True
+                        job.response = response
+                        active += advance(job)
+                finally:
+                    pool.close()
+                    pool.join()
+
+                for job in jobs:
+                    if not job.error:
+                        _debug("S3Sync.synchronize: %s success" %
+                               job.task.resource_name)
+                        job.task.update_record(last_sync=job.now)
+
+            # Success
+            for repository in locked:
+                results[repository.id] = xml.json_message()
+
+        finally:
+            for repository in locked:
+                self.__unlock(repository)
+
+        return results
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __dependencies(jobs):
+        """
+            Find the jobs each job of a repository has to wait for: those
+            of the tasks for the tables which its table references. Like
+            in S3ImportJob, the tables get dependency levels (referenced
+            tables first), and circular references are broken by only
+            waiting for jobs of a lower level.
+
+            @param jobs: the jobs of the repository, in task order
+        """
+
+        db = current.db
+        model = current.manager.model
+
+        tables = dict()
+        for job in jobs:
+            tables.setdefault(job.task.resource_name, []).append(job)
+
+        references = dict()
+        for tablename in tables:
+            references[tablename] = keys = set()
+            try:
+                model.load(tablename)
+                table = db[tablename]
+            except:
                 continue
-            _debug("S3Sync.synchronize: %s success" % task.resource_name)
-            task.update_record(last_sync=now)
+            for fn in table.fields:
+                fieldtype = str(table[fn].type)
+                if fieldtype.startswith("reference "):
+                    ktablename = fieldtype[10:]
+                elif fieldtype.startswith("list:reference "):
+                    ktablename = fieldtype[15:]
+                else:
+                    continue
+                if ktablename != tablename and ktablename in tables:
+                    keys.add(ktablename)
+
+        levels = dict()
+        def level(tablename):
+            if tablename in levels:
+                return levels[tablename]
+            levels[tablename] = 0
+            l = 0
+            for ktablename in references[tablename]:
+                l = max(l, level(ktablename) + 1)
+            levels[tablename] = l
+            return l
+
+        for job in jobs:
+            tablename = job.task.resource_name
+            l = level(tablename)
+            for ktablename in references[tablename]:
+                if levels[ktablename] < l:
+                    for dependency in tables[ktablename]:
+                        job.depends.append(dependency)
+                        dependency.dependents.append(job)
+        return
+
+    # -------------------------------------------------------------------------
+    def __lock(self, repository, manual=False):
+        """
+            Mark a repository as being synchronized, both in this process
+            and in the sync_status table (for other processes)
+
+            @param repository: the repository (sync_repository row)
+            @param manual: whether this is a manual synchronization
 
-        # Success
-        return xml.json_message()
+            @returns: True if successful, False if the repository is
+                      already being synchronized
+        """
+
+        S3Sync.lock.acquire()
+        try:
+            lock = S3Sync.locks.get(repository.id, None)
+            if lock is None:
+                lock = S3Sync.locks[repository.id] = threading.Lock()
+        finally:
+            S3Sync.lock.release()
+        if not lock.acquire(False):
+            return False
+
+        db = current.db
+        manager = current.manager
+
+        tablename = "sync_status"
+        manager.load(tablename)
+        table = db[tablename]
+
+        query = (table.repository_id == repository.id)
+        if not db(query).count():
+            table.insert(repository_id=repository.id, running=False)
+        query &= ((table.running == False) | (table.running == None))
+        success = db(query).update(running=True,
+                                   manual=manual,
+                                   timestmp=datetime.datetime.utcnow())
+        # Commit, so that other processes see the status
+        db.commit()
+        if not success:
+            lock.release()
+            return False
+        return True
 
     # -------------------------------------------------------------------------
-    def __pull(self, repository, task):
+    def __unlock(self, repository):
         """
-            Outgoing pull
+            Mark a repository as no longer being synchronized
 
             @param repository: the repository (sync_repository row)
-            @param task: the task (sync_task row)
         """
 
-        ignore_errors = True
+        self.set_status(repository_id=repository.id,
+                        running=False,
+                        manual=False)
+        current.db.commit()
+        S3Sync.locks[repository.id].release()
+
+    # -------------------------------------------------------------------------
+    def __get_opener(self, repository):
+        """
+            Get the URL opener for a repository, with the proxy and
+            authentication handlers of the repository and a handler which
+            keeps the connections to the peer open between requests.
+
+            Openers are kept per repository in this process instead of
+            installing them globally, so that several repositories can
+            be synchronized at the same time.
+
+            @param repository: the repository (sync_repository row)
+        """
+
+        config = self.__get_config()
+        url = repository.url
+        proxy = repository.proxy or config.proxy or None
+        username = repository.username
+        password = repository.password
+
+        key = (url, proxy, username, password)
+        S3Sync.lock.acquire()
+        try:
+            opener = S3Sync.openers.get(repository.id, None)
+            if opener is None or opener.key != key:
+                handlers = [S3SyncHTTPHandler()]
+
+                # Proxy handling
+                if proxy:
+                    _debug("using proxy=%s" % proxy)
+                    url_split = url.split("://", 1)
+                    if len(url_split) == 2:
+                        protocol = url_split[0]
+                    else:
+                        protocol = "http"
+                    proxy_handler = urllib2.ProxyHandler({protocol: proxy})
+                    handlers.append(proxy_handler)
+
+                # Authentication handling: a 401 handler just in case the
+                # peer does not accept unsolicited auth data (see __request)
+                if username and password:
+                    passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
+                    passwd_manager.add_password(realm=None,
+                                                uri=url,
+                                                user=username,
+                                                passwd=password)
+                    auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
+                    handlers.append(auth_handler)
+
+                opener = urllib2.build_opener(*handlers)
+                opener.key = key
+                # Whether the peer accepts compressed data
+                opener.compress = True
+                S3Sync.openers[repository.id] = opener
+        finally:
+            S3Sync.lock.release()
+        return opener
+
+    # -------------------------------------------------------------------------
+    def __request(self, repository, url, data=None, compress=False):
+        """
+            Prepare a request to a repository
+
+            @param repository: the repository (sync_repository row)
+            @param url: the URL
+            @param data: the data to send
+            @param compress: gzip the data (if the peer accepts it), and
+                             accept a gzipped response
+
+            @returns: a Storage with the opener, the urllib2.Request, and
+                      the fallback request with uncompressed data (or None)
+        """
+
+        opener = self.__get_opener(repository)
+
+        def build(data, encoding=None):
+            req = urllib2.Request(url=url, data=data)
+            if data is not None:
+                req.add_header("Content-Type", "text/xml")
+            if encoding:
+                req.add_header("Content-Encoding", encoding)
+            if compress:
+                req.add_header("Accept-Encoding", "gzip")
+
+            username = repository.username
+            password = repository.password
+            if username and password:
+                # Send auth data unsolicitedly (the only way with Eden instances):
+                import base64
+                base64string = base64.encodestring('%s:%s' %
+                                                   (username, password))[:-1]
+                req.add_header("Authorization", "Basic %s" % base64string)
+            return req
+
+        if data is not None and compress and opener.compress:
+            request = build(self.__compress(data), encoding="gzip")
+            fallback = build(data)
+        else:
+            request = build(data)
+            fallback = None
+
+        return Storage(opener=opener, request=request, fallback=fallback)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __compress(data):
+        """
+            Compress data with gzip
+
+            @param data: the data (string)
+        """
+
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode="wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return buf.getvalue()
+
+    # -------------------------------------------------------------------------
+    def __select_chunk(self, resource, msince=None, cursor=None, size=None):
+        """
+            Select the next chunk of records to synchronize: the records
+            modified after msince, ordered by modification date and id,
+            which follow the cursor
+
+            Records referenced by the chunk are exported together with it
+            (dereference) if they have been modified after msince, so that
+            e.g. the parent of a gis_location which falls into a later
+            chunk of the same table is still imported before the child.
+
+            @param resource: the S3Resource
+            @param msince: the minimum modification date
+            @param cursor: the position of the chunk, as returned for the
+                           previous chunk
+            @param size: the number of records in a chunk
+
+            @returns: tuple (ids, cursor), cursor being the position of the
+                      next chunk, or None if this is the last chunk
+        """
+
+        db = current.db
         xml = current.manager.xml
 
+        table = resource.table
+        mtime = table[xml.MTIME]
+        pkey = table._id
+
+        query = resource.get_query()
+        if msince is not None:
+            query &= (mtime > msince)
+        if cursor:
+            try:
+                timestmp, record_id = cursor.rsplit(",", 1)
+                if "." in timestmp:
+                    tfmt = "%s.%%f" % xml.ISOFORMAT
+                else:
+                    tfmt = xml.ISOFORMAT
+                timestmp = datetime.datetime.strptime(timestmp, tfmt)
+                record_id = long(record_id)
+            except ValueError:
+                pass
+            else:
+                query &= ((mtime > timestmp) | \
+                          ((mtime == timestmp) & (pkey > record_id)))
+
+        rows = db(query).select(pkey, mtime,
+                                orderby=mtime|pkey,
+                                limitby=(0, size))
+        ids = [row[pkey.name] for row in rows]
+        if len(rows) == size:
+            last = rows.last()
+            cursor = "%s,%s" % (last[xml.MTIME].isoformat(), last[pkey.name])
+        else:
+            cursor = None
+        return (ids, cursor)
+
+    # -------------------------------------------------------------------------
+    def __pull_request(self, job):
+        """
+            Prepare the request for (the next chunk of) an outgoing pull
+
+            @param job: the job (Storage with repository and task)
+        """
+
+        xml = current.manager.xml
+        repository = job.repository
+        task = job.task
+
         resource_name = task.resource_name
-        prefix, name = resource_name.split("_", 1)
 
         _debug("S3Sync.__pull(%s, %s)" % (repository.url, resource_name))
 
         # Construct the URL
         config = self.__get_config()
-        proxy = repository.proxy or config.proxy or None
         url = "%s/sync/sync.xml?resource=%s&repository=%s" % \
               (repository.url, resource_name, config.uuid)
 
-        username = repository.username
-        password = repository.password
-        last_sync = task.last_sync
-
-        # Get the target resource for this task
-        resource = current.manager.define_resource(prefix, name)
-
         # Add msince and deleted to the URL
+        last_sync = task.last_sync
         if last_sync and task.update_policy not in ("THIS", "OTHER"):
             url += "&msince=%s" % xml.encode_iso_datetime(last_sync)
         url += "&include_deleted=True"
 
+        # Request the next chunk after the checkpoint
+        chunk_size = current.deployment_settings.get_sync_chunk_size()
+        if chunk_size:
+            url += "&chunk=%s" % chunk_size
+            if task.pull_checkpoint:
+                url += "&after=%s" % urllib2.quote(task.pull_checkpoint)
+
         _debug("...pull from URL %s" % url)
 
-        response = None
-        url_split = url.split("://", 1)
-        if len(url_split) == 2:
-            protocol, path = url_split
-        else:
-            protocol, path = "http", None
-
-        # Prepare the request
-        import urllib2
-        req = urllib2.Request(url=url)
-        handlers = []
-
-        # Proxy handling
-        if proxy:
-            _debug("using proxy=%s" % proxy)
-            proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-            handlers.append(proxy_handler)
-
-        # Authentication handling
-        if username and password:
-            # Send auth data unsolicitedly (the only way with Eden instances):
-            import base64
-            base64string = base64.encodestring('%s:%s' %
-                                               (username, password))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-            # Just in case the peer does not accept that, add a 401 handler:
-            passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            passwd_manager.add_password(realm=None,
-                                        uri=url,
-                                        user=username,
-                                        passwd=password)
-            auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-            handlers.append(auth_handler)
-
-        # Install all handlers
-        if handlers:
-            opener = urllib2.build_opener(*handlers)
-            urllib2.install_opener(opener)
+        return self.__request(repository, url, compress=True)
+
+    # -------------------------------------------------------------------------
+    def __pull_import(self, job, response):
+        """
+            Import the response to an outgoing pull, and store the position
+            of the next chunk in the task
+
+            @param job: the job (Storage with repository and task)
+            @param response: the response (see _fetch)
+
+            @returns: tuple (error, more), more being True if there are
+                      more chunks to pull
+        """
+
+        ignore_errors = True
+        db = current.db
+        xml = current.manager.xml
+        repository = job.repository
+        task = job.task
+
+        resource_name = task.resource_name
+        prefix, name = resource_name.split("_", 1)
+
+        # Get the target resource for this task
+        resource = current.manager.define_resource(prefix, name)
 
         remote = False
         output = None
-        response = None
 
-        # Execute the request
-        try:
-            f = urllib2.urlopen(req)
-        except urllib2.HTTPError, e:
+        if response.remote:
             result = self.log.ERROR
             remote = True # Peer error
-            code = e.code
-            message = e.read()
+            code = response.code
+            message = response.error
             try:
                 # Sahana-Eden would send a JSON message,
                 # try to extract the actual error message:
@@ -318,22 +822,22 @@ class S3Sync(S3Method):
             except etree.XMLSyntaxError:
                 pass
             output = xml.json_message(False, code, message, tree=None)
-        except:
+        elif response.error is not None:
             result = self.log.FATAL
-            code = 400
-            message = sys.exc_info()[1]
+            code = response.code
+            message = response.error
             output = xml.json_message(False, code, message)
         else:
             result = self.log.SUCCESS
-            response = f
 
         # Get import strategy and update policy
         strategy = task.strategy
         update_policy = task.update_policy
         conflict_policy = task.conflict_policy
+        last_sync = task.last_sync
 
         # Try to import the response
-        if response:
+        if response.body:
             success = True
             message = ""
             try:
@@ -342,7 +846,7 @@ class S3Sync(S3Method):
                              self.__resolve_conflict(item,
                                                      repository,
                                                      resource)
-                success = import_xml(response,
+                success = import_xml(StringIO(response.body),
                                      ignore_errors=ignore_errors,
                                      strategy=strategy,
                                      update_policy=update_policy,
@@ -384,6 +888,7 @@ class S3Sync(S3Method):
             result = self.log.ERROR
             remote = True
             message = "no data received from peer"
+            output = xml.json_message(False, 400, message)
 
         # log the operation
         self.log.write(repository_id=repository.id,
@@ -396,33 +901,38 @@ class S3Sync(S3Method):
                        message=message)
 
         _debug("S3Sync.__pull import %s: %s" % (result, message))
-        return output
+
+        if output is not None:
+            return (output, False)
+
+        # Commit the chunk together with the checkpoint
+        task.update_record(pull_checkpoint=response.cursor)
+        db.commit()
+        return (None, response.cursor is not None)
 
     # -------------------------------------------------------------------------
-    def __push(self, repository, task):
+    def __push_request(self, job):
         """
-            Outgoing push
+            Prepare the request for (the next chunk of) an outgoing push
+
+           @param job: the job (Storage with repository and task)
 
-           @param repository: a sync_repository row
-           @param task: a sync_task row
+           @returns: the request, or None if there is no data to send
          """
 
         xml = current.manager.xml
+        repository = job.repository
+        task = job.task
 
         resource_name = task.resource_name
-        prefix, name = resource_name.split("_", 1)
 
         _debug("S3Sync.__push(%s, %s)" % (repository.url, resource_name))
 
         # Construct the URL
         config = self.__get_config()
-        proxy = repository.proxy or config.proxy or None
         url = "%s/sync/sync.xml?resource=%s&repository=%s" % \
               (repository.url, resource_name, config.uuid)
 
-        username = repository.username
-        password = repository.password
-
         strategy = task.strategy
         if strategy:
             url += "&strategy=%s" % ",".join(strategy)
@@ -444,59 +954,66 @@ class S3Sync(S3Method):
         prefix, name = task.resource_name.split("_", 1)
         resource = current.manager.define_resource(prefix, name,
                                                    include_deleted=True)
+
+        # Select the next chunk after the checkpoint
+        chunk_size = current.deployment_settings.get_sync_chunk_size()
+        if chunk_size and xml.MTIME in resource.table.fields:
+            ids, job.cursor = self.__select_chunk(resource,
+                                                  msince=last_sync,
+                                                  cursor=task.push_checkpoint,
+                                                  size=chunk_size)
+            if not ids:
+                return None
+            resource = current.manager.define_resource(prefix, name,
+                                                       id=ids,
+                                                       include_deleted=True)
+        else:
+            job.cursor = None
+
         data = resource.export_xml(msince=last_sync)
+        if not data:
+            return None
 
-        remote = False
-        output = None
+        return self.__request(repository, url, data=data, compress=True)
 
-        if data:
-            # Find the protocol
-            url_split = url.split("://", 1)
-            if len(url_split) == 2:
-                protocol, path = url_split
-            else:
-                protocol, path = "http", None
+    # -------------------------------------------------------------------------
+    def __push_result(self, job, response):
+        """
+            Log the result of an outgoing push, and store the position
+            of the next chunk in the task
 
-            # Generate the request
-            import urllib2
-            req = urllib2.Request(url=url, data=data)
-            req.add_header('Content-Type', "text/xml")
+           @param job: the job (Storage with repository and task)
+           @param response: the response (see _fetch), None if there
+                            was no data to send
 
-            handlers = []
-            if proxy:
-                # Proxy handling
-                _debug("using proxy=%s" % proxy)
-                proxy_handler = urllib2.ProxyHandler({protocol: proxy})
-                handlers.append(proxy_handler)
-            if username and password:
-                # Authentication handling:
-                # send auth credentials unsolicitedly
-                import base64
-                base64string = base64.encodestring('%s:%s' %
-                                                   (username, password))[:-1]
-                req.add_header("Authorization", "Basic %s" % base64string)
-                # Just in case the peer does not accept that
-                # => add a 401 handler:
-                passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passwd_manager.add_password(realm=None,
-                                            uri=url,
-                                            user=username,
-                                            passwd=password)
-                auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-                handlers.append(auth_handler)
-            # Install all handlers
-            if handlers:
-                opener = urllib2.build_opener(*handlers)
-                urllib2.install_opener(opener)
+           @returns: tuple (error, more), more being True if there are
+                     more chunks to push
+         """
 
-            # Execute the request
-            try:
-                f = urllib2.urlopen(req)
-            except urllib2.HTTPError, e:
-                result = self.log.FATAL
+        db = current.db
+        xml = current.manager.xml
+        repository = job.repository
+        task = job.task
+
+        remote = False
+        output = None
+
+        if response is None:
+            if job.chunks:
+                # Last chunk already sent
+                if task.push_checkpoint:
+                    task.update_record(push_checkpoint=None)
+                    db.commit()
+                return (None, False)
+            # No data to send
+            result = self.log.WARNING
+            message = "No data to sent"
+        elif response.error is not None:
+            result = self.log.FATAL
+            code = response.code
+            message = response.error
+            if response.remote:
                 remote = True # Peer error
-                code = e.code
-                message = e.read()
                 try:
                     # Sahana-Eden would send a JSON message,
                     # try to extract the actual error message:
@@ -504,19 +1021,10 @@ class S3Sync(S3Method):
                     message = message_json.get("message", message)
                 except:
                     pass
-                output = xml.json_message(False, code, message)
-            except:
-                result = self.log.FATAL
-                code = 400
-                message = sys.exc_info()[1]
-                output = xml.json_message(False, code, message)
-            else:
-                result = self.log.SUCCESS
-                message = "data sent successfully"
+            output = xml.json_message(False, code, message)
         else:
-            # No data to send
-            result = self.log.WARNING
-            message = "No data to sent"
+            result = self.log.SUCCESS
+            message = "data sent successfully"
 
         # log the operation
         self.log.write(repository_id=repository.id,
@@ -528,7 +1036,14 @@ class S3Sync(S3Method):
                        result=result,
                        message=message)
 
-        return output
+        if output is not None or response is None:
+            return (output, False)
+
+        # Peer has acknowledged the chunk => store the checkpoint
+        job.chunks += 1
+        task.update_record(push_checkpoint=job.cursor)
+        db.commit()
+        return (None, job.cursor is not None)
 
     # -------------------------------------------------------------------------
     def __register(self, r, **attr):
@@ -615,42 +1130,18 @@ class S3Sync(S3Method):
 
         # Construct the URL
         config = self.__get_config()
-        proxy = repository.proxy or config.proxy or None
         url = "%s/sync/repository/register.xml?repository=%s" % \
               (repository.url, config.uuid)
         _debug("...send to URL %s" % url)
 
-        username = repository.username
-        password = repository.password
-
         # Generate the request
-        import urllib2
-        req = urllib2.Request(url=url)
-        handlers = []
-        if proxy:
-            proxy_handler = urllib2.ProxyHandler({"http": proxy})
-            handlers.append(proxy_handler)
-        if username and password:
-            import base64
-            base64string = base64.encodestring('%s:%s' %
-                                               (username, password))[:-1]
-            req.add_header("Authorization", "Basic %s" % base64string)
-            passwd_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
-            passwd_manager.add_password(realm=None,
-                                        uri=url,
-                                        user=username,
-                                        passwd=password)
-            auth_handler = urllib2.HTTPBasicAuthHandler(passwd_manager)
-            handlers.append(auth_handler)
-        if handlers:
-            opener = urllib2.build_opener(*handlers)
-            urllib2.install_opener(opener)
+        request = self.__request(repository, url)
 
         # Execute the request
         success = True
         remote = False
         try:
-            f = urllib2.urlopen(req)
+            f = request.opener.open(request.request)
         except urllib2.HTTPError, e:
             result = self.log.FATAL
             remote = True # Peer error
@@ -744,16 +1235,48 @@ class S3Sync(S3Method):
             except ValueError:
                 msince = None
 
+        chunk = _vars.get("chunk", None)
+        if chunk is not None:
+            try:
+                chunk = int(chunk)
+            except ValueError:
+                chunk = None
+        headers = current.response.headers
+
         # Export the resource
         resource = r.resource
-        output = resource.export_xml(start=start,
-                                     limit=limit,
-                                     msince=msince)
+        if chunk and xml.MTIME in resource.table.fields:
+            # Export the next chunk, and the position of the chunk after
+            ids, cursor = self.__select_chunk(resource,
+                                              msince=msince,
+                                              cursor=_vars.get("after", None),
+                                              size=chunk)
+            if ids:
+                resource = manager.define_resource(resource.prefix,
+                                                   resource.name,
+                                                   id=ids,
+                                                   include_deleted=resource.include_deleted)
+                output = resource.export_xml(msince=msince)
+            else:
+                output = xml.tostring(xml.tree(None,
+                                               domain=manager.domain,
+                                               results=0))
+            if cursor:
+                headers["X-Sync-Next"] = cursor
+        else:
+            output = resource.export_xml(start=start,
+                                         limit=limit,
+                                         msince=msince)
 
         # Set content type header
-        headers = current.response.headers
         headers["Content-Type"] = "text/xml"
 
+        # Compress the output if the peer accepts it
+        accept_encoding = r.env.http_accept_encoding
+        if output and accept_encoding and "gzip" in accept_encoding:
+            output = self.__compress(output)
+            headers["Content-Encoding"] = "gzip"
+
         # Log the operation
         self.log.write(repository_id=repository.id,
                        resource_name=r.resource.tablename,
@@ -848,6 +1371,13 @@ class S3Sync(S3Method):
 
         # Get the source
         source = r.read_body()
+        if r.env.http_content_encoding == "gzip":
+            try:
+                source = [StringIO(zlib.decompress(s.read(),
+                                                   16 + zlib.MAX_WBITS))
+                          for s in source]
+            except zlib.error:
+                r.error(400, "Invalid compressed data")
 
         # Import resource
         resource = r.resource
@@ -970,6 +1500,129 @@ class S3Sync(S3Method):
 
 # =============================================================================
 
+class S3SyncHTTPHandler(urllib2.AbstractHTTPHandler):
+    """
+        HTTP(S) handler for requests to peer repositories, which keeps
+        the connections to the peer open between requests (keep-alive)
+        instead of opening a new connection for every request like the
+        default handlers of urllib2.
+
+        Responses are read completely before the connection is returned
+        to the pool, and the pool is thread-safe, so that several
+        resources can be pulled from the same peer at the same time.
+    """
+
+    # Take precedence over the default HTTP(S) handlers
+    handler_order = 400
+
+    http_request = urllib2.AbstractHTTPHandler.do_request_
+    https_request = urllib2.AbstractHTTPHandler.do_request_
+
+    # -------------------------------------------------------------------------
+    def __init__(self, debuglevel=0):
+        """
+            Constructor
+
+            @param debuglevel: the debug level for httplib
+        """
+
+        urllib2.AbstractHTTPHandler.__init__(self, debuglevel=debuglevel)
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    # -------------------------------------------------------------------------
+    def http_open(self, req):
+        return self.__open(httplib.HTTPConnection, req)
+
+    # -------------------------------------------------------------------------
+    def https_open(self, req):
+        return self.__open(httplib.HTTPSConnection, req)
+
+    # -------------------------------------------------------------------------
+    def __open(self, connection_class, req):
+        """
+            Send a request through an idle (or a new) connection
+
+            @param connection_class: the httplib connection class
+            @param req: the urllib2.Request
+        """
+
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError("no host given")
+        tunnel = getattr(req, "_tunnel_host", None)
+        key = (connection_class, host, tunnel)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                                   if k not in headers))
+        headers = dict((k.title(), v) for k, v in headers.items())
+        headers["Connection"] = "keep-alive"
+        tunnel_headers = dict()
+        if tunnel and "Proxy-Authorization" in headers:
+            tunnel_headers["Proxy-Authorization"] = \
+                headers.pop("Proxy-Authorization")
+
+        while True:
+            connection = self.__get(key)
+            reused = connection is not None
+            if not reused:
+                connection = connection_class(host, timeout=req.timeout)
+                connection.set_debuglevel(self._debuglevel)
+                if tunnel:
+                    connection.set_tunnel(tunnel, headers=tunnel_headers)
+            try:
+                connection.request(req.get_method(),
+                                   req.get_selector(),
+                                   req.data,
+                                   headers)
+                r = connection.getresponse()
+                body = r.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused:
+                    # Closed by the peer in the meantime => try again
+                    continue
+                raise urllib2.URLError(e)
+            break
+
+        if r.will_close:
+            connection.close()
+        else:
+            self.__put(key, connection)
+
+        response = urllib2.addinfourl(StringIO(body),
+                                      r.msg,
+                                      req.get_full_url(),
+                                      r.status)
+        response.msg = r.reason
+        return response
+
+    # -------------------------------------------------------------------------
+    def __get(self, key):
+        """ Take an idle connection from the pool """
+
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key, None)
+            if connections:
+                return connections.pop()
+            return None
+        finally:
+            self.lock.release()
+
+    # -------------------------------------------------------------------------
+    def __put(self, key, connection):
+        """ Return a connection to the pool """
+
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(key, []).append(connection)
+        finally:
+            self.lock.release()
+
+# =============================================================================
+
 class S3SyncLog(S3Method):
     """ Synchronization Logger """
 
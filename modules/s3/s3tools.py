@@ -482,8 +482,13 @@ class S3BulkImporter(object):
 #                                      vars=vars)
 #            from s3import import S3Importer
 #            r.set_handler("import", S3Importer(), transform=True)
-            # Execute the request
-            output = r()
+            # Execute the request (using bulk imports)
+            bulk_import = manager.bulk_import
+            manager.bulk_import = True
+            try:
+                output = r()
+            finally:
+                manager.bulk_import = bulk_import
             # If it doesn't import - use this to check the
             # returned message and error tree for validation errors:
             #print >> sys.stderr, "%s=%s" % (r.tablename, output)
@@ -315,7 +315,8 @@ class S3Trackable(object):
             elif r[self.TRACK_ID]:
                 data.update({self.TRACK_ID:r[self.TRACK_ID]})
                 ptable.insert(**data)
-                self.__update_timestamp(r[self.TRACK_ID], timestmp)
+                self.__update_index(r[self.TRACK_ID], timestmp,
+                                    location_id=location)
 
 
     # -------------------------------------------------------------------------
@@ -376,7 +377,8 @@ class S3Trackable(object):
                     continue
                 data.update({self.TRACK_ID:r[self.TRACK_ID]})
                 ptable.insert(**data)
-                self.__update_timestamp(r[self.TRACK_ID], timestmp)
+                self.__update_index(r[self.TRACK_ID], timestmp,
+                                    interlock=interlock)
 
 
     # -------------------------------------------------------------------------
@@ -435,6 +437,8 @@ class S3Trackable(object):
                 tablename, record = presence.interlock.split(",", 1)
                 trackable = S3Trackable(current.db, tablename, record)
                 location = trackable.get_location(timestmp=timestmp)
+                if isinstance(location, Row):
+                    location = location.id
                 if timestmp - presence.timestmp < timedelta(seconds=1):
                     timestmp = timestmp + timedelta(seconds=1)
                 data = dict(location_id=location,
@@ -442,7 +446,8 @@ class S3Trackable(object):
                             interlock=None)
                 data.update({self.TRACK_ID:r[self.TRACK_ID]})
                 ptable.insert(**data)
-                self.__update_timestamp(r[self.TRACK_ID], timestmp)
+                self.__update_index(r[self.TRACK_ID], timestmp,
+                                    location_id=location)
 
 
     # -------------------------------------------------------------------------
@@ -576,20 +581,31 @@ class S3Trackable(object):
 
 
     # -------------------------------------------------------------------------
-    def __update_timestamp(self, track_id, timestamp):
+    def __update_index(self, track_id, timestamp,
+                       location_id=None,
+                       interlock=None):
         """
-            Update the timestamp of a trackable
+            Update the latest presence of a trackable (timestamp, location
+            and interlock), unless it already has a later presence
 
             @param track_id: the trackable ID (super-entity key)
             @param timestamp: the timestamp
+            @param location_id: the location of the presence
+            @param interlock: the interlock of the presence
         """
 
         if timestamp is None:
             timestamp = datetime.utcnow()
+        trackable = None
         if track_id:
             trackable = self.table[track_id]
         if trackable:
-            trackable.update_record(track_timestmp=timestamp)
+            if trackable.track_timestmp and \
+               trackable.track_timestmp > timestamp:
+                return
+            trackable.update_record(track_timestmp=timestamp,
+                                    track_location_id=location_id,
+                                    track_interlock=interlock)
 
 
 # =============================================================================
@@ -599,6 +615,9 @@ class S3Tracker(object):
 
     """
 
+    # Maximum number of levels of check-ins to follow
+    MAX_DEPTH = 16
+
     def __init__(self):
         """
         Constructor
@@ -634,8 +653,59 @@ class S3Tracker(object):
         """
         Get all instances of the given entity at the given location and time
 
+        @param entity: the trackable type (a Table or a tablename)
+        @param location: a location (as Row or record ID) or a list of
+                         location IDs, finds all instances at this location
+                         or at any location below it in the hierarchy
+        @param bbox: a bounding box as dict with min_lon, min_lat, max_lon
+                     and max_lat (as returned by gis.get_bounds), finds all
+                     instances located within this box
+        @param timestmp: the date/time (defaults to current time)
+
+        @returns: a Rows object with the instance records
+
         """
-        raise NotImplementedError
+
+        db = current.db
+        TRACK_ID = S3Trackable.TRACK_ID
+        ltable = db[S3Trackable.LOCATION]
+
+        if isinstance(entity, str):
+            table = db[entity]
+        else:
+            table = entity
+        if TRACK_ID not in table.fields:
+            raise SyntaxError("No trackable type: %s" % table._tablename)
+
+        query = (table[TRACK_ID] != None)
+        if "deleted" in table.fields:
+            query = query & (table.deleted != True)
+        rows = db(query).select(table[TRACK_ID])
+        locations = self.__locate([r[TRACK_ID] for r in rows], timestmp)
+
+        # Filter the locations found
+        location_ids = list(set([l for l in locations.values() if l]))
+        if not location_ids:
+            return Rows(records=[], compact=False)
+        lquery = (ltable.id.belongs(location_ids))
+        if location is not None:
+            lquery = lquery & self.__location_query(location)
+        if bbox is not None:
+            if isinstance(bbox, (list, tuple)):
+                min_lon, min_lat, max_lon, max_lat = bbox
+            else:
+                min_lon, min_lat = bbox["min_lon"], bbox["min_lat"]
+                max_lon, max_lat = bbox["max_lon"], bbox["max_lat"]
+            lquery = lquery & \
+                     (ltable.lon >= min_lon) & (ltable.lon <= max_lon) & \
+                     (ltable.lat >= min_lat) & (ltable.lat <= max_lat)
+        rows = db(lquery).select(ltable.id)
+        found = set([r.id for r in rows])
+        track_ids = [t for t in locations if locations[t] in found]
+        if not track_ids:
+            return Rows(records=[], compact=False)
+
+        return db(query & (table[TRACK_ID].belongs(track_ids))).select()
 
 
     # -------------------------------------------------------------------------
@@ -646,8 +716,314 @@ class S3Tracker(object):
         Get all trackables of the given type that are checked-in
         to the given instance at the given time
 
+        @param table: the table (or tablename) of the instance
+        @param record: the instance record (as Row or record ID)
+        @param instance_type: the trackable type (tablename), None for all
+        @param timestmp: the date/time (defaults to current time)
+
+        @returns: a Rows object with the instance records, or with the
+                  sit_trackable records if no instance_type is given
+
         """
-        raise NotImplementedError
+
+        db = current.db
+        TRACK_ID = S3Trackable.TRACK_ID
+        UID = S3Trackable.UID
+        stable = db.sit_trackable
+
+        if isinstance(table, str):
+            table = db[table]
+        if isinstance(record, Rows):
+            record = record.first()
+        if isinstance(record, Row):
+            if "instance_type" in record and UID in record:
+                table = db[record.instance_type]
+                query = table[UID] == record[UID]
+                record = db(query).select(table._id,
+                                          limitby=(0, 1)).first()
+                if not record:
+                    return Rows(records=[], compact=False)
+            record = record[table._id.name]
+        interlock = "%s,%s" % (table, record)
+
+        if timestmp is None:
+            timestmp = datetime.utcnow()
+
+        # Trackables whose latest presence is this check-in
+        query = (stable.deleted != True)
+        if instance_type is not None:
+            query = query & (stable.instance_type == instance_type)
+        rows = db(query &
+                  (stable.track_interlock == interlock) &
+                  (stable.track_timestmp <= timestmp)).select(stable[TRACK_ID])
+        track_ids = [r[TRACK_ID] for r in rows]
+
+        # Trackables with a later presence, or without index, need their
+        # presence at timestmp from the log
+        unindexed = (stable.track_timestmp != None) & \
+                    (stable.track_location_id == None) & \
+                    (stable.track_interlock == None)
+        rows = db(query &
+                  ((stable.track_timestmp > timestmp) | unindexed)).select(stable[TRACK_ID])
+        presence = self.__latest_presence([r[TRACK_ID] for r in rows],
+                                          timestmp)
+        track_ids += [t for t in presence if presence[t][1] == interlock]
+        if not track_ids:
+            return Rows(records=[], compact=False)
+
+        if instance_type is not None:
+            itable = db[instance_type]
+            query = (itable[TRACK_ID].belongs(track_ids))
+            if "deleted" in itable.fields:
+                query = query & (itable.deleted != True)
+            return db(query).select()
+        else:
+            return db(stable[TRACK_ID].belongs(track_ids)).select()
+
+
+    # -------------------------------------------------------------------------
+    def __latest_presence(self, track_ids, timestmp=None):
+        """
+            Get the latest presence of trackables (at the given time),
+            from the presence index where it is valid for that time,
+            otherwise from the presence log
+
+            @param track_ids: list of trackable IDs (super-entity keys)
+            @param timestmp: the date/time (defaults to current time)
+
+            @returns: a dict {track_id: (location_id, interlock)}
+        """
+
+        db = current.db
+        TRACK_ID = S3Trackable.TRACK_ID
+        stable = db.sit_trackable
+        ptable = db[S3Trackable.PRESENCE]
+
+        if timestmp is None:
+            timestmp = datetime.utcnow()
+
+        presence = {}
+        if not track_ids:
+            return presence
+
+        rows = db(stable[TRACK_ID].belongs(track_ids)).select(stable[TRACK_ID],
+                                                              stable.track_timestmp,
+                                                              stable.track_location_id,
+                                                              stable.track_interlock)
+        log = []
+        for row in rows:
+            track_id = row[TRACK_ID]
+            if not row.track_timestmp:
+                # No presence logged through the tracker => check the log
+                log.append(track_id)
+            elif row.track_timestmp > timestmp or \
+                 not row.track_location_id and not row.track_interlock:
+                # Later presence, or not yet indexed => check the log
+                log.append(track_id)
+            else:
+                presence[track_id] = (row.track_location_id,
+                                      row.track_interlock)
+
+        if log:
+            query = (ptable.deleted != True) & \
+                    (ptable[TRACK_ID].belongs(log)) & \
+                    (ptable.timestmp <= timestmp)
+            # Time of the latest presence of each trackable
+            latest = ptable.timestmp.max()
+            rows = db(query).select(ptable[TRACK_ID],
+                                    latest,
+                                    groupby=ptable[TRACK_ID])
+            latest = dict([(row[ptable[TRACK_ID]], row[latest])
+                           for row in rows])
+            if latest:
+                # Read only the latest presence of each trackable
+                query &= (ptable.timestmp.belongs(set(latest.values())))
+                rows = db(query).select(ptable[TRACK_ID],
+                                        ptable.timestmp,
+                                        ptable.location_id,
+                                        ptable.interlock,
+                                        orderby=ptable.id)
+                for row in rows:
+                    track_id = row[TRACK_ID]
+                    if row.timestmp == latest.get(track_id, None):
+                        presence[track_id] = (row.location_id, row.interlock)
+
+        return presence
+
+
+    # -------------------------------------------------------------------------
+    def __locate(self, track_ids, timestmp=None):
+        """
+            Find the current locations of trackables (at the given time)
+            with a fixed number of queries per level of check-ins, rather
+            than per trackable
+
+            @param track_ids: list of trackable IDs (super-entity keys)
+            @param timestmp: the date/time (defaults to current time)
+
+            @returns: a dict {track_id: location_id}
+        """
+
+        db = current.db
+        TRACK_ID = S3Trackable.TRACK_ID
+        LOCATION_ID = S3Trackable.LOCATION_ID
+
+        # Where each trackable is: (True, location_id) at a location,
+        # (False, track_id) checked-in to another trackable, or None
+        pointers = {}
+
+        # Read the presences level by level of check-ins
+        pending = list(set(track_ids))
+        depth = 0
+        while pending and depth < self.MAX_DEPTH:
+            depth += 1
+            presence = self.__latest_presence(pending, timestmp)
+
+            interlocks = {}
+            for track_id in pending:
+                location_id, interlock = presence.get(track_id, (None, None))
+                pointers[track_id] = None
+                if interlock:
+                    tablename, record_id = interlock.split(",", 1)
+                    records = interlocks.setdefault(tablename, {})
+                    records.setdefault(int(record_id), []).append(track_id)
+                elif location_id:
+                    pointers[track_id] = (True, location_id)
+
+            # Look up the instances checked-in to, table by table
+            pending = set()
+            for tablename in interlocks:
+                records = interlocks[tablename]
+                table = db[tablename]
+                fields = [table._id]
+                if TRACK_ID in table.fields:
+                    fields.append(table[TRACK_ID])
+                if LOCATION_ID in table.fields:
+                    fields.append(table[LOCATION_ID])
+                if len(fields) == 1:
+                    continue
+                rows = db(table._id.belongs(records.keys())).select(*fields)
+                for row in rows:
+                    target = row.get(TRACK_ID, None)
+                    if target:
+                        pointer = (False, target)
+                        if target not in pointers:
+                            pending.add(target)
+                    elif row.get(LOCATION_ID, None):
+                        pointer = (True, row[LOCATION_ID])
+                    else:
+                        continue
+                    for track_id in records[row[table._id.name]]:
+                        pointers[track_id] = pointer
+            pending = list(pending)
+
+        # Follow the check-ins to a location. Where the chain ends without
+        # location (or runs in circles), the last trackable of the chain
+        # is at its base location.
+        resolved = {}
+        terminals = {}
+        for track_id in track_ids:
+            chain = []
+            visited = set()
+            current_id = track_id
+            location_id = None
+            terminal = None
+            while True:
+                if current_id in resolved:
+                    location_id = resolved[current_id]
+                    terminal = terminals.get(current_id, None)
+                    break
+                if current_id in visited:
+                    # Circular check-in
+                    terminal = chain[-1]
+                    break
+                chain.append(current_id)
+                visited.add(current_id)
+                pointer = pointers.get(current_id, None)
+                if pointer is None:
+                    terminal = current_id
+                    break
+                is_location, value = pointer
+                if is_location:
+                    location_id = value
+                    break
+                current_id = value
+            for t in chain:
+                resolved[t] = location_id
+                terminals[t] = terminal
+
+        # Fall back to the base location of the last trackable of the chain
+        base = set([terminals[t] for t in track_ids
+                    if not resolved[t] and terminals[t]])
+        if base:
+            base = self.__base_locations(list(base))
+        locations = {}
+        for track_id in track_ids:
+            location_id = resolved[track_id]
+            if not location_id:
+                location_id = base.get(terminals[track_id], None)
+            if location_id:
+                locations[track_id] = location_id
+
+        return locations
+
+    # -------------------------------------------------------------------------
+    def __base_locations(self, track_ids):
+        """
+            Get the base locations of trackables, type by type
+
+            @param track_ids: list of trackable IDs (super-entity keys)
+
+            @returns: a dict {track_id: location_id}
+        """
+
+        db = current.db
+        TRACK_ID = S3Trackable.TRACK_ID
+        LOCATION_ID = S3Trackable.LOCATION_ID
+        stable = db.sit_trackable
+
+        locations = {}
+        rows = db(stable[TRACK_ID].belongs(track_ids)).select(stable[TRACK_ID],
+                                                              stable.instance_type)
+        types = {}
+        for row in rows:
+            types.setdefault(row.instance_type, []).append(row[TRACK_ID])
+        for instance_type in types:
+            table = db[instance_type]
+            if LOCATION_ID not in table.fields:
+                continue
+            query = (table[TRACK_ID].belongs(types[instance_type]))
+            rows = db(query).select(table[TRACK_ID], table[LOCATION_ID])
+            for row in rows:
+                if row[LOCATION_ID]:
+                    locations[row[TRACK_ID]] = row[LOCATION_ID]
+        return locations
+
+
+    # -------------------------------------------------------------------------
+    def __location_query(self, location):
+        """
+            Query for a location or any location below it in the hierarchy
+
+            @param location: the location (as Row or record ID) or a list
+                             of location IDs
+        """
+
+        db = current.db
+        ltable = db[S3Trackable.LOCATION]
+
+        if isinstance(location, Row):
+            location = location.id
+        if not isinstance(location, (list, tuple)):
+            location = [location]
+        location = [int(l) for l in location]
+
+        query = (ltable.id.belongs(location))
+        rows = db(query).select(ltable.path)
+        for row in rows:
+            if row.path:
+                query = query | (ltable.path.like("%s/%%" % row.path))
+        return query
 
 
 # =============================================================================
@@ -35,13 +35,18 @@
     OTHER DEALINGS IN THE SOFTWARE.
 """
 
-__all__ = ["S3XML"]
+__all__ = ["S3XML", "S3XMLWriter", "S3XSLTCache"]
 
+import os
 import sys
 import csv
+import time
 import datetime
+import threading
 import urllib2
 
+from xml.sax.saxutils import quoteattr
+
 from gluon import *
 from gluon.storage import Storage
 import gluon.contrib.simplejson as json
@@ -64,6 +69,7 @@ class S3XML(S3Codec):
     namespace = "sahana"
 
     CACHE_TTL = 20 # time-to-live of RAM cache for field representations
+    REF_CHUNK_SIZE = 500 # max number of keys per query in prefetch_references
 
     UID = "uuid"
     MCI = "mci"
@@ -193,6 +199,12 @@ class S3XML(S3Codec):
 
         self.filter_mci = False # Set to true to suppress export at MCI<0
 
+        # Reference cache for rmap, see prefetch_references
+        self.ref_cache = Storage()
+
+        # Marker and popup cache for gis_encode, see prefetch_popups
+        self.gis_cache = Storage(markers={}, filters={}, represent={})
+
     # XML+XSLT tools ==========================================================
     #
     def parse(self, source):
@@ -235,12 +247,18 @@ class S3XML(S3Codec):
             _args = dict(_args)
         else:
             _args = None
-        stylesheet = self.parse(stylesheet_path)
 
-        if stylesheet:
+        # Get the compiled stylesheet from the cache
+        try:
+            transformer, version = S3XSLTCache.get(stylesheet_path)
+        except:
+            # Error parsing or compiling the XSL stylesheet
+            e = sys.exc_info()[1]
+            self.error = e
+            return None
+
+        try:
             try:
-                ac = etree.XSLTAccessControl(read_file=True, read_network=True)
-                transformer = etree.XSLT(stylesheet, access_control=ac)
                 if _args:
                     result = transformer(tree, **_args)
                 else:
@@ -250,9 +268,8 @@ class S3XML(S3Codec):
                 e = sys.exc_info()[1]
                 self.error = e
                 return None
-        else:
-            # Error parsing the XSL stylesheet
-            return None
+        finally:
+            S3XSLTCache.release(stylesheet_path, transformer, version)
 
     # -------------------------------------------------------------------------
     def envelope(self, tree, stylesheet_path, **args):
@@ -465,10 +482,134 @@ class S3XML(S3Codec):
             return role.role
         return None
 
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def _ktable(table, fieldname):
+        """
+            Get the name of the referenced table for a reference field
+
+            @param table: the database table
+            @param fieldname: the field name
+
+            @returns: tuple (ktablename, multiple), ktablename is None
+                      if the field is not a reference field
+        """
+
+        fieldtype = str(table[fieldname].type)
+        if fieldtype.startswith("reference"):
+            return (fieldtype[10:], False)
+        elif fieldtype.startswith("list:reference"):
+            return (fieldtype[15:], True)
+        else:
+            return (None, False)
+
+    # -------------------------------------------------------------------------
+    def clear_references(self):
+        """
+            Clear the reference cache (to be called at the start of
+            every export, as the cache is not invalidated on updates)
+        """
+
+        self.ref_cache = Storage()
+        self.gis_cache = Storage(markers={}, filters={}, represent={})
+
+    # -------------------------------------------------------------------------
+    def prefetch_references(self, table, records, fields):
+        """
+            Resolve all references in a set of records with one query
+            per referenced table (instead of one query per reference
+            in rmap), and store the results in the reference cache
+
+            @param table: the database table
+            @param records: the records (iterable of Rows)
+            @param fields: list of reference field names in this table
+        """
+
+        db = current.db
+        manager = self.manager
+
+        # Collect all foreign keys per referenced table
+        keys = Storage()
+        for f in fields:
+            if f not in table.fields:
+                continue
+            ktablename, multiple = self._ktable(table, f)
+            if not ktablename or ktablename not in db:
+                continue
+            if not multiple and table[f].represent and \
+               f not in (self.CUSER, self.MUSER, self.OUSER, self.OROLE):
+                # Look up the labels for rmap
+                manager.prefetch_represent(table[f], records=records)
+            if ktablename in keys:
+                ids = keys[ktablename]
+            else:
+                ids = keys[ktablename] = set()
+            for record in records:
+                value = record.get(f, None)
+                if not value:
+                    continue
+                if isinstance(value, (list, tuple)):
+                    ids.update(value)
+                else:
+                    ids.add(value)
+
+        ref_cache = self.ref_cache
+        chunk = self.REF_CHUNK_SIZE
+        for ktablename, ids in keys.items():
+            if ktablename in ref_cache:
+                cache = ref_cache[ktablename]
+                ids = ids.difference(cache)
+            else:
+                cache = ref_cache[ktablename] = Storage()
+            if not ids:
+                continue
+            ktable = db[ktablename]
+            pkey = ktable._id
+            kfields = [pkey]
+            for fn in (self.UID, "instance_type", self.DELETED, self.MCI,
+                       self.Lat, self.Lon):
+                if fn in ktable.fields:
+                    kfields.append(ktable[fn])
+            ids = list(ids)
+            for i in xrange(0, len(ids), chunk):
+                subset = ids[i:i+chunk]
+                rows = db(pkey.belongs(subset)).select(*kfields)
+                for row in rows:
+                    cache[row[pkey.name]] = row
+                # Remember the missing keys, so rmap can skip them
+                # without falling back to a query
+                for k in subset:
+                    if k not in cache:
+                        cache[k] = None
+        return
+
+    # -------------------------------------------------------------------------
+    def _cached_references(self, ktablename, ids):
+        """
+            Look up referenced records in the reference cache
+
+            @param ktablename: the referenced table name
+            @param ids: list of referenced record IDs
+
+            @returns: list of the cached records (None for missing
+                      records), or None if not all ids are cached
+        """
+
+        cache = self.ref_cache.get(ktablename, None)
+        if cache is None:
+            return None
+        try:
+            return [cache[k] for k in ids]
+        except KeyError:
+            return None
+
     # -------------------------------------------------------------------------
     def rmap(self, table, record, fields):
         """
-            Generates a reference map for a record
+            Generates a reference map for a record, looks up the
+            referenced records in the reference cache first (see
+            prefetch_references), and falls back to queries for
+            references which have not been prefetched
 
             @param table: the database table
             @param record: the record
@@ -477,6 +618,9 @@ class S3XML(S3Codec):
 
         db = current.db
         reference_map = []
+        filter_mci = self.filter_mci
+        DELETED = self.DELETED
+        MCI = self.MCI
 
         for f in fields:
             ids = record.get(f, None)
@@ -484,14 +628,8 @@ class S3XML(S3Codec):
                 continue
             if not isinstance(ids, (list, tuple)):
                 ids = [ids]
-            multiple = False
-            fieldtype = str(table[f].type)
-            if fieldtype.startswith("reference"):
-                ktablename = fieldtype[10:]
-            elif fieldtype.startswith("list:reference"):
-                ktablename = fieldtype[15:]
-                multiple = True
-            else:
+            ktablename, multiple = self._ktable(table, f)
+            if not ktablename:
                 continue
 
             ktable = db[ktablename]
@@ -501,10 +639,28 @@ class S3XML(S3Codec):
             uids = None
             supertable = None
 
-            if ktable._id.name != "id" and "instance_type" in ktable.fields:
+            is_super = pkey != "id" and "instance_type" in ktable.fields
+
+            krecords = self._cached_references(ktablename, ids)
+            if krecords is not None:
+                if is_super:
+                    krecords = [r for r in krecords if r is not None]
+                else:
+                    # Apply the DELETED and MCI filters
+                    deleted = DELETED in ktable.fields
+                    mci = filter_mci and MCI in ktable.fields
+                    krecords = [r for r in krecords
+                                if r is not None and
+                                   not (deleted and r[DELETED]) and
+                                   not (mci and r[MCI] < 0)]
+
+            if is_super:
                 if multiple:
                     continue
-                krecord = ktable[ids[0]]
+                if krecords is not None:
+                    krecord = krecords and krecords[0] or None
+                else:
+                    krecord = ktable[ids[0]]
                 if not krecord:
                     continue
                 ktablename = krecord.instance_type
@@ -514,25 +670,29 @@ class S3XML(S3Codec):
                     continue
                 uids = [uid]
             elif self.UID in ktable.fields:
-                query = (ktable[pkey].belongs(ids))
-                if "deleted" in ktable:
-                    query = (ktable.deleted == False) & query
-                if self.filter_mci and "mci" in ktable:
-                    query = (ktable.mci >= 0) & query
-                krecords = current.db(query).select(ktable[self.UID])
+                if krecords is None:
+                    query = (ktable[pkey].belongs(ids))
+                    if "deleted" in ktable:
+                        query = (ktable.deleted == False) & query
+                    if filter_mci and "mci" in ktable:
+                        query = (ktable.mci >= 0) & query
+                    krecords = db(query).select(ktable[self.UID])
                 if krecords:
                     uids = [r[self.UID] for r in krecords if r[self.UID]]
                     if ktable._tablename != current.auth.settings.table_group_name:
                         uids = [self.export_uid(u) for u in uids]
                 else:
                     continue
+            elif krecords is not None:
+                if not krecords:
+                    continue
             else:
                 query = (ktable._id.belongs(ids))
                 if "deleted" in ktable:
                     query = (ktable.deleted == False) & query
-                if self.filter_mci and "mci" in ktable:
+                if filter_mci and "mci" in ktable:
                     query = (ktable.mci >= 0) & query
-                if not current.db(query).count():
+                if not db(query).count():
                     continue
 
             value = str(table[f].formatter(record[f])).decode("utf-8")
@@ -614,7 +774,6 @@ class S3XML(S3Codec):
         if not current.gis:
             return
 
-        gis = current.gis
         db = current.db
 
         # Quicker to download Icons from Static
@@ -628,6 +787,11 @@ class S3XML(S3Codec):
                             self.Lat in db[r.table].fields and \
                             self.Lon in db[r.table].fields,
                             rmap)
+        if not references:
+            return
+
+        if popup_fields:
+            popup_fields = popup_fields.split("/")
 
         for i in xrange(0, len(references)):
             r = references[i]
@@ -635,18 +799,29 @@ class S3XML(S3Codec):
                 r_id = r.id[0]
             else:
                 continue # Multi-reference
-            ktable = db[r.table]
-            LatLon = db(ktable.id == r_id).select(ktable[self.Lat],
-                                                  ktable[self.Lon],
-                                                  limitby=(0, 1))
+            # Lookup the LatLon in the reference cache first
+            # (see prefetch_references)
+            LatLon = self._cached_references(r.table, [r_id])
+            if LatLon is not None:
+                LatLon = LatLon[0]
+            else:
+                ktable = db[r.table]
+                LatLon = db(ktable.id == r_id).select(ktable[self.Lat],
+                                                      ktable[self.Lon],
+                                                      limitby=(0, 1)).first()
             if LatLon:
-                LatLon = LatLon.first()
                 if LatLon[self.Lat] is not None and \
                    LatLon[self.Lon] is not None:
                     r.element.set(self.ATTRIBUTE.lat,
                                   "%.6f" % LatLon[self.Lat])
                     r.element.set(self.ATTRIBUTE.lon,
                                   "%.6f" % LatLon[self.Lon])
+                    # Lookup Marker (Icon) and GPS Marker (Symbol)
+                    # @ToDo: Remove the Public URL to keep filesize small when
+                    # loading off same server? (GeoJSON &layer=xx)
+                    marker_url, symbol = self.gis_marker(resource, record,
+                                                         marker=marker,
+                                                         download_url=download_url)
                     if shape or size or colour:
                         # Feature Queries
                         # We don't want a default Marker if these are specified
@@ -656,61 +831,35 @@ class S3XML(S3Codec):
                             r.element.set(self.ATTRIBUTE.size, size)
                         if colour:
                             r.element.set(self.ATTRIBUTE.colour, colour)
-
-                    # Lookup Marker (Icon)
-                    # @ToDo: Remove the Public URL to keep filesize small when
-                    # loading off same server? (GeoJSON &layer=xx)
-                    # @ToDo: Return the markers outside the records
-                    #        (as there are many less of them)
-                    #        & use the stylesheet to hook-up appropriately
-                    elif marker:
-                        marker_url = "%s/gis_marker.image.%s.png" % \
-                                     (download_url, marker)
                     else:
-                        marker = gis.get_marker(tablename=resource.tablename, record=record)
-                        marker_url = "%s/%s" % (download_url, marker.image)
-                    r.element.set(self.ATTRIBUTE.marker, marker_url)
-                    # Lookup GPS Marker (Symbol)
-                    symbol = gis.get_gps_marker(resource.tablename, record)
+                        r.element.set(self.ATTRIBUTE.marker, marker_url)
                     r.element.set(self.ATTRIBUTE.sym, symbol)
                     if popup_fields:
                         # Internal feature Layers
                         # Build the HTML for the onHover Tooltip
                         T = current.T
-                        popup_fields = popup_fields.split("/")
-                        fieldname = popup_fields[0]
                         if popup_label:
                             tooltip = "(%s)" % T(popup_label)
                         else:
                             tooltip = ""
-                        try:
-                            value = record[fieldname]
-                            if value:
-                                field = resource.table[fieldname]
-                                # @ToDo: Slow query which would be
-                                # good to optimise
-                                represent = gis.get_representation(field,
-                                                                   value)
-                                tooltip = "%s %s" % (represent, tooltip)
-                        except:
-                            # This field isn't in the table
-                            pass
-
+                        first = True
                         for fieldname in popup_fields:
                             try:
-                                if fieldname != popup_fields[0]:
-                                    value = record[fieldname]
-                                    if value:
-                                        field = resource.table[fieldname]
-                                        # @ToDo: Slow query which would be
-                                        # good to optimise
-                                        represent = gis.get_representation(
-                                                        field, value)
+                                value = record[fieldname]
+                                if value:
+                                    field = resource.table[fieldname]
+                                    represent = self.gis_represent(field,
+                                                                   value)
+                                    if first:
+                                        tooltip = "%s %s" % (represent,
+                                                             tooltip)
+                                    else:
                                         tooltip = "%s<br />%s" % (tooltip,
                                                                   represent)
                             except:
                                 # This field isn't in the table
                                 pass
+                            first = False
                         try:
                             # encode suitable for use as XML attribute
                             tooltip = self.xml_encode(tooltip).decode("utf-8")
@@ -737,6 +886,109 @@ class S3XML(S3Codec):
                         # when not needed?)
                         r.element.set(self.ATTRIBUTE.url, popup_url)
 
+    # -------------------------------------------------------------------------
+    def gis_marker(self, resource, record, marker=None, download_url=""):
+        """
+            Get the marker URL and GPS symbol for a record, resolved
+            once per table, marker and values of the feature class
+            filter fields
+
+            @param resource: the resource
+            @param record: the record
+            @param marker: filename to override filenames in marker URLs
+            @param download_url: the download URL for marker images
+
+            @returns: tuple (marker_url, symbol)
+        """
+
+        gis = current.gis
+        db = current.db
+
+        tablename = resource.tablename
+        markers = self.gis_cache.markers
+
+        # Filter fields of the feature classes for this table
+        filters = self.gis_cache.filters.get(tablename, None)
+        if filters is None:
+            table_fclass = db.gis_feature_class
+            query = (table_fclass.resource == tablename)
+            rows = db(query).select(table_fclass.filter_field,
+                                    cache=gis.cache)
+            filters = [row.filter_field for row in rows if row.filter_field]
+            filters = self.gis_cache.filters[tablename] = sorted(set(filters))
+
+        key = (tablename, marker, download_url) + \
+              tuple([record.get(f, None) for f in filters])
+        if key in markers:
+            return markers[key]
+
+        if marker:
+            marker_url = "%s/gis_marker.image.%s.png" % \
+                         (download_url, marker)
+        else:
+            _marker = gis.get_marker(tablename=tablename, record=record)
+            marker_url = "%s/%s" % (download_url, _marker.image)
+        symbol = gis.get_gps_marker(tablename, record)
+
+        markers[key] = (marker_url, symbol)
+        return (marker_url, symbol)
+
+    # -------------------------------------------------------------------------
+    def gis_represent(self, field, value):
+        """
+            Get the popup representation of a field value, looks it up
+            in the cache first (see prefetch_popups)
+
+            @param field: the field
+            @param value: the value
+        """
+
+        key = "%s.%s" % (field.tablename, field.name)
+        cache = self.gis_cache.represent.get(key, None)
+        if cache is not None:
+            try:
+                if value in cache:
+                    return cache[value]
+            except TypeError:
+                # Unhashable value
+                pass
+        return current.gis.get_representation(field, value)
+
+    # -------------------------------------------------------------------------
+    def prefetch_popups(self, table, records, popup_fields):
+        """
+            Represent the popup fields of a set of records in bulk, and
+            store the results in the popup cache
+
+            @param table: the database table
+            @param records: the records (iterable of Rows)
+            @param popup_fields: the popup fields ("/"-separated)
+        """
+
+        if not popup_fields or not current.gis:
+            return
+
+        gis = current.gis
+        represent = self.gis_cache.represent
+        for fieldname in popup_fields.split("/"):
+            if fieldname not in table.fields:
+                continue
+            field = table[fieldname]
+            key = "%s.%s" % (table._tablename, fieldname)
+            if key in represent:
+                cache = represent[key]
+            else:
+                cache = represent[key] = {}
+            values = set()
+            for record in records:
+                value = record.get(fieldname, None)
+                if value and not isinstance(value, (list, tuple)) and \
+                   value not in cache:
+                    values.add(value)
+            if values:
+                cache.update(gis.get_representations(field, list(values)))
+        return
+
     # -------------------------------------------------------------------------
     def resource(self, parent, table, record,
                  fields=[],
@@ -1554,6 +1806,18 @@ class S3XML(S3Codec):
 
             return obj
 
+    # -------------------------------------------------------------------------
+    @classmethod
+    def resource2json(cls, element):
+        """
+            Converts a single <resource> element into JSON (native mode),
+            used for incremental JSON export
+
+            @param element: the <resource> element
+        """
+
+        return json.dumps(cls.__element2json(element, native=True))
+
     # -------------------------------------------------------------------------
     @classmethod
     def tree2json(cls, tree, pretty_print=False):
@@ -1602,9 +1866,43 @@ class S3XML(S3Codec):
             @todo: add a character encoding parameter to skip the guessing
         """
 
-        root = etree.Element(cls.TAG.table)
-        if resourcename is not None:
-            root.set(cls.ATTRIBUTE.name, resourcename)
+        trees = cls.csv2trees(source,
+                              resourcename=resourcename,
+                              extra_data=extra_data,
+                              delimiter=delimiter,
+                              quotechar=quotechar)
+        return trees.next()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def csv2trees(cls, source,
+                  resourcename=None,
+                  extra_data=None,
+                  delimiter=",",
+                  quotechar='"',
+                  chunk_size=None):
+        """
+            Convert a table-form CSV source into a sequence of element trees
+            (see csv2tree) with at most chunk_size rows each, reading the
+            source only as far as needed for the current tree.
+
+            @param source: the source (file-like object)
+            @param resourcename: the resource name
+            @param extra_data: dict of extra cols to add to each row
+            @param delimiter: delimiter for values
+            @param quotechar: quotation character
+            @param chunk_size: maximum number of rows per tree, None
+                               to convert the whole source into one tree
+
+            @returns: a generator of element trees (yields at least one
+                      tree, which is empty if the source has no rows)
+        """
+
+        def new_root():
+            root = etree.Element(cls.TAG.table)
+            if resourcename is not None:
+                root.set(cls.ATTRIBUTE.name, resourcename)
+            return root
 
         def add_col(row, key, value):
             col = etree.SubElement(row, cls.TAG.col)
@@ -1640,6 +1938,10 @@ class S3XML(S3Codec):
                     else:
                         e = encoding
                         break
+
+        root = new_root()
+        rows = 0
+        chunks = 0
         try:
             reader = csv.DictReader(utf_8_encode(source),
                                     delimiter=delimiter,
@@ -1652,6 +1954,12 @@ class S3XML(S3Codec):
                     for key in extra_data:
                         if key not in r:
                             add_col(row, key, extra_data[key])
+                rows += 1
+                if chunk_size and rows >= chunk_size:
+                    chunks += 1
+                    yield etree.ElementTree(root)
+                    root = new_root()
+                    rows = 0
         except csv.Error:
             e = sys.exc_info()[1]
             raise HTTP(400, body=cls.json_message(False, 400, e))
@@ -1659,6 +1967,373 @@ class S3XML(S3Codec):
         # Use this to debug the source tree if needed:
         #print >>sys.stderr, cls.tostring(root, pretty_print=True)
 
-        return  etree.ElementTree(root)
+        if rows or not chunks:
+            yield etree.ElementTree(root)
+
+# =============================================================================
+
+class S3XSLTCache(object):
+    """
+        Process-wide cache of compiled XSLT stylesheets, keyed by the
+        stylesheet path and the modification times of the stylesheet
+        and all stylesheets it imports or includes (recursively)
+
+        Compiled transformers are handed out to one request at a time
+        (see get/release), and further transformers compiled as needed
+        when the stylesheet is in use by concurrent requests.
+    """
+
+    # Max number of idle transformers kept per stylesheet
+    MAX_IDLE = 8
+
+    lock = threading.Lock()
+
+    # Stylesheet path => Storage(version, idle transformers)
+    entries = {}
+
+    # Counters
+    stats = Storage(hits=0,
+                    misses=0,
+                    compiled=0,
+                    compile_time=0.0)
+
+    warmed_up = False
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def get(cls, path):
+        """
+            Get a compiled transformer for a stylesheet
+
+            @param path: the stylesheet path (or URL)
+
+            @returns: tuple (transformer, version), the transformer
+                      must be handed back with release(path, version)
+                      when the transformation is complete
+
+            @raises: any parser or XSLT errors
+        """
+
+        try:
+            os.path.getmtime(path)
+        except (OSError, TypeError):
+            # Not a local file => do not cache
+            return (cls.compile(path), None)
+
+        cls.lock.acquire()
+        try:
+            entry = cls.entries.get(path, None)
+            if entry is not None and entry.idle and \
+               cls.__current(entry.version):
+                cls.stats.hits += 1
+                return (entry.idle.pop(), entry.version)
+            cls.stats.misses += 1
+        finally:
+            cls.lock.release()
+
+        # Determine the version before compiling, so that modifications
+        # during the compilation are picked up with the next request
+        version = cls.__version(path)
+        return (cls.compile(path), version)
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def release(cls, path, transformer, version):
+        """
+            Hand back a transformer after use
+
+            @param path: the stylesheet path
+            @param transformer: the transformer
+            @param version: the version returned by get()
+        """
+
+        if version is None:
+            return
+        cls.lock.acquire()
+        try:
+            entry = cls.entries.get(path, None)
+            if entry is None or entry.version != version:
+                if not cls.__current(version):
+                    # Transformer of an outdated version
+                    return
+                # New or modified stylesheet
+                entry = cls.entries[path] = Storage(version=version, idle=[])
+            if len(entry.idle) < cls.MAX_IDLE:
+                entry.idle.append(transformer)
+        finally:
+            cls.lock.release()
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def compile(cls, path):
+        """
+            Parse and compile a stylesheet
+
+            @param path: the stylesheet path (or URL)
+
+            @returns: the transformer (etree.XSLT)
+        """
+
+        start = time.time()
+
+        source = path
+        if isinstance(source, basestring) and source[:5] == "https":
+            source = urllib2.urlopen(source)
+        parser = etree.XMLParser(no_network=False)
+        stylesheet = etree.parse(source, parser)
+        ac = etree.XSLTAccessControl(read_file=True, read_network=True)
+        transformer = etree.XSLT(stylesheet, access_control=ac)
+
+        duration = time.time() - start
+        cls.lock.acquire()
+        try:
+            cls.stats.compiled += 1
+            cls.stats.compile_time += duration
+        finally:
+            cls.lock.release()
+        return transformer
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def __version(cls, path):
+        """
+            Get the version of a stylesheet, i.e. the modification times
+            of the stylesheet and of all local stylesheets it imports or
+            includes (recursively)
+
+            @param path: the stylesheet path
+
+            @returns: tuple of (path, mtime) tuples, starting with
+                      the stylesheet itself
+        """
+
+        XSL = "{http://www.w3.org/1999/XSL/Transform}"
+        tags = ("%simport" % XSL, "%sinclude" % XSL)
+
+        version = []
+        seen = set()
+        pending = [path]
+        while pending:
+            filename = pending.pop(0)
+            if filename in seen:
+                continue
+            seen.add(filename)
+            try:
+                mtime = os.path.getmtime(filename)
+            except OSError:
+                # Missing import => compilation fails anyway
+                continue
+            version.append((filename, mtime))
+            try:
+                root = etree.parse(filename).getroot()
+            except (IOError, etree.XMLSyntaxError):
+                continue
+            folder = os.path.dirname(filename)
+            for element in root:
+                if element.tag not in tags:
+                    continue
+                href = element.get("href")
+                if not href or "://" in href:
+                    # Remote stylesheets are not tracked
+                    continue
+                pending.append(os.path.normpath(os.path.join(folder, href)))
+        return tuple(version)
+
+    # -------------------------------------------------------------------------
+    @staticmethod
+    def __current(version):
+        """
+            Check whether a stylesheet version is still current
+
+            @param version: the version as returned by __version()
+
+            @returns: True if none of the files has been modified
+        """
+
+        for filename, mtime in version:
+            try:
+                if os.path.getmtime(filename) != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def warmup(cls, folder):
+        """
+            Compile all stylesheets in a folder (recursively) and add
+            them to the cache, to be run once at startup
+
+            @param folder: the folder, usually static/formats
+        """
+
+        if cls.warmed_up:
+            return
+        cls.warmed_up = True
+        for root, dirs, files in os.walk(folder):
+            for filename in files:
+                if not filename.endswith(".xsl"):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    transformer, version = cls.get(path)
+                except:
+                    # Not a standalone stylesheet (e.g. imported templates)
+                    continue
+                cls.release(path, transformer, version)
+        return
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def statistics(cls):
+        """
+            Get the cache counters
+
+            @returns: Storage with hits, misses, compiled (number of
+                      compiled stylesheets), compile_time (seconds),
+                      cached (number of cached stylesheets)
+        """
+
+        cls.lock.acquire()
+        try:
+            stats = Storage(cls.stats)
+            stats.cached = len(cls.entries)
+        finally:
+            cls.lock.release()
+        return stats
+
+    # -------------------------------------------------------------------------
+    @classmethod
+    def clear(cls):
+        """ Drop all cached transformers """
+
+        cls.lock.acquire()
+        try:
+            cls.entries = {}
+        finally:
+            cls.lock.release()
+
+# =============================================================================
+
+class S3XMLWriter(object):
+    """
+        Incremental writer for S3XML documents (as XML or native JSON),
+        writes <resource> elements to the output stream one at a time,
+        so that the element tree never has to be held in memory as a
+        whole (used for streaming exports)
+    """
+
+    def __init__(self, stream, root, as_json=False, pretty_print=False):
+        """
+            Constructor
+
+            @param stream: the output stream (file-like object)
+            @param root: the root element (attributes only, any child
+                         elements are ignored)
+            @param as_json: write native JSON instead of XML
+            @param pretty_print: insert newlines/indentation in XML output
+        """
+
+        self.stream = stream
+        self.root = root
+        self.as_json = as_json
+        self.pretty_print = pretty_print
+
+        self.master = None
+        self.items = 0
+        self.spool = Storage()
+
+    # -------------------------------------------------------------------------
+    def open(self, tablename):
+        """
+            Write the document header
+
+            @param tablename: the name of the master table
+        """
+
+        root = self.root
+        self.master = tablename
+
+        if self.as_json:
+            attributes = dict([(S3XML.PREFIX.attribute + k, v)
+                               for k, v in root.attrib.items()])
+            header = json.dumps(attributes)[:-1]
+            if attributes:
+                header = "%s, " % header
+            header = '%s"%s_%s": [' % (header, S3XML.PREFIX.resource, tablename)
+        else:
+            # Start tag of the root element (etree.xmlfile would require
+            # lxml>=3.1, so the tag is serialized here)
+            attributes = []
+            for k, v in root.attrib.items():
+                if isinstance(v, unicode):
+                    v = v.encode("utf-8")
+                attributes.append(" %s=%s" % (k, quoteattr(v)))
+            header = "<?xml version='1.0' encoding='utf-8'?>\n<%s%s>" % \
+                     (root.tag, "".join(attributes))
+            if self.pretty_print:
+                header = "%s\n" % header
+        self.stream.write(header)
+
+    # -------------------------------------------------------------------------
+    def write(self, tablename, element):
+        """
+            Write a <resource> element
+
+            @param tablename: the table name of the resource
+            @param element: the <resource> element
+        """
+
+        if self.as_json:
+            item = S3XML.resource2json(element)
+            if tablename == self.master:
+                stream = self.stream
+                items = self.items
+                self.items += 1
+            else:
+                # Other tables are spooled until the master list is closed
+                spool = self.spool
+                if tablename not in spool:
+                    import tempfile
+                    spool[tablename] = Storage(file=tempfile.TemporaryFile(),
+                                               items=0)
+                stream = spool[tablename].file
+                items = spool[tablename].items
+                spool[tablename].items += 1
+            if items:
+                stream.write(", ")
+            stream.write(item)
+        else:
+            self.stream.write(etree.tostring(element,
+                                             xml_declaration=False,
+                                             encoding="utf-8",
+                                             pretty_print=self.pretty_print))
+
+    # -------------------------------------------------------------------------
+    def close(self):
+        """
+            Write the document trailer
+        """
+
+        stream = self.stream
+        if self.as_json:
+            stream.write("]")
+            for tablename, spool in self.spool.items():
+                stream.write(', "%s_%s": [' % (S3XML.PREFIX.resource,
+                                               tablename))
+                spooled = spool.file
+                spooled.seek(0)
+                while True:
+                    chunk = spooled.read(65536)
+                    if not chunk:
+                        break
+                    stream.write(chunk)
+                spooled.close()
+                stream.write("]")
+            stream.write("}")
+        else:
+            stream.write("</%s>" % self.root.tag)
+        self.spool = Storage()
 
 # End =========================================================================
@@ -54,6 +54,9 @@ class S3Config(Storage):
         self.gis = Storage()
         self.osm = Storage()    # Backwards-compatiblity, deprecate soon
         self.mail = Storage()
+        self.msg = Storage()
+        self.pdf = Storage()
+        self.sync = Storage()
         self.twitter = Storage()
         self.L10n = Storage()
         self.options = Storage()
@@ -156,6 +159,16 @@ class S3Config(Storage):
         return self.base.get("public_url", "http://127.0.0.1:8000")
     def get_base_cdn(self):
         return self.base.get("cdn", False)
+    def get_base_xslt_warmup(self):
+        """ Whether to compile all XSLT stylesheets at startup (rather than at first use) """
+        return self.base.get("xslt_warmup", False)
+    def get_base_import_chunk_size(self):
+        """
+            Import CSV files uploaded for direct import in chunks of this
+            many rows, committing each chunk separately (None to import
+            every file in one job)
+        """
+        return self.base.get("import_chunk_size", None)
 
     # -------------------------------------------------------------------------
     # Database settings
@@ -338,6 +351,40 @@ class S3Config(Storage):
     def get_mail_limit(self):
         """ A daily limit to the number of messages which can be sent """
         return self.mail.get("limit", None)
+    def get_mail_pool_size(self):
+        """
+            Number of SMTP connections which S3Msg keeps open to send
+            Email (0 to use a new connection for each message)
+        """
+        return self.mail.get("pool_size", 2)
+
+    # Outbox settings
+    def get_msg_outbox_batch_size(self):
+        """
+            Number of Outbox messages whose recipients are looked up
+            and whose results are recorded together
+        """
+        return self.msg.get("outbox_batch_size", 500)
+    def get_msg_outbox_workers(self):
+        """
+            Maximum number of messages sent concurrently through the
+            Email or SMS gateway (1 to send them one at a time)
+        """
+        return self.msg.get("outbox_workers", 4)
+
+    # Synchronization settings
+    def get_sync_workers(self):
+        """
+            Maximum number of requests to peer repositories running at
+            the same time during synchronization
+        """
+        return self.sync.get("workers", 4)
+    def get_sync_chunk_size(self):
+        """
+            Number of records to transfer per request during
+            synchronization (0 to transfer all records at once)
+        """
+        return self.sync.get("chunk_size", 500)
 
     # Twitter settings
     def get_twitter_oauth_consumer_key(self):
@@ -353,6 +400,12 @@ class S3Config(Storage):
         return self.ui.get("pdf_logo", None)
 
     # Optical Character Recognition (OCR)
+    def get_pdf_ocr_processes(self):
+        """
+            Number of worker processes to OCR the pages of a scanned form
+            (None for the number of CPUs, 1 to process them in one thread)
+        """
+        return self.pdf.get("ocr_processes", None)
     def get_pdf_excluded_fields(self, resourcename):
         excluded_fields_dict = {
             "hms_hospital" : [
@@ -389,6 +442,12 @@ class S3Config(Storage):
     def get_ui_autocomplete(self):
         """ Currently Unused """
         return self.ui.get("autocomplete", False)
+    def get_ui_autocomplete_index(self):
+        """
+            Use a text index for autocomplete searches
+            (see S3TextIndex, in-memory unless pg_trgm is available)
+        """
+        return self.ui.get("autocomplete_index", True)
     def get_ui_update_label(self):
         return self.ui.get("update_label", current.T("Open"))
     def get_ui_cluster(self):
@@ -0,0 +1,16 @@
+
+class RolledBack(object):
+    """Turns commits into no-ops and rolls back all database changes
+    at the end of a test no matter what happens, for testing code
+    which commits by itself.
+
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db._adapter.commit = lambda: None
+
+    def __exit__(self, type, value, traceback):
+        del self.db._adapter.commit
+        self.db.rollback()
@@ -10,3 +10,5 @@ from AddedRole import *
 from ExpectedException import *
 from Change import *
 from ExpectSessionWarning import ExpectSessionWarning
+from RolledBack import RolledBack
+from insert_person import insert_person
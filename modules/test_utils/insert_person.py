@@ -0,0 +1,15 @@
+
+def insert_person(db, manager, first_name, last_name, email=None):
+    """Inserts a person with its person entity (and an email address
+    as contact), returns the tuple (person_id, pe_id).
+
+    """
+    table = db.pr_person
+    person_id = table.insert(first_name=first_name, last_name=last_name)
+    manager.model.update_super(table, dict(id=person_id))
+    pe_id = table[person_id].pe_id
+    if email:
+        db.pr_contact.insert(pe_id=pe_id,
+                             contact_method="EMAIL",
+                             value=email)
+    return person_id, pe_id
@@ -0,0 +1,47 @@
+#
+# Script to benchmark the lookahead of S3ImportJob
+#
+# - designed to be run within the web2py environment
+#   cd /path/to/web2py
+#   python web2py.py -S eden -M -R applications/eden/static/scripts/tools/benchmark_import.py
+#
+# - builds import trees of 1k, 10k and 100k gis_location elements, each
+#   referencing the next one by TUID, and prints the time it takes to find
+#   the referenced elements of all of them (should grow linearly)
+#
+
+import time
+
+from lxml import etree
+
+def import_tree(size):
+    """ Import tree with a chain of gis_location elements """
+
+    root = etree.Element("s3xml")
+    for i in xrange(size):
+        resource = etree.SubElement(root, "resource",
+                                    name="gis_location",
+                                    tuid="LOC%s" % i)
+        data = etree.SubElement(resource, "data", field="name")
+        data.text = "Location %s" % i
+        etree.SubElement(resource, "reference",
+                         field="parent",
+                         resource="gis_location",
+                         tuid="LOC%s" % ((i + 1) % size))
+    return etree.ElementTree(root)
+
+table = db.gis_location
+for size in (1000, 10000, 100000):
+    tree = import_tree(size)
+    job = s3base.S3ImportJob(s3mgr, table, tree=tree)
+    start = time.time()
+    found = 0
+    for element in tree.getroot():
+        found += len(job.lookahead(element,
+                                   table=table,
+                                   fields=["parent"],
+                                   tree=tree,
+                                   directory=job.directory))
+    duration = time.time() - start
+    print "lookahead: %6s elements, %6s references in %.3fs" % \
+          (size, found, duration)
@@ -0,0 +1,50 @@
+#
+# Script to benchmark the page transformation of the OCR of scanned forms
+#
+# - designed to be run within the web2py environment
+#   cd /path/to/web2py
+#   python web2py.py -S eden -M -R applications/eden/static/scripts/tools/benchmark_ocr.py
+#
+# - requires NumPy and PIL
+#
+# - transforms a synthetic scan of an A4 form at 300 dpi (seven markers
+#   along the edges and rows of text-like blobs in between) and prints the
+#   time per page
+#
+
+import random
+import time
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    import Image, ImageDraw
+
+width, height = 2480, 3508
+image = Image.new("L", (width, height), 255)
+draw = ImageDraw.Draw(image)
+
+left, right = 150, width - 150
+top, bottom = 150, height - 150
+middle = height / 2
+for x, y in ((left, top), (left, middle), (left, bottom),
+             (width / 2, top),
+             (right, top), (right, middle), (right, bottom)):
+    draw.rectangle((x - 20, y - 20, x + 20, y + 20), fill=0)
+
+random.seed(0)
+for y in xrange(400, height - 400, 30):
+    for x in xrange(400, width - 400, 24):
+        if random.random() < 0.5:
+            draw.rectangle((x, y,
+                            x + random.randint(3, 10),
+                            y + random.randint(5, 14)),
+                           fill=random.randint(0, 150))
+
+durations = []
+for i in xrange(5):
+    start = time.time()
+    page = s3base.S3OCRImageParser.transformPage(image)
+    durations.append(time.time() - start)
+print "transformPage: %s markers, best %.3fs, mean %.3fs per page" % \
+      (len(page["markers"]), min(durations), sum(durations) / len(durations))
@@ -0,0 +1,121 @@
+
+test_utils = local_import("test_utils")
+
+def _permission(role_id):
+    """ S3Permission with table ACLs for a restricted test controller """
+
+    permission = s3base.S3Permission(auth)
+    permission.policy = 5
+    permission.use_cacls = True
+    permission.use_facls = True
+    permission.use_tacls = True
+    permission.modules = Storage(acltest=Storage(restricted=True))
+    permission.clear_cache()
+    session.s3.roles = [role_id]
+    return permission
+
+def _uncached_page_acl(permission, c, f, roles):
+    """ page_acl as looked up from the database """
+
+    table = permission.table
+    query = (table.deleted != True) & \
+            (table.controller == c) & \
+            ((table.function == f) | (table.function == None)) & \
+            (table.group_id.belongs(roles))
+    rows = db(query).select()
+    controller_acl = [(row.oacl, row.uacl) for row in rows
+                      if not row.function]
+    function_acl = [(row.oacl, row.uacl) for row in rows
+                    if row.function]
+    if function_acl:
+        return permission.most_permissive(function_acl)
+    elif controller_acl:
+        return permission.most_permissive(controller_acl)
+    return (permission.NONE, permission.NONE)
+
+def _uncached_table_acl(permission, tablename, c, roles):
+    """ table_acl as looked up from the database (no default) """
+
+    table = permission.table
+    query = (table.deleted != True) & \
+            (table.tablename == tablename) & \
+            ((table.controller == c) | (table.controller == None)) & \
+            (table.group_id.belongs(roles))
+    rows = db(query).select()
+    return permission.most_permissive([(row.oacl, row.uacl)
+                                       for row in rows])
+
+def test_cached_acls_match_database():
+    roles = session.s3.roles
+    try:
+        role_id = db.auth_group.insert(role="ACL Test")
+        READ = auth.permission.READ
+        CREATE = auth.permission.CREATE
+        UPDATE = auth.permission.UPDATE
+        table = auth.permission.table
+        # ACLs with a tablename also apply to the page
+        for c, f, t, acl in (("acltest", None, None, READ),
+                             ("acltest", None, "acltest_record", CREATE),
+                             ("acltest", "fn", "acltest_record", UPDATE),
+                             (None, None, "acltest_record", READ),
+                             ("other", "fn", None, UPDATE)):
+            table.insert(group_id=role_id,
+                         controller=c,
+                         function=f,
+                         tablename=t,
+                         oacl=acl,
+                         uacl=acl)
+        permission = _permission(role_id)
+        for f in ("fn", "index"):
+            permission.page_acls = Storage()
+            test_utils.assert_equal(permission.page_acl(c="acltest", f=f),
+                                    _uncached_page_acl(permission,
+                                                       "acltest", f,
+                                                       [role_id]))
+        test_utils.assert_equal(permission.page_acl(c="acltest", f="index"),
+                                (READ | CREATE, READ | CREATE))
+
+        rtable = Storage(_tablename="acltest_record")
+        test_utils.assert_equal(permission.table_acl(table=rtable,
+                                                     c="acltest"),
+                                _uncached_table_acl(permission,
+                                                    "acltest_record",
+                                                    "acltest",
+                                                    [role_id]))
+    finally:
+        session.s3.roles = roles
+        auth.permission.clear_cache()
+        db.rollback()
+
+def test_acl_index_buckets():
+    roles = session.s3.roles
+    try:
+        role_id = db.auth_group.insert(role="ACL Index Test")
+        READ = auth.permission.READ
+        table = auth.permission.table
+        for c, f, t in (("acltest", None, None),
+                        ("acltest", "fn", "acltest_record"),
+                        (None, None, "acltest_record"),
+                        ("other", "fn", None)):
+            table.insert(group_id=role_id,
+                         controller=c,
+                         function=f,
+                         tablename=t,
+                         oacl=READ,
+                         uacl=READ)
+        permission = _permission(role_id)
+        index = permission.get_acls([role_id])
+        # ACLs are looked up per controller and per table, with a
+        # wildcard bucket (None) for ACLs without function/controller
+        test_utils.assert_equal(sorted(index.controllers.keys()),
+                                ["acltest", "other"])
+        test_utils.assert_equal(sorted(index.controllers["acltest"].keys()),
+                                [None, "fn"])
+        test_utils.assert_equal(sorted(index.tables.keys()),
+                                ["acltest_record"])
+        test_utils.assert_equal(sorted(index.tables["acltest_record"].keys()),
+                                [None, "acltest"])
+    finally:
+        session.s3.roles = roles
+        auth.permission.clear_cache()
+        db.rollback()
@@ -0,0 +1,50 @@
+
+test_utils = local_import("test_utils")
+
+data = [
+    dict(id=1, org="A", type="x", value=3),
+    dict(id=2, org="A", type="y", value=None),
+    dict(id=3, org="B", type="x", value=5),
+    dict(id=4, org="B", type="x", value=1),
+]
+
+def test_pivot_count():
+    pt = s3base.S3PivotTable(data, "value", ["org"], ["type"], "count")
+    test_utils.assert_equal(list(pt), [[1, 0], [2, 0]])
+    test_utils.assert_equal(pt.rnames, [[("org", "A")], [("org", "B")]])
+    test_utils.assert_equal(pt.cnames, [[("type", "x")], [("type", "y")]])
+    test_utils.assert_equal(pt.row_tots, [1, 2])
+    test_utils.assert_equal(pt.col_tots, [3, 0])
+    test_utils.assert_equal(pt.grand_tot, 3)
+
+def test_pivot_sum_without_cols():
+    pt = s3base.S3PivotTable(data, "value", ["org"], [], "sum")
+    test_utils.assert_equal(list(pt), [[3], [6]])
+    test_utils.assert_equal(pt.cnames, [1])
+    test_utils.assert_equal(pt.grand_tot, 9)
+
+def test_pivot_group_concat():
+    pt = s3base.S3PivotTable(data, "id", ["org"], ["type"], "group_concat")
+    test_utils.assert_equal(list(pt), [["1", "2"], ["3,4", None]])
+    test_utils.assert_equal(pt.grand_tot, None)
+
+def test_pivot_preaggregated_cells():
+    # Cells as aggregated by the database: [count, sum, min, max, values]
+    cells = {(("A",), ("x",)): [1, 3, 3, 3, []],
+             (("B",), ("x",)): [2, 6, 1, 5, []]}
+    pt = s3base.S3PivotTable(None, "value", ["org"], ["type"], "avg",
+                             cells=cells)
+    test_utils.assert_equal(list(pt), [[3.0], [3.0]])
+    test_utils.assert_equal(pt.row_tots, [3.0, 3.0])
+    test_utils.assert_equal(pt.grand_tot, 3.0)
+
+def test_pushdown_requires_dimensions():
+    cube = s3base.S3Cube()
+    cube.rows = []
+    cube.cols = []
+    cube.fact = "id"
+    lfields = Storage(id=Storage(field=db.org_organisation.id))
+    # No rows and no cols => nothing to GROUP BY => pivot in Python
+    assert not cube._pushdown(["id"], lfields, "count")
+    cube.rows = ["id"]
+    assert cube._pushdown(["id"], lfields, "count")
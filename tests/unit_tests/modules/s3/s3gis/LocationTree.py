@@ -0,0 +1,29 @@
+
+from gluon import current
+
+test_utils = local_import("test_utils")
+
+def test_rolled_back_changes_are_undone():
+    tree = s3base.S3LocationTree()
+    table = db.gis_location
+    request = current.request
+    # Stand-in for the request which changes the location
+    current.request = Storage()
+    try:
+        parent = table.insert(name="Tree Test Parent")
+        child = table.insert(name="Tree Test Child", parent=parent)
+        tree.update_record(parent)
+        tree.update_record(child)
+        test_utils.assert_equal(tree.ancestors(child), [parent])
+        db.rollback()
+        # Request still running => keep the changes
+        tree.reread()
+        assert child in tree
+    finally:
+        current.request = request
+        db.rollback()
+    # Request ended => the rolled back records are re-read (=removed)
+    tree.reread()
+    assert child not in tree
+    assert parent not in tree
+    test_utils.assert_equal(tree.changed, {})
@@ -0,0 +1,59 @@
+
+import threading
+
+from gluon import current
+
+test_utils = local_import("test_utils")
+
+def _index():
+    index = s3base.S3PointIndex()
+    index.update([Storage(id=1, deleted=False, lat=0.0, lon=0.0,
+                          lat_min=None, lat_max=None,
+                          lon_min=None, lon_max=None),
+                  Storage(id=2, deleted=False, lat=0.5, lon=0.5,
+                          lat_min=0.0, lat_max=1.0,
+                          lon_min=0.0, lon_max=1.0),
+                  Storage(id=3, deleted=False, lat=10.0, lon=179.5,
+                          lat_min=None, lat_max=None,
+                          lon_min=None, lon_max=None)])
+    return index
+
+def test_radius():
+    index = _index()
+    # 0.5/0.5 is ~79km away from 0/0
+    test_utils.assert_equal([i for i, d in index.radius(0, 0, 50)], [1])
+    test_utils.assert_equal([i for i, d in index.radius(0, 0, 100)], [1, 2])
+    distance = index.radius(0, 0, 100)[1][1]
+    assert 78 < distance < 80
+    # Deleted records are no longer found
+    index.update([Storage(id=1, deleted=True)])
+    test_utils.assert_equal([i for i, d in index.radius(0, 0, 100)], [2])
+
+def test_bbox():
+    index = _index()
+    test_utils.assert_equal(sorted(index.bbox(-1, -1, 0.6, 0.6)), [1, 2])
+    test_utils.assert_equal(index.bbox(0.6, 0.6, 2, 2), [])
+    # Bounds intersecting with the box
+    test_utils.assert_equal(index.bbox(0.6, 0.6, 2, 2, bounds=True), [2])
+    # Box across the 180th meridian
+    test_utils.assert_equal(index.bbox(179, 9, -179, 11), [3])
+
+def test_get_does_not_deadlock():
+    S3PointIndex = s3base.S3PointIndex
+    previous = S3PointIndex.instance
+    S3PointIndex.instance = None
+    result = []
+    def load():
+        # current is thread-local
+        current.db = db
+        current.manager = s3mgr
+        result.append(S3PointIndex.get())
+    thread = threading.Thread(target=load)
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+    try:
+        assert not thread.is_alive()
+        assert result and result[0] is not None
+    finally:
+        S3PointIndex.instance = previous
@@ -0,0 +1,252 @@
+
+import os
+
+from lxml import etree
+
+test_utils = local_import("test_utils")
+
+def _import_tree(size):
+    """ Import tree with a chain of gis_location elements referencing
+        each other by TUID (the last element referencing the first) """
+
+    root = etree.Element("s3xml")
+    for i in xrange(size):
+        resource = etree.SubElement(root, "resource",
+                                    name="gis_location",
+                                    tuid="LOC%s" % i)
+        data = etree.SubElement(resource, "data", field="name")
+        data.text = "Location %s" % i
+        reference = etree.SubElement(resource, "reference",
+                                     field="parent",
+                                     resource="gis_location",
+                                     tuid="LOC%s" % ((i + 1) % size))
+    return etree.ElementTree(root)
+
+class ScanCountingElement(etree.ElementBase):
+    """ Element counting the searches through the tree below it """
+
+    scans = []
+
+    def xpath(self, *args, **kwargs):
+        self.scans.append("xpath")
+        return etree.ElementBase.xpath(self, *args, **kwargs)
+
+    def iterdescendants(self, *args, **kwargs):
+        self.scans.append("iterdescendants")
+        return etree.ElementBase.iterdescendants(self, *args, **kwargs)
+
+def _lookahead_scans(size):
+    """ The tree searches to look ahead from all elements of a tree """
+
+    parser = etree.XMLParser()
+    lookup = etree.ElementDefaultClassLookup(element=ScanCountingElement)
+    parser.set_element_class_lookup(lookup)
+    source = etree.tostring(_import_tree(size))
+    tree = etree.ElementTree(etree.fromstring(source, parser))
+    table = db.gis_location
+    job = s3base.S3ImportJob(s3mgr, table, tree=tree)
+    del ScanCountingElement.scans[:]
+    found = 0
+    for element in tree.getroot():
+        references = job.lookahead(element,
+                                   table=table,
+                                   fields=["parent"],
+                                   tree=tree,
+                                   directory=job.directory)
+        found += len(references)
+    test_utils.assert_equal(found, size)
+    return list(ScanCountingElement.scans)
+
+def test_lookahead_finds_referenced_elements():
+    tree = _import_tree(3)
+    table = db.gis_location
+    job = s3base.S3ImportJob(s3mgr, table, tree=tree)
+    element = tree.getroot()[0]
+    references = job.lookahead(element,
+                               table=table,
+                               fields=["parent"],
+                               tree=tree,
+                               directory=job.directory)
+    test_utils.assert_equal(len(references), 1)
+    entry = references[0].entry
+    test_utils.assert_equal(entry.uid, "LOC1")
+    assert entry.element is tree.getroot()[1]
+
+def test_lookahead_scans_tree_once():
+    # The UID directory is built in a single pass over the tree, instead
+    # of searching the tree for every reference
+    test_utils.assert_equal(_lookahead_scans(10), ["iterdescendants"])
+    test_utils.assert_equal(_lookahead_scans(100), ["iterdescendants"])
+
+def test_csv2trees_chunks():
+    from StringIO import StringIO
+    source = StringIO("name\n" + "".join(["Row %s\n" % i for i in xrange(5)]))
+    trees = list(s3mgr.xml.csv2trees(source, chunk_size=2))
+    test_utils.assert_equal([len(t.getroot()) for t in trees], [2, 2, 1])
+    # An empty source still gives one (empty) tree
+    trees = list(s3mgr.xml.csv2trees(StringIO("name\n"), chunk_size=2))
+    test_utils.assert_equal([len(t.getroot()) for t in trees], [0])
+
+def test_chunked_import_is_opt_in():
+    from StringIO import StringIO
+    csv = "Name\n" + "".join(["Chunk Organisation %s\n" % i
+                               for i in xrange(3)])
+    stylesheet = os.path.join(request.folder, "static", "formats",
+                              "s3csv", "org", "organisation.xsl")
+    resource = s3mgr.define_resource("org", "organisation")
+    table = db.org_organisation
+    query = table.name.like("Chunk Organisation %")
+    statuses = []
+    progress = lambda status: statuses.append(Storage(status))
+    chunk_size = s3mgr.import_chunk_size
+    try:
+        # The configured chunk size alone doesn't chunk the import
+        s3mgr.import_chunk_size = 2
+        resource.import_xml(StringIO(csv),
+                            format="csv",
+                            stylesheet=stylesheet,
+                            progress=progress)
+        test_utils.assert_equal(statuses, [])
+        test_utils.assert_equal(db(query).count(), 3)
+        db.rollback()
+
+        resource.import_xml(StringIO(csv),
+                            format="csv",
+                            stylesheet=stylesheet,
+                            chunk_size=2,
+                            progress=progress)
+        test_utils.assert_equal([status.chunk for status in statuses],
+                                [1, 2])
+        last = statuses[-1]
+        test_utils.assert_equal((last.rows, last.imported,
+                                 last.errors, last.ignored),
+                                (3, 3, 0, 0))
+        test_utils.assert_equal(db(query).count(), 3)
+    finally:
+        s3mgr.import_chunk_size = chunk_size
+        db.rollback()
+        # Chunks are committed
+        db(query).delete()
+        db.commit()
+
+def test_compact_directory_carries_tuids():
+    tree = _import_tree(3)
+    table = db.gis_location
+    job = s3base.S3ImportJob(s3mgr, table, tree=tree)
+    for element in tree.getroot():
+        job.add_item(element=element)
+    try:
+        job.commit()
+        directory = job.compact_directory()
+        for i in xrange(3):
+            entry = directory[("gis_location", "tuid", "LOC%s" % i)]
+            assert entry.id
+            assert entry.element is None and entry.item_id is None
+    finally:
+        db.rollback()
+
+def _organisation_tree(uids):
+    """ Import tree with an org_organisation element for each UID """
+
+    root = etree.Element("s3xml")
+    for i, uid in enumerate(uids):
+        resource = etree.SubElement(root, "resource",
+                                    name="org_organisation",
+                                    uuid=uid)
+        data = etree.SubElement(resource, "data", field="name")
+        data.text = "Bulk Organisation %s" % i
+    return etree.ElementTree(root)
+
+def _bulk_import(tree, table):
+    job = s3base.S3ImportJob(s3mgr, table, tree=tree, bulk=True)
+    for element in tree.getroot():
+        job.add_item(element=element)
+    success = job.commit()
+    return job, success
+
+def test_bulk_import_inserts_batch():
+    table = db.org_organisation
+    uids = ["BULK-ORG-%s" % i for i in xrange(3)]
+    tree = _organisation_tree(uids)
+    try:
+        job, success = _bulk_import(tree, table)
+        assert success
+        rows = db(table.uuid.belongs(uids)).select(table.id)
+        test_utils.assert_equal(len(rows), 3)
+        ids = set([item.id for item in job.items.values()])
+        test_utils.assert_equal(ids, set([row.id for row in rows]))
+    finally:
+        db.rollback()
+
+def test_bulk_import_deduplicates_within_batch():
+    # The second element with the same UID updates the first record
+    # instead of failing the whole batch with an IntegrityError
+    table = db.org_organisation
+    tree = _organisation_tree(["BULK-ORG-A", "BULK-ORG-B", "BULK-ORG-A"])
+    try:
+        job, success = _bulk_import(tree, table)
+        assert success
+        assert job.error is None
+        rows = db(table.uuid == "BULK-ORG-A").select(table.id, table.name)
+        test_utils.assert_equal(len(rows), 1)
+        test_utils.assert_equal(rows[0].name, "Bulk Organisation 2")
+        query = table.uuid.belongs(["BULK-ORG-A", "BULK-ORG-B"])
+        test_utils.assert_equal(db(query).count(), 2)
+    finally:
+        db.rollback()
+
+def test_bulk_import_resolver_sees_batch():
+    # gis_location has a deduplicate resolver (by name and level), which
+    # must find the record inserted for an earlier item of the same batch
+    table = db.gis_location
+    root = etree.Element("s3xml")
+    for i in xrange(2):
+        resource = etree.SubElement(root, "resource",
+                                    name="gis_location",
+                                    uuid="BULK-LOC-%s" % i)
+        data = etree.SubElement(resource, "data", field="name")
+        data.text = "Bulk Location"
+        data = etree.SubElement(resource, "data", field="level")
+        data.text = "L1"
+    tree = etree.ElementTree(root)
+    try:
+        job, success = _bulk_import(tree, table)
+        assert success
+        query = (table.name == "Bulk Location") & (table.deleted != True)
+        test_utils.assert_equal(db(query).count(), 1)
+    finally:
+        db.rollback()
+
+def test_bulk_import_flushes_only_on_resolver_collisions():
+    # Locations with different names can't be duplicates of each other,
+    # so they are inserted with a single bulk_insert
+    table = db.gis_location
+    root = etree.Element("s3xml")
+    for i in xrange(5):
+        resource = etree.SubElement(root, "resource",
+                                    name="gis_location",
+                                    uuid="BULK-LOC-%s" % i)
+        data = etree.SubElement(resource, "data", field="name")
+        data.text = "Bulk Location %s" % (i % 4)
+        data = etree.SubElement(resource, "data", field="level")
+        data.text = "L1"
+    tree = etree.ElementTree(root)
+    job = s3base.S3ImportJob(s3mgr, table, tree=tree, bulk=True)
+    flushes = []
+    flush = job._S3ImportJob__flush
+    def count_flush():
+        flushes.append(len(job.pending))
+        flush()
+    job._S3ImportJob__flush = count_flush
+    for element in tree.getroot():
+        job.add_item(element=element)
+    try:
+        assert job.commit()
+        # Flushed only before the duplicate name, which then updates
+        # the first record
+        test_utils.assert_equal(flushes, [4])
+        query = (table.name.like("Bulk Location %")) & \
+                (table.deleted != True)
+        test_utils.assert_equal(db(query).count(), 4)
+    finally:
+        db.rollback()
@@ -0,0 +1,202 @@
+
+import asyncore
+import datetime
+import smtpd
+import threading
+
+from multiprocessing.dummy import Pool
+
+test_utils = local_import("test_utils")
+
+class SMTPStandIn(smtpd.SMTPServer):
+    """ Local SMTP server collecting the messages it receives """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+        self.running = False
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self.running = False
+        self.close()
+
+def test_smtp_pool_sends_and_reconnects():
+    server = SMTPStandIn()
+    server.start()
+    try:
+        pool = s3base.S3SMTPPool("127.0.0.1:%s" % server.port,
+                                 "sender@example.com",
+                                 size=1)
+        assert pool.send("one@example.com", "Subject", "Message")
+        # A session dropped by the server is re-opened
+        session = pool.idle.get()
+        session.sock.close()
+        pool.idle.put(session)
+        assert pool.send(["two@example.com"], "Subject", "Message",
+                         cc="three@example.com")
+        test_utils.assert_equal(pool.open, 1)
+        test_utils.assert_equal(server.messages[-1][1],
+                                ["two@example.com", "three@example.com"])
+        pool.close()
+        test_utils.assert_equal(pool.open, 0)
+    finally:
+        server.stop()
+
+def test_smtp_pool_reuses_connections():
+    server = SMTPStandIn()
+    server.start()
+    try:
+        count = 100
+        pool = s3base.S3SMTPPool("127.0.0.1:%s" % server.port,
+                                 "sender@example.com",
+                                 size=4)
+        workers = Pool(4)
+        results = workers.map(lambda i: pool.send("to%s@example.com" % i,
+                                                  "Test",
+                                                  "Message"),
+                              xrange(count))
+        workers.close()
+        workers.join()
+        pool.close()
+
+        assert all(results)
+        test_utils.assert_equal(len(server.messages), count)
+        # The messages share the (at most 4) pooled sessions instead of
+        # opening a connection each
+        assert server.connections <= 4, \
+               "%s connections for %s messages" % (server.connections, count)
+    finally:
+        server.stop()
+
+def _outbox(pe_ids):
+    """ A message in the Outbox to each of pe_ids """
+
+    s3mgr.load("msg_outbox")
+    message_id = db.msg_log.insert(subject="Outbox Test",
+                                   message="Message")
+    for pe_id in pe_ids:
+        db.msg_outbox.insert(message_id=message_id,
+                             pe_id=pe_id,
+                             pr_message_method="EMAIL")
+    return message_id
+
+def _sender(sent, message_id):
+    """ Stand-in for the EMAIL sender, collecting the recipients """
+
+    def send(row_id, _message_id, to, subject, message):
+        if _message_id == message_id:
+            sent.append(to)
+        return True
+    return lambda contact_method, outgoing_sms_handler=None: \
+                  Storage(prepare=lambda recipient: recipient,
+                          send=send,
+                          concurrent=False,
+                          mail=True)
+
+def test_outbox_fans_out_to_groups_and_organisations():
+    person_ids = []
+    pe_ids = []
+    # process_outbox commits
+    with test_utils.RolledBack(db):
+        for name in ("Member", "Staff"):
+            email = "%s@example.com" % name
+            person_id, pe_id = test_utils.insert_person(db, s3mgr,
+                                                        name, "Outbox Test",
+                                                        email)
+            person_ids.append(person_id)
+            pe_ids.append(pe_id)
+        table = db.pr_group
+        group_id = table.insert(name="Outbox Test Group")
+        s3mgr.model.update_super(table, dict(id=group_id))
+        db.pr_group_membership.insert(group_id=group_id,
+                                      person_id=person_ids[0])
+        table = db.org_organisation
+        org_id = table.insert(name="Outbox Test Organisation")
+        s3mgr.model.update_super(table, dict(id=org_id))
+        db.hrm_human_resource.insert(organisation_id=org_id,
+                                     person_id=person_ids[1])
+        group_pe_id = db.pr_group[group_id].pe_id
+        org_pe_id = db.org_organisation[org_id].pe_id
+        # An entity which can't receive messages
+        other_pe_id = db.pr_pentity.insert(instance_type="org_office")
+        pe_ids.extend([group_pe_id, org_pe_id, other_pe_id])
+        message_id = _outbox([group_pe_id, org_pe_id, other_pe_id])
+
+        sent = []
+        msg = s3base.S3Msg()
+        msg._S3Msg__get_sender = _sender(sent, message_id)
+        msg.process_outbox(contact_method="EMAIL")
+
+        table = db.msg_outbox
+        rows = db(table.message_id == message_id).select()
+        status = dict([(row.pe_id, row.status) for row in rows])
+        # Group and organisation messages are replaced by member messages
+        test_utils.assert_equal(status[group_pe_id], 2)
+        test_utils.assert_equal(status[org_pe_id], 2)
+        generated = [row for row in rows if row.system_generated]
+        test_utils.assert_equal(sorted([row.pe_id for row in generated]),
+                                sorted(pe_ids[:2]))
+        test_utils.assert_equal(sorted(sent),
+                                ["Member@example.com", "Staff@example.com"])
+        assert all([row.status == 2 for row in generated])
+        # Messages to other entities are marked as invalid
+        test_utils.assert_equal(status[other_pe_id], 4)
+
+def test_outbox_respects_mail_limit_across_batches():
+    settings = deployment_settings
+    mail = Storage(settings.mail)
+    msg_settings = Storage(settings.msg)
+    pe_ids = []
+    s3mgr.load("msg_outbox")
+    try:
+        # process_outbox commits
+        with test_utils.RolledBack(db):
+            for i in xrange(5):
+                person_id, pe_id = test_utils.insert_person(
+                                        db, s3mgr,
+                                        "Recipient %s" % i, "Outbox Test",
+                                        "to%s@example.com" % i)
+                pe_ids.append(pe_id)
+            message_id = _outbox(pe_ids)
+            # Room for 3 more messages today, sent in batches of 2
+            cutoff = request.utcnow - datetime.timedelta(hours=24)
+            used = db(db.msg_limit.created_on > cutoff).count()
+            settings.mail.limit = used + 3
+            settings.msg.outbox_batch_size = 2
+
+            sent = []
+            msg = s3base.S3Msg()
+            msg._S3Msg__get_sender = _sender(sent, message_id)
+            msg.process_outbox(contact_method="EMAIL")
+
+            test_utils.assert_equal(sent, ["to0@example.com",
+                                           "to1@example.com",
+                                           "to2@example.com"])
+            table = db.msg_outbox
+            rows = db(table.message_id == message_id).select(orderby=table.id)
+            test_utils.assert_equal([row.status for row in rows],
+                                    [2, 2, 2, 1, 1])
+            query = db.msg_limit.created_on > cutoff
+            test_utils.assert_equal(db(query).count(), used + 3)
+    finally:
+        settings.mail = mail
+        settings.msg = msg_settings
@@ -0,0 +1,137 @@
+
+import random
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    import Image, ImageDraw
+
+test_utils = local_import("test_utils")
+s3pdf = local_import("s3.s3pdf")
+S3OCRImageParser = s3pdf.S3OCRImageParser
+
+def _scanned_form(width=2480, height=3508):
+    """ Synthetic scan of an A4 OCR form at 300 dpi: seven markers
+        along the edges and rows of text-like blobs in between """
+
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+
+    left, right = 150, width - 150
+    top, bottom = 150, height - 150
+    middle = height / 2
+    markers = [(left, top), (left, middle), (left, bottom),
+               (width / 2, top),
+               (right, top), (right, middle), (right, bottom)]
+    for x, y in markers:
+        draw.rectangle((x - 20, y - 20, x + 20, y + 20), fill=0)
+
+    random.seed(0)
+    for y in xrange(400, height - 400, 30):
+        for x in xrange(400, width - 400, 24):
+            if random.random() < 0.5:
+                draw.rectangle((x, y,
+                                x + random.randint(3, 10),
+                                y + random.randint(5, 14)),
+                               fill=random.randint(0, 150))
+    return image, markers
+
+def _reference_binary(image, threshold=180):
+    """ Binarisation pixel by pixel """
+
+    image = image.convert("L")
+    width, height = image.size
+    return [[image.getpixel((x, y)) < threshold and 0 or 255
+             for x in xrange(width)]
+            for y in xrange(height)]
+
+def _reference_regions(binary):
+    """ Connected black regions (4-connectivity) by flood fill, as tuples
+        (area, min_x, max_x, min_y, max_y) """
+
+    height, width = len(binary), len(binary[0])
+    seen = set()
+    regions = []
+    for y in xrange(height):
+        for x in xrange(width):
+            if binary[y][x] != 0 or (x, y) in seen:
+                continue
+            seen.add((x, y))
+            stack = [(x, y)]
+            area, min_x, max_x, min_y, max_y = 0, x, x, y, y
+            while stack:
+                px, py = stack.pop()
+                area += 1
+                min_x, max_x = min(min_x, px), max(max_x, px)
+                min_y, max_y = min(min_y, py), max(max_y, py)
+                for nx, ny in ((px - 1, py), (px + 1, py),
+                               (px, py - 1), (px, py + 1)):
+                    if 0 <= nx < width and 0 <= ny < height and \
+                       binary[ny][nx] == 0 and (nx, ny) not in seen:
+                        seen.add((nx, ny))
+                        stack.append((nx, ny))
+            regions.append((area, min_x, max_x, min_y, max_y))
+    return sorted(regions)
+
+def _reference_markers(binary):
+    """ Marker selection from the reference regions """
+
+    centers = []
+    for area, min_x, max_x, min_y, max_y in _reference_regions(binary):
+        if area <= 320 or max_y == min_y:
+            continue
+        aspectratio = float(max_x - min_x) / (max_y - min_y)
+        if 0.67 < aspectratio < 1.5:
+            centers.append(((min_x + max_x) / 2, (min_y + max_y) / 2))
+    centers.sort()
+    return sorted(centers[0:3], key=lambda c: c[1]) + centers[3:4] + \
+           sorted(centers[4:7], key=lambda c: c[1])
+
+def _regions(binary):
+    regions = S3OCRImageParser.findRegions(binary)
+    return sorted(zip(regions.area.tolist(),
+                      regions.min_x.tolist(),
+                      regions.max_x.tolist(),
+                      regions.min_y.tolist(),
+                      regions.max_y.tolist()))
+
+def test_find_regions():
+    binary = [[255,   0,   0, 255],
+              [  0, 255,   0, 255],
+              [  0,   0,   0, 255],
+              [255, 255, 255,   0]]
+    regions = S3OCRImageParser.findRegions(binary)
+    test_utils.assert_equal(sorted(regions.area.tolist()), [1, 7])
+    big = regions.area.tolist().index(7)
+    test_utils.assert_equal((regions.min_x[big], regions.max_x[big],
+                             regions.min_y[big], regions.max_y[big]),
+                            (0, 2, 0, 2))
+
+def test_regions_match_reference():
+    # Random patterns with many touching, nested and diagonal regions
+    for seed in xrange(5):
+        random.seed(seed)
+        binary = [[random.random() < 0.45 and 0 or 255
+                   for x in xrange(60)]
+                  for y in xrange(40)]
+        test_utils.assert_equal(_regions(binary),
+                                _reference_regions(binary))
+
+def test_binary_matches_reference():
+    image, markers = _scanned_form(width=300, height=200)
+    random.seed(0)
+    for i in xrange(500):
+        image.putpixel((random.randint(0, 299), random.randint(0, 199)),
+                       random.randint(0, 255))
+    binary = S3OCRImageParser.convertImage2binary(image)
+    test_utils.assert_equal(binary.tolist(), _reference_binary(image))
+
+def test_transform_page():
+    image, markers = _scanned_form(width=900, height=1100)
+    binary = _reference_binary(image)
+    test_utils.assert_equal(S3OCRImageParser.getMarkers(binary),
+                            _reference_markers(binary))
+    page = S3OCRImageParser.transformPage(image)
+    test_utils.assert_equal(page["markers"], markers)
+    test_utils.assert_equal(page["orientation"], 0.0)
+    test_utils.assert_equal(page["image"].size, image.size)
@@ -1,6 +1,74 @@
 
 import unittest
 
+from lxml import etree
+
 class Test_s3mgr_raises_on_nonexistent_modules(unittest.TestCase):
     def test(test):
         test.assertRaises(Exception, s3mgr.load, "something that doesn't exist")
+
+class Test_S3RepresentCache(unittest.TestCase):
+    def test_lru_and_invalidate(test):
+        cache = s3base.S3RepresentCache(size=2)
+        field = db.org_office.organisation_id
+        cache.set(field, 1, "A")
+        cache.set(field, 2, "B")
+        test.assertEqual(cache.get(field, 1), "A")
+        # Adding a third label drops the least recently used one (2)
+        cache.set(field, 3, "C")
+        test.assertEqual(cache.get(field, 2), None)
+        test.assertEqual(cache.get(field, 1), "A")
+        # Updating the referenced record drops its label
+        cache.invalidate("org_organisation", 1)
+        test.assertEqual(cache.get(field, 1), None)
+        test.assertEqual(cache.get(field, 3), "C")
+
+    def test_invalidate_id_and_ttl(test):
+        cache = s3base.S3RepresentCache()
+        field = db.org_organisation.id
+        cache.set(field, 1, "A")
+        cache.set(field, 2, "B")
+        # Writing the record drops the label of its id
+        cache.invalidate("org_organisation", 1)
+        test.assertEqual(cache.get(field, 1), None)
+        test.assertEqual(cache.get(field, 2), "B")
+        # Labels expire after the TTL
+        entry = cache.entries[cache.key(field, 2)]
+        entry[4] -= cache.ttl + 1
+        test.assertEqual(cache.get(field, 2), None)
+
+    def test_represent_override(test):
+        cache = s3base.S3RepresentCache()
+        field = db.org_office.organisation_id
+        represent = field.represent
+        cache.set(field, 1, "A")
+        try:
+            # An overridden represent neither reads nor poisons the
+            # labels of the model default
+            field.represent = lambda v: "Organisation %s" % v
+            test.assertEqual(cache.get(field, 1), None)
+            cache.set(field, 1, "Organisation 1")
+            test.assertEqual(cache.get(field, 1), "Organisation 1")
+        finally:
+            field.represent = represent
+        test.assertEqual(cache.get(field, 1), "A")
+        # Invalidation drops the labels of all represents
+        cache.invalidate("org_organisation", 1)
+        test.assertEqual(cache.get(field, 1), None)
+        test.assertEqual(len(cache), 0)
+        test.assertEqual(cache.records, {})
+
+class Test_S3Resource_export_chunks(unittest.TestCase):
+    def test_chunks(test):
+        resource = s3mgr.define_resource("gis", "location")
+        total = resource.count()
+        chunks = list(resource.export_chunks(limit=5,
+                                             dereference=False,
+                                             chunk_size=2))
+        # Header, one chunk per 2 records, trailer
+        test.assertEqual(len(chunks), 2 + (min(total, 5) + 1) // 2)
+        test.assertTrue(chunks[0].startswith("<?xml"))
+        tree = etree.fromstring("".join(chunks))
+        test.assertEqual(tree.tag, "s3xml")
+        test.assertEqual(tree.get("results"), str(total))
+        test.assertEqual(len(tree.findall("resource")), min(total, 5))
@@ -0,0 +1,24 @@
+
+from gluon.storage import Storage
+
+test_utils = local_import("test_utils")
+
+def test_text_index_ranking():
+    index = s3base.S3TextIndex("org_organisation")
+    index.backend = "memory"
+    index.update([Storage(id=1, deleted=False,
+                          name="Red Cross Society", acronym="RCS"),
+                  Storage(id=2, deleted=False,
+                          name="Red Cross", acronym="RC"),
+                  Storage(id=3, deleted=False,
+                          name="Medical Red Cross", acronym=None),
+                  Storage(id=4, deleted=False,
+                          name="Sacred Heart", acronym=None)])
+    clauses = [("red cross", ["name", "acronym"])]
+    # Exact match first, then prefix, then word prefix matches
+    test_utils.assert_equal(index.search(clauses), [2, 1, 3])
+    # Substring matches
+    test_utils.assert_equal(index.search([("red", ["name"])]), [2, 1, 3, 4])
+    # Deleted records are removed from the index
+    index.update([Storage(id=2, deleted=True)])
+    test_utils.assert_equal(index.search(clauses), [1, 3])
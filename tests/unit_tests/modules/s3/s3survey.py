@@ -0,0 +1,153 @@
+
+import os
+
+from StringIO import StringIO
+
+test_utils = local_import("test_utils")
+
+def _series():
+    """ A series with an option, a numeric and a free text question """
+
+    s3mgr.load("survey_series")
+    template_id = db.survey_template.insert(name="Analysis Test")
+    series_id = db.survey_series.insert(name="Analysis Test",
+                                        template_id=template_id)
+    questions = []
+    for (code, type) in (("AT-1", "Option"),
+                         ("AT-2", "Numeric"),
+                         ("AT-3", "String")):
+        questions.append(db.survey_question.insert(name="Test %s" % code,
+                                                   code=code,
+                                                   type=type))
+    return [series_id] + questions
+
+def _respond(series_id, answers):
+    """ Insert a response without the onaccept """
+
+    complete_id = db.survey_complete.insert(series_id=series_id)
+    for (question_id, value) in answers.items():
+        db.survey_answer.insert(complete_id=complete_id,
+                                question_id=question_id,
+                                value=value)
+    return complete_id
+
+def test_analysis_counts():
+    try:
+        (series_id, option, numeric, text) = _series()
+        _respond(series_id, {option: "Yes", numeric: "2", text: "A"})
+        _respond(series_id, {option: "Yes", numeric: "2", text: "B"})
+        s3 = response.s3
+        s3.survey_buildAnalysis(series_id)
+
+        # Changed answers are moved from one value to the other
+        s3.survey_updateAnalysis(series_id,
+                                 {option: "Yes", numeric: "2", text: "B"},
+                                 {option: "No", numeric: "5", text: "C"})
+        # New response
+        s3.survey_updateAnalysis(series_id,
+                                 {},
+                                 {option: "No", numeric: "2", text: "D"})
+        analysis = s3.survey_getSeriesAnalysis(series_id)
+        test_utils.assert_equal(sorted(analysis[option]),
+                                [("No", 2), ("Yes", 1)])
+        test_utils.assert_equal(sorted(analysis[numeric]),
+                                [("2", 2), ("5", 1)])
+        # Free text questions only count the replies
+        test_utils.assert_equal(analysis[text], [(None, 3)])
+        # One record per value
+        table = db.survey_analysis
+        query = (table.series_id == series_id) & \
+                (table.question_id == option)
+        test_utils.assert_equal(db(query).count(), 2)
+
+        # The analysis is built from the counts
+        tool = s3.survey_getQuestionAnalysis(option, "Option", series_id)
+        test_utils.assert_equal(tool.list, {"No": 2, "Yes": 1})
+        test_utils.assert_equal(tool.replies, 3)
+        tool = s3.survey_getQuestionAnalysis(numeric, "Numeric", series_id)
+        test_utils.assert_equal(tool.cnt, 3)
+        test_utils.assert_equal(tool.sum, 9)
+        test_utils.assert_equal(tool.average, 3.0)
+        test_utils.assert_equal(tool.max, 5)
+
+        # Deleted responses are removed from the analysis
+        s3.survey_updateAnalysis(series_id,
+                                 {option: "No", numeric: "2", text: "D"},
+                                 {})
+        analysis = s3.survey_getSeriesAnalysis(series_id)
+        test_utils.assert_equal(sorted(analysis[option]),
+                                [("No", 1), ("Yes", 1)])
+    finally:
+        db.rollback()
+
+def _template():
+    """ A template (and series) with an option and a numeric question """
+
+    s3mgr.load("survey_series")
+    template_id = db.survey_template.insert(name="Import Test")
+    series_id = db.survey_series.insert(name="Import Test",
+                                        template_id=template_id)
+    section_id = db.survey_section.insert(name="Import Test",
+                                          posn=1,
+                                          template_id=template_id)
+    questions = []
+    for (posn, code, type) in ((1, "IT-1", "Option"),
+                               (2, "IT-2", "Numeric")):
+        question_id = db.survey_question.insert(name="Test %s" % code,
+                                                code=code,
+                                                type=type)
+        db.survey_question_list.insert(posn=posn,
+                                       template_id=template_id,
+                                       question_id=question_id,
+                                       section_id=section_id)
+        questions.append(question_id)
+    return [series_id] + questions
+
+def test_import_complete_csv():
+    try:
+        (series_id, option, numeric) = _template()
+        source = StringIO('"Template","Series","IT-1","IT-2"\n'
+                          '"Import Test","Import Test","Yes","2"\n'
+                          '"Import Test","Import Test","No","two"\n'
+                          '"Import Test","Import Test","No","5"\n')
+        stylesheet = os.path.join(request.folder, "static", "formats",
+                                  "s3csv", "survey", "complete.xsl")
+        resource = s3mgr.define_resource("survey", "complete")
+        resource.import_xml(source,
+                            format="csv",
+                            stylesheet=stylesheet,
+                            ignore_errors=True)
+
+        # The response with the invalid answer is reported, not saved
+        errors = resource.error_tree.findall("resource[@name='survey_complete']")
+        test_utils.assert_equal(len(errors), 1)
+        ctable = db.survey_complete
+        rows = db(ctable.series_id == series_id).select(ctable.id)
+        test_utils.assert_equal(len(rows), 2)
+
+        # The answers of the other responses are saved
+        atable = db.survey_answer
+        query = (atable.complete_id.belongs([row.id for row in rows])) & \
+                (atable.deleted != True)
+        answers = db(query).select(atable.question_id, atable.value)
+        test_utils.assert_equal(sorted([(a.question_id, a.value)
+                                        for a in answers]),
+                                sorted([(option, "Yes"), (numeric, "2"),
+                                        (option, "No"), (numeric, "5")]))
+        analysis = response.s3.survey_getSeriesAnalysis(series_id)
+        test_utils.assert_equal(sorted(analysis[option]),
+                                [("No", 1), ("Yes", 1)])
+
+        # Answers saved without the validation are skipped and reported
+        response.warning = None
+        complete_id = rows.first().id
+        response.s3.survey_save_answers_for_complete(complete_id,
+                                                     {"IT-1": "No",
+                                                      "IT-2": "two"})
+        assert "IT-2" in response.warning
+        query = (atable.complete_id == complete_id) & \
+                (atable.question_id == numeric)
+        assert db(query).select(atable.value).first().value != "two"
+    finally:
+        response.warning = None
+        db.rollback()
@@ -0,0 +1,385 @@
+
+import cgi
+import datetime
+import gzip
+import threading
+import time
+import urllib2
+import zlib
+import BaseHTTPServer
+import SocketServer
+
+from StringIO import StringIO
+from multiprocessing.dummy import Pool
+
+from lxml import etree
+
+test_utils = local_import("test_utils")
+
+class PeerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Peer repository stand-in, counting the connections """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        body = "<s3xml>%s</s3xml>" % self.path
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Peer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    connections = 0
+
+def test_sync_http_handler_keeps_connections_open():
+    peer = Peer(("127.0.0.1", 0), PeerHandler)
+    thread = threading.Thread(target=peer.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        url = "http://127.0.0.1:%s/sync/sync.xml?resource=%%s" % \
+              peer.server_address[1]
+        opener = urllib2.build_opener(s3base.S3SyncHTTPHandler())
+        fetch = lambda i: opener.open(url % i).read()
+
+        test_utils.assert_equal(fetch(0),
+                                "<s3xml>/sync/sync.xml?resource=0</s3xml>")
+        results = Pool(4).map(fetch, xrange(1, 101))
+        test_utils.assert_equal(len(results), 100)
+        # The requests have been sent through at most 4 connections
+        assert peer.connections <= 4
+    finally:
+        peer.shutdown()
+
+class RepositoryHandler(PeerHandler):
+    """ Peer repository stand-in, serving and receiving S3XML in chunks """
+
+    def parse(self):
+        path, query = self.path.split("?", 1)
+        params = cgi.parse_qs(query)
+        return params["resource"][0], params
+
+    def do_GET(self):
+        server = self.server
+        resource, params = self.parse()
+        time.sleep(server.delays.get(resource, 0))
+        chunks = server.chunks.get(resource, [])
+        if "chunk" in params:
+            position = int(params.get("after", ["0"])[0])
+            resources = chunks[position:position + 1]
+            more = position + 1 < len(chunks)
+        else:
+            position = None
+            resources = chunks
+            more = False
+        server.requests.append(("GET", resource, position))
+        body = "<s3xml>%s</s3xml>" % "".join(resources)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        if more:
+            self.send_header("X-Sync-Next", str(position + 1))
+        accept_encoding = self.headers.get("Accept-Encoding", "")
+        if server.compress and "gzip" in accept_encoding:
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode="wb")
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        resource, params = self.parse()
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding", None) == "gzip":
+            if not server.compress:
+                server.rejected += 1
+                self.send_response(415)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        server.requests.append(("POST", resource, body))
+        body = '{"status": "success", "statuscode": "200"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class Repository(Peer):
+
+    def __init__(self, chunks=None, delays=None, compress=True):
+        Peer.__init__(self, ("127.0.0.1", 0), RepositoryHandler)
+        self.chunks = chunks or {}
+        self.delays = delays or {}
+        self.compress = compress
+        self.requests = []
+        self.rejected = 0
+        self.url = "http://127.0.0.1:%s" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+def _sync(peer, tasks):
+    """
+        Synchronize with a peer repository stand-in, removes the
+        repository afterwards (synchronization commits)
+
+        @param peer: the Repository stand-in
+        @param tasks: list of dicts with the sync_task fields
+
+        @returns: the sync_task records after the synchronization
+    """
+
+    s3mgr.load("sync_repository")
+    if not db(db.sync_config.id > 0).count():
+        db.sync_config.insert()
+    repository_id = db.sync_repository.insert(name="Test Peer",
+                                              url=peer.url)
+    for task in tasks:
+        db.sync_task.insert(repository_id=repository_id, **task)
+    db.commit()
+    repository = db.sync_repository[repository_id]
+    query = (db.sync_task.repository_id == repository_id)
+    auth.override = True
+    try:
+        s3base.S3Sync().synchronize_all([repository])
+        return db(query).select(orderby=db.sync_task.id)
+    finally:
+        auth.override = False
+        db(query).delete()
+        db(db.sync_log.repository_id == repository_id).delete()
+        db(db.sync_status.repository_id == repository_id).delete()
+        db(db.sync_repository.id == repository_id).delete()
+        db.commit()
+
+def _organisations(count):
+    """ Peer chunks with one org_organisation each """
+
+    return ["""<resource name="org_organisation" uuid="SYNC-ORG-%s">
+                 <data field="name">Sync Organisation %s</data>
+               </resource>""" % (i, i) for i in xrange(count)]
+
+def _insert_organisations(count, since):
+    """ Local org_organisation records modified after since """
+
+    table = db.org_organisation
+    for i in xrange(count):
+        table.insert(uuid="SYNC-ORG-%s" % i,
+                     name="Sync Organisation %s" % i,
+                     modified_on=since + datetime.timedelta(seconds=i + 1))
+    db.commit()
+
+def _delete_organisations():
+    table = db.org_organisation
+    db(table.uuid.like("SYNC-ORG-%")).delete()
+    db.commit()
+
+def test_synchronize_imports_referenced_tables_first():
+    # The organisation arrives after the office which references it,
+    # but is imported first although its task comes last
+    organisation = """<resource name="org_organisation" uuid="SYNC-ORG">
+                        <data field="name">Sync Organisation</data>
+                      </resource>"""
+    office = """<resource name="org_office" uuid="SYNC-OFFICE">
+                  <data field="name">Sync Office</data>
+                  <reference field="organisation_id"
+                             resource="org_organisation"
+                             uuid="SYNC-ORG"/>
+                </resource>"""
+    peer = Repository(chunks={"org_organisation": [organisation],
+                              "org_office": [office]},
+                      delays={"org_organisation": 0.5})
+    peer.start()
+    otable = db.org_organisation
+    ftable = db.org_office
+    try:
+        _sync(peer, [dict(resource_name="org_office", mode=1),
+                     dict(resource_name="org_organisation", mode=1)])
+        org = db(otable.uuid == "SYNC-ORG").select(otable.id).first()
+        office = db(ftable.uuid == "SYNC-OFFICE").select(ftable.id,
+                    ftable.organisation_id).first()
+        assert org and office
+        test_utils.assert_equal(office.organisation_id, org.id)
+    finally:
+        peer.shutdown()
+        db(ftable.uuid == "SYNC-OFFICE").delete()
+        db(otable.uuid == "SYNC-ORG").delete()
+        db.commit()
+
+def test_synchronize_independent_tasks_concurrently():
+    # gis_location doesn't reference org_organisation, so its chunks are
+    # pulled while the (slow) organisation chunks are still on their way
+    locations = ["""<resource name="gis_location" uuid="SYNC-LOC-%s">
+                      <data field="name">Sync Location %s</data>
+                    </resource>""" % (i, i) for i in xrange(3)]
+    peer = Repository(chunks={"org_organisation": _organisations(2),
+                              "gis_location": locations},
+                      delays={"org_organisation": 0.5})
+    peer.start()
+    table = db.gis_location
+    try:
+        _sync(peer, [dict(resource_name="org_organisation", mode=1),
+                     dict(resource_name="gis_location", mode=1)])
+        requests = peer.requests
+        assert requests.index(("GET", "gis_location", 2)) < \
+               requests.index(("GET", "org_organisation", 1))
+        query = table.uuid.like("SYNC-LOC-%")
+        test_utils.assert_equal(db(query).count(), 3)
+    finally:
+        peer.shutdown()
+        _delete_organisations()
+        db(table.uuid.like("SYNC-LOC-%")).delete()
+        db.commit()
+
+def test_pull_chunks():
+    peer = Repository(chunks={"org_organisation": _organisations(3)})
+    peer.start()
+    table = db.org_organisation
+    try:
+        tasks = _sync(peer, [dict(resource_name="org_organisation", mode=1)])
+        test_utils.assert_equal(peer.requests,
+                                [("GET", "org_organisation", 0),
+                                 ("GET", "org_organisation", 1),
+                                 ("GET", "org_organisation", 2)])
+        query = table.uuid.like("SYNC-ORG-%")
+        test_utils.assert_equal(db(query).count(), 3)
+        # Complete => no checkpoint
+        test_utils.assert_equal(tasks[0].pull_checkpoint, None)
+        assert tasks[0].last_sync
+    finally:
+        peer.shutdown()
+        _delete_organisations()
+
+def test_pull_resumes_from_checkpoint():
+    # Uncompressed responses
+    peer = Repository(chunks={"org_organisation": _organisations(3)},
+                      compress=False)
+    peer.start()
+    table = db.org_organisation
+    try:
+        _sync(peer, [dict(resource_name="org_organisation",
+                          mode=1,
+                          pull_checkpoint="1")])
+        test_utils.assert_equal(peer.requests,
+                                [("GET", "org_organisation", 1),
+                                 ("GET", "org_organisation", 2)])
+        rows = db(table.uuid.like("SYNC-ORG-%")).select(table.uuid,
+                                                        orderby=table.uuid)
+        test_utils.assert_equal([row.uuid for row in rows],
+                                ["SYNC-ORG-1", "SYNC-ORG-2"])
+    finally:
+        peer.shutdown()
+        _delete_organisations()
+
+def _push(peer, since, **attr):
+    """ Push org_organisation in chunks of 1 record """
+
+    settings = deployment_settings.sync
+    chunk_size = settings.get("chunk_size", None)
+    settings.chunk_size = 1
+    try:
+        task = dict(resource_name="org_organisation",
+                    mode=2,
+                    last_sync=since)
+        task.update(attr)
+        tasks = _sync(peer, [task])
+    finally:
+        if chunk_size is None:
+            del settings["chunk_size"]
+        else:
+            settings.chunk_size = chunk_size
+    pushed = []
+    for method, resource, body in peer.requests:
+        test_utils.assert_equal((method, resource),
+                                ("POST", "org_organisation"))
+        uids = etree.XML(body).xpath("resource/@uuid")
+        pushed.append([uid for uid in uids if uid.startswith("SYNC-ORG-")])
+    return tasks, pushed
+
+def test_push_chunks():
+    since = datetime.datetime(2030, 1, 1)
+    peer = Repository()
+    peer.start()
+    try:
+        _insert_organisations(3, since)
+        tasks, pushed = _push(peer, since)
+        test_utils.assert_equal(pushed, [["SYNC-ORG-0"],
+                                         ["SYNC-ORG-1"],
+                                         ["SYNC-ORG-2"]])
+        test_utils.assert_equal(tasks[0].push_checkpoint, None)
+    finally:
+        peer.shutdown()
+        _delete_organisations()
+
+def test_push_resumes_from_checkpoint():
+    since = datetime.datetime(2030, 1, 1)
+    table = db.org_organisation
+    # The peer does not accept compressed data => fallback
+    peer = Repository(compress=False)
+    peer.start()
+    try:
+        _insert_organisations(3, since)
+        first = db(table.uuid == "SYNC-ORG-0").select(table.id,
+                                                      table.modified_on,
+                                                      limitby=(0, 1)).first()
+        checkpoint = "%s,%s" % (first.modified_on.isoformat(), first.id)
+        tasks, pushed = _push(peer, since, push_checkpoint=checkpoint)
+        test_utils.assert_equal(pushed, [["SYNC-ORG-1"], ["SYNC-ORG-2"]])
+        # Only the first chunk has been sent compressed
+        test_utils.assert_equal(peer.rejected, 1)
+        test_utils.assert_equal(tasks[0].push_checkpoint, None)
+    finally:
+        peer.shutdown()
+        _delete_organisations()
+
+def test_push_chunk_includes_referenced_records():
+    # A parent location modified after its child is in a later chunk,
+    # but also exported (as referenced record) with the child
+    since = datetime.datetime(2030, 1, 1)
+    table = db.gis_location
+    peer = Repository()
+    peer.start()
+    settings = deployment_settings.sync
+    chunk_size = settings.get("chunk_size", None)
+    settings.chunk_size = 1
+    try:
+        parent = table.insert(uuid="SYNC-LOC-PARENT",
+                              name="Sync Parent",
+                              modified_on=since + datetime.timedelta(seconds=2))
+        table.insert(uuid="SYNC-LOC-CHILD",
+                     name="Sync Child",
+                     parent=parent,
+                     modified_on=since + datetime.timedelta(seconds=1))
+        db.commit()
+        _sync(peer, [dict(resource_name="gis_location",
+                          mode=2,
+                          last_sync=since)])
+        method, resource, body = peer.requests[0]
+        uids = etree.XML(body).xpath("resource/@uuid")
+        assert "SYNC-LOC-CHILD" in uids
+        assert "SYNC-LOC-PARENT" in uids
+    finally:
+        if chunk_size is None:
+            del settings["chunk_size"]
+        else:
+            settings.chunk_size = chunk_size
+        peer.shutdown()
+        db(table.uuid.like("SYNC-LOC-%")).delete()
+        db.commit()
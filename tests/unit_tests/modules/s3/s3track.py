@@ -0,0 +1,40 @@
+
+from datetime import datetime, timedelta
+
+test_utils = local_import("test_utils")
+
+def test_get_all_and_checked_in():
+    ltable = db.gis_location
+    ptable = db.pr_person
+    try:
+        location = ltable.insert(name="Tracker Test Location", lat=10, lon=10)
+        driver = test_utils.insert_person(db, s3mgr, "Driver", "Tracker")[0]
+        passenger = test_utils.insert_person(db, s3mgr,
+                                             "Passenger", "Tracker")[0]
+        s3tracker(ptable, driver).set_location(location)
+        s3tracker(ptable, passenger).check_in(ptable, driver)
+
+        # The passenger is located through the check-in to the driver
+        found = [row.id for row in s3tracker.get_all(ptable,
+                                                     location=location)]
+        assert driver in found and passenger in found
+        found = [row.id for row in s3tracker.get_all(ptable,
+                                                     bbox=(9, 9, 11, 11))]
+        assert driver in found and passenger in found
+        found = [row.id for row in s3tracker.get_all(ptable,
+                                                     bbox=(11, 11, 12, 12))]
+        assert driver not in found and passenger not in found
+
+        checked_in = s3tracker.get_checked_in(ptable, driver,
+                                              instance_type="pr_person")
+        test_utils.assert_equal([row.id for row in checked_in], [passenger])
+
+        # A check-out within a second of the check-in is logged 1s later
+        s3tracker(ptable, passenger).check_out(ptable, driver)
+        later = datetime.utcnow() + timedelta(seconds=2)
+        checked_in = s3tracker.get_checked_in(ptable, driver,
+                                              instance_type="pr_person",
+                                              timestmp=later)
+        test_utils.assert_equal(len(checked_in), 0)
+    finally:
+        db.rollback()
@@ -0,0 +1,82 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lxml import etree
+
+STYLESHEET = """<?xml version="1.0"?>
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+    <xsl:import href="%s"/>
+    <xsl:output method="text"/>
+    <xsl:template match="/"><xsl:call-template name="label"/></xsl:template>
+</xsl:stylesheet>"""
+
+TEMPLATES = """<?xml version="1.0"?>
+<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+    <xsl:template name="label">%s</xsl:template>
+</xsl:stylesheet>"""
+
+class Test_S3XSLTCache(unittest.TestCase):
+    def setUp(test):
+        test.folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(test.folder, "formats"))
+        test.path = os.path.join(test.folder, "formats", "main.xsl")
+        test.commons = os.path.join(test.folder, "commons.xsl")
+        test._write(test.path, STYLESHEET % "../commons.xsl")
+        test._write(test.commons, TEMPLATES % "old")
+        s3base.S3XSLTCache.clear()
+
+    def tearDown(test):
+        s3base.S3XSLTCache.clear()
+        shutil.rmtree(test.folder)
+
+    def _write(test, path, contents, mtime=None):
+        f = open(path, "w")
+        f.write(contents)
+        f.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def _transform(test):
+        cache = s3base.S3XSLTCache
+        transformer, version = cache.get(test.path)
+        try:
+            return str(transformer(etree.XML("<s3xml/>")))
+        finally:
+            cache.release(test.path, transformer, version)
+
+    def test_hits_and_invalidation(test):
+        stats = s3base.S3XSLTCache.stats
+        misses, hits = stats.misses, stats.hits
+
+        test.assertEqual(test._transform(), "old")
+        test.assertEqual(test._transform(), "old")
+        test.assertEqual(stats.misses - misses, 1)
+        test.assertEqual(stats.hits - hits, 1)
+
+        # Modifying the imported stylesheet invalidates the transformer
+        mtime = os.path.getmtime(test.commons) + 10
+        test._write(test.commons, TEMPLATES % "new", mtime=mtime)
+        test.assertEqual(test._transform(), "new")
+        test.assertEqual(stats.misses - misses, 2)
+        test.assertEqual(test._transform(), "new")
+        test.assertEqual(stats.hits - hits, 2)
+
+        # ...and so does modifying the stylesheet itself
+        mtime = os.path.getmtime(test.path) + 10
+        test._write(test.path, STYLESHEET % "../commons.xsl", mtime=mtime)
+        test.assertEqual(test._transform(), "new")
+        test.assertEqual(stats.misses - misses, 3)
+        test.assertEqual(s3base.S3XSLTCache.statistics().cached, 1)
+
+    def test_outdated_transformer_not_cached(test):
+        cache = s3base.S3XSLTCache
+        transformer, version = cache.get(test.path)
+        # Imported stylesheet modified while the transformer is in use
+        mtime = os.path.getmtime(test.commons) + 10
+        test._write(test.commons, TEMPLATES % "new", mtime=mtime)
+        cache.release(test.path, transformer, version)
+        test.assertEqual(cache.entries, {})
+        test.assertEqual(test._transform(), "new")